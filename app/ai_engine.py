@@ -1,17 +1,50 @@
 # app/ai_engine.py
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import os
 import json
+import time
+import datetime
+import threading
 from dotenv import load_dotenv
+from app.context_builder import format_turn, estimate_tokens
+from app import metrics
+from app.logs import HOT_SAMPLE, get_logger
+from app.llm_router import LLM_TIMEOUT_SECONDS, LLMRouter
+
+log = get_logger("ai_engine")
 
 # Load API Key
 load_dotenv()
 api_key = os.getenv("GOOGLE_API_KEY")
+# Trỏ sang server giả lập (vd: http://127.0.0.1:9100 - xem bench/stub_gemini.py) để test offline
+api_endpoint = os.getenv("GEMINI_API_ENDPOINT")
 if not api_key:
-    print("❌ Lỗi: Chưa cấu hình GOOGLE_API_KEY")
+    log.error("gemini_api_key_missing")
+elif api_endpoint:
+    genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": api_endpoint})
 else:
     genai.configure(api_key=api_key)
 
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# Context Caching bắt buộc dùng model có version cố định
+GEMINI_CACHE_MODEL = os.getenv("GEMINI_CACHE_MODEL", "gemini-2.0-flash-001")
+GENERATION_CONFIG = {"response_mime_type": "application/json"}
+# Model rẻ dùng để gộp tóm tắt hội thoại (context summary_mode="llm")
+GEMINI_SUMMARY_MODEL = os.getenv("GEMINI_SUMMARY_MODEL", "gemini-2.0-flash-lite")
+
+# Provider dự phòng (app/llm_router.py): chỉ đăng ký khi có OPENAI_API_KEY
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")   # vd: http://127.0.0.1:9400/v1 (bench/stub_openai.py)
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "1") == "1"
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))   # giây
+CONTEXT_CACHE_REFRESH_BEFORE = 300   # Còn < 5 phút là gia hạn TTL
+CONTEXT_CACHE_RETRY_AFTER = 3600     # Tạo cache thất bại (vd: prompt quá ngắn) -> 1 tiếng sau mới thử lại
+# Lỗi gọi model kèm cache do chính cache (không tồn tại / hết hạn / không có quyền)
+CACHE_ERRORS = (google_exceptions.NotFound, google_exceptions.PermissionDenied, google_exceptions.InvalidArgument)
+
 # ==============================================================================
 # 1. SYSTEM PROMPT (BẢN GỐC TỪ TÀI LIỆU - DÙNG CHUNG TOÀN HỆ THỐNG)
 # ==============================================================================
@@ -42,22 +75,16 @@ Rất quan trọng:
 """
 
 # ==============================================================================
-# 2. USER PROMPT TEMPLATE (TEMPLATE ĐỘNG)
+# 2. PROMPT THEO PAGE (CỐ ĐỊNH THEO CONFIG) + PROMPT THEO LƯỢT (ĐỘNG)
 # ==============================================================================
-USER_PROMPT_TEMPLATE = """
+# Phần cố định: chỉ phụ thuộc config của Page -> dựng 1 lần / phiên bản config,
+# gộp với MASTER_SYSTEM_PROMPT làm system instruction và đăng ký Context Cache.
+PAGE_PROMPT_TEMPLATE = """
 Bạn đang làm việc cho brand: {BRAND_NAME}
 Chủ đề hiện tại (topic): {TOPIC}
 Giọng điệu (tone): {TONE_STYLE}
 Cách xưng hô: Bạn xưng là "{CALL_ME}" và gọi khách là "{CALL_USER}".
 
-Trạng thái flow hiện tại (flow_state): {FLOW_STATE}
-
-Dữ liệu đã biết về khách (session_data, JSON):
-{SESSION_DATA_JSON}
-
-Tin nhắn khách vừa gửi (user_message):
-"{USER_MESSAGE}"
-
 Yêu cầu:
 1. Trả lời khách bằng tiếng Việt, đúng giọng điệu của {BRAND_NAME} và {TOPIC}.
 2. Giữ câu trả lời từ 1–4 câu, thân thiện, rõ ràng, không lan man.
@@ -77,14 +104,313 @@ Yêu cầu:
 }}
 """
 
-def generate_ai_response(chat_history, config, session_data_json):
+# Phần động: gửi mỗi lượt (tóm tắt + lịch sử đã được context_builder chặn theo ngân sách token)
+TURN_PROMPT_TEMPLATE = """
+Tóm tắt các lượt trước (conversation_summary):
+{SUMMARY}
+
+Lịch sử chat gần đây (recent_history, cũ -> mới):
+{RECENT_HISTORY}
+
+Trạng thái flow hiện tại (flow_state): {FLOW_STATE}
+
+Dữ liệu đã biết về khách (session_data, JSON):
+{SESSION_DATA_JSON}
+
+Tin nhắn khách vừa gửi (user_message):
+"{USER_MESSAGE}"
+"""
+
+# ==============================================================================
+# 3. POOL MODEL + CONTEXT CACHE
+# ==============================================================================
+_lock = threading.Lock()
+_model_pool = {}        # (model_name, system_instruction, generation_config) -> GenerativeModel
+_cached_model_pool = {} # tên CachedContent -> GenerativeModel
+_page_prompts = {}      # (page_name, config_version) -> system instruction đầy đủ
+_context_caches = {}    # (page_name, config_version) -> {"cache", "expires_at"} | {"retry_at"}
+_page_versions = {}     # page_name -> config_version đang dùng (đổi version -> dọn bản cũ)
+
+_usage_stats = {
+    "calls": 0,
+    "errors": 0,
+    "cache_hits": 0,          # số lượt dùng được Context Cache
+    "prompt_tokens": 0,       # tổng input token (kể cả phần nằm trong cache)
+    "cached_tokens": 0,       # phần input token lấy từ cache
+    "output_tokens": 0,
+    "latency_ms": 0.0,
+}
+
+def get_model(model_name, system_instruction=None, generation_config=None):
+    """Lấy GenerativeModel từ pool (tạo 1 lần cho mỗi bộ tham số)"""
+    key = (model_name, system_instruction, json.dumps(generation_config or {}, sort_keys=True))
+    model = _model_pool.get(key)
+    if model is None:
+        with _lock:
+            model = _model_pool.get(key)
+            if model is None:
+                model = genai.GenerativeModel(
+                    model_name=model_name,
+                    system_instruction=system_instruction,
+                    generation_config=generation_config
+                )
+                _model_pool[key] = model
+    return model
+
+def _page_key(config):
+    compiled = config.get("_compiled", {})
+    return (config.get("page_name"), compiled.get("version") or config.get("config_version"))
+
+def _evict_page_version(page_name, version):
+    """Config Page đổi version: bỏ prompt / model / Context Cache của version cũ (xóa cả cache phía Gemini)"""
+    with _lock:
+        prompt = _page_prompts.pop((page_name, version), None)
+        entry = _context_caches.pop((page_name, version), None)
+        for key in [k for k in _model_pool if prompt is not None and k[1] == prompt]:
+            del _model_pool[key]
+        if entry and "cache" in entry:
+            _cached_model_pool.pop(entry["cache"].name, None)
+    if entry and "cache" in entry:
+        try:
+            entry["cache"].delete()
+        except Exception as e:
+            log.warning("context_cache_delete_failed", page=page_name, version=version, error=str(e))
+    log.info("page_prompt_evicted", page=page_name, version=version)
+
+def _version_mtime(version):
+    """mtime trong version "<config_version>@<mtime>" của config_loader; None nếu không có"""
+    _, sep, mtime = str(version or "").rpartition("@")
+    return int(mtime) if sep and mtime.isdigit() else None
+
+def _is_stale_version(page_name, version):
+    """Version cũ hơn version hiện tại của Page (lượt còn chạy với config trước khi reload)"""
+    current = _page_versions.get(page_name)
+    if current is None or current == version:
+        return False
+    old, new = _version_mtime(version), _version_mtime(current)
+    return old is not None and new is not None and old < new
+
+def _render_page_prompt(config):
+    meta = config.get("meta_data", {})
+    settings = config.get("system_settings", {})
+    # Biến cố định của Page đã được config_loader tính sẵn; config tự dựng tay thì tính tại chỗ
+    prompt_vars = config.get("_compiled", {}).get("prompt_vars") or {
+        "BRAND_NAME": meta.get("brand_default", "Unknown Brand"),
+        "TOPIC": config.get("topic_id", "general"),
+        "TONE_STYLE": meta.get("tone_style", "thân thiện"),
+        "CALL_ME": settings.get("call_me", "mình"),
+        "CALL_USER": settings.get("call_user", "bạn"),
+    }
+    return MASTER_SYSTEM_PROMPT + PAGE_PROMPT_TEMPLATE.format(**prompt_vars)
+
+def build_page_prompt(config):
+    """System instruction cố định của Page = MASTER_SYSTEM_PROMPT + phần brand/tone/topic"""
+    key = _page_key(config)
+    prompt = _page_prompts.get(key)
+    if prompt is None:
+        if _is_stale_version(*key):
+            # Lượt còn chạy với config cũ sau khi reload -> dựng prompt tại chỗ, không đụng version mới
+            return _render_page_prompt(config)
+        previous = _page_versions.get(key[0])
+        _page_versions[key[0]] = key[1]
+        if previous is not None and previous != key[1]:
+            _evict_page_version(key[0], previous)
+        prompt = _page_prompts[key] = _render_page_prompt(config)
+    return prompt
+
+def get_context_cache(config, system_instruction):
+    """
+    Trả về CachedContent chứa system instruction của Page (tạo / gia hạn khi cần).
+    None nếu tắt cache hoặc API từ chối (vd: prompt ngắn hơn mức tối thiểu của Gemini).
+    """
+    if not CONTEXT_CACHE_ENABLED:
+        return None
+
+    key = _page_key(config)
+    if _page_versions.get(key[0], key[1]) != key[1]:
+        # Lượt còn chạy với config cũ sau khi reload -> gửi prompt đầy đủ, không tạo lại cache cũ
+        return None
+    now = time.time()
+    entry = _context_caches.get(key)
+    if entry and "cache" in entry and entry["expires_at"] - now > CONTEXT_CACHE_REFRESH_BEFORE:
+        return entry["cache"]
+    if entry and now < entry.get("retry_at", 0):
+        return None
+
+    with _lock:
+        entry = _context_caches.get(key)
+        if entry and "cache" in entry:
+            if entry["expires_at"] - now > CONTEXT_CACHE_REFRESH_BEFORE:
+                return entry["cache"]
+            # Sắp hết hạn -> gia hạn TTL
+            try:
+                entry["cache"].update(ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL))
+                entry["expires_at"] = now + CONTEXT_CACHE_TTL
+                return entry["cache"]
+            except Exception as e:
+                log.warning("context_cache_refresh_failed", page=key[0], error=str(e))
+
+        try:
+            cache = genai.caching.CachedContent.create(
+                model=GEMINI_CACHE_MODEL,
+                display_name=f"page-{key[0]}-{key[1]}"[:120],
+                system_instruction=system_instruction,
+                ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL),
+            )
+        except Exception as e:
+            log.warning("context_cache_create_failed", page=key[0], error=str(e))
+            _context_caches[key] = {"retry_at": now + CONTEXT_CACHE_RETRY_AFTER}
+            return None
+
+        _context_caches[key] = {"cache": cache, "expires_at": now + CONTEXT_CACHE_TTL}
+        log.info("context_cache_created", page=key[0], version=key[1])
+        return cache
+
+def _get_cached_model(cache):
+    model = _cached_model_pool.get(cache.name)
+    if model is None:
+        model = genai.GenerativeModel.from_cached_content(
+            cached_content=cache, generation_config=GENERATION_CONFIG
+        )
+        _cached_model_pool[cache.name] = model
+    return model
+
+def _drop_context_cache(config):
+    entry = _context_caches.pop(_page_key(config), None)
+    if entry and "cache" in entry:
+        _cached_model_pool.pop(entry["cache"].name, None)
+
+def _record_usage(provider, prompt_tokens, cached_tokens, output_tokens, latency_ms, used_cache):
+    with _lock:
+        _usage_stats["calls"] += 1
+        _usage_stats["cache_hits"] += 1 if used_cache else 0
+        _usage_stats["prompt_tokens"] += prompt_tokens
+        _usage_stats["cached_tokens"] += cached_tokens
+        _usage_stats["output_tokens"] += output_tokens
+        _usage_stats["latency_ms"] += latency_ms
+
+    # Token gắn theo Page của lượt chat đang chạy (trace của thread hiện tại)
+    page_id = metrics.current_page_id()
+    metrics.inc("chatbot_llm_calls_total", page_id=page_id, provider=provider, status="ok",
+                cache="hit" if used_cache else "miss")
+    metrics.inc("chatbot_llm_tokens_total", prompt_tokens - cached_tokens, page_id=page_id, kind="prompt")
+    metrics.inc("chatbot_llm_tokens_total", cached_tokens, page_id=page_id, kind="cached")
+    metrics.inc("chatbot_llm_tokens_total", output_tokens, page_id=page_id, kind="output")
+    log.info("llm_call", sample=HOT_SAMPLE, page_id=page_id, provider=provider, latency_ms=round(latency_ms),
+             prompt_tokens=prompt_tokens, cached_tokens=cached_tokens, output_tokens=output_tokens)
+
+def get_usage_stats():
+    """Thống kê token / độ trễ từ lúc process chạy"""
+    with _lock:
+        stats = dict(_usage_stats)
+    calls = stats["calls"] or 1
+    stats["avg_latency_ms"] = round(stats["latency_ms"] / calls, 1)
+    stats["avg_prompt_tokens"] = round(stats["prompt_tokens"] / calls, 1)
+    stats["avg_uncached_prompt_tokens"] = round((stats["prompt_tokens"] - stats["cached_tokens"]) / calls, 1)
+    return stats
+
+# ==============================================================================
+# 4. GỌI AI
+# ==============================================================================
+def _generate(model, prompt, on_chunk=None):
+    """Gọi Gemini, trả về (response, text JSON đầy đủ); có on_chunk -> stream, đẩy từng mảnh text ra ngoài"""
+    # Router tự failover / hedge -> SDK không tự retry (retry mặc định che lỗi 503 và kéo dài độ trễ)
+    options = {"timeout": LLM_TIMEOUT_SECONDS, "retry": None}
+    if on_chunk is None:
+        response = model.generate_content(prompt, request_options=options)
+        return response, response.text
+
+    response = model.generate_content(prompt, stream=True, request_options=options)
+    pieces = []
+    for chunk in response:
+        try:
+            piece = chunk.text
+        except ValueError:
+            # Mảnh cuối có thể chỉ chứa finish_reason / usage, không có text
+            continue
+        pieces.append(piece)
+        on_chunk(piece)
+    return response, "".join(pieces)
+
+def call_gemini(system_instruction, prompt, config, on_chunk=None):
+    """Provider "gemini": dùng Context Cache của Page, cache lỗi thì gửi prompt đầy đủ"""
+    cache = get_context_cache(config, system_instruction)
+    started = time.perf_counter()
+    try:
+        if cache is not None:
+            model = _get_cached_model(cache)
+        else:
+            model = get_model(GEMINI_MODEL, system_instruction, GENERATION_CONFIG)
+        response, text = _generate(model, prompt, on_chunk)
+    except CACHE_ERRORS as e:
+        if cache is None:
+            raise
+        # Cache bị xóa / hết hạn phía server -> bỏ cache, gửi prompt đầy đủ.
+        # Lỗi khác (503, timeout...) ném lên cho router failover / tính vào circuit breaker
+        log.warning("context_cache_failed", error=str(e))
+        _drop_context_cache(config)
+        cache = None
+        model = get_model(GEMINI_MODEL, system_instruction, GENERATION_CONFIG)
+        response, text = _generate(model, prompt, on_chunk)
+
+    usage = getattr(response, "usage_metadata", None)
+    _record_usage("gemini",
+                  getattr(usage, "prompt_token_count", 0) or 0,
+                  getattr(usage, "cached_content_token_count", 0) or 0,
+                  getattr(usage, "candidates_token_count", 0) or 0,
+                  (time.perf_counter() - started) * 1000, cache is not None)
+    return text
+
+_openai_client = None
+
+def call_openai(system_instruction, prompt, config, on_chunk=None):
+    """Provider "openai": Chat Completions ở chế độ JSON (OPENAI_BASE_URL trỏ sang stub để test offline)"""
+    global _openai_client
+    if _openai_client is None:
+        from openai import OpenAI
+        # Router tự failover / hedge -> SDK không tự retry
+        _openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL,
+                                timeout=LLM_TIMEOUT_SECONDS, max_retries=0)
+    messages = [{"role": "system", "content": system_instruction}, {"role": "user", "content": prompt}]
+    started = time.perf_counter()
+    if on_chunk is None:
+        response = _openai_client.chat.completions.create(
+            model=OPENAI_MODEL, messages=messages, response_format={"type": "json_object"})
+        text = response.choices[0].message.content
+        usage = response.usage
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        output_tokens = getattr(usage, "completion_tokens", 0) or 0
+    else:
+        stream = _openai_client.chat.completions.create(
+            model=OPENAI_MODEL, messages=messages, response_format={"type": "json_object"}, stream=True)
+        pieces = []
+        for chunk in stream:
+            piece = chunk.choices[0].delta.content if chunk.choices else None
+            if piece:
+                pieces.append(piece)
+                on_chunk(piece)
+        text = "".join(pieces)
+        # Stream không trả usage -> ước lượng
+        prompt_tokens = estimate_tokens(system_instruction) + estimate_tokens(prompt)
+        output_tokens = estimate_tokens(text)
+    _record_usage("openai", prompt_tokens, 0, output_tokens, (time.perf_counter() - started) * 1000, False)
+    return text
+
+# Thứ tự provider / hedging / circuit breaker: xem app/llm_router.py
+router = LLMRouter({"gemini": call_gemini})
+if OPENAI_API_KEY:
+    router.register("openai", call_openai)
+
+def generate_ai_response(chat_history, config, session_data_json, flow_state=None, summary="",
+                         on_reply_text=None):
     """
     Hàm fill biến vào Template và gọi AI
+    chat_history: các lượt gần đây (tin cuối là tin khách vừa gửi)
+    flow_state: state hiện tại của session (field "state")
+    summary: tóm tắt các lượt cũ đã rơi khỏi chat_history
+    on_reply_text: callback(text, done) nhận reply_text dần dần khi stream (xem app/reply_stream.py)
     """
     # 1. Chuẩn bị dữ liệu để fill vào Template
-    meta = config.get("meta_data", {})
-    settings = config.get("system_settings", {})
-    
     # Parse session data
     try:
         if isinstance(session_data_json, str):
@@ -95,42 +421,72 @@ def generate_ai_response(chat_history, config, session_data_json):
         session_dict = {}
 
     # Lấy state hiện tại từ session
-    current_state = session_dict.get("last_state", "START") 
+    current_state = flow_state or session_dict.get("last_state", "START") 
     
     # Lấy tin nhắn cuối
     last_msg = chat_history[-1]["content"] if chat_history else ""
 
-    # 2. Fill biến vào Template (Prompt Injection)
-    user_prompt = USER_PROMPT_TEMPLATE.format(
-        BRAND_NAME=meta.get("brand_default", "Unknown Brand"),
-        TOPIC=config.get("topic_id", "general"),
-        TONE_STYLE=meta.get("tone_style", "thân thiện"),
-        CALL_ME=settings.get("call_me", "mình"),
-        CALL_USER=settings.get("call_user", "bạn"),
+    # 2. Fill biến vào Template: phần cố định lấy từ cache, mỗi lượt chỉ dựng phần động
+    system_instruction = build_page_prompt(config)
+    recent_history = "\n".join(format_turn(t) for t in chat_history[:-1])
+    turn_prompt = TURN_PROMPT_TEMPLATE.format(
+        SUMMARY=summary or "(chưa có)",
+        RECENT_HISTORY=recent_history or "(chưa có)",
         FLOW_STATE=current_state,
         SESSION_DATA_JSON=json.dumps(session_dict, ensure_ascii=False),
         USER_MESSAGE=last_msg
     )
 
-    # 3. Gọi Model (Gemini 2.0 Flash)
+    # 3. Gọi Model qua router (Gemini / OpenAI theo thứ tự của Page, hedge + failover)
     try:
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash", 
-            system_instruction=MASTER_SYSTEM_PROMPT, # <--- System Prompt Cố định
-            generation_config={"response_mime_type": "application/json"}
-        )
-        
-        # Gửi kèm lịch sử chat (tối ưu token, chỉ gửi 5 câu gần nhất + Prompt Template)
-        # Lưu ý: Với Gemini, ta có thể gửi history qua biến history hoặc nhúng vào prompt. 
-        # Để đơn giản và đúng template, ta gửi prompt template là nội dung chính.
-        
-        response = model.generate_content(user_prompt)
-        return json.loads(response.text)
-        
+        result, provider = router.generate(config, system_instruction, turn_prompt, json.loads, on_reply_text)
+        return result
+
     except Exception as e:
-        print(f"❌ Lỗi AI Engine: {e}")
+        with _lock:
+            _usage_stats["errors"] += 1
+        metrics.inc("chatbot_llm_calls_total", page_id=metrics.current_page_id(), provider="",
+                    status="unavailable", cache="")
+        log.error("llm_unavailable", page_id=metrics.current_page_id(), error=str(e))
         return {
             "reply_text": "Hệ thống đang bận xíu, anh/chị chờ em lát nha.",
             "next_state": "ERROR",
             "need_phone": False
-        }
\ No newline at end of file
+        }
+
+
+# ==============================================================================
+# 5. GỘP TÓM TẮT HỘI THOẠI (summary_mode = "llm")
+# ==============================================================================
+SUMMARY_SYSTEM_PROMPT = """
+Bạn cập nhật bản tóm tắt hội thoại giữa Khách và nhân viên tư vấn.
+Giữ lại: thông tin khách đã cung cấp (triệu chứng, nhu cầu, ngân sách, thói quen...),
+câu hỏi đã hỏi / đã được trả lời, cam kết đã đưa ra. Bỏ lời chào hỏi, câu xã giao.
+Chỉ trả về bản tóm tắt mới dạng gạch đầu dòng, không thêm gì khác.
+"""
+
+SUMMARY_PROMPT_TEMPLATE = """
+Bản tóm tắt hiện tại:
+{SUMMARY}
+
+Lượt hội thoại mới cần gộp vào:
+{TURN}
+
+Viết lại bản tóm tắt (tối đa khoảng {MAX_WORDS} từ).
+"""
+
+def summarize_turn(summary, turn, max_tokens):
+    """Gộp 1 lượt vào bản tóm tắt bằng model rẻ; lỗi thì trả None để dùng cách trích xuất"""
+    try:
+        model = get_model(GEMINI_SUMMARY_MODEL, SUMMARY_SYSTEM_PROMPT, {"max_output_tokens": max_tokens})
+        response = model.generate_content(SUMMARY_PROMPT_TEMPLATE.format(
+            SUMMARY=summary or "(trống)",
+            TURN=format_turn(turn),
+            MAX_WORDS=max(20, int(max_tokens * 0.6)),
+        ))
+        text = (response.text or "").strip()
+        if text and estimate_tokens(text) <= max_tokens * 1.2:
+            return text
+    except Exception as e:
+        log.warning("summary_failed", error=str(e))
+    return None
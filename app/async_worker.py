@@ -0,0 +1,211 @@
+# app/async_worker.py
+"""
+Worker chế độ ASYNC: giữ hàng trăm hội thoại cùng chạy song song.
+
+- Vòng lặp lấy tin từ hàng đợi (app/chat_queue.py) không chặn event loop (chạy trong thread riêng).
+- Mỗi sự kiện được đưa vào "làn" của khách hàng (SerialLanes):
+  cùng khách -> tuần tự (history/session không bị xen kẽ), khác khách -> song song.
+- Phần xử lý nặng (Gemini, Graph API, CRM) là code đồng bộ nên chạy trong ThreadPool
+  có kích thước bằng giới hạn đồng thời WORKER_CONCURRENCY.
+
+- Với QUEUE_BACKEND=stream, 1 tin chỉ được XACK khi MỌI sự kiện bên trong đã xử lý xong.
+- Với QUEUE_BACKEND=fair, chỉ kéo đủ lấp chỗ trống trong hàng chờ cục bộ (nhỏ): Page nào được
+  phục vụ trước do scheduler trong Redis quyết định (app/fair_queue.py), không bị FIFO lại.
+- Burst coalescing: khách nhắn dồn dập ("alo", "shop ơi", "giá bao nhiêu"...) thì các tin đến
+  trong cửa sổ burst.window_ms (config Page) được gộp thành 1 lượt gọi AI duy nhất.
+  Typing indicator được gửi ngay khi tin đầu tiên tới.
+- SIGTERM: ngừng kéo tin, xử lý nốt mọi tin đã kéo về (kể cả đang chờ trong làn) rồi mới thoát.
+
+Chạy: WORKER_MODE=async python app/worker.py
+"""
+import asyncio
+import json
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from app import metrics, worker
+from app.lanes import SerialLanes
+from app.logs import HOT_SAMPLE, get_logger
+
+# Số lượt hội thoại (turn) được xử lý cùng lúc
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "100"))
+
+log = get_logger("async_worker")
+
+class _Delivery:
+    """Theo dõi 1 tin trong queue: còn bao nhiêu sự kiện chưa xong, có sự kiện nào lỗi không"""
+    __slots__ = ("msg_id", "remaining", "failed")
+
+    def __init__(self, msg_id, remaining):
+        self.msg_id = msg_id
+        self.remaining = remaining
+        self.failed = False
+
+
+class AsyncWorkerEngine:
+    def __init__(self, concurrency=WORKER_CONCURRENCY):
+        self.concurrency = concurrency
+        # +1 thread cho vòng lặp kéo tin từ queue
+        self.executor = ThreadPoolExecutor(max_workers=concurrency + 1, thread_name_prefix="turn")
+        self.lanes = None
+        self._running = False
+
+    async def _gather(self, key, item):
+        """
+        Chờ trong cửa sổ burst để gộp các tin khách gửi liên tiếp.
+        Trả về item gốc, hoặc ("burst", [item, ...]) nếu có nhiều tin được gộp.
+        """
+        delivery, (page_id, config, topic_id, messaging) = item
+        if worker.customer_message_text(page_id, messaging) is None:
+            return item
+        window, max_messages = worker.burst_settings(config)
+        if window <= 0 or max_messages <= 1:
+            return item
+
+        loop = asyncio.get_running_loop()
+        # Cho khách thấy Bot đang soạn tin ngay lập tức (không chờ kết quả)
+        loop.run_in_executor(self.executor, worker.send_typing_indicator, page_id, key)
+
+        def same_burst(queued):
+            _, (q_page_id, _, _, q_messaging) = queued
+            return q_page_id == page_id and worker.customer_message_text(q_page_id, q_messaging) is not None
+
+        items = [item]
+        deadline = loop.time() + window * worker.BURST_MAX_WAIT_FACTOR
+        try:
+            while len(items) < max_messages:
+                await asyncio.sleep(max(0.0, min(window, deadline - loop.time())))
+                taken = self.lanes.take(key, same_burst, max_messages - len(items))
+                items.extend(taken)
+                if not taken or loop.time() >= deadline:
+                    break
+        except Exception as e:
+            # Tin đã lấy khỏi làn chỉ còn nằm trong items -> vẫn xử lý, không bỏ rơi
+            log.warning("burst_gather_failed", page_id=page_id, sender_id=key, error=str(e))
+
+        if len(items) == 1:
+            return item
+        log.info("burst_coalesced", sample=HOT_SAMPLE, page_id=page_id, sender_id=key, messages=len(items))
+        return ("burst", items)
+
+    async def _run_event(self, key, item):
+        loop = asyncio.get_running_loop()
+        if item[0] == "burst":
+            items = item[1]
+            _, (page_id, config, topic_id, messaging) = items[0]
+            texts = [worker.customer_message_text(p, m) for _, (p, _, _, m) in items]
+            # Thời gian chờ tính từ tin đầu tiên của burst
+            call = (worker.handle_customer_turn, page_id, config, topic_id, key, texts, messaging.get("_queued_at"))
+        else:
+            items = [item]
+            _, (page_id, config, topic_id, messaging) = item
+            call = (worker.handle_messaging, page_id, config, topic_id, messaging)
+
+        failed = False
+        try:
+            await loop.run_in_executor(self.executor, *call)
+        except Exception as e:
+            failed = True
+            metrics.inc("chatbot_errors_total", component="worker", page_id=page_id)
+            log.error("event_failed", page_id=page_id, sender_id=key, error=str(e), exc_info=True)
+        finally:
+            try:
+                await self._finish(items, failed)
+            except Exception as e:
+                # Redis lỗi lúc ACK: tin nằm lại pending / lease, được thử lại khi hết hạn
+                log.error("settle_failed", page_id=page_id, sender_id=key, error=str(e))
+
+    async def _finish(self, items, failed):
+        for delivery, _ in items:
+            delivery.failed = delivery.failed or failed
+            delivery.remaining -= 1
+            if delivery.remaining == 0:
+                await self._settle(delivery)
+
+    async def _on_lane_error(self, key, item):
+        """gather / handler lỗi trước khi xử lý -> coi như sự kiện lỗi (release, thử lại sau)"""
+        metrics.inc("chatbot_errors_total", component="worker", page_id="")
+        await self._finish(item[1] if item[0] == "burst" else [item], True)
+
+    async def _settle(self, delivery):
+        loop = asyncio.get_running_loop()
+        # Có sự kiện lỗi -> không ACK, để tin được claim lại và thử lại sau
+        # (backend fair: trả slot, tin về đầu list của Page)
+        settle = worker.chat_queue.release if delivery.failed else worker.chat_queue.ack
+        await loop.run_in_executor(self.executor, settle, delivery.msg_id)
+
+    async def dispatch(self, msg_id, body):
+        """Chia 1 cục webhook vào làn của từng khách"""
+        events = list(worker.iter_events(body, worker.enqueued_at(msg_id, body)))
+        delivery = _Delivery(msg_id, len(events))
+        if not events:
+            await self._settle(delivery)
+            return
+        for event in events:
+            page_id, _, _, messaging = event
+            self.lanes.submit(worker.conversation_key(page_id, messaging), (delivery, event))
+
+    async def _heartbeat(self):
+        # Chạy trên event loop: loop bị treo thì supervisor (app/supervisor.py) thấy heartbeat dừng
+        while True:
+            worker.heartbeat(self.lanes.pending)
+            await asyncio.sleep(1)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.lanes = SerialLanes(self._run_event, self.concurrency, gather=self._gather,
+                                 on_error=self._on_lane_error)
+        self._running = True
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        heartbeat = asyncio.create_task(self._heartbeat())
+        log.info("async_worker_started", concurrency=self.concurrency)
+
+        # Không kéo thêm tin khi đã tồn đọng quá nhiều (giữ thứ tự & bộ nhớ ổn định).
+        # Backend fair (pull_exact): chỉ kéo đúng số chỗ còn trống, thứ tự do scheduler chọn
+        backlog_limit = self.concurrency * worker.chat_queue.prefetch
+        while self._running and not worker.stopping():
+            try:
+                await self.lanes.wait_below(backlog_limit)
+                if not self._running or worker.stopping():
+                    break
+
+                pull_kwargs = {"block_ms": 1000}
+                if getattr(worker.chat_queue, "pull_exact", False):
+                    pull_kwargs["count"] = backlog_limit - self.lanes.pending
+                batch = await loop.run_in_executor(
+                    self.executor, lambda: worker.chat_queue.pull(**pull_kwargs)
+                )
+                for msg_id, raw_json in batch:
+                    try:
+                        body = json.loads(raw_json)
+                    except Exception as e:
+                        worker.chat_queue.fail(msg_id, raw_json, f"JSON lỗi: {e}")
+                        continue
+                    await self.dispatch(msg_id, body)
+
+            except Exception as e:
+                metrics.inc("chatbot_errors_total", component="queue", page_id="")
+                log.error("worker_loop_failed", error=str(e))
+                await asyncio.sleep(1)
+
+        await self.lanes.join()
+        heartbeat.cancel()
+
+    def stop(self):
+        worker.request_stop()
+        self._running = False
+
+
+def run_async_worker(concurrency=WORKER_CONCURRENCY):
+    engine = AsyncWorkerEngine(concurrency)
+    try:
+        asyncio.run(engine.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    run_async_worker()
@@ -0,0 +1,283 @@
+# app/chat_queue.py
+"""
+Hàng đợi tin nhắn giữa Webhook (main.py) và Worker.
+
+QUEUE_BACKEND=list   -> Redis List "chat_queue" (RPUSH / BLPOP) như cũ.
+                        BLPOP là lấy-là-xóa: worker chết giữa chừng thì mất tin.
+QUEUE_BACKEND=stream -> Redis Streams + Consumer Group:
+                        - Webhook: XADD
+                        - Worker: XREADGROUP theo lô, XACK chỉ sau khi xử lý xong
+                        - XAUTOCLAIM lấy lại tin "treo" của worker đã chết; tin worker còn đang giữ
+                          (chờ trong làn / đang xử lý) được XCLAIM làm mới định kỳ để không bị claim lại
+                        - release: tin lỗi được đánh dấu "treo" ngay -> thử lại ở lần claim kế tiếp
+                        - Tin lỗi quá MAX_DELIVERIES lần -> dead-letter stream
+QUEUE_BACKEND=fair   -> Mỗi Page 1 list + scheduler công bằng có trọng số, giới hạn đồng thời
+                        theo Page và làn ưu tiên (xem app/fair_queue.py).
+
+Giao diện chung: push / pull / ack / release (trả slot khi xử lý lỗi) / fail
+                 depth (số tin chờ) / oldest_age (số giây tin chờ lâu nhất đã chờ) - dùng cho autoscale.
+"""
+import os
+import socket
+import threading
+import time
+
+import redis
+
+from app.fair_queue import FairQueue, enqueue_async as fair_enqueue_async, webhook_time
+from app.logs import get_logger
+
+QUEUE_BACKEND = os.getenv("QUEUE_BACKEND", "list").lower()
+
+CHAT_QUEUE = "chat_queue"
+CHAT_STREAM = os.getenv("CHAT_STREAM", "chat_stream")
+CHAT_GROUP = os.getenv("CHAT_GROUP", "chat_workers")
+DEAD_LETTER_STREAM = f"{CHAT_STREAM}:dead"
+
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", "1000000"))    # Giới hạn độ dài stream (xấp xỉ)
+STREAM_BATCH = int(os.getenv("STREAM_BATCH", "32"))           # Số tin kéo mỗi lần XREADGROUP
+CLAIM_IDLE_MS = int(os.getenv("STREAM_CLAIM_IDLE_MS", "60000"))  # Tin treo quá lâu -> claim lại
+CLAIM_INTERVAL_SECONDS = 5
+MAX_DELIVERIES = int(os.getenv("STREAM_MAX_DELIVERIES", "5"))
+
+log = get_logger("chat_queue")
+
+
+def default_consumer_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ListQueue:
+    """Backend cũ: Redis List. ack/fail không làm gì (tin đã bị xóa khi BLPOP)"""
+
+    # Worker async được kéo trước tối đa 2 x số slot
+    prefetch = 2
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    def push(self, raw):
+        self.redis.rpush(CHAT_QUEUE, raw)
+
+    def pull(self, count=1, block_ms=5000):
+        """Trả về list [(msg_id, raw)]"""
+        packed_item = self.redis.blpop(CHAT_QUEUE, timeout=max(1, block_ms // 1000))
+        if not packed_item:
+            return []
+        return [(None, packed_item[1])]
+
+    def ack(self, msg_id):
+        pass
+
+    def release(self, msg_id):
+        pass
+
+    def fail(self, msg_id, raw, error):
+        log.error("message_dropped", backend="list", error=str(error))
+
+    def depth(self):
+        return self.redis.llen(CHAT_QUEUE)
+
+    def oldest_age(self):
+        # List không lưu thời điểm vào hàng đợi -> dùng entry.time Facebook gắn vào webhook
+        queued_at = webhook_time(self.redis.lindex(CHAT_QUEUE, 0))
+        return max(0.0, time.time() - queued_at) if queued_at else 0.0
+
+
+class StreamQueue:
+    prefetch = 2
+
+    def __init__(self, redis_client, consumer=None):
+        self.redis = redis_client
+        self.consumer = consumer or default_consumer_name()
+        self._group_ready = False
+        self._last_claim = 0.0
+        self._claim_cursor = "0-0"
+        # Tin đã kéo về mà chưa ACK / release (kể cả đang chờ trong làn của worker async)
+        self._inflight = set()
+        self._inflight_lock = threading.Lock()
+        self._refresher = None
+
+    # ------------------------------------------------
+    # Phía Webhook
+    # ------------------------------------------------
+    def push(self, raw):
+        self.redis.xadd(CHAT_STREAM, {"body": raw}, maxlen=STREAM_MAXLEN, approximate=True)
+
+    # ------------------------------------------------
+    # Phía Worker
+    # ------------------------------------------------
+    def ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            self.redis.xgroup_create(CHAT_STREAM, CHAT_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def pull(self, count=STREAM_BATCH, block_ms=5000):
+        """
+        Kéo 1 lô tin: ưu tiên tin treo của consumer đã chết (XAUTOCLAIM),
+        sau đó mới đến tin mới (XREADGROUP '>').
+        Trả về list [(msg_id, raw)]
+        """
+        self.ensure_group()
+
+        now = time.time()
+        if now - self._last_claim >= CLAIM_INTERVAL_SECONDS:
+            self._last_claim = now
+            reclaimed = self._reclaim(count)
+            if reclaimed:
+                return self._track(reclaimed)
+
+        resp = self.redis.xreadgroup(
+            CHAT_GROUP, self.consumer, {CHAT_STREAM: ">"}, count=count, block=block_ms
+        )
+        if not resp:
+            return []
+        _, entries = resp[0]
+        return self._track([(msg_id, fields.get(b"body")) for msg_id, fields in entries])
+
+    def _track(self, batch):
+        with self._inflight_lock:
+            self._inflight.update(msg_id for msg_id, _ in batch)
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="stream-refresh", daemon=True)
+            self._refresher.start()
+        return batch
+
+    def _untrack(self, msg_id):
+        with self._inflight_lock:
+            self._inflight.discard(msg_id)
+
+    def _refresh_loop(self):
+        """XCLAIM (JUSTID, không tăng số lần giao) các tin đang giữ -> idle về 0, XAUTOCLAIM không lấy mất"""
+        while True:
+            time.sleep(CLAIM_IDLE_MS / 3000)
+            with self._inflight_lock:
+                ids = list(self._inflight)
+            try:
+                for i in range(0, len(ids), 500):
+                    self.redis.xclaim(CHAT_STREAM, CHAT_GROUP, self.consumer, 0, ids[i:i + 500], justid=True)
+            except redis.RedisError as e:
+                log.warning("stream_refresh_failed", error=str(e), inflight=len(ids))
+
+    def _reclaim(self, count):
+        resp = self.redis.xautoclaim(
+            CHAT_STREAM, CHAT_GROUP, self.consumer,
+            min_idle_time=CLAIM_IDLE_MS, start_id=self._claim_cursor, count=count
+        )
+        # redis >= 7 trả thêm list id đã bị xóa khỏi stream (Redis tự gỡ khỏi pending);
+        # redis 6.2 trả nil cho tin đã bị xóa (redis-py -> (None, None)) -> bỏ qua
+        self._claim_cursor = resp[0]
+        entries = [entry for entry in resp[1] if entry[0] is not None]
+        if not entries:
+            return []
+
+        # Đếm số lần đã giao cho từng tin để chặn "poison message"
+        first_id, last_id = entries[0][0], entries[-1][0]
+        pending = self.redis.xpending_range(
+            CHAT_STREAM, CHAT_GROUP, min=first_id, max=last_id,
+            count=len(entries), consumername=self.consumer
+        )
+        deliveries = {p["message_id"]: p["times_delivered"] for p in pending}
+
+        batch = []
+        with self._inflight_lock:
+            held = set(self._inflight)
+        for msg_id, fields in entries:
+            if msg_id in held:
+                # Chính consumer này đang giữ (chưa kịp làm mới) -> không xử lý lần 2
+                continue
+            if not fields:
+                # Tin không còn nội dung (đã bị xóa khỏi stream) -> gỡ khỏi pending
+                self.redis.xack(CHAT_STREAM, CHAT_GROUP, msg_id)
+                continue
+            raw = fields.get(b"body")
+            if deliveries.get(msg_id, 0) > MAX_DELIVERIES:
+                self.fail(msg_id, raw, f"vượt quá {MAX_DELIVERIES} lần xử lý")
+                continue
+            batch.append((msg_id, raw))
+
+        if batch:
+            log.info("messages_reclaimed", count=len(batch), consumer=self.consumer)
+        return batch
+
+    def ack(self, msg_id):
+        self._untrack(msg_id)
+        self.redis.xack(CHAT_STREAM, CHAT_GROUP, msg_id)
+
+    def release(self, msg_id):
+        """
+        Không ACK: tin nằm lại trong pending. Đặt idle = CLAIM_IDLE_MS để lần XAUTOCLAIM kế tiếp
+        (<= CLAIM_INTERVAL_SECONDS, worker bất kỳ) thử lại ngay thay vì chờ đủ CLAIM_IDLE_MS
+        """
+        self._untrack(msg_id)
+        self.redis.xclaim(CHAT_STREAM, CHAT_GROUP, self.consumer, 0, [msg_id],
+                          idle=CLAIM_IDLE_MS, justid=True)
+
+    def fail(self, msg_id, raw, error):
+        """Chuyển tin sang dead-letter stream rồi ACK để không bị giao lại"""
+        self._untrack(msg_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.xadd(
+            DEAD_LETTER_STREAM,
+            {"body": raw or b"", "error": str(error)[:500], "source_id": msg_id, "consumer": self.consumer},
+            maxlen=STREAM_MAXLEN, approximate=True
+        )
+        pipe.xack(CHAT_STREAM, CHAT_GROUP, msg_id)
+        pipe.execute()
+        log.error("message_dead_lettered", msg_id=msg_id, stream=DEAD_LETTER_STREAM, error=str(error))
+
+    def _group_info(self):
+        try:
+            groups = self.redis.xinfo_groups(CHAT_STREAM)
+        except redis.ResponseError:
+            return None
+        return next((g for g in groups if g.get("name") in (CHAT_GROUP, CHAT_GROUP.encode())), None)
+
+    def depth(self):
+        """Tin chưa xử lý xong: lag (chưa giao) + pending (chưa ACK) của group"""
+        group = self._group_info()
+        if group is None:
+            return 0
+        return (group.get("lag") or 0) + (group.get("pending") or 0)
+
+    def oldest_age(self):
+        """Tuổi tin cũ nhất chưa giao cho worker nào (ID stream = thời điểm XADD)"""
+        group = self._group_info()
+        if group is None:
+            return 0.0
+        last = group.get("last-delivered-id") or b"0-0"
+        last = last if isinstance(last, bytes) else last.encode()
+        entries = self.redis.xrange(CHAT_STREAM, min=b"(" + last, count=1)
+        if not entries:
+            return 0.0
+        msg_id = entries[0][0].decode() if isinstance(entries[0][0], bytes) else entries[0][0]
+        return max(0.0, time.time() - int(msg_id.split("-")[0]) / 1000)
+
+
+def get_chat_queue(redis_client, backend=None):
+    backend = (backend or QUEUE_BACKEND).lower()
+    if backend == "stream":
+        return StreamQueue(redis_client)
+    if backend == "fair":
+        return FairQueue(redis_client)
+    return ListQueue(redis_client)
+
+
+async def enqueue_async(async_redis, raw, backend=None):
+    """
+    Đẩy tin vào hàng đợi bằng client redis.asyncio (dùng cho Webhook, không chặn event loop).
+    `raw` là bytes gốc của request, đẩy nguyên văn không parse lại (trừ backend fair).
+    """
+    backend = (backend or QUEUE_BACKEND).lower()
+    if backend == "stream":
+        await async_redis.xadd(CHAT_STREAM, {"body": raw}, maxlen=STREAM_MAXLEN, approximate=True)
+    elif backend == "fair":
+        # Phải parse để tách theo Page / làn ưu tiên
+        await fair_enqueue_async(async_redis, raw)
+    else:
+        await async_redis.rpush(CHAT_QUEUE, raw)
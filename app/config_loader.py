@@ -1,49 +1,216 @@
 # app/config_loader.py
+"""
+Registry cấu hình Page (Topic Pack) nằm sẵn trong bộ nhớ.
+
+- Lúc khởi động: đọc toàn bộ configs/*.json 1 lần.
+- Page ID lấy từ field "page_ids" BÊN TRONG từng file config (không còn PAGE_MAP cứng).
+- Các giá trị dẫn xuất (page_name fallback, topic_id, biến prompt, luật phân loại)
+  được tính sẵn 1 lần cho mỗi phiên bản file -> nằm trong config["_compiled"].
+- Hot-reload: cứ CONFIG_RELOAD_INTERVAL giây kiểm tra mtime, file đổi thì nạp lại.
+- Nhiều worker: publish lên kênh Redis CONFIG_RELOAD_CHANNEL để mọi process nạp lại ngay.
+    python -m app.config_loader reload
+
+Trên đường nóng, load_config(page_id) chỉ là 1 lần tra dict.
+"""
 import json
 import os
+import threading
+import time
+
+from app.lead_scoring import compile_scoring
+from app.logs import get_logger
 
 # Đường dẫn đến thư mục configs
 CONFIG_DIR = os.path.join(os.getcwd(), "configs")
 
-# BẢN ĐỒ ÁNH XẠ PAGE ID -> FILE CONFIG
-PAGE_MAP = {
-    # ID Page thật của anh -> File Topic Pack mới
-    "105524314620167": "bo_thuoc_360.json",
-    
-    # ID giả lập test BĐS
-    "2002": "bds_luxury.json"
-}
+# Bao lâu kiểm tra mtime 1 lần (giây)
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "2"))
+CONFIG_RELOAD_CHANNEL = "config_reload"
+
+log = get_logger("config")
+
+
+def compile_config(config, mtime):
+    """
+    Tính sẵn các giá trị dẫn xuất cho 1 file config (chạy 1 lần / phiên bản file)
+    """
+    meta = config.get("meta_data", {})
+    settings = config.get("system_settings", {})
+
+    # --- LOGIC TỰ SỬA LỖI (FALLBACK) ---
+    # Nếu config cũ có 'page_name', dùng nó.
+    # Nếu config mới không có, tìm trong 'meta_data'.
+    page_name = config.get("page_name")
+    if not page_name:
+        page_name = meta.get("brand_default", "Unknown Page")
+    config["page_name"] = page_name
+
+    # Config cũ dùng "topic", config mới dùng "topic_id"
+    topic_id = config.get("topic_id") or config.get("topic") or "general"
+    config["topic_id"] = topic_id
+
+    classification_rules = config.get("logic_rules", {}).get("classification_rules", {})
+
+    config["_compiled"] = {
+        "page_ids": [str(p) for p in config.get("page_ids", [])],
+        # Phiên bản = config_version + mtime -> sửa file mà quên tăng version vẫn nhận ra
+        "version": f"{config.get('config_version', 'v0')}@{int(mtime)}",
+        # Biến fill vào phần prompt cố định của Page
+        "prompt_vars": {
+            "BRAND_NAME": meta.get("brand_default", "Unknown Brand"),
+            "TOPIC": topic_id,
+            "TONE_STYLE": meta.get("tone_style", "thân thiện"),
+            "CALL_ME": settings.get("call_me", "mình"),
+            "CALL_USER": settings.get("call_user", "bạn"),
+        },
+        "classification_rules": dict(classification_rules),
+        "classification_prompt": "\n".join(
+            f"- {name}: {desc}" for name, desc in classification_rules.items()
+        ),
+        # Bảng điểm Lead (app/lead_scoring.py)
+        "scoring": compile_scoring(config),
+    }
+    return config
+
+
+class ConfigRegistry:
+    def __init__(self, config_dir=CONFIG_DIR, reload_interval=CONFIG_RELOAD_INTERVAL):
+        self.config_dir = config_dir
+        self.reload_interval = reload_interval
+        self._by_page = {}   # page_id -> config (đã compile)
+        self._files = {}     # filename -> (mtime, config)
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._loaded = False
+
+    # ------------------------------------------------
+    # Nạp / nạp lại
+    # ------------------------------------------------
+    def _read_file(self, filename):
+        file_path = os.path.join(self.config_dir, filename)
+        try:
+            mtime = os.path.getmtime(file_path)
+            with open(file_path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            return mtime, compile_config(config, mtime)
+        except Exception as e:
+            log.error("config_read_failed", file=filename, error=str(e))
+            return None
+
+    def reload(self, force=False):
+        """Quét thư mục configs, chỉ đọc lại file mới/đã đổi mtime"""
+        with self._lock:
+            try:
+                filenames = sorted(f for f in os.listdir(self.config_dir) if f.endswith(".json"))
+            except FileNotFoundError:
+                log.error("config_dir_missing", path=self.config_dir)
+                filenames = []
+
+            files = {}
+            changed = force or set(filenames) != set(self._files)
+            for filename in filenames:
+                old = self._files.get(filename)
+                try:
+                    mtime = os.path.getmtime(os.path.join(self.config_dir, filename))
+                except OSError:
+                    continue
+                if old and old[0] == mtime and not force:
+                    files[filename] = old
+                    continue
+                loaded = self._read_file(filename)
+                if loaded:
+                    files[filename] = loaded
+                    changed = True
+                elif old:
+                    # File đang sửa dở / lỗi JSON -> giữ bản cũ
+                    files[filename] = old
+
+            if changed or not self._loaded:
+                by_page = {}
+                for filename, (_, config) in files.items():
+                    for page_id in config["_compiled"]["page_ids"]:
+                        if page_id in by_page:
+                            log.warning("config_duplicate_page", page_id=page_id, file=filename)
+                            continue
+                        by_page[page_id] = config
+                # Đổi tham chiếu 1 lần -> luồng đọc không bao giờ thấy dict dở dang
+                self._by_page = by_page
+                if self._loaded:
+                    log.info("config_reloaded", pages=len(by_page))
+
+            self._files = files
+            self._loaded = True
+            self._last_check = time.monotonic()
+
+    def invalidate(self):
+        """Bắt buộc đọc lại toàn bộ ở lần truy cập tới"""
+        self._last_check = 0.0
+        self._loaded = False
+
+    def get(self, page_id):
+        now = time.monotonic()
+        if not self._loaded:
+            self.reload(force=True)
+        elif now - self._last_check >= self.reload_interval:
+            self.reload()
+        return self._by_page.get(str(page_id))
+
+    def page_ids(self):
+        return list(self._by_page)
+
+    # ------------------------------------------------
+    # Đồng bộ nhiều worker qua Redis Pub/Sub
+    # ------------------------------------------------
+    def start_reload_listener(self, redis_client):
+        """Chạy thread nền nghe kênh reload; nhận tín hiệu là nạp lại ngay"""
+        def listen():
+            while True:
+                try:
+                    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(CONFIG_RELOAD_CHANNEL)
+                    for message in pubsub.listen():
+                        if message.get("type") == "message":
+                            self.invalidate()
+                            self.reload(force=True)
+                except Exception as e:
+                    log.warning("config_reload_listener_failed", error=str(e))
+                    time.sleep(5)
+
+        thread = threading.Thread(target=listen, name="config-reload", daemon=True)
+        thread.start()
+        return thread
+
+
+def publish_reload(redis_client):
+    """Báo cho mọi worker nạp lại config"""
+    return redis_client.publish(CONFIG_RELOAD_CHANNEL, "reload")
+
+
+registry = ConfigRegistry()
+
 
 def load_config(page_id):
     """
-    Hàm đọc file config JSON dựa trên Page ID
+    Lấy config đã compile theo Page ID (tra dict, không đọc đĩa)
     """
-    filename = PAGE_MAP.get(str(page_id))
-    
-    if not filename:
-        print(f" Không tìm thấy mapping cho Page ID: {page_id}")
+    config = registry.get(page_id)
+    if not config:
+        log.warning("config_page_unknown", page_id=page_id)
         return None
+    return config
 
-    file_path = os.path.join(CONFIG_DIR, filename)
-    
-    if not os.path.exists(file_path):
-        print(f" File không tồn tại: {file_path}")
-        return None
 
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            config = json.load(f)
-            
-        # --- LOGIC TỰ SỬA LỖI (FALLBACK) ---
-        # Nếu config cũ có 'page_name', dùng nó.
-        # Nếu config mới không có, tìm trong 'meta_data'.
-        page_name = config.get("page_name")
-        if not page_name:
-            page_name = config.get("meta_data", {}).get("brand_default", "Unknown Page")
-            
-        # print(f"📂 Đã đọc file: {filename} ({page_name})")
-        return config
-        
-    except Exception as e:
-        print(f" Lỗi đọc config {filename}: {e}")
-        return None
\ No newline at end of file
+if __name__ == "__main__":
+    import sys
+    import redis
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if len(sys.argv) > 1 and sys.argv[1] == "reload":
+        r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        print(f"📣 Đã gửi tín hiệu reload tới {publish_reload(r)} worker")
+    else:
+        registry.reload(force=True)
+        for page_id in registry.page_ids():
+            config = registry.get(page_id)
+            print(f"{page_id} -> {config['page_name']} ({config['_compiled']['version']})")
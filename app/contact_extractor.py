@@ -0,0 +1,179 @@
+# app/contact_extractor.py
+"""
+Bóc SĐT / Email tiếng Việt: regex biên dịch sẵn lúc import + tra dict theo từ.
+
+Tin thường chỉ tốn 1 lượt quét chữ số (+ kiểm tra "@" bằng `in`). Lượt quét có chữ số
+đọc bằng chữ chỉ chạy khi tin có dấu hiệu (có "không"/"ko" hoặc 1 đoạn số cụt bắt đầu bằng 0/84).
+
+Bắt được:
+- SĐT di động 03/05/07/08/09 + 8 số và số bàn 02x + 8 số.
+- Đầu +84 / 84 / (+84) -> chuẩn hóa về 0 (vd: "+84 912.345.678" -> "0912345678").
+- Số bị tách bởi khoảng trắng, dấu chấm, gạch ngang, ngoặc ("0912 345 678", "091-234-5678").
+- Số đọc bằng chữ, có dấu hoặc không, xen lẫn chữ số
+  ("không chín một hai ba bốn năm sáu bảy tám", "khong 9 mot 2...").
+- Email (chuẩn hóa chữ thường).
+
+Không bắt: SĐT phải phủ trọn các nhóm chữ số nó nằm trong -> không cắt SĐT ra từ giữa mã đơn,
+số tài khoản, đầu 0084... ("mã đơn 20240912345678", "stk 1903 4567 8901 234").
+
+API:
+    extract_contacts(text)   -> {"phones": [...], "emails": [...]}
+    extract_phone(text) / extract_email(text) -> giá trị đầu tiên hoặc None
+    extract_batch(texts)     -> list kết quả, dùng khi quét lại lịch sử chat hàng loạt
+    first_contacts(texts)    -> (phone, email) đầu tiên trong nhiều tin (burst đã gộp)
+"""
+import re
+
+# Chữ số đọc bằng chữ (có dấu + không dấu + cách nói miền Nam/Bắc)
+DIGIT_WORDS = {
+    "không": "0", "khong": "0", "ko": "0",
+    "một": "1", "mot": "1", "mốt": "1",
+    "hai": "2",
+    "ba": "3",
+    "bốn": "4", "bon": "4", "tư": "4",
+    "năm": "5", "nam": "5", "lăm": "5", "nhăm": "5",
+    "sáu": "6", "sau": "6",
+    "bảy": "7", "bẩy": "7", "bay": "7",
+    "tám": "8", "tam": "8",
+    "chín": "9", "chin": "9",
+}
+
+
+# Lượt quét chính: chữ số tách bởi khoảng trắng / . - ( ) /, có thể có dấu + đầu.
+# Mở đầu bằng 1 lớp ký tự -> sre nhảy nhanh qua đoạn không có số.
+_DIGITS_RE = re.compile(r"[+\d][\d\s.\-()/]*")
+# SĐT đọc bằng chữ luôn mở đầu bằng số 0 ("không"/"khong"/"ko") hoặc chữ số thật
+_WORD_PUNCT = ".,;:!?()[]\"'-/"
+# Email chỉ được quét khi tin có "@" (kiểm tra bằng `in`, gần như miễn phí)
+_EMAIL_RE = re.compile(r"(?<![\w.%+-])[\w.%+-]+@[\w-]+(?:\.[\w-]+)*\.[a-z]{2,}", re.IGNORECASE)
+# Trên các nhóm chữ số đã ghép (fullmatch): đầu 84 hoặc 0, rồi mã mạng
+_PHONE_RE = re.compile(r"(?:84|0)([35789]\d{8}|2\d{9})")
+_NON_DIGIT_RE = re.compile(r"\D")
+_DIGIT_GROUP_RE = re.compile(r"\d+")
+# Chuỗi ghép phải có ít nhất ngần này chữ số mới xét là SĐT (0 + 9 số)
+MIN_PHONE_DIGITS = 10
+# ... và nhiều nhất ngần này (84 + số bàn 2x + 8 số)
+MAX_PHONE_DIGITS = 12
+
+
+def normalize_phone(phone):
+    """Chỉ giữ chữ số; +84 / 84 -> 0 (vd: "+84 912.345.678" -> "0912345678")"""
+    digits = _NON_DIGIT_RE.sub("", str(phone or ""))
+    if digits.startswith("84") and len(digits) in (11, 12):
+        digits = "0" + digits[2:]
+    return digits or None
+
+
+def normalize_email(email):
+    email = str(email or "").strip().lower()
+    return email or None
+
+
+def _spoken_runs(lowered):
+    """
+    Lượt quét phụ theo từ: gom các từ liền nhau là chữ số / chữ số đọc bằng chữ
+    ("không chín 1 hai..." -> "091 2...") thành chuỗi chữ số.
+    Tra dict theo từ rẻ hơn nhiều so với 1 regex "|" dài thử ở mọi vị trí.
+    """
+    runs, current = [], []
+    # Mỗi từ là 1 nhóm (nối bằng khoảng trắng) -> SĐT phải phủ trọn các từ như lượt quét chữ số
+    for word in lowered.split():
+        word = word.strip(_WORD_PUNCT)
+        digit = DIGIT_WORDS.get(word)
+        if digit is None and word.isdigit():
+            digit = word
+        if digit is not None:
+            current.append(digit)
+        elif current:
+            runs.append(" ".join(current))
+            current = []
+    if current:
+        runs.append(" ".join(current))
+    return runs
+
+
+def _phones_in(groups):
+    """
+    groups: các nhóm chữ số liền nhau của 1 đoạn (đã bỏ dấu phân cách).
+    SĐT = 1 hoặc nhiều nhóm liền nhau ghép lại đúng độ dài, không lấy 1 phần của nhóm.
+    """
+    phones = []
+    i = 0
+    while i < len(groups):
+        digits = ""
+        for j in range(i, len(groups)):
+            digits += groups[j]
+            m = len(digits) >= MIN_PHONE_DIGITS and _PHONE_RE.fullmatch(digits)
+            if m or len(digits) >= MAX_PHONE_DIGITS:
+                break
+        if m:
+            phones.append("0" + m.group(1))
+            i = j + 1
+        else:
+            i += 1
+    return phones
+
+
+def _collect_phones(runs, phones):
+    """Thêm SĐT tìm được trong các chuỗi chữ số; trả về True nếu có chuỗi giống đầu SĐT bị cụt"""
+    partial = False
+    for run in runs:
+        # Đoạn ngắn hơn 10 ký tự không thể chứa SĐT -> bỏ qua trước khi ghép chữ số
+        if len(run) < MIN_PHONE_DIGITS:
+            partial = partial or run.startswith(("0", "84", "+"))
+            continue
+        groups = [run] if run.isdigit() else _DIGIT_GROUP_RE.findall(run)
+        digits = "".join(groups)
+        if len(digits) < MIN_PHONE_DIGITS:
+            partial = partial or digits.startswith(("0", "84"))
+            continue
+        for phone in _phones_in(groups):
+            if phone not in phones:
+                phones.append(phone)
+    return partial
+
+
+def extract_contacts(text):
+    phones, emails = [], []
+    if not text:
+        return {"phones": phones, "emails": emails}
+    if "@" in text:
+        for email in _EMAIL_RE.findall(text):
+            email = email.lower()
+            if email not in emails:
+                emails.append(email)
+
+    partial = _collect_phones(_DIGITS_RE.findall(text), phones)
+    # Lượt phụ chỉ chạy khi tin có thể chứa số đọc bằng chữ (hiếm) -> tin thường không tốn thêm
+    if not phones:
+        lowered = text.lower()
+        if partial or "không" in lowered or "khong" in lowered or "ko" in lowered:
+            _collect_phones(_spoken_runs(lowered), phones)
+    return {"phones": phones, "emails": emails}
+
+
+def extract_phone(text):
+    phones = extract_contacts(text)["phones"]
+    return phones[0] if phones else None
+
+
+def extract_email(text):
+    emails = extract_contacts(text)["emails"]
+    return emails[0] if emails else None
+
+
+def extract_batch(texts):
+    """Quét hàng loạt (vd: lịch sử chat trong Redis), 1 kết quả / tin"""
+    extract = extract_contacts
+    return [extract(text) for text in texts]
+
+
+def first_contacts(texts):
+    """(phone, email) đầu tiên tìm thấy trong nhiều tin"""
+    phone = email = None
+    for result in extract_batch(texts):
+        phone = phone or (result["phones"][0] if result["phones"] else None)
+        email = email or (result["emails"][0] if result["emails"] else None)
+        if phone and email:
+            break
+    return phone, email
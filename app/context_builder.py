@@ -0,0 +1,155 @@
+# app/context_builder.py
+"""
+Dựng ngữ cảnh hội thoại gửi cho AI trong 1 ngân sách token cố định.
+
+- Các lượt GẦN NHẤT được xếp vào từ mới -> cũ cho tới khi hết ngân sách "max_tokens".
+- Lượt nào bị đẩy ra khỏi cửa sổ thì được GỘP DẦN (từng lượt một) vào bản tóm tắt
+  cuốn chiếu (rolling summary) lưu trong session: field "summary" + "summary_seq".
+  Không bao giờ tóm tắt lại từ đầu.
+- Cửa sổ không bao giờ chứa tin đã nằm trong bản tóm tắt (seq < summary_seq), và tin sắp rơi khỏi
+  đoạn nạp từ Redis ở lượt sau (history_fetch) được gộp ngay lượt này -> không tin nào bị mất hay lặp 2 lần.
+- Bản tóm tắt bị chặn ở "summary_max_tokens" -> input mỗi lượt luôn bị chặn trên,
+  dù hội thoại kéo dài bao lâu.
+
+Số thứ tự tin nhắn (seq): session field "msg_seq" = tổng số tin đã ghi vào history
+(Lua commit tự tăng). Tin thứ i trong đoạn history vừa nạp có seq = msg_seq - len + i.
+"summary_seq" = các tin có seq < giá trị này đã nằm trong bản tóm tắt.
+
+Cấu hình theo Page (tùy chọn):
+    "context": {
+        "max_tokens": 1200,          # ngân sách cho lịch sử gần đây
+        "summary_max_tokens": 300,   # trần của bản tóm tắt
+        "history_fetch": 30,         # số tin nạp từ Redis mỗi lượt
+        "summary_mode": "extractive" # hoặc "llm" (gọi Gemini để gộp tóm tắt)
+    }
+"""
+import os
+
+from app.session_store import HISTORY_MAX
+
+DEFAULT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "1200"))
+DEFAULT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "300"))
+DEFAULT_HISTORY_FETCH = 30
+# Số tin tối đa được ghi thêm trước lượt kế tiếp (khách + Bot, tin nhắc khách của app/timers.py)
+FOLD_AHEAD_MESSAGES = 4
+
+# Trong bản tóm tắt trích xuất, mỗi lượt chỉ giữ tối đa ngần này ký tự
+USER_LINE_CHARS = 160
+BOT_LINE_CHARS = 80
+
+ROLE_LABELS = {"user": "Khách", "model": "Bạn", "assistant": "Bạn"}
+
+
+def estimate_tokens(text):
+    """Ước lượng nhanh: tiếng Việt có dấu ~ 3 ký tự / token"""
+    return len(text or "") // 3 + 1
+
+
+def context_settings(config):
+    settings = (config or {}).get("context", {})
+    return {
+        "max_tokens": settings.get("max_tokens", DEFAULT_MAX_TOKENS),
+        "summary_max_tokens": settings.get("summary_max_tokens", DEFAULT_SUMMARY_MAX_TOKENS),
+        "history_fetch": settings.get("history_fetch", DEFAULT_HISTORY_FETCH),
+        "summary_mode": settings.get("summary_mode", "extractive"),
+    }
+
+
+def format_turn(turn):
+    return f"{ROLE_LABELS.get(turn.get('role'), 'Khách')}: {turn.get('content', '')}"
+
+
+def _first_sentence(text, limit):
+    text = " ".join((text or "").split())
+    for mark in (". ", "? ", "! "):
+        pos = text.find(mark)
+        if 0 < pos < limit:
+            return text[:pos + 1]
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+
+def fold_extractive(summary, turn, max_tokens):
+    """
+    Gộp 1 lượt vào bản tóm tắt bằng cách trích câu chính.
+    Vượt trần -> bỏ dòng cũ nhất của Bot trước, rồi mới tới dòng của Khách
+    (thông tin khách cung cấp quý hơn lời Bot đã nói).
+    """
+    lines = [line for line in (summary or "").split("\n") if line]
+    is_user = turn.get("role") == "user"
+    limit = USER_LINE_CHARS if is_user else BOT_LINE_CHARS
+    lines.append(f"{ROLE_LABELS.get(turn.get('role'), 'Khách')}: {_first_sentence(turn.get('content', ''), limit)}")
+
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        bot_index = next((i for i, line in enumerate(lines[:-1]) if not line.startswith("Khách:")), None)
+        lines.pop(bot_index if bot_index is not None else 0)
+    return "\n".join(lines)
+
+
+class ContextBuilder:
+    def __init__(self, llm_summarizer=None):
+        # llm_summarizer(summary, turn, max_tokens) -> str | None  (dùng khi summary_mode="llm")
+        self.llm_summarizer = llm_summarizer
+
+    def fold(self, summary, turn, settings):
+        if settings["summary_mode"] == "llm" and self.llm_summarizer:
+            folded = self.llm_summarizer(summary, turn, settings["summary_max_tokens"])
+            if folded:
+                return folded
+        return fold_extractive(summary, turn, settings["summary_max_tokens"])
+
+    def build(self, history, session, config, new_turns):
+        """
+        history  : các tin đã lưu vừa nạp từ Redis (cũ -> mới)
+        session  : dict session (msg_seq, summary, summary_seq)
+        new_turns: tin mới của lượt này (chưa lưu), luôn được gửi đủ
+
+        Trả về {"turns", "summary", "summary_seq", "folded"}
+        """
+        settings = context_settings(config)
+        try:
+            msg_seq = int(session.get("msg_seq") or len(history))
+        except (TypeError, ValueError):
+            msg_seq = len(history)
+        first_seq = msg_seq - len(history)
+
+        summary = session.get("summary", "") or ""
+        try:
+            summary_seq = int(session.get("summary_seq") or 0)
+        except (TypeError, ValueError):
+            summary_seq = 0
+        # Tin cũ hơn đoạn vừa nạp mà chưa tóm tắt thì đã mất -> bắt đầu từ đoạn đang có
+        summary_seq = max(summary_seq, first_seq)
+
+        # Cửa sổ bắt đầu từ tin chưa tóm tắt, và chừa ra các tin sẽ rơi khỏi đoạn nạp ở lượt sau
+        # (Redis chỉ trả history_fetch tin mới nhất) để chúng được gộp ngay bây giờ
+        fetch = min(settings["history_fetch"], HISTORY_MAX)
+        min_start = max(0, summary_seq - first_seq, len(history) + FOLD_AHEAD_MESSAGES - fetch)
+
+        # 1. Xếp tin gần nhất vào ngân sách (tin mới của lượt luôn được giữ)
+        budget = settings["max_tokens"] - sum(estimate_tokens(format_turn(t)) for t in new_turns)
+        window_start = len(history)
+        for i in range(len(history) - 1, min_start - 1, -1):
+            cost = estimate_tokens(format_turn(history[i]))
+            if cost > budget:
+                break
+            budget -= cost
+            window_start = i
+
+        # 2. Gộp từng tin vừa rơi khỏi cửa sổ (chưa tóm tắt) vào bản tóm tắt
+        folded = 0
+        for i in range(len(history)):
+            seq = first_seq + i
+            if i >= window_start:
+                break
+            if seq < summary_seq:
+                continue
+            summary = self.fold(summary, history[i], settings)
+            summary_seq = seq + 1
+            folded += 1
+
+        return {
+            "turns": history[window_start:] + list(new_turns),
+            "summary": summary,
+            "summary_seq": summary_seq,
+            "folded": folded,
+        }
@@ -2,27 +2,80 @@
 import requests
 import json
 import os
+import time
 import redis
+from app import metrics
+from app.lead_index import LeadIndex
+from app.logs import HOT_SAMPLE, get_logger
 
 # Cấu hình Charm.Contact (Sau này thay bằng URL thật)
 CHARM_API_URL = os.getenv("CHARM_API_URL", "http://127.0.0.1:8000/mock-crm/leads")
+CHARM_BULK_URL = os.getenv("CHARM_BULK_URL", CHARM_API_URL.rstrip("/") + "/batch")
 CHARM_API_KEY = os.getenv("CHARM_API_KEY", "mock-key")
 
+# Hàng đợi do app/crm_dispatcher.py tiêu thụ
+CRM_LEADS_QUEUE = "crm_leads_queue"          # list: lead mới chờ gửi
+CRM_RETRY_SCHEDULE = "crm_retry_schedule"    # zset: lead lỗi, score = thời điểm thử lại
+CRM_RETRY_QUEUE = "crm_retry_queue"          # list cũ, dispatcher chuyển dần sang lịch retry
+CRM_DEAD_LETTER = "crm_dead_letter"          # list: quá số lần thử
+CRM_STATS_KEY = "crm:stats"
+
+log = get_logger("crm")
+
 class CRMConnector:
-    def __init__(self):
-        # Kết nối Redis để làm hàng đợi Retry
-        redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-        self.redis = redis.from_url(redis_url)
+    def __init__(self, redis_client=None):
+        # Kết nối Redis để làm hàng đợi gửi Lead / Retry
+        if redis_client is None:
+            redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+            redis_client = redis.from_url(redis_url)
+        self.redis = redis_client
+        self.lead_index = LeadIndex(redis_client)
+
+    def enqueue_lead(self, lead_data: dict):
+        """
+        Đường chat chỉ tốn 2 round trip (tra chỉ mục + Lua): LeadIndex quyết định (tạo / cập nhật field đổi /
+        hoãn / bỏ qua) và xếp vào hàng đợi ngay trong Lua. CRMDispatcher gom batch và gửi sau.
+        """
+        decision, lead_id = self.lead_index.upsert(lead_data, CRM_LEADS_QUEUE, CRM_RETRY_SCHEDULE, CRM_STATS_KEY)
+        metrics.inc("chatbot_crm_leads_total", page_id=metrics.current_page_id(), result=decision)
+        log.info("lead_enqueued", sample=1.0 if decision == "create" else HOT_SAMPLE,
+                 lead_id=lead_id, decision=decision)
+        return decision
+
+    def stats(self):
+        """Độ sâu các hàng đợi + thống kê giao lead (dispatcher ghi vào crm:stats)"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen(CRM_LEADS_QUEUE)
+        pipe.zcard(CRM_RETRY_SCHEDULE)
+        pipe.llen(CRM_RETRY_QUEUE)
+        pipe.llen(CRM_DEAD_LETTER)
+        pipe.lindex(CRM_LEADS_QUEUE, 0)
+        pipe.hgetall(CRM_STATS_KEY)
+        pending, retrying, legacy, dead, oldest, raw_stats = pipe.execute()
+        oldest_age = 0.0
+        if oldest:
+            try:
+                oldest_age = round(time.time() - json.loads(oldest)["enqueued_at"], 3)
+            except (ValueError, KeyError):
+                pass
+        return {
+            "pending": pending,
+            "retrying": retrying + legacy,
+            "dead": dead,
+            "oldest_pending_seconds": oldest_age,
+            **{k.decode(): v.decode() for k, v in raw_stats.items()},
+        }
 
     def push_lead(self, lead_data: dict):
         """
+        Gửi ĐỒNG BỘ 1 lead (script lẻ / debug). Worker dùng enqueue_lead().
         Quy trình chuẩn:
         1. Check xem khách có chưa (Deduplication).
         2. Nếu chưa -> Tạo mới (Create).
         3. Nếu có rồi -> Cập nhật (Update).
         4. Nếu lỗi -> Đẩy vào Queue Retry.
         """
-        print(f" Đang bắn Lead sang CRM: {lead_data['phone']}...")
+        log.info("crm_push_sync", facebook_uid=lead_data.get("facebook_uid"))
 
         try:
             # --- BƯỚC 1: CHECK TRÙNG & GỬI (LOGIC GỘP) ---
@@ -43,26 +96,27 @@ class CRMConnector:
             
             # --- BƯỚC 2: XỬ LÝ KẾT QUẢ ---
             if response.status_code in [200, 201]:
-                print(f"✅ CRM Success: Deal ID {response.json().get('deal_id', 'Unknown')}")
+                log.info("crm_push_ok", deal_id=response.json().get("deal_id", "Unknown"))
                 return True
                 
             else:
-                print(f" CRM Trả lỗi {response.status_code}: {response.text}")
+                log.warning("crm_push_rejected", status=response.status_code, body=response.text[:200])
                 # Logic Retry nằm ở dưới
                 raise Exception(f"CRM Error {response.status_code}")
 
         except Exception as e:
             # --- BƯỚC 3: CƠ CHẾ RETRY (CỨU HỘ DỮ LIỆU) ---
-            print(f" LỖI KẾT NỐI CRM: {e}")
-            print(" Đang đẩy vào hàng đợi Retry (crm_retry_queue)...")
+            metrics.inc("chatbot_errors_total", component="crm", page_id="")
+            log.warning("crm_push_failed", error=str(e), retry=CRM_RETRY_SCHEDULE)
             
             # Lưu dữ liệu vào Redis để Worker khác xử lý lại sau
             self.retry_push(lead_data)
             return False
 
     def retry_push(self, lead_data):
-        """Đẩy lead bị lỗi vào Redis để thử lại sau"""
+        """Đẩy lead bị lỗi vào lịch retry (dispatcher thử lại ngay ở lượt flush kế tiếp)"""
         try:
-            self.redis.rpush("crm_retry_queue", json.dumps(lead_data))
+            envelope = {"lead": lead_data, "attempts": 1, "enqueued_at": time.time()}
+            self.redis.zadd(CRM_RETRY_SCHEDULE, {json.dumps(envelope, ensure_ascii=False): time.time()})
         except Exception as e:
-            print(f" LỖI NGHIÊM TRỌNG: Không thể lưu Retry! {e}")
\ No newline at end of file
+            log.error("crm_retry_save_failed", error=str(e))
\ No newline at end of file
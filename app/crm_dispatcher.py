@@ -0,0 +1,293 @@
+# app/crm_dispatcher.py
+"""
+Dispatcher đẩy Lead sang CRM, tách khỏi luồng chat.
+
+Worker chỉ gọi CRMConnector.enqueue_lead() (1 lệnh RPUSH). Dispatcher:
+- Chờ lead bằng BLPOP (không quét), có lead thì gom thêm trong CRM_FLUSH_INTERVAL_MS (hoặc tới khi
+  đủ CRM_BATCH_SIZE lead) từ "crm_leads_queue" + lead tới hạn retry, gửi 1 request tới endpoint bulk
+  (CHARM_BULK_URL).
+- Lead lỗi (cả batch lỗi, hoặc CRM báo lỗi riêng từng lead) -> zset "crm_retry_schedule"
+  với score = thời điểm thử lại (backoff lũy thừa + jitter).
+- Quá CRM_MAX_ATTEMPTS lần -> "crm_dead_letter".
+- Lead cũ còn nằm trong list "crm_retry_queue" (bản trước chỉ đẩy vào, không ai đọc)
+  được chuyển sang lịch retry khi dispatcher khởi động.
+
+Thống kê (độ sâu hàng đợi, độ trễ giao lead) ghi vào hash "crm:stats", đọc qua
+CRMConnector.stats() hoặc GET /crm/stats trên webhook server.
+
+Chạy riêng:  python -m app.crm_dispatcher
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+
+from app import metrics
+from app.crm_connector import (
+    CHARM_API_KEY, CHARM_BULK_URL, CRM_LEADS_QUEUE, CRM_RETRY_QUEUE,
+    CRM_RETRY_SCHEDULE, CRM_DEAD_LETTER, CRM_STATS_KEY,
+)
+from app.lead_index import DEFERRED_PREFIX, SETTLE_DEFERRED_LUA, lead_key
+from app.logs import get_logger
+
+CRM_BATCH_SIZE = int(os.getenv("CRM_BATCH_SIZE", "50"))
+CRM_FLUSH_INTERVAL_MS = int(os.getenv("CRM_FLUSH_INTERVAL_MS", "500"))
+CRM_MAX_ATTEMPTS = int(os.getenv("CRM_MAX_ATTEMPTS", "8"))
+CRM_TIMEOUT_SECONDS = float(os.getenv("CRM_TIMEOUT_SECONDS", "10"))
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 3600
+LATENCY_WINDOW = 500     # Số mẫu độ trễ gần nhất dùng tính p50/p95
+
+log = get_logger("crm_dispatcher")
+
+# Lấy tối đa ARGV[2] lead tới hạn (score <= ARGV[1]) và xóa khỏi zset trong cùng 1 lệnh
+# -> nhiều dispatcher chạy song song cũng không lấy trùng.
+POP_DUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due > 0 then redis.call('ZREM', KEYS[1], unpack(due)) end
+return due
+"""
+
+
+def retry_delay(attempts):
+    """Backoff lũy thừa có jitter: ~5s, 10s, 20s... tối đa 1 giờ"""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+class CRMDispatcher:
+    def __init__(self, redis_url=None, bulk_url=CHARM_BULK_URL, batch_size=CRM_BATCH_SIZE,
+                 flush_interval_ms=CRM_FLUSH_INTERVAL_MS, max_attempts=CRM_MAX_ATTEMPTS):
+        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        self.bulk_url = bulk_url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_attempts = max_attempts
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._running = False
+
+    # ------------------------------------------------
+    # Lấy lead
+    # ------------------------------------------------
+    async def _migrate_legacy_retries(self):
+        """crm_retry_queue (list lead thô) -> lịch retry, thử lại ngay"""
+        moved = 0
+        while True:
+            raw = await self.redis.lpop(CRM_RETRY_QUEUE)
+            if raw is None:
+                break
+            try:
+                lead = json.loads(raw)
+            except ValueError:
+                continue
+            envelope = {"lead": lead, "attempts": 1, "enqueued_at": time.time()}
+            await self.redis.zadd(CRM_RETRY_SCHEDULE, {json.dumps(envelope, ensure_ascii=False): time.time()})
+            moved += 1
+        if moved:
+            log.info("crm_legacy_retries_migrated", moved=moved, source=CRM_RETRY_QUEUE)
+
+    async def _next_batch(self):
+        batch = []
+        due = await self._pop_due(keys=[CRM_RETRY_SCHEDULE], args=[time.time(), self.batch_size])
+        batch.extend(due)
+
+        if not batch:
+            # Hàng đợi rỗng: chặn trên Redis chờ lead đầu tiên (không quét LPOP liên tục);
+            # hết 1 giây thì quay lại xem lịch retry
+            packed = await self.redis.blpop(CRM_LEADS_QUEUE, timeout=1)
+            if not packed:
+                return []
+            batch.append(packed[1])
+
+        # Đã có lead: gom thêm trong CRM_FLUSH_INTERVAL_MS bằng LPOP count, hết hàng thì BLPOP phần thời gian còn lại
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and self._running:
+            raws = await self.redis.lpop(CRM_LEADS_QUEUE, self.batch_size - len(batch))
+            if raws:
+                batch.extend(raws)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.01:
+                break
+            packed = await self.redis.blpop(CRM_LEADS_QUEUE, timeout=remaining)
+            if not packed:
+                break
+            batch.append(packed[1])
+
+        # Bản hoãn của LeadIndex: member "deferred:<lead_id>", nội dung nằm ở field "deferred" của "lead:<lead_id>"
+        prefix = DEFERRED_PREFIX.encode()
+        deferred_ids = [raw[len(prefix):].decode() for raw in batch if raw.startswith(prefix)]
+        pending = {}
+        if deferred_ids:
+            pipe = self.redis.pipeline(transaction=False)
+            for lead_id in deferred_ids:
+                pipe.hget(lead_key(lead_id), "deferred")
+            pending = dict(zip(deferred_ids, await pipe.execute()))
+
+        envelopes = []
+        for raw in batch:
+            lead_id = raw[len(prefix):].decode() if raw.startswith(prefix) else None
+            if lead_id is not None:
+                raw = pending[lead_id]
+                if raw is None:
+                    # Lượt chat sau đó đã gửi thẳng phần hoãn
+                    continue
+            try:
+                envelope = json.loads(raw)
+            except ValueError:
+                metrics.inc("chatbot_errors_total", component="crm", page_id="")
+                log.warning("crm_lead_invalid_json", raw=raw[:80])
+                continue
+            if lead_id is not None:
+                # Giữ nguyên chuỗi đã đọc để SETTLE_DEFERRED_LUA biết bản hoãn có bị thay trong lúc gửi không
+                envelope["_deferred"] = {"lead_id": lead_id, "raw": raw.decode()}
+            envelopes.append(envelope)
+        return envelopes
+
+    # ------------------------------------------------
+    # Gửi & xử lý kết quả
+    # ------------------------------------------------
+    async def _send(self, envelopes):
+        """Trả về list (envelope, ok, lỗi) theo đúng thứ tự gửi"""
+        headers = {"Authorization": f"Bearer {CHARM_API_KEY}"}
+        try:
+            response = await self.client.post(self.bulk_url, headers=headers,
+                                              json={"leads": [e["lead"] for e in envelopes]})
+        except httpx.HTTPError as e:
+            return [(env, False, f"{type(e).__name__}: {e}") for env in envelopes]
+
+        if response.status_code not in (200, 201, 207):
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+            return [(env, False, error) for env in envelopes]
+
+        try:
+            results = response.json().get("results", [])
+        except ValueError:
+            results = []
+        outcome = []
+        for i, env in enumerate(envelopes):
+            result = results[i] if i < len(results) else {}
+            ok = result.get("status") == "success"
+            outcome.append((env, ok, result.get("error") or ("" if ok else "CRM không trả kết quả")))
+        return outcome
+
+    async def _settle(self, outcome):
+        now = time.time()
+        delivered = failed = dead = 0
+        pipe = self.redis.pipeline(transaction=False)
+        for env, ok, error in outcome:
+            deferred = env.pop("_deferred", None)
+            if ok:
+                delivered += 1
+                self.latencies.append(now - env.get("enqueued_at", now))
+                metrics.observe("chatbot_stage_seconds", now - env.get("enqueued_at", now),
+                                page_id="", stage="crm_delivery")
+                if deferred:
+                    await self._settle_deferred(keys=[lead_key(deferred["lead_id"]), CRM_RETRY_SCHEDULE],
+                                                args=[deferred["raw"], "1", now, "", 0, ""], client=pipe)
+                continue
+            env["attempts"] = env.get("attempts", 0) + 1
+            env["last_error"] = error
+            retry_at = now + retry_delay(env["attempts"])
+            if env["attempts"] >= self.max_attempts:
+                dead += 1
+                pipe.rpush(CRM_DEAD_LETTER, json.dumps(env, ensure_ascii=False))
+                retry = ""
+            else:
+                failed += 1
+                retry = json.dumps(env, ensure_ascii=False)
+                if not deferred:
+                    pipe.zadd(CRM_RETRY_SCHEDULE, {retry: retry_at})
+            if deferred:
+                # Hẹn lại đúng member "deferred:<lead_id>" -> lượt chat sau vẫn gộp / thay được
+                await self._settle_deferred(keys=[lead_key(deferred["lead_id"]), CRM_RETRY_SCHEDULE],
+                                            args=[deferred["raw"], "0", now, retry, retry_at,
+                                                  DEFERRED_PREFIX + deferred["lead_id"]], client=pipe)
+
+        pipe.hincrby(CRM_STATS_KEY, "delivered", delivered)
+        pipe.hincrby(CRM_STATS_KEY, "retried", failed)
+        pipe.hincrby(CRM_STATS_KEY, "dead_lettered", dead)
+        pipe.hset(CRM_STATS_KEY, mapping={
+            "latency_p50_ms": int(_percentile(self.latencies, 0.5) * 1000),
+            "latency_p95_ms": int(_percentile(self.latencies, 0.95) * 1000),
+            "last_flush_at": now,
+        })
+        await pipe.execute()
+
+        for result, count in (("delivered", delivered), ("retry", failed), ("dead_letter", dead)):
+            if count:
+                metrics.inc("chatbot_crm_leads_total", count, page_id="", result=result)
+        if delivered:
+            log.info("crm_delivered", leads=delivered, p95_ms=int(_percentile(self.latencies, 0.95) * 1000))
+        if failed or dead:
+            log.warning("crm_delivery_failed", retry=failed, dead_letter=dead)
+
+    async def flush_once(self):
+        envelopes = await self._next_batch()
+        if envelopes:
+            with metrics.span("crm_push"):
+                outcome = await self._send(envelopes)
+            await self._settle(outcome)
+        return len(envelopes)
+
+    # ------------------------------------------------
+    # Vòng lặp
+    # ------------------------------------------------
+    async def run(self):
+        import redis.asyncio as aioredis
+
+        self.redis = aioredis.from_url(self.redis_url)
+        self._pop_due = self.redis.register_script(POP_DUE_LUA)
+        self._settle_deferred = self.redis.register_script(SETTLE_DEFERRED_LUA)
+        self.client = httpx.AsyncClient(timeout=CRM_TIMEOUT_SECONDS)
+        self._running = True
+        log.info("crm_dispatcher_started", batch=self.batch_size,
+                 flush_ms=int(self.flush_interval * 1000), url=self.bulk_url)
+
+        await self._migrate_legacy_retries()
+        while self._running:
+            try:
+                await self.flush_once()
+            except Exception as e:
+                metrics.inc("chatbot_errors_total", component="crm_dispatcher", page_id="")
+                log.error("crm_dispatcher_loop_failed", error=str(e))
+                await asyncio.sleep(1)
+
+        await self.client.aclose()
+        await self.redis.aclose()
+
+    def stop(self):
+        self._running = False
+
+
+def start_dispatcher_thread(redis_url=None):
+    """Chạy dispatcher trong thread nền (event loop riêng) bên trong process worker"""
+    dispatcher = CRMDispatcher(redis_url)
+    dispatcher.thread = threading.Thread(target=lambda: asyncio.run(dispatcher.run()), name="crm", daemon=True)
+    dispatcher.thread.start()
+    return dispatcher
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    import redis
+
+    metrics.start_flusher(redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+    try:
+        asyncio.run(CRMDispatcher().run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,200 @@
+# app/dedup.py
+"""
+Chống xử lý lại webhook Facebook gửi lặp (FB gửi lại khi ack chậm / timeout): sự kiện đã nhận
+bị bỏ ngay tại webhook, trước khi vào hàng đợi -> không gọi LLM, không trả lời / đẩy lead 2 lần.
+
+- Khóa chống trùng của 1 sự kiện (event_id): message.mid (cả tin echo của Admin), postback.mid,
+  delivery / read theo watermark. Sự kiện không có khóa thì luôn cho qua.
+- 2 lớp, kiểm tra + đánh dấu trong 1 lệnh Lua cho cả cục webhook (1 round-trip):
+  1. Gần đây (chính xác): SET NX "fb_dedup:<event_id>" TTL DEDUP_RECENT_SECONDS. Phần lớn lần gửi lại
+     tới trong vài giây - vài phút nên rơi vào lớp này.
+  2. Dài hạn (xác suất): Bloom filter trên bitmap Redis, xoay vòng theo cửa sổ DEDUP_BLOOM_WINDOW_SECONDS
+     (giữ 2 thế hệ: hiện tại + trước đó) -> nhớ sự kiện ít nhất 1 cửa sổ với bộ nhớ cố định
+     (~DEDUP_BLOOM_CAPACITY sự kiện / cửa sổ, sai số DEDUP_BLOOM_ERROR_RATE), dù có hàng triệu tin mỗi ngày.
+     Bloom không có âm tính giả; dương tính giả (bỏ nhầm 1 tin mới) có xác suất <= DEDUP_BLOOM_ERROR_RATE
+     khi filter đầy. DEDUP_BLOOM_CAPACITY=0 -> chỉ dùng lớp 1.
+- Webhook đẩy vào hàng đợi lỗi -> release_async đánh dấu "chưa nhận" để lần FB gửi lại vẫn được xử lý
+  (key chuyển sang "0": lần sau được coi là mới và không tra Bloom). Key "0" sống bằng đời Bloom
+  (2 cửa sổ) vì bit Bloom của sự kiện đã được bật: lần gửi lại tới sau DEDUP_RECENT_SECONDS vẫn không bị bỏ.
+- Số sự kiện bị bỏ: counter chatbot_webhook_duplicates_total{layer="recent"|"bloom"} (GET /metrics).
+"""
+import hashlib
+import json
+import math
+import os
+import time
+
+from app import metrics
+from app.logs import get_logger
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_PREFIX = "fb_dedup:"
+DEDUP_BLOOM_PREFIX = "fb_dedup_bloom:"
+DEDUP_RECENT_SECONDS = int(os.getenv("DEDUP_RECENT_SECONDS", "900"))
+DEDUP_BLOOM_WINDOW_SECONDS = int(os.getenv("DEDUP_BLOOM_WINDOW_SECONDS", "86400"))
+DEDUP_BLOOM_CAPACITY = int(os.getenv("DEDUP_BLOOM_CAPACITY", "2000000"))
+DEDUP_BLOOM_ERROR_RATE = float(os.getenv("DEDUP_BLOOM_ERROR_RATE", "0.000001"))
+
+NEW, RECENT, BLOOM = 0, 1, 2
+LAYERS = {RECENT: "recent", BLOOM: "bloom"}
+
+# KEYS: bloom thế hệ hiện tại, bloom thế hệ trước
+# ARGV: prefix key gần đây, TTL gần đây, TTL bloom, số hàm băm k, rồi từng sự kiện: event_id, k vị trí bit
+# Trả về trạng thái từng sự kiện: 0 = mới, 1 = trùng (gần đây), 2 = trùng (bloom)
+CHECK_LUA = """
+local k = tonumber(ARGV[4])
+local out = {}
+local added = false
+local i = 5
+while i <= #ARGV do
+    local key = ARGV[1] .. ARGV[i]
+    local status = 0
+    if redis.call('SET', key, '1', 'NX', 'EX', ARGV[2]) then
+        if k > 0 then
+            local in_current, in_previous = true, true
+            for j = 1, k do
+                if in_current and redis.call('GETBIT', KEYS[1], ARGV[i + j]) == 0 then in_current = false end
+                if in_previous and redis.call('GETBIT', KEYS[2], ARGV[i + j]) == 0 then in_previous = false end
+                if not in_current and not in_previous then break end
+            end
+            if in_current or in_previous then status = 2 end
+            if not in_current then
+                for j = 1, k do redis.call('SETBIT', KEYS[1], ARGV[i + j], 1) end
+                added = true
+            end
+        end
+    elseif redis.call('GET', key) == '0' then
+        -- Lần trước đẩy vào hàng đợi lỗi (release) -> xử lý như sự kiện mới
+        redis.call('SET', key, '1', 'EX', ARGV[2])
+    else
+        status = 1
+    end
+    out[#out + 1] = status
+    i = i + 1 + k
+end
+if added then redis.call('EXPIRE', KEYS[1], ARGV[3]) end
+return out
+"""
+
+log = get_logger("dedup")
+
+
+def bloom_parameters(capacity=DEDUP_BLOOM_CAPACITY, error_rate=DEDUP_BLOOM_ERROR_RATE):
+    """(số bit m, số hàm băm k) tối ưu cho capacity phần tử với tỉ lệ dương tính giả error_rate"""
+    if capacity <= 0:
+        return 0, 0
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+
+BLOOM_BITS, BLOOM_HASHES = bloom_parameters()
+
+
+def bloom_positions(event_id, bits=BLOOM_BITS, hashes=BLOOM_HASHES):
+    """k vị trí bit của event_id (double hashing trên 1 lần blake2b)"""
+    digest = hashlib.blake2b(event_id.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:], "big") | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def event_id(page_id, messaging):
+    """Khóa chống trùng của 1 sự kiện webhook (None nếu không xác định được)"""
+    for kind in ("message", "postback"):
+        mid = (messaging.get(kind) or {}).get("mid")
+        if mid:
+            return f"{kind[0]}:{mid}"
+    sender_id = (messaging.get("sender") or {}).get("id")
+    for kind in ("delivery", "read"):
+        watermark = (messaging.get(kind) or {}).get("watermark")
+        if watermark:
+            return f"{kind[0]}:{page_id}:{sender_id}:{watermark}"
+    return None
+
+
+def webhook_event_ids(raw):
+    """event_id của mọi sự kiện trong 1 cục webhook ([] nếu body lỗi)"""
+    try:
+        body = json.loads(raw)
+    except (TypeError, ValueError):
+        return []
+    ids = []
+    for entry in body.get("entry", []):
+        page_id = str(entry.get("id"))
+        for messaging in entry.get("messaging", []):
+            eid = event_id(page_id, messaging)
+            if eid:
+                ids.append(eid)
+    return ids
+
+
+def bloom_keys(now=None):
+    generation = int((now or time.time()) // DEDUP_BLOOM_WINDOW_SECONDS)
+    return [f"{DEDUP_BLOOM_PREFIX}{generation}", f"{DEDUP_BLOOM_PREFIX}{generation - 1}"]
+
+
+_async_check = {}   # id(client redis.asyncio) -> script đã đăng ký
+
+
+async def filter_webhook_async(async_redis, raw):
+    """
+    Bỏ các sự kiện đã nhận khỏi 1 cục webhook.
+    Trả về (raw còn lại hoặc None nếu mọi sự kiện đều trùng, [event_id mới]).
+    Không sự kiện nào trùng -> trả lại nguyên bytes gốc.
+    """
+    body = json.loads(raw)
+    events = []   # (entry, messaging, page_id, event_id)
+    for entry in body.get("entry", []):
+        page_id = str(entry.get("id"))
+        for messaging in entry.get("messaging", []):
+            events.append((entry, messaging, page_id, event_id(page_id, messaging)))
+    keyed = [event for event in events if event[3]]
+    if not keyed:
+        return raw, []
+
+    script = _async_check.get(id(async_redis))
+    if script is None:
+        script = _async_check[id(async_redis)] = async_redis.register_script(CHECK_LUA)
+    args = [DEDUP_PREFIX, DEDUP_RECENT_SECONDS, DEDUP_BLOOM_WINDOW_SECONDS * 2, BLOOM_HASHES]
+    for _, _, _, eid in keyed:
+        args.append(eid)
+        if BLOOM_HASHES:
+            args.extend(bloom_positions(eid))
+    try:
+        statuses = await script(keys=bloom_keys(), args=args)
+    except Exception as e:
+        # Không kiểm tra được thì cho qua (thà trả lời 2 lần còn hơn mất tin)
+        metrics.inc("chatbot_errors_total", component="dedup", page_id="")
+        log.warning("dedup_check_failed", error=str(e))
+        return raw, []
+
+    duplicates = set()
+    fresh = []
+    for (_, messaging, page_id, eid), status in zip(keyed, statuses):
+        if status == NEW:
+            fresh.append(eid)
+            continue
+        duplicates.add(id(messaging))
+        metrics.inc("chatbot_webhook_duplicates_total", layer=LAYERS[status], page_id=page_id)
+    if not duplicates:
+        return raw, fresh
+    log.info("webhook_duplicates_dropped", events=len(duplicates))
+    if len(duplicates) == len(events):
+        return None, fresh
+
+    entries = []
+    for entry in body.get("entry", []):
+        kept = [m for m in entry.get("messaging", []) if id(m) not in duplicates]
+        if kept:
+            entries.append({**entry, "messaging": kept})
+    return json.dumps({**body, "entry": entries}, ensure_ascii=False).encode(), fresh
+
+
+async def release_async(async_redis, event_ids):
+    """Đánh dấu lại là chưa nhận (webhook không đẩy được vào hàng đợi -> chờ FB gửi lại)"""
+    if not event_ids:
+        return
+    pipe = async_redis.pipeline(transaction=False)
+    for eid in event_ids:
+        pipe.set(DEDUP_PREFIX + eid, "0", ex=max(DEDUP_RECENT_SECONDS, DEDUP_BLOOM_WINDOW_SECONDS * 2), xx=True)
+    await pipe.execute()
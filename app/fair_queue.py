@@ -0,0 +1,540 @@
+# app/fair_queue.py
+"""
+Hàng đợi công bằng theo Page (QUEUE_BACKEND=fair): 1 Page nổ traffic (bài viral) không làm
+khách của Page khác chờ sau cả backlog của nó như với 1 list "chat_queue" chung.
+
+- Webhook tách cục webhook theo entry (Page) -> mỗi Page 1 list riêng "chat_fair:q:<page_id>".
+- Scheduler (Lua, nguyên tử, dùng chung cho mọi worker process) chọn Page theo
+  start-time fair queueing: zset "chat_fair:active" giữ "thời gian ảo" của các Page đang có tin,
+  lấy Page có thời gian ảo nhỏ nhất rồi cộng 1/weight -> Page weight 2 được phục vụ gấp đôi
+  Page weight 1 khi cùng đang tồn đọng. Page vừa có tin trở lại bắt đầu từ thời gian ảo hiện tại
+  (không tích "tín dụng" lúc rảnh).
+- Giới hạn đồng thời theo Page (toàn hệ thống): mỗi tin lấy ra giữ 1 "lease" tới khi ack/release;
+  Page đã đủ max_concurrency thì bị bỏ qua. Worker chết -> lease hết hạn sau FAIR_LEASE_SECONDS.
+- Làn ưu tiên "chat_fair:priority": tin có SĐT / Email và tin Admin (echo -> bật HUMAN mode)
+  được lấy trước mọi Page, không tính giới hạn đồng thời, nhưng vẫn bị tính vào thời gian ảo của Page.
+  Tin ưu tiên KHÔNG vượt lên trước tin thường cùng khách: khách còn tin chờ trong list của Page
+  (đếm trong hash "chat_fair:queued", kể cả tin trước đó trong cùng cục webhook) thì tin ưu tiên
+  của khách đó vào list của Page, sau các tin kia.
+- Worker rảnh chờ bằng BLPOP trên "chat_fair:wake" (webhook / ack đẩy tín hiệu) thay vì poll.
+
+- Tin đã lấy ra được giữ kèm lease (hash "chat_fair:bodies") tới khi ack: release (xử lý lỗi) hoặc lease
+  hết hạn (worker chết) -> tin quay về đầu list của Page để giao lại; giao quá FAIR_MAX_DELIVERIES lần
+  hoặc fail() -> dead-letter "chat_fair:dead". Worker đang giữ tin thì lease được gia hạn định kỳ.
+
+Config Page ghi đè mặc định:
+    "scheduling": {"weight": 1, "max_concurrency": 0, "priority": true}     (0 = không giới hạn)
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+import redis
+
+from app.config_loader import load_config
+from app.contact_extractor import extract_contacts
+from app.logs import get_logger
+
+FAIR_PREFIX = "chat_fair:q:"
+FAIR_ACTIVE = "chat_fair:active"        # zset page_id -> thời gian ảo
+FAIR_VTIME = "chat_fair:vtime"          # thời gian ảo hiện tại (của tin thường gần nhất được lấy)
+FAIR_CONF = "chat_fair:conf"            # hash page_id -> "weight|max_concurrency"
+FAIR_INFLIGHT = "chat_fair:inflight"    # hash page_id -> số tin đang xử lý
+FAIR_LEASES = "chat_fair:leases"        # zset "<page_id>|<id>" -> hạn lease (ms)
+FAIR_PRIORITY = "chat_fair:priority"    # list "<page_id>\t<khách,...>\t<body>"
+FAIR_BODIES = "chat_fair:bodies"        # hash lease -> "<số lần giao>|<khách,...>\t<body>"
+FAIR_DEAD = "chat_fair:dead"            # list JSON tin bị bỏ (dead-letter)
+FAIR_QUEUED = "chat_fair:queued"        # hash "<page_id>|<khách>" -> số phần đang chờ trong list của Page
+FAIR_WAKE = "chat_fair:wake"
+
+FAIR_DEFAULT_WEIGHT = float(os.getenv("FAIR_DEFAULT_WEIGHT", "1"))
+FAIR_DEFAULT_MAX_CONCURRENCY = int(os.getenv("FAIR_DEFAULT_MAX_CONCURRENCY", "0"))
+FAIR_LEASE_SECONDS = int(os.getenv("FAIR_LEASE_SECONDS", "120"))
+FAIR_MAX_DELIVERIES = int(os.getenv("FAIR_MAX_DELIVERIES", "5"))
+FAIR_DEAD_MAXLEN = int(os.getenv("FAIR_DEAD_MAXLEN", "100000"))
+FAIR_SCAN_PAGES = 32     # Số Page còn slot (thời gian ảo nhỏ nhất) xét mỗi lần chọn
+FAIR_WAKE_MAX = 64       # Số tín hiệu đánh thức tối đa nằm chờ
+
+# KEYS: list của Page, active, vtime, conf, priority, wake, queued
+# ARGV: page_id, body, weight, max_concurrency, ưu tiên (1/0), FAIR_WAKE_MAX, khách trong phần (cách nhau ',')
+# Phần tử list của Page: "[<số lần đã giao>|]<khách,...>\t<body>" để PULL_LUA trừ lại số đếm trong queued
+PUSH_LUA = """
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[3] .. '|' .. ARGV[4])
+local priority = ARGV[5] == '1'
+if priority then
+    -- Khách còn tin thường đang chờ -> xếp sau các tin đó
+    for customer in string.gmatch(ARGV[7], '[^,]+') do
+        if redis.call('HEXISTS', KEYS[7], ARGV[1] .. '|' .. customer) == 1 then
+            priority = false
+            break
+        end
+    end
+end
+if priority then
+    redis.call('RPUSH', KEYS[5], ARGV[1] .. '\\t' .. ARGV[7] .. '\\t' .. ARGV[2])
+else
+    for customer in string.gmatch(ARGV[7], '[^,]+') do
+        redis.call('HINCRBY', KEYS[7], ARGV[1] .. '|' .. customer, 1)
+    end
+    redis.call('RPUSH', KEYS[1], ARGV[7] .. '\\t' .. ARGV[2])
+    if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+        redis.call('ZADD', KEYS[2], redis.call('GET', KEYS[3]) or 0, ARGV[1])
+    end
+end
+if redis.call('LLEN', KEYS[6]) < tonumber(ARGV[6]) then redis.call('RPUSH', KEYS[6], 1) end
+return 1
+"""
+
+# Dùng chung cho PULL_LUA / RELEASE_LUA: trả tin của lease về đầu list của Page để giao lại;
+# đã giao đủ max_deliveries lần -> dead-letter. Trả về 1 = giao lại, 2 = dead-letter, 0 = không còn tin
+REQUEUE_LUA = """
+local function requeue(bodies, queued, active, vtime, dead, token, page, queue, max_deliveries, dead_max, err)
+    local record = redis.call('HGET', bodies, token)
+    if not record then return 0 end
+    redis.call('HDEL', bodies, token)
+    local bar = string.find(record, '|', 1, true)
+    local deliveries = tonumber(string.sub(record, 1, bar - 1))
+    local rest = string.sub(record, bar + 1)
+    local sep = string.find(rest, '\\t', 1, true)
+    if deliveries >= max_deliveries then
+        redis.call('RPUSH', dead, cjson.encode({page_id = page, lease = token, deliveries = deliveries,
+                                                error = err, body = string.sub(rest, sep + 1)}))
+        redis.call('LTRIM', dead, -dead_max, -1)
+        return 2
+    end
+    for customer in string.gmatch(string.sub(rest, 1, sep - 1), '[^,]+') do
+        redis.call('HINCRBY', queued, page .. '|' .. customer, 1)
+    end
+    redis.call('LPUSH', queue, record)
+    if not redis.call('ZSCORE', active, page) then
+        redis.call('ZADD', active, redis.call('GET', vtime) or 0, page)
+    end
+    return 1
+end
+"""
+
+# KEYS: active, vtime, conf, inflight, leases, priority, queued, bodies, dead, list của từng Page
+# ARGV: now (ms), lease (ms), số tin tối đa, id lease, FAIR_MAX_DELIVERIES, FAIR_DEAD_MAXLEN,
+#       page_id (cùng thứ tự với KEYS[10..])
+# Page do Python lấy trước (Page ứng viên còn slot + Page của lease đã hết hạn) để mọi list đụng tới
+# đều nằm trong KEYS; lease hết hạn của Page không được khai báo để lại cho lần kéo sau
+# Trả về {[lease, body, lease, body, ...], số tin bị dead-letter do hết hạn lease}
+PULL_LUA = REQUEUE_LUA + """
+local now, lease_ms, want = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local max_deliveries, dead_max = tonumber(ARGV[5]), tonumber(ARGV[6])
+
+local queues, queue_of = {}, {}
+for i = 7, #ARGV do
+    queues[#queues + 1] = {ARGV[i], KEYS[i + 3]}
+    queue_of[ARGV[i]] = KEYS[i + 3]
+end
+
+local function page_of(token)
+    return string.sub(token, 1, string.find(token, '|', 1, true) - 1)
+end
+
+-- Lease đã hết hạn (worker chết giữa chừng): trả slot, tin về đầu list của Page để giao lại
+local dead = 0
+local expired = redis.call('ZRANGEBYSCORE', KEYS[5], '-inf', now, 'LIMIT', 0, 100)
+for _, token in ipairs(expired) do
+    local page = page_of(token)
+    if queue_of[page] then
+        redis.call('ZREM', KEYS[5], token)
+        redis.call('HINCRBY', KEYS[4], page, -1)
+        if requeue(KEYS[8], KEYS[7], KEYS[1], KEYS[2], KEYS[9], token, page, queue_of[page],
+                   max_deliveries, dead_max, 'lease expired') == 2 then
+            dead = dead + 1
+        end
+    end
+end
+
+local conf_cache = {}
+local function conf(page)
+    if not conf_cache[page] then
+        local raw = redis.call('HGET', KEYS[3], page) or '1|0'
+        local sep = string.find(raw, '|', 1, true)
+        conf_cache[page] = {tonumber(string.sub(raw, 1, sep - 1)) or 1, tonumber(string.sub(raw, sep + 1)) or 0}
+    end
+    return conf_cache[page]
+end
+
+local out, n = {}, 0
+local function take(page, deliveries, customers, body)
+    n = n + 1
+    local token = page .. '|' .. ARGV[4] .. ':' .. n
+    redis.call('ZADD', KEYS[5], now + lease_ms, token)
+    redis.call('HINCRBY', KEYS[4], page, 1)
+    redis.call('HSET', KEYS[8], token, (deliveries + 1) .. '|' .. customers .. '\\t' .. body)
+    table.insert(out, token)
+    table.insert(out, body)
+end
+
+-- Tách tiền tố "[<số lần giao>|]<khách,...>" của phần tử list Page, trừ số đếm tin chờ của từng khách
+-- (phần tử cũ không có tiền tố là body JSON nguyên văn)
+local function unwrap(page, item)
+    if string.sub(item, 1, 1) == '{' then return 0, '', item end
+    local sep = string.find(item, '\\t', 1, true)
+    local prefix, deliveries = string.sub(item, 1, sep - 1), 0
+    local bar = string.find(prefix, '|', 1, true)
+    if bar then
+        deliveries = tonumber(string.sub(prefix, 1, bar - 1)) or 0
+        prefix = string.sub(prefix, bar + 1)
+    end
+    for customer in string.gmatch(prefix, '[^,]+') do
+        local field = page .. '|' .. customer
+        if redis.call('HINCRBY', KEYS[7], field, -1) <= 0 then redis.call('HDEL', KEYS[7], field) end
+    end
+    return deliveries, prefix, string.sub(item, sep + 1)
+end
+
+-- 1. Làn ưu tiên (không tính giới hạn đồng thời, vẫn tính vào thời gian ảo của Page)
+while n < want do
+    local item = redis.call('LPOP', KEYS[6])
+    if not item then break end
+    local sep = string.find(item, '\\t', 1, true)
+    local page, rest, customers = string.sub(item, 1, sep - 1), string.sub(item, sep + 1), ''
+    if string.sub(rest, 1, 1) ~= '{' then
+        -- "<page>\\t<khách,...>\\t<body>" (phần tử cũ: "<page>\\t<body>")
+        sep = string.find(rest, '\\t', 1, true)
+        customers, rest = string.sub(rest, 1, sep - 1), string.sub(rest, sep + 1)
+    end
+    if redis.call('ZSCORE', KEYS[1], page) then
+        redis.call('ZINCRBY', KEYS[1], tostring(1 / conf(page)[1]), page)
+    end
+    take(page, 0, customers, rest)
+end
+
+-- 2. Trong các Page ứng viên: Page có thời gian ảo nhỏ nhất, còn slot
+while n < want do
+    local best, best_vtime
+    for _, candidate in ipairs(queues) do
+        local page = candidate[1]
+        local vtime = not candidate.done and tonumber(redis.call('ZSCORE', KEYS[1], page))
+        if not vtime then
+            candidate.done = true
+        elseif best_vtime == nil or vtime < best_vtime then
+            local cap = conf(page)[2]
+            if cap <= 0 or tonumber(redis.call('HGET', KEYS[4], page) or '0') < cap then
+                best, best_vtime = candidate, vtime
+            end
+        end
+    end
+    if not best then break end
+    local page, queue = best[1], best[2]
+    local item = redis.call('LPOP', queue)
+    if item then
+        redis.call('SET', KEYS[2], tostring(best_vtime))
+        if redis.call('LLEN', queue) > 0 then
+            redis.call('ZADD', KEYS[1], tostring(best_vtime + 1 / conf(page)[1]), page)
+        else
+            redis.call('ZREM', KEYS[1], page)
+            best.done = true
+        end
+        take(page, unwrap(page, item))
+    else
+        redis.call('ZREM', KEYS[1], page)
+        best.done = true
+    end
+end
+return {out, dead}
+"""
+
+# KEYS: leases, inflight, wake, list của Page (lấy từ lease), bodies, active, vtime, queued, dead
+# ARGV: lease, FAIR_WAKE_MAX, "ack" | "requeue" | "dead", FAIR_MAX_DELIVERIES, FAIR_DEAD_MAXLEN, lỗi
+# Trả về 0 = lease không còn (đã hết hạn, tin đã được giao lại), 1 = xong / giao lại, 2 = dead-letter
+RELEASE_LUA = REQUEUE_LUA + """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then return 0 end
+local page = string.sub(ARGV[1], 1, string.find(ARGV[1], '|', 1, true) - 1)
+redis.call('HINCRBY', KEYS[2], page, -1)
+local result = 1
+if ARGV[3] == 'ack' then
+    redis.call('HDEL', KEYS[5], ARGV[1])
+else
+    local max_deliveries = ARGV[3] == 'dead' and 0 or tonumber(ARGV[4])
+    result = requeue(KEYS[5], KEYS[8], KEYS[6], KEYS[7], KEYS[9], ARGV[1], page, KEYS[4],
+                     max_deliveries, tonumber(ARGV[5]), ARGV[6])
+end
+-- Page còn tin (bị chặn vì đủ slot / vừa được trả tin về) -> đánh thức worker đang chờ
+if redis.call('LLEN', KEYS[4]) > 0 and redis.call('LLEN', KEYS[3]) < tonumber(ARGV[2]) then
+    redis.call('RPUSH', KEYS[3], 1)
+end
+return result
+"""
+
+log = get_logger("fair_queue")
+
+
+def scheduling_settings(config):
+    """(weight, max_concurrency, dùng làn ưu tiên) của Page"""
+    scheduling = (config or {}).get("scheduling", {})
+    return (
+        max(0.01, float(scheduling.get("weight", FAIR_DEFAULT_WEIGHT))),
+        int(scheduling.get("max_concurrency", FAIR_DEFAULT_MAX_CONCURRENCY)),
+        scheduling.get("priority", True),
+    )
+
+
+def webhook_time(raw):
+    """Thời điểm (giây) Facebook tạo cục webhook = entry.time sớm nhất; None nếu không rõ"""
+    try:
+        entries = json.loads(raw).get("entry", [])
+    except (TypeError, ValueError, AttributeError):
+        return None
+    times = [entry["time"] for entry in entries if entry.get("time")]
+    return min(times) / 1000 if times else None
+
+
+def customer_of(page_id, messaging):
+    """ID khách của sự kiện (như worker.conversation_key): echo / Page tự gửi -> người nhận"""
+    message = messaging.get("message") or {}
+    sender_id = str(messaging.get("sender", {}).get("id"))
+    if message.get("is_echo") or sender_id == page_id:
+        return str(messaging.get("recipient", {}).get("id"))
+    return sender_id
+
+
+def is_priority_event(page_id, messaging):
+    """Tin Admin (echo / Page tự gửi) hoặc tin khách có SĐT / Email"""
+    message = messaging.get("message") or {}
+    if message.get("is_echo") or str(messaging.get("sender", {}).get("id")) == page_id:
+        return True
+    text = message.get("text")
+    if not text:
+        return False
+    contacts = extract_contacts(text)
+    return bool(contacts["phones"] or contacts["emails"])
+
+
+def split_webhook(body):
+    """
+    Tách 1 cục webhook thành các phần [(page_id, body con, ưu tiên, [khách])] - mỗi phần chỉ thuộc
+    1 Page, 1 làn; phần ưu tiên chỉ gồm 1 khách (PUSH_LUA có thể hạ cả phần xuống list của Page).
+    Khách đã có sự kiện thường trước đó trong entry thì các sự kiện sau của khách cũng đi làn thường.
+    Thứ tự sự kiện trong cùng làn được giữ nguyên.
+    """
+    parts = []
+    entries = body.get("entry", [])
+    for entry in entries:
+        page_id = str(entry.get("id"))
+        _, _, use_priority = scheduling_settings(load_config(page_id))
+        priority_lanes, normal, normal_customers = {}, [], []
+        for messaging in entry.get("messaging", []):
+            customer = customer_of(page_id, messaging)
+            if use_priority and customer not in normal_customers and is_priority_event(page_id, messaging):
+                priority_lanes.setdefault(customer, []).append(messaging)
+                continue
+            normal.append(messaging)
+            if customer not in normal_customers:
+                normal_customers.append(customer)
+        lanes = [(True, events, [customer]) for customer, events in priority_lanes.items()]
+        if normal:
+            lanes.append((False, normal, normal_customers))
+        for priority, events, customers in lanes:
+            if len(entries) == 1 and len(lanes) == 1:
+                # Thường gặp nhất: 1 Page, 1 làn -> giữ nguyên cục webhook (đẩy bytes gốc)
+                parts.append((page_id, body, priority, customers))
+                continue
+            sub_entry = {**entry, "messaging": events}
+            parts.append((page_id, {"object": body.get("object"), "entry": [sub_entry]}, priority, customers))
+    return parts
+
+
+def _push_calls(raw):
+    """[(keys, args)] của PUSH_LUA cho từng phần của 1 cục webhook"""
+    body = json.loads(raw)
+    calls = []
+    for page_id, sub_body, priority, customers in split_webhook(body):
+        weight, max_concurrency, _ = scheduling_settings(load_config(page_id))
+        payload = raw if sub_body is body else json.dumps(sub_body, ensure_ascii=False)
+        calls.append((
+            [FAIR_PREFIX + page_id, FAIR_ACTIVE, FAIR_VTIME, FAIR_CONF, FAIR_PRIORITY, FAIR_WAKE, FAIR_QUEUED],
+            [page_id, payload, weight, max_concurrency, 1 if priority else 0, FAIR_WAKE_MAX, ",".join(customers)],
+        ))
+    return calls
+
+
+class FairQueue:
+    """Cùng giao diện ListQueue / StreamQueue (app/chat_queue.py); msg_id = lease"""
+
+    # Worker async kéo vừa đủ lấp đầy prefetch * concurrency (pull_exact): đệm cục bộ nhỏ để slot
+    # không rảnh khi làn của khách đang bận, thứ tự phục vụ giữa các Page vẫn do scheduler quyết định
+    prefetch = 2
+    pull_exact = True
+
+    def __init__(self, redis_client, lease_seconds=FAIR_LEASE_SECONDS):
+        self.redis = redis_client
+        self.lease_ms = lease_seconds * 1000
+        self._push = redis_client.register_script(PUSH_LUA)
+        self._pull = redis_client.register_script(PULL_LUA)
+        self._release = redis_client.register_script(RELEASE_LUA)
+        # Lease đã kéo về mà chưa ack / release (kể cả đang chờ trong làn của worker async)
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._refresher = None
+
+    def push(self, raw):
+        for keys, args in _push_calls(raw):
+            self._push(keys=keys, args=args)
+
+    def pull(self, count=1, block_ms=5000):
+        """Trả về list [(lease, raw)]; không có tin (hoặc mọi Page đã đủ slot) thì chờ tối đa block_ms"""
+        deadline = time.monotonic() + block_ms / 1000
+        items = []
+        while True:
+            now_ms = int(time.time() * 1000)
+            pages = self.candidate_pages()
+            # Page của lease đã hết hạn: tin được trả về list của Page đó -> list phải nằm trong KEYS
+            for token in self.redis.zrangebyscore(FAIR_LEASES, "-inf", now_ms, start=0, num=100):
+                page_id = token.decode().split("|", 1)[0]
+                if page_id not in pages:
+                    pages.append(page_id)
+            flat, dead = self._pull(
+                keys=[FAIR_ACTIVE, FAIR_VTIME, FAIR_CONF, FAIR_INFLIGHT, FAIR_LEASES, FAIR_PRIORITY, FAIR_QUEUED,
+                      FAIR_BODIES, FAIR_DEAD, *(FAIR_PREFIX + page_id for page_id in pages)],
+                args=[now_ms, self.lease_ms, count - len(items), uuid.uuid4().hex[:12],
+                      FAIR_MAX_DELIVERIES, FAIR_DEAD_MAXLEN, *pages]
+            )
+            if dead:
+                log.error("message_dead_lettered", backend="fair", messages=dead, list=FAIR_DEAD,
+                          error="lease expired")
+            items.extend(self._track(list(zip(flat[0::2], flat[1::2]))))
+            if flat and pages and len(items) < count:
+                # Các Page ứng viên đã hết slot / hết tin -> lấy nhóm Page còn slot kế tiếp
+                continue
+            if items:
+                return items
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            self.redis.blpop(FAIR_WAKE, timeout=max(1, int(min(remaining, 1))))
+
+    def candidate_pages(self):
+        """
+        Tối đa FAIR_SCAN_PAGES Page còn slot, theo thời gian ảo tăng dần: Page đã đủ max_concurrency
+        bị bỏ qua và đọc tiếp zset -> Page phía sau còn slot + còn tin không bị các Page bị chặn che mất
+        """
+        pages, start = [], 0
+        while len(pages) < FAIR_SCAN_PAGES:
+            chunk = [p.decode() for p in self.redis.zrange(FAIR_ACTIVE, start, start + FAIR_SCAN_PAGES - 1)]
+            if not chunk:
+                break
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hmget(FAIR_CONF, chunk)
+            pipe.hmget(FAIR_INFLIGHT, chunk)
+            confs, inflight = pipe.execute()
+            for page_id, conf, busy in zip(chunk, confs, inflight):
+                cap = int(conf.split(b"|")[1]) if conf else 0
+                if cap <= 0 or int(busy or 0) < cap:
+                    pages.append(page_id)
+            start += len(chunk)
+        return pages[:FAIR_SCAN_PAGES]
+
+    def _track(self, batch):
+        with self._held_lock:
+            self._held.update(token for token, _ in batch)
+        if batch and self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="fair-lease-refresh", daemon=True)
+            self._refresher.start()
+        return batch
+
+    def _refresh_loop(self):
+        """Gia hạn lease của các tin đang giữ (ZADD XX: lease đã hết hạn và bị giao lại thì thôi)"""
+        while True:
+            time.sleep(max(1.0, self.lease_ms / 3000))
+            with self._held_lock:
+                tokens = list(self._held)
+            if not tokens:
+                continue
+            lease_until = int(time.time() * 1000) + self.lease_ms
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for i in range(0, len(tokens), 500):
+                    pipe.zadd(FAIR_LEASES, {token: lease_until for token in tokens[i:i + 500]}, xx=True)
+                pipe.execute()
+            except redis.RedisError as e:
+                log.warning("fair_lease_refresh_failed", error=str(e), held=len(tokens))
+
+    def _settle(self, msg_id, mode, error=""):
+        """Trả slot đồng thời của Page; mode: ack (xong) / requeue (giao lại) / dead (dead-letter)"""
+        with self._held_lock:
+            self._held.discard(msg_id)
+        token = msg_id.decode() if isinstance(msg_id, bytes) else msg_id
+        page_id = token.split("|", 1)[0]
+        result = self._release(
+            keys=[FAIR_LEASES, FAIR_INFLIGHT, FAIR_WAKE, FAIR_PREFIX + page_id, FAIR_BODIES,
+                  FAIR_ACTIVE, FAIR_VTIME, FAIR_QUEUED, FAIR_DEAD],
+            args=[msg_id, FAIR_WAKE_MAX, mode, FAIR_MAX_DELIVERIES, FAIR_DEAD_MAXLEN, str(error)[:500]]
+        )
+        if result == 0:
+            # Lease đã hết hạn trong lúc xử lý -> tin đã được trả về hàng đợi / giao cho worker khác
+            log.warning("fair_lease_lost", page_id=page_id, lease=token, settle=mode)
+        elif result == 2:
+            log.error("message_dead_lettered", backend="fair", page_id=page_id, lease=token, list=FAIR_DEAD,
+                      error=str(error) or f"vượt quá {FAIR_MAX_DELIVERIES} lần xử lý")
+        return result
+
+    def ack(self, msg_id):
+        if msg_id:
+            self._settle(msg_id, "ack")
+
+    def release(self, msg_id):
+        """Xử lý lỗi: trả slot và đưa tin về đầu list của Page để giao lại (quá số lần -> dead-letter)"""
+        if msg_id:
+            self._settle(msg_id, "requeue", "xử lý lỗi")
+
+    def fail(self, msg_id, raw, error):
+        """Chuyển tin sang dead-letter "chat_fair:dead" (không giao lại)"""
+        if msg_id:
+            self._settle(msg_id, "dead", error)
+
+    def depth(self):
+        return sum(depth for depth, _ in self.page_depths().values()) + self.redis.llen(FAIR_PRIORITY)
+
+    def oldest_age(self):
+        """Số giây tin chờ lâu nhất (đầu list của từng Page + làn ưu tiên) đã chờ"""
+        pages = self.redis.zrange(FAIR_ACTIVE, 0, FAIR_SCAN_PAGES - 1)
+        pipe = self.redis.pipeline(transaction=False)
+        for page_id in pages:
+            pipe.lindex(FAIR_PREFIX + page_id.decode(), 0)
+        pipe.lindex(FAIR_PRIORITY, 0)
+        heads = [head[head.find(b"{"):] for head in pipe.execute() if head]   # bỏ tiền tố page / khách
+        times = [t for t in map(webhook_time, heads) if t]
+        return max(0.0, time.time() - min(times)) if times else 0.0
+
+    def page_depths(self):
+        """{page_id: (số tin chờ, số tin đang xử lý)} của các Page đang có tin chờ"""
+        pages = [p.decode() for p in self.redis.zrange(FAIR_ACTIVE, 0, -1)]
+        pipe = self.redis.pipeline(transaction=False)
+        for page_id in pages:
+            pipe.llen(FAIR_PREFIX + page_id)
+        pipe.hgetall(FAIR_INFLIGHT)
+        *depths, inflight = pipe.execute()
+        inflight = {k.decode(): int(v) for k, v in inflight.items()}
+        return {page_id: (depth, inflight.get(page_id, 0)) for page_id, depth in zip(pages, depths)}
+
+
+_async_push = {}   # id(client redis.asyncio) -> script đã đăng ký
+
+
+async def enqueue_async(async_redis, raw):
+    """Webhook: tách theo Page / làn rồi đẩy (redis.asyncio)"""
+    script = _async_push.get(id(async_redis))
+    if script is None:
+        script = _async_push[id(async_redis)] = async_redis.register_script(PUSH_LUA)
+    for keys, args in _push_calls(raw):
+        await script(keys=keys, args=args)
+
+
+async def page_depths_async(async_redis):
+    """Như FairQueue.page_depths cho webhook: {page_id: (chờ, đang xử lý)} + số tin trong làn ưu tiên"""
+    pages = [p.decode() for p in await async_redis.zrange(FAIR_ACTIVE, 0, -1)]
+    pipe = async_redis.pipeline(transaction=False)
+    for page_id in pages:
+        pipe.llen(FAIR_PREFIX + page_id)
+    pipe.hgetall(FAIR_INFLIGHT)
+    pipe.llen(FAIR_PRIORITY)
+    *depths, inflight, priority = await pipe.execute()
+    inflight = {k.decode(): int(v) for k, v in inflight.items()}
+    return {page_id: (depth, inflight.get(page_id, 0)) for page_id, depth in zip(pages, depths)}, priority
@@ -3,18 +3,28 @@ import os
 import requests
 import json
 
+from app.logs import HOT_SAMPLE, get_logger
+
+log = get_logger("fb")
+
+# Gửi đồng bộ (FB_SEND_MODE=direct / script lẻ). Luồng chính dùng app/outbound.py
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v18.0/me/messages")
+FB_TIMEOUT_SECONDS = 10
+
 class FacebookClient:
     def __init__(self):
         # Lấy Token từ file .env
         self.page_access_token = os.getenv("FB_PAGE_ACCESS_TOKEN")
-        self.api_url = "https://graph.facebook.com/v18.0/me/messages"
+        self.api_url = GRAPH_API_URL
+        # Giữ kết nối keep-alive giữa các lần gửi (không bắt tay TLS lại mỗi tin)
+        self.session = requests.Session()
 
     def send_text_message(self, recipient_id, text):
         """
         Gửi tin nhắn văn bản trả lời khách hàng
         """
         if not self.page_access_token:
-            print(" Chưa cấu hình FB_PAGE_ACCESS_TOKEN trong .env")
+            log.error("page_token_missing", env="FB_PAGE_ACCESS_TOKEN")
             return
 
         headers = {
@@ -28,11 +38,34 @@ class FacebookClient:
             "messaging_type": "RESPONSE"
         }
 
+        response = None
         try:
-            response = requests.post(self.api_url, headers=headers, json=payload)
+            response = self.session.post(self.api_url, headers=headers, json=payload, timeout=FB_TIMEOUT_SECONDS)
             response.raise_for_status() # Báo lỗi nếu FB từ chối
-            print(f" Đã gửi tin nhắn cho khách {recipient_id}: {text[:20]}...")
+            log.info("fb_sent", sample=HOT_SAMPLE, recipient_id=recipient_id)
+        except Exception as e:
+            # Response 4xx/5xx có bool() = False -> phải so với None
+            log.warning("fb_send_failed", recipient_id=recipient_id, error=str(e),
+                        body=response.text[:300] if response is not None else None)
+
+    def send_sender_action(self, recipient_id, action="typing_on"):
+        """
+        Gửi hành động hiển thị (typing_on / typing_off / mark_seen) để khách thấy Bot đang soạn tin
+        """
+        if not self.page_access_token:
+            return
+
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.page_access_token}"
+        }
+        payload = {
+            "recipient": {"id": recipient_id},
+            "sender_action": action
+        }
+
+        try:
+            response = self.session.post(self.api_url, headers=headers, json=payload, timeout=5)
+            response.raise_for_status()
         except Exception as e:
-            print(f" Lỗi gửi tin FB: {e}")
-            if response:
-                print(f"   Chi tiết FB báo: {response.text}")
\ No newline at end of file
+            log.warning("fb_sender_action_failed", recipient_id=recipient_id, action=action, error=str(e))
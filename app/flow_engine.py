@@ -1,41 +1,26 @@
 # app/flow_engine.py
-import re
 import json
 from app.schemas import LeadData
+from app import contact_extractor, lead_scoring
+from app.logs import HOT_SAMPLE, get_logger
+
+log = get_logger("flow")
 
 class FlowEngine:
     def __init__(self, redis_client):
         self.redis = redis_client
 
-    def calculate_score(self, phone, email, stage, classification):
+    def calculate_score(self, phone, email, stage, classification, config=None):
         """
         Hàm chấm điểm Lead (Lead Scoring Algorithm)
-        Thang điểm: 0 - 100
+        Thang điểm: 0 - 100, trọng số lấy từ bảng điểm của Page (app/lead_scoring.py)
         """
-        score = 10 # Điểm sàn cho bất kỳ ai nhắn tin
-        
-        # 1. Điểm hạ tầng (Contact Info) -> Quan trọng nhất
-        if phone or email: 
-            score += 50
-        
-        # 2. Điểm phân loại (AI Classification)
-        classification = (classification or "").lower()
-        if "nghien_nang" in classification: score += 15  # Khách đau khổ -> Dễ chốt
-        if "vip" in classification: score += 20          # Khách tiền nhiều
-        if "stress" in classification: score += 10       # Khách có vấn đề tâm lý cần giải quyết
-        
-        # 3. Điểm giai đoạn (Pipeline Stage)
-        stage = (stage or "").upper()
-        if stage == "HOT": score += 20
-        elif stage == "WARM": score += 10
-        elif stage == "QUALIFIED": score += 5
-        
-        # Giới hạn max 100
-        return min(score, 100)
+        return lead_scoring.score_one(lead_scoring.scoring_table(config), bool(phone or email), stage, classification)
 
-    def process_ai_result(self, sender_id, message_text, ai_json, config):
+    def process_ai_result(self, sender_id, message_text, ai_json, config, message_parts=None):
         """
         TRÁI TIM LOGIC: Điều phối dữ liệu từ AI sang CRM
+        message_parts: các tin nhắn gốc khi nhiều tin được gộp thành 1 lượt
         """
         # -------------------------------------------------------
         # 1. BÓC TÁCH DỮ LIỆU AN TOÀN (SAFE PARSING)
@@ -61,8 +46,8 @@ class FlowEngine:
         # -------------------------------------------------------
         # 2. SĂN TÌM SĐT & EMAIL (REGEX + AI SUPPORT)
         # -------------------------------------------------------
-        phone = self.extract_phone_number(message_text)
-        email = self.extract_email(message_text)
+        # 1 lượt quét / tin (app/contact_extractor.py), kể cả số đọc bằng chữ, +84...
+        phone, email = contact_extractor.first_contacts(message_parts or [message_text])
         
         # Nếu Regex thất bại, thử niềm tin vào AI
         if not phone and detected_info: 
@@ -73,22 +58,11 @@ class FlowEngine:
         # -------------------------------------------------------
         # 3. XÁC ĐỊNH PIPELINE STAGE (TỰ ĐỘNG PHÂN PHỄU)
         # -------------------------------------------------------
-        stage = "NEW" # Mặc định: Khách mới chưa biết gì
-        
-        # Level 2: QUALIFIED (AI đã phân loại được khách -> Không phải spam)
-        if classification and classification.lower() != "unknown":
-            stage = "QUALIFIED"
-            
-        # Level 3: WARM (Khách có intent mua hàng hoặc AI đánh giá tốt)
-        if "warm" in classification.lower() or "muon_mua" in intent.lower():
-            stage = "WARM"
-            
-        # Level 4: HOT (Có SĐT/Email -> Sale phải gọi ngay lập tức)
-        if phone or email:
-            stage = "HOT"
+        # NEW -> QUALIFIED (AI phân loại được) -> WARM (muốn mua) -> HOT (có SĐT/Email)
+        stage = lead_scoring.derive_stage(classification, intent, bool(phone or email))
 
         # Tính điểm Score sau khi đã có Stage
-        lead_score = self.calculate_score(phone, email, stage, classification)
+        lead_score = self.calculate_score(phone, email, stage, classification, config)
 
         # -------------------------------------------------------
         # 4. ĐÓNG GÓI DỮ LIỆU (LEAD SCHEMA CHUẨN)
@@ -133,33 +107,36 @@ class FlowEngine:
         # CHỈ ĐẨY CRM KHI ĐẠT MỤC TIÊU TỐI THƯỢNG (CÓ DATA LIÊN HỆ)
         if phone or email:
             action_signal = "PUSH_CRM"
-            print(f"💎 ĐÃ BẮT ĐƯỢC SĐT/EMAIL -> KÍCH HOẠT PUSH CRM NGAY!")
+            log.info("contact_captured", sender_id=sender_id, has_phone=bool(phone), has_email=bool(email),
+                     score=lead_score)
             
         # (Tùy chọn) Chỉ báo CRM nếu khách cực kỳ Hot (Score > 80) để Sale vào chat tay
         elif lead_score >= 80:
             action_signal = "PUSH_CRM"
-            print(f"🔥 KHÁCH RẤT TIỀM NĂNG (Score {lead_score}) -> Báo CRM để Sale hỗ trợ")
+            log.info("hot_lead", sender_id=sender_id, score=lead_score, stage=stage)
             
         else:
             # Còn lại: Chỉ chat, không làm phiền CRM
-            print(f"💬 Đang dẫn dắt... (Chưa có SĐT -> Không đẩy CRM)")
+            log.info("nurturing", sample=HOT_SAMPLE, sender_id=sender_id, score=lead_score, stage=stage)
 
         # -------------------------------------------------------
-        # 6. LƯU TRẠNG THÁI HỘI THOẠI (STATE MANAGEMENT)
+        # 6. TRẠNG THÁI HỘI THOẠI
         # -------------------------------------------------------
-        if self.redis:
-            # Chỉ cập nhật state nếu AI có đề xuất state mới
-            if next_state and next_state != "DEFAULT":
-                self.redis.hset(f"session:{sender_id}", "current_state", next_state)
-            
-            # Lưu tags vào Redis để dùng cho các logic sau
-            for tag in tags:
-                self.redis.rpush(f"tags:{sender_id}", tag)
+        # Không ghi Redis ở đây nữa: next_state & tags được trả về để worker ghi
+        # cùng session/history trong 1 lần commit (app/session_store.py).
+        # Tags được đếm theo khách + đưa vào chỉ mục phân khúc của Page (app/tag_store.py).
+        # Chỉ cập nhật state nếu AI có đề xuất state mới
+        if next_state == "DEFAULT":
+            next_state = None
 
         return {
             "text_to_send": reply_text,
             "action": action_signal,
-            "lead_data": lead.to_dict()
+            "lead_data": lead.to_dict(),
+            "next_state": next_state,
+            "tags": tags,
+            "score": lead_score,
+            "stage": stage
         }
 
     # ====================================================
@@ -167,16 +144,9 @@ class FlowEngine:
     # ====================================================
 
     def extract_phone_number(self, text):
-        """Tìm SĐT VN (An toàn tuyệt đối)"""
-        if not text: return None
-        # Xóa nhiễu
-        clean_text = text.replace('.', '').replace('-', '').replace(' ', '')
-        # Regex: Đầu 03,05,07,08,09 + 8 số
-        matches = re.findall(r'0[3|5|7|8|9]\d{8}', clean_text)
-        return matches[0] if matches else None
+        """Tìm SĐT VN (đã chuẩn hóa về dạng 0xxxxxxxxx)"""
+        return contact_extractor.extract_phone(text)
 
     def extract_email(self, text):
-        """Tìm Email (An toàn tuyệt đối)"""
-        if not text: return None
-        match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', text)
-        return
\ No newline at end of file
+        """Tìm Email (chữ thường)"""
+        return contact_extractor.extract_email(text)
@@ -0,0 +1,99 @@
+# app/lanes.py
+import asyncio
+from collections import deque
+
+from app.logs import get_logger
+
+log = get_logger("lanes")
+
+
+class SerialLanes:
+    """
+    Bộ điều phối "làn" theo khóa:
+    - Cùng 1 khóa (vd: sender_id) -> chạy TUẦN TỰ đúng thứ tự submit.
+    - Khác khóa -> chạy SONG SONG, tối đa `max_inflight` job cùng lúc.
+    Mỗi khóa chỉ giữ 1 task khi đang có việc, hết việc thì tự giải phóng.
+    """
+
+    def __init__(self, handler, max_inflight, gather=None, on_error=None):
+        # handler : async def handler(key, item)
+        # gather  : async def gather(key, item) -> item  (tùy chọn, chạy TRƯỚC khi chiếm slot,
+        #           vd: chờ gộp các tin đến liên tiếp bằng take())
+        # on_error: async def on_error(key, item) - gather / handler lỗi: item không được xử lý,
+        #           phải trả lại (vd: release tin trong queue) thay vì bỏ rơi
+        self.handler = handler
+        self.gather = gather
+        self.on_error = on_error
+        self.max_inflight = max_inflight
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._queues = {}
+        self._tasks = {}
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def pending(self):
+        """Số job đã nhận nhưng chưa xử lý xong (kể cả đang chạy)"""
+        return self._pending
+
+    @property
+    def active_keys(self):
+        return len(self._tasks)
+
+    def submit(self, key, item):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(item)
+        self._pending += 1
+        self._idle.clear()
+
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._drain(key))
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                item = queue.popleft()
+                try:
+                    if self.gather:
+                        item = await self.gather(key, item)
+                    async with self._slots:
+                        await self.handler(key, item)
+                except Exception as e:
+                    log.error("lane_failed", key=key, error=str(e))
+                    if self.on_error:
+                        try:
+                            await self.on_error(key, item)
+                        except Exception as e:
+                            log.error("lane_settle_failed", key=key, error=str(e))
+                finally:
+                    self._pending -= 1
+        finally:
+            del self._queues[key]
+            del self._tasks[key]
+            if self._pending == 0:
+                self._idle.set()
+
+    def take(self, key, predicate, limit):
+        """
+        Lấy ra (tối đa `limit`) job LIÊN TIẾP ở đầu làn thỏa predicate.
+        Dừng ở job đầu tiên không thỏa để không phá thứ tự.
+        """
+        queue = self._queues.get(key)
+        taken = []
+        while queue and len(taken) < limit and predicate(queue[0]):
+            taken.append(queue.popleft())
+            self._pending -= 1
+        return taken
+
+    async def wait_below(self, limit):
+        """Backpressure: chờ tới khi số job tồn đọng < limit"""
+        while self._pending >= limit:
+            await asyncio.sleep(0.01)
+
+    async def join(self):
+        """Chờ xử lý hết mọi job đang có"""
+        await self._idle.wait()
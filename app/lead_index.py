@@ -0,0 +1,217 @@
+# app/lead_index.py
+"""
+Chỉ mục định danh Lead: tránh bắn lại CRM mỗi lượt khách còn chat sau khi đã để lại SĐT.
+
+- Định danh: SĐT chuẩn hóa / email chuẩn hóa / facebook_uid -> lead_id
+  (key "lead:idx:phone:<sđt>", "lead:idx:email:<email>", "lead:idx:fb:<uid>").
+  Cùng SĐT từ 2 tài khoản FB -> cùng 1 lead, không tạo 2 deal.
+- Hash "lead:<lead_id>" lưu fingerprint TỪNG field đã gửi ("f:<field>"), thời điểm gửi gần nhất.
+- Lượt mới: so fingerprint -> không đổi gì thì bỏ qua; có đổi thì chỉ gửi field đã đổi
+  (op "update", kèm field định danh). Lead mới thì gửi đủ (op "create").
+- Chưa hết LEAD_MIN_REPUSH_SECONDS kể từ lần gửi trước -> hoãn: bản update nằm ở field "deferred"
+  của "lead:<lead_id>", lịch retry của CRM dispatcher chỉ giữ "deferred:<lead_id>" (1 member / lead).
+  Thay đổi tiếp theo trong lúc chờ được gộp vào bản hoãn đó. Dispatcher gửi bản hoãn xong thì
+  SETTLE_DEFERRED_LUA xóa "deferred" / "d:*" và cập nhật pushed_at; gửi lỗi thì hẹn lại đúng member đó.
+
+Python tra lead_id (MGET chỉ mục) để khai báo "lead:<lead_id>" trong KEYS, rồi toàn bộ quyết định
++ RPUSH/ZADD nằm trong 1 Lua script (chỉ mục vừa bị lượt khác đổi -> tra lại).
+"""
+import hashlib
+import json
+import os
+import time
+
+from app.contact_extractor import normalize_email, normalize_phone
+
+LEAD_MIN_REPUSH_SECONDS = int(os.getenv("LEAD_MIN_REPUSH_SECONDS", "600"))
+LEAD_INDEX_TTL_SECONDS = int(os.getenv("LEAD_INDEX_TTL_SECONDS", str(86400 * 90)))
+UPSERT_ATTEMPTS = 3
+
+# Member của lịch retry trỏ tới bản hoãn trong "lead:<lead_id>"
+DEFERRED_PREFIX = "deferred:"
+
+# Field luôn thay đổi theo từng tin -> không tính vào fingerprint
+VOLATILE_FIELDS = ("data_raw", "notes")
+# Field luôn đi kèm bản update để CRM tìm đúng lead
+IDENTITY_FIELDS = ("facebook_uid", "phone", "email")
+# Field ngữ cảnh gửi kèm mỗi bản update (không tự kích hoạt update)
+CONTEXT_FIELDS = ("notes",)
+
+# KEYS[1]=crm_leads_queue, KEYS[2]=crm_retry_schedule, KEYS[3]=crm:stats, KEYS[4]=lead:<lead_id> (Python đã tra),
+# KEYS[5..]=key định danh
+# ARGV[1]=JSON {lead_id, now, min_interval, ttl, fields[], hashes{field: fp}, values{field: json}, identity[], context[]}
+UPSERT_LEAD_LUA = """
+local p = cjson.decode(ARGV[1])
+
+local lead_id = nil
+for i = 5, #KEYS do
+    local v = redis.call('GET', KEYS[i])
+    if v then lead_id = v; break end
+end
+lead_id = lead_id or p.lead_id
+-- Chỉ mục vừa bị lượt khác đổi sau khi Python tra -> Python tra lại với lead_id mới
+if 'lead:' .. lead_id ~= KEYS[4] then return {'retry', lead_id} end
+for i = 5, #KEYS do redis.call('SET', KEYS[i], lead_id, 'EX', p.ttl) end
+
+local rec = KEYS[4]
+local member = 'deferred:' .. lead_id
+local pushed_at = tonumber(redis.call('HGET', rec, 'pushed_at') or '0')
+local deferred = redis.call('HGET', rec, 'deferred')
+local is_new = pushed_at == 0 and not deferred
+
+local changed = {}
+for field, fp in pairs(p.hashes) do
+    if redis.call('HGET', rec, 'f:' .. field) ~= fp then
+        table.insert(changed, field)
+        redis.call('HSET', rec, 'f:' .. field, fp)
+    end
+end
+redis.call('EXPIRE', rec, p.ttl)
+if #changed == 0 then
+    redis.call('HINCRBY', KEYS[3], 'lead_skip', 1)
+    return {'skip', lead_id}
+end
+
+-- Field cần gửi: tất cả (lead mới) | định danh + ngữ cảnh + field đổi + field còn chờ trong bản hoãn
+-- (field chờ mà lượt này không nhắc lại thì dùng giá trị đã lưu ở "d:<field>")
+local values = p.values
+local include = {}
+if is_new then
+    for field, _ in pairs(values) do include[field] = true end
+else
+    for _, field in ipairs(p.identity) do include[field] = true end
+    for _, field in ipairs(p.context) do include[field] = true end
+    for _, field in ipairs(changed) do include[field] = true end
+    for _, field in ipairs(p.fields) do
+        local pending = redis.call('HGET', rec, 'd:' .. field)
+        if pending then
+            include[field] = true
+            values[field] = values[field] or pending
+        end
+    end
+end
+
+local parts = {'"op":"' .. (is_new and 'create' or 'update') .. '"', '"lead_id":' .. cjson.encode(lead_id)}
+for field, _ in pairs(include) do
+    if values[field] then table.insert(parts, cjson.encode(field) .. ':' .. values[field]) end
+end
+local envelope = '{"lead":{' .. table.concat(parts, ',') .. '},"attempts":0,"enqueued_at":' .. p.now .. '}'
+
+-- Bản hoãn kiểu cũ dùng chính envelope làm member
+if deferred then redis.call('ZREM', KEYS[2], deferred) end
+
+if not is_new and p.now - pushed_at < p.min_interval then
+    redis.call('ZADD', KEYS[2], pushed_at + p.min_interval, member)
+    redis.call('HSET', rec, 'deferred', envelope)
+    for field, _ in pairs(include) do
+        if values[field] then redis.call('HSET', rec, 'd:' .. field, values[field]) end
+    end
+    redis.call('HINCRBY', KEYS[3], 'lead_deferred', 1)
+    return {'deferred', lead_id}
+end
+
+if deferred then redis.call('ZREM', KEYS[2], member) end
+redis.call('RPUSH', KEYS[1], envelope)
+redis.call('HSET', rec, 'pushed_at', p.now)
+redis.call('HDEL', rec, 'deferred')
+for _, field in ipairs(p.fields) do redis.call('HDEL', rec, 'd:' .. field) end
+redis.call('HINCRBY', KEYS[3], is_new and 'lead_create' or 'lead_update', 1)
+return {is_new and 'create' or 'update', lead_id}
+"""
+
+# Dispatcher đã gửi (hoặc bỏ) bản hoãn lấy từ member "deferred:<lead_id>"
+# KEYS[1]=lead:<lead_id>, KEYS[2]=crm_retry_schedule
+# ARGV[1]=envelope đã gửi, ARGV[2]='1' thành công | '0' lỗi, ARGV[3]=now,
+# ARGV[4]=envelope thử lại ('' = hết lượt, bỏ), ARGV[5]=giờ thử lại, ARGV[6]=member
+SETTLE_DEFERRED_LUA = """
+if ARGV[2] == '1' then
+    local pushed_at = tonumber(redis.call('HGET', KEYS[1], 'pushed_at') or '0')
+    if tonumber(ARGV[3]) > pushed_at then redis.call('HSET', KEYS[1], 'pushed_at', ARGV[3]) end
+end
+-- Bản hoãn đã bị thay (gộp thay đổi mới / lượt chat đã gửi thẳng) -> bản mới tự lo phần còn lại
+if redis.call('HGET', KEYS[1], 'deferred') ~= ARGV[1] then return 0 end
+if ARGV[2] == '1' then
+    redis.call('HDEL', KEYS[1], 'deferred')
+    for field, _ in pairs(cjson.decode(ARGV[1]).lead) do redis.call('HDEL', KEYS[1], 'd:' .. field) end
+elseif ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[1], 'deferred', ARGV[4])
+    redis.call('ZADD', KEYS[2], ARGV[5], ARGV[6])
+else
+    -- Hết lượt: giữ "d:*" -> lượt cập nhật sau gửi kèm lại
+    redis.call('HDEL', KEYS[1], 'deferred')
+end
+return 1
+"""
+
+
+def lead_key(lead_id):
+    return f"lead:{lead_id}"
+
+
+def field_fingerprint(value):
+    if isinstance(value, list):
+        value = sorted(str(v) for v in value)
+    raw = json.dumps(value, ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(raw.encode(), digest_size=8).hexdigest()
+
+
+def identity_keys(lead_data):
+    """Ưu tiên SĐT > email > facebook_uid khi tra lead_id"""
+    keys = []
+    phone = normalize_phone(lead_data.get("phone"))
+    email = normalize_email(lead_data.get("email"))
+    if phone:
+        keys.append(f"lead:idx:phone:{phone}")
+    if email:
+        keys.append(f"lead:idx:email:{email}")
+    if lead_data.get("facebook_uid"):
+        keys.append(f"lead:idx:fb:{lead_data['facebook_uid']}")
+    return keys
+
+
+class LeadIndex:
+    def __init__(self, redis_client, min_repush_seconds=LEAD_MIN_REPUSH_SECONDS, ttl=LEAD_INDEX_TTL_SECONDS):
+        self.redis = redis_client
+        self.min_repush_seconds = min_repush_seconds
+        self.ttl = ttl
+        self._upsert_script = redis_client.register_script(UPSERT_LEAD_LUA)
+
+    def upsert(self, lead_data, queue_key, schedule_key, stats_key):
+        """
+        Quyết định + xếp hàng trong 1 round trip.
+        Trả về (decision, lead_id): decision = create | update | deferred | skip
+        """
+        lead = dict(lead_data)
+        if lead.get("phone"):
+            lead["phone"] = normalize_phone(lead["phone"])
+        if lead.get("email"):
+            lead["email"] = normalize_email(lead["email"])
+        # Field rỗng không ghi đè dữ liệu đã gửi (vd: lượt sau không nhắc lại SĐT)
+        values = {k: v for k, v in lead.items() if v not in (None, "", [])}
+
+        keys = identity_keys(lead)
+        if not keys:
+            return "skip", None
+
+        default_id = keys[0].split(":", 2)[2]
+        payload = {
+            "lead_id": default_id,
+            "now": time.time(),
+            "min_interval": self.min_repush_seconds,
+            "ttl": self.ttl,
+            "fields": list(lead),
+            "hashes": {k: field_fingerprint(v) for k, v in values.items() if k not in VOLATILE_FIELDS},
+            "values": {k: json.dumps(v, ensure_ascii=False) for k, v in values.items()},
+            "identity": [f for f in IDENTITY_FIELDS if f in values],
+            "context": [f for f in CONTEXT_FIELDS if f in values],
+        }
+        args = [json.dumps(payload, ensure_ascii=False)]
+        lead_id = next((v.decode() for v in self.redis.mget(keys) if v), default_id)
+        for _ in range(UPSERT_ATTEMPTS):
+            decision, found = self._upsert_script(keys=[queue_key, schedule_key, stats_key, lead_key(lead_id)] + keys,
+                                                  args=args)
+            decision, found = decision.decode(), found.decode()
+            if decision != "retry":
+                return decision, found
+            lead_id = found
+        raise RuntimeError(f"chỉ mục lead thay đổi liên tục: {keys}")
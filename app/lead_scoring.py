@@ -0,0 +1,334 @@
+# app/lead_scoring.py
+"""
+Chấm điểm Lead theo bảng điểm biên dịch từ config của từng Page.
+
+Config (tùy chọn, thiếu key nào thì dùng mặc định = luật cũ trong FlowEngine):
+    "scoring": {
+        "base": 10,                       # điểm sàn cho bất kỳ ai nhắn tin
+        "contact": 50,                    # có SĐT / Email
+        "classification_weights": {"nghien_nang": 15, "vip": 20, "stress": 10},
+        "stage_weights": {"HOT": 20, "WARM": 10, "QUALIFIED": 5},
+        "max": 100
+    }
+Nhãn trong logic_rules.classification_rules luôn có mặt trong bảng (trọng số mặc định 0).
+Nhãn được so theo chuỗi con trong classification AI trả về (giữ đúng cách cũ).
+
+2 chế độ:
+- score_one()  : 1 lead / lượt chat (Python thuần, không tốn overhead NumPy).
+- rescore      : chấm lại HÀNG LOẠT session đã lưu khi đổi luật (NumPy + process pool,
+                 SCAN Redis theo lô, pipeline đọc/ghi). Chạy:
+    python -m app.lead_scoring rescore [--page 2002] [--workers 4] [--dry-run] [--push-crm]
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+DEFAULT_SCORING = {
+    "base": 10,
+    "contact": 50,
+    "classification_weights": {"nghien_nang": 15, "vip": 20, "stress": 10},
+    "stage_weights": {"HOT": 20, "WARM": 10, "QUALIFIED": 5},
+    "max": 100,
+}
+STAGES = ("NEW", "QUALIFIED", "WARM", "HOT")
+
+RESCORE_BATCH = 1000
+RESCORE_MAX_INFLIGHT_FACTOR = 2     # số lô đang xử lý tối đa = workers * hệ số này
+
+
+# ==========================================
+#  BIÊN DỊCH BẢNG ĐIỂM
+# ==========================================
+def compile_scoring(config):
+    """Chạy 1 lần / phiên bản config (gọi từ config_loader.compile_config)"""
+    settings = config.get("scoring", {})
+    rules = config.get("logic_rules", {}).get("classification_rules", {})
+
+    weights = dict(DEFAULT_SCORING["classification_weights"])
+    weights.update(settings.get("classification_weights", {}))
+    for label in rules:
+        weights.setdefault(label, 0)
+    labels = [label.lower() for label in weights]
+
+    stage_weights = dict(DEFAULT_SCORING["stage_weights"])
+    stage_weights.update({k.upper(): v for k, v in settings.get("stage_weights", {}).items()})
+
+    table = {
+        "base": settings.get("base", DEFAULT_SCORING["base"]),
+        "contact": settings.get("contact", DEFAULT_SCORING["contact"]),
+        "max": settings.get("max", DEFAULT_SCORING["max"]),
+        "labels": labels,
+        "label_weights": np.array(list(weights.values()), dtype=np.int32),
+        # Theo thứ tự STAGES để tra bằng chỉ số trong chế độ vector
+        "stage_weights": np.array([stage_weights.get(s, 0) for s in STAGES], dtype=np.int32),
+    }
+    fingerprint = json.dumps([table["base"], table["contact"], table["max"], labels,
+                              table["label_weights"].tolist(), table["stage_weights"].tolist()])
+    table["version"] = hashlib.blake2b(fingerprint.encode(), digest_size=4).hexdigest()
+    return table
+
+
+def scoring_table(config):
+    compiled = (config or {}).get("_compiled", {})
+    return compiled.get("scoring") or compile_scoring(config or {})
+
+
+# ==========================================
+#  1 LEAD (ĐƯỜNG CHAT)
+# ==========================================
+def derive_stage(classification, intent, has_contact):
+    """Giai đoạn phễu: NEW -> QUALIFIED -> WARM -> HOT"""
+    classification = (classification or "").lower()
+    if has_contact:
+        return "HOT"
+    if "warm" in classification or "muon_mua" in (intent or "").lower():
+        return "WARM"
+    if classification and classification != "unknown":
+        return "QUALIFIED"
+    return "NEW"
+
+
+def score_one(table, has_contact, stage, classification):
+    classification = (classification or "").lower()
+    score = table["base"]
+    if has_contact:
+        score += table["contact"]
+    for label, weight in zip(table["labels"], table["label_weights"]):
+        if label in classification:
+            score += int(weight)
+    stage = (stage or "").upper()
+    if stage in STAGES:
+        score += int(table["stage_weights"][STAGES.index(stage)])
+    return min(score, table["max"])
+
+
+# ==========================================
+#  HÀNG LOẠT (NUMPY)
+# ==========================================
+def score_batch(table, has_contact, classifications, intents):
+    """
+    has_contact: bool[n], classifications / intents: list[str] độ dài n.
+    Trả về (scores int32[n], stage_idx int8[n]).
+    Khớp chuỗi con chỉ làm trên các giá trị classification KHÁC NHAU (thường vài chục),
+    phần còn lại là phép toán vector.
+    """
+    has_contact = np.asarray(has_contact, dtype=bool)
+    classes = np.array([(c or "").lower() for c in classifications], dtype=object)
+    uniq_classes, class_inverse = np.unique(classes, return_inverse=True)
+    match = np.array([[label in c for label in table["labels"]] for c in uniq_classes], dtype=bool)
+    class_points = (match.astype(np.int32) @ table["label_weights"]) if len(table["labels"]) else np.zeros(len(uniq_classes), dtype=np.int32)
+    warm_class = np.array(["warm" in c for c in uniq_classes], dtype=bool)
+    qualified_class = np.array([bool(c) and c != "unknown" for c in uniq_classes], dtype=bool)
+
+    intents = np.array([(i or "").lower() for i in intents], dtype=object)
+    uniq_intents, intent_inverse = np.unique(intents, return_inverse=True)
+    warm_intent = np.array(["muon_mua" in i for i in uniq_intents], dtype=bool)
+
+    warm = warm_class[class_inverse] | warm_intent[intent_inverse]
+    stage_idx = np.select(
+        [has_contact, warm, qualified_class[class_inverse]],
+        [STAGES.index("HOT"), STAGES.index("WARM"), STAGES.index("QUALIFIED")],
+        default=STAGES.index("NEW"),
+    ).astype(np.int8)
+
+    scores = (table["base"] + has_contact * table["contact"] + class_points[class_inverse]
+              + table["stage_weights"][stage_idx])
+    return np.minimum(scores, table["max"]).astype(np.int32), stage_idx
+
+
+def _history_has_contact(raw_history):
+    """SĐT / Email trong tin khách của history (session cũ chưa ghi has_contact vào data)"""
+    from app.contact_extractor import extract_batch
+    from app.session_store import parse_history
+
+    texts = [item.get("content") for item in parse_history(raw_history) if item.get("role") == "user"]
+    return any(result["phones"] or result["emails"] for result in extract_batch(texts))
+
+
+def _session_has_contact(data, lead_id, raw_history, old_stage):
+    """True / False; None = không rõ (không nên ghi đè điểm cũ)"""
+    if "has_contact" in data:
+        return bool(data["has_contact"])
+    # Session cũ: suy ra từ chỉ mục lead (lead_id theo SĐT/email), rồi tới history
+    if (lead_id or "").startswith(("phone:", "email:")) or _history_has_contact(raw_history or []):
+        return True
+    # History đã bị cắt (HISTORY_MAX) mà điểm cũ đã tính có liên hệ -> không rõ
+    return None if old_stage == "HOT" else False
+
+
+def _rescore_rows(rows):
+    """
+    Chạy trong process con: rows = [(sender_id, page_id, raw_data, lead_id, old_score, old_stage, raw_history)]
+    raw_history chỉ được đọc cho session chưa ghi has_contact (None nếu không cần).
+    Trả về list (sender_id, page_id, score, stage, version, changed); session không rõ có liên hệ
+    hay không thì bỏ qua (giữ điểm cũ).
+    """
+    from app.config_loader import registry
+
+    by_page = {}
+    for row in rows:
+        by_page.setdefault(row[1], []).append(row)
+
+    results = []
+    for page_id, page_rows in by_page.items():
+        config = registry.get(page_id)
+        if not config:
+            continue
+        table = scoring_table(config)
+        known_rows, has_contact, classifications, intents = [], [], [], []
+        for row in page_rows:
+            _, _, raw_data, lead_id, _, old_stage, raw_history = row
+            try:
+                data = json.loads(raw_data) if raw_data else {}
+            except ValueError:
+                data = {}
+            contact = _session_has_contact(data, lead_id, raw_history, old_stage)
+            if contact is None:
+                continue
+            known_rows.append(row)
+            has_contact.append(contact)
+            classifications.append(data.get("classification", ""))
+            # Session cũ chưa lưu intent -> sub_topic (giá trị đường chat dùng khi AI không trả intent)
+            intents.append(data.get("intent") or data.get("subtopic", ""))
+
+        if not known_rows:
+            continue
+        scores, stage_idx = score_batch(table, has_contact, classifications, intents)
+        for row, score, stage in zip(known_rows, scores.tolist(), stage_idx.tolist()):
+            old_score = row[4]
+            results.append((row[0], page_id, score, STAGES[stage], table["version"], old_score != str(score)))
+    return results
+
+
+def _init_rescore_worker():
+    from app.config_loader import registry
+    registry.reload(force=True)
+
+
+def rescore(redis_client, page_id=None, workers=None, batch=RESCORE_BATCH, dry_run=False, push_crm=False):
+    """
+    SCAN session:* theo lô -> pipeline đọc -> process pool tính điểm -> pipeline ghi field
+    lead_score / lead_stage / score_version vào session (chỉ session có điểm thay đổi).
+    push_crm: đẩy điểm mới sang CRM cho lead ĐÃ từng được tạo (qua LeadIndex -> chỉ gửi field đổi).
+    Session cũ chưa ghi has_contact: quét SĐT / Email trong history; vẫn không rõ thì giữ điểm cũ.
+    """
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+    from app.session_store import history_key
+
+    workers = workers or os.cpu_count() or 1
+    crm = None
+    if push_crm:
+        from app.crm_connector import CRMConnector
+        crm = CRMConnector(redis_client)
+
+    stats = {"scanned": 0, "scored": 0, "changed": 0, "pushed": 0}
+    started = time.time()
+
+    def read_batch(keys):
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, "page_id", "data", "lead_score", "lead_stage")
+            pipe.get(f"lead:idx:fb:{key[len(b'session:'):].decode()}")
+        raw = pipe.execute()
+        rows = []
+        for i, key in enumerate(keys):
+            session_page, data, old_score, old_stage = raw[2 * i]
+            lead_id = raw[2 * i + 1]
+            if not session_page or (page_id and session_page.decode() != str(page_id)):
+                continue
+            rows.append([key[len(b"session:"):].decode(), session_page.decode(),
+                         data.decode() if data else "", lead_id.decode() if lead_id else "",
+                         old_score.decode() if old_score else None,
+                         old_stage.decode() if old_stage else None, None])
+
+        # Session cũ chưa ghi has_contact (và chưa có lead theo SĐT/email) -> đọc history để quét liên hệ
+        unknown = [row for row in rows
+                   if '"has_contact"' not in row[2] and not row[3].startswith(("phone:", "email:"))]
+        if unknown:
+            pipe = redis_client.pipeline(transaction=False)
+            for row in unknown:
+                pipe.lrange(history_key(row[0]), 0, -1)
+            for row, raw_history in zip(unknown, pipe.execute()):
+                row[6] = raw_history
+        return [tuple(row) for row in rows]
+
+    def write_results(results):
+        stats["scored"] += len(results)
+        changed = [r for r in results if r[5]]
+        stats["changed"] += len(changed)
+        if dry_run or not changed:
+            return
+        pipe = redis_client.pipeline(transaction=False)
+        for sender_id, _, score, stage, version, _ in changed:
+            pipe.hset(f"session:{sender_id}", mapping={
+                "lead_score": score, "lead_stage": stage, "score_version": version,
+            })
+        pipe.execute()
+        if crm:
+            exists = redis_client.pipeline(transaction=False)
+            for sender_id, *_ in changed:
+                exists.exists(f"lead:idx:fb:{sender_id}")
+            for (sender_id, _, score, _, _, _), known in zip(changed, exists.execute()):
+                if known:
+                    crm.enqueue_lead({"facebook_uid": sender_id, "score": score})
+                    stats["pushed"] += 1
+
+    max_inflight = workers * RESCORE_MAX_INFLIGHT_FACTOR
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_rescore_worker) as pool:
+        pending = set()
+        for key_batch in _scan_batches(redis_client, "session:*", batch):
+            stats["scanned"] += len(key_batch)
+            rows = read_batch(key_batch)
+            if rows:
+                pending.add(pool.submit(_rescore_rows, rows))
+            # Backpressure: không đọc Redis nhanh hơn tốc độ tính điểm
+            while len(pending) >= max_inflight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write_results(future.result())
+        for future in pending:
+            write_results(future.result())
+
+    elapsed = time.time() - started
+    stats["seconds"] = round(elapsed, 2)
+    stats["sessions_per_second"] = int(stats["scored"] / elapsed) if elapsed else 0
+    return stats
+
+
+def _scan_batches(redis_client, pattern, batch):
+    keys = []
+    for key in redis_client.scan_iter(match=pattern, count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            yield keys
+            keys = []
+    if keys:
+        yield keys
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    import redis
+    from dotenv import load_dotenv
+
+    sys.path.append(os.getcwd())
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Chấm lại điểm Lead hàng loạt theo config hiện tại")
+    parser.add_argument("command", choices=["rescore"])
+    parser.add_argument("--page", help="chỉ chấm session của page_id này")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=RESCORE_BATCH)
+    parser.add_argument("--dry-run", action="store_true", help="chỉ đếm, không ghi")
+    parser.add_argument("--push-crm", action="store_true", help="đẩy điểm mới sang CRM (lead đã tồn tại)")
+    args = parser.parse_args()
+
+    r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    result = rescore(r, page_id=args.page, workers=args.workers, batch=args.batch,
+                     dry_run=args.dry_run, push_crm=args.push_crm)
+    print(f"✅ Rescore xong: {result}")
@@ -0,0 +1,326 @@
+# app/llm_router.py
+"""
+Điều phối nhiều nhà cung cấp LLM (Gemini, OpenAI...) cho 1 lượt chat.
+
+- Thứ tự provider theo config Page: "llm": {"providers": ["gemini", "openai"], "hedge": true}
+  (mặc định LLM_PROVIDERS). Provider chưa đăng ký (vd: thiếu OPENAI_API_KEY) bị bỏ qua.
+- Mỗi provider có thống kê cuốn chiếu (độ trễ, tỉ lệ lỗi trong LLM_STATS_MAX_AGE giây gần nhất).
+- Hedging: request đầu quá hạn p95 của provider đó (kẹp trong [LLM_HEDGE_MIN_MS, LLM_HEDGE_MAX_MS])
+  mà chưa xong -> gửi thêm 1 request tới provider kế tiếp, lấy kết quả nào về trước.
+  Hạn tính từ lúc request thực sự chạy (không tính thời gian chờ thread trong pool).
+  Chỉ có 1 provider thì request dự phòng gửi lại chính provider đó.
+- Failover: request lỗi -> thử ngay provider kế tiếp.
+- Circuit breaker: lỗi liên tiếp / tỉ lệ lỗi cao -> "open" (bỏ qua provider) LLM_BREAKER_COOLDOWN giây,
+  sau đó "half_open" cho 1 request thăm dò; thành công thì đóng lại.
+- Streaming (app/reply_stream.py): chỉ 1 request được đẩy reply_text ra ngoài (request đầu tiên có text);
+  khách đã thấy text của request nào thì CHỈ dùng kết quả của request đó (không trộn câu trả lời):
+  kết quả của request khác bị bỏ, request đó lỗi -> LLMUnavailable (không failover sang câu trả lời khác).
+
+Provider = hàm (system_instruction, prompt, config, on_chunk) -> text JSON, on_chunk(mảnh text thô)
+khi stream (None = không stream). Đăng ký ở app/ai_engine.py.
+"""
+import collections
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from app import metrics
+from app.logs import get_logger
+from app.reply_stream import ReplyTextExtractor
+
+LLM_PROVIDERS = [p.strip() for p in os.getenv("LLM_PROVIDERS", "gemini,openai").split(",") if p.strip()]
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "25"))
+# Mỗi lượt chat đang chạy giữ tối đa 2 request (chính + hedge / failover) -> pool mặc định
+# 2 x số lượt đồng thời của worker (WORKER_CONCURRENCY ở chế độ async, 1 ở chế độ sync) + dư cho request thua
+WORKER_MODE = os.getenv("WORKER_MODE", "sync").lower()
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "100"))
+LLM_ROUTER_THREADS = int(os.getenv("LLM_ROUTER_THREADS", "0")) or \
+    2 * (WORKER_CONCURRENCY if WORKER_MODE == "async" else 1) + 8
+
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "1") == "1"
+LLM_HEDGE_DEFAULT_MS = float(os.getenv("LLM_HEDGE_DEFAULT_MS", "4000"))   # chưa đủ mẫu để tính p95
+LLM_HEDGE_MIN_MS = float(os.getenv("LLM_HEDGE_MIN_MS", "1000"))
+LLM_HEDGE_MAX_MS = float(os.getenv("LLM_HEDGE_MAX_MS", "10000"))
+LLM_HEDGE_POLL_SECONDS = 0.05
+
+LLM_STATS_WINDOW = 200          # số mẫu giữ lại / provider
+LLM_STATS_MAX_AGE = 300         # giây
+LLM_STATS_MIN_SAMPLES = 20      # ít hơn -> chưa tin p95 / tỉ lệ lỗi
+
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))        # lỗi liên tiếp
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))     # giây
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+log = get_logger("llm_router")
+
+
+class LLMUnavailable(Exception):
+    """Mọi provider đều lỗi / bị ngắt mạch / quá thời gian"""
+
+
+class ProviderStats:
+    def __init__(self, window=LLM_STATS_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=window)   # (thời điểm, giây, ok)
+
+    def record(self, seconds, ok):
+        with self._lock:
+            self._samples.append((time.time(), seconds, ok))
+
+    def _recent(self, since=0.0):
+        cutoff = max(time.time() - LLM_STATS_MAX_AGE, since)
+        with self._lock:
+            return [s for s in self._samples if s[0] >= cutoff]
+
+    def p95(self):
+        latencies = sorted(seconds for _, seconds, ok in self._recent() if ok)
+        if len(latencies) < LLM_STATS_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self, since=0.0):
+        """(tỉ lệ lỗi, số mẫu) - chỉ tính mẫu từ thời điểm since"""
+        recent = self._recent(since)
+        if not recent:
+            return 0.0, 0
+        return sum(1 for _, _, ok in recent if not ok) / len(recent), len(recent)
+
+    def snapshot(self):
+        rate, samples = self.error_rate()
+        p95 = self.p95()
+        return {"samples": samples, "error_rate": round(rate, 3),
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None}
+
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._closed_at = 0.0      # lỗi trước lần đóng mạch gần nhất không tính vào tỉ lệ lỗi
+        self._probing = False
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN and time.time() >= self._open_until:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok, stats):
+        with self._lock:
+            if ok:
+                self._failures = 0
+                if self.state == HALF_OPEN:
+                    self._probing = False
+                    self._transition(CLOSED)
+                return
+            self._failures += 1
+            if self.state == HALF_OPEN:
+                self._probing = False
+                self._trip()
+                return
+            rate, samples = stats.error_rate(since=self._closed_at)
+            if self.state == CLOSED and (self._failures >= LLM_BREAKER_FAILURES or
+                                         (samples >= LLM_STATS_MIN_SAMPLES and rate >= LLM_BREAKER_ERROR_RATE)):
+                self._trip()
+
+    def _trip(self):
+        self._open_until = time.time() + LLM_BREAKER_COOLDOWN
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        log.warning("llm_breaker", provider=self.name, state=state, previous=self.state,
+                    consecutive_failures=self._failures)
+        metrics.inc("chatbot_llm_breaker_total", provider=self.name, state=state)
+        if state == CLOSED:
+            self._closed_at = time.time()
+        self.state = state
+
+
+class _StreamGate:
+    """Chỉ 1 request (request đầu tiên có text) được đẩy reply_text ra on_reply_text"""
+
+    def __init__(self, on_reply_text):
+        self.on_reply_text = on_reply_text
+        self.owner = None
+        self._lock = threading.Lock()
+
+    def claim(self, attempt_id):
+        """Chốt kết quả của attempt_id: True nếu chưa request nào khác đẩy text ra ngoài (từ giờ cũng không)"""
+        with self._lock:
+            if self.owner is None:
+                self.owner = attempt_id
+            return self.owner == attempt_id
+
+    def for_attempt(self, attempt_id):
+        if self.on_reply_text is None:
+            return None
+        extractor = ReplyTextExtractor()
+
+        def on_chunk(piece):
+            if extractor.done or self.on_reply_text is None:
+                return
+            text = extractor.feed(piece)
+            if not (text or extractor.done):
+                return
+            with self._lock:
+                if self.owner is None:
+                    self.owner = attempt_id
+                elif self.owner != attempt_id:
+                    return
+            try:
+                self.on_reply_text(text, extractor.done)
+            except Exception as e:
+                # Gửi sớm lỗi thì thôi, câu trả lời đầy đủ vẫn được gửi sau
+                log.warning("early_reply_failed", page_id=metrics.current_page_id(), error=str(e))
+                self.on_reply_text = None
+
+        return on_chunk
+
+
+class LLMRouter:
+    def __init__(self, providers=None):
+        self.providers = {}
+        self.stats = {}
+        self.breakers = {}
+        self.executor = ThreadPoolExecutor(max_workers=LLM_ROUTER_THREADS, thread_name_prefix="llm")
+        for name, call in (providers or {}).items():
+            self.register(name, call)
+
+    def register(self, name, call):
+        self.providers[name] = call
+        self.stats[name] = ProviderStats()
+        self.breakers[name] = CircuitBreaker(name)
+
+    def provider_order(self, config):
+        order = config.get("llm", {}).get("providers") or LLM_PROVIDERS
+        return [name for name in order if name in self.providers]
+
+    def hedge_deadline(self, name):
+        p95 = self.stats[name].p95()
+        if p95 is None:
+            return LLM_HEDGE_DEFAULT_MS / 1000
+        return min(max(p95 * 1000, LLM_HEDGE_MIN_MS), LLM_HEDGE_MAX_MS) / 1000
+
+    def _run(self, name, trace, system_instruction, prompt, config, on_chunk, parse, on_start=None):
+        """Chạy trong thread của router: gọi provider + ghi thống kê / breaker (kể cả request thua)"""
+        if on_start is not None:
+            on_start()
+        started = time.perf_counter()
+        ok = False
+        try:
+            with metrics.use_trace(trace):
+                result = parse(self.providers[name](system_instruction, prompt, config, on_chunk))
+            ok = True
+            return result
+        except Exception as e:
+            metrics.inc("chatbot_llm_calls_total", page_id=trace.page_id if trace else "",
+                        provider=name, status="error", cache="")
+            log.warning("llm_attempt_failed", provider=name, error=str(e)[:300])
+            raise
+        finally:
+            self.stats[name].record(time.perf_counter() - started, ok)
+            self.breakers[name].record(ok, self.stats[name])
+
+    def generate(self, config, system_instruction, prompt, parse, on_reply_text=None):
+        """
+        Trả về (kết quả parse(text), tên provider).
+        Ném LLMUnavailable nếu không provider nào trả lời được trong LLM_TIMEOUT_SECONDS.
+        """
+        order = self.provider_order(config)
+        if not order:
+            raise LLMUnavailable("chưa cấu hình provider nào")
+        # Chỉ 1 provider -> cho phép gửi lại chính nó 1 lần (hedge / failover)
+        queue = order if len(order) > 1 else order * 2
+        hedge = config.get("llm", {}).get("hedge", LLM_HEDGE_ENABLED)
+
+        trace = metrics.current_trace()
+        gate = _StreamGate(on_reply_text)
+        pending = {}      # future -> (attempt_id, tên provider)
+        started_at = {}   # attempt_id -> lúc thread của pool bắt đầu chạy request
+        errors = []
+        attempts = itertools.count()
+        deadline = time.monotonic() + LLM_TIMEOUT_SECONDS
+
+        def launch():
+            while queue:
+                name = queue.pop(0)
+                if not self.breakers[name].allow():
+                    errors.append(f"{name}: circuit open")
+                    continue
+                attempt_id = next(attempts)
+                future = self.executor.submit(self._run, name, trace, system_instruction, prompt, config,
+                                              gate.for_attempt(attempt_id), parse,
+                                              lambda: started_at.setdefault(attempt_id, time.monotonic()))
+                pending[future] = (attempt_id, name)
+                return name, attempt_id
+            return None, None
+
+        def hedge_time():
+            # Request còn chờ thread trong pool -> chưa tính hạn, xem lại sau LLM_HEDGE_POLL_SECONDS
+            attempt_id, delay = hedge_wait
+            begun = started_at.get(attempt_id)
+            return begun + delay if begun is not None else time.monotonic() + LLM_HEDGE_POLL_SECONDS
+
+        primary, primary_id = launch()
+        hedge_wait = (primary_id, self.hedge_deadline(primary)) if primary and hedge else None
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                errors.append("timeout")
+                break
+            timeout = deadline - now
+            hedge_at = hedge_time() if hedge_wait is not None else None
+            if hedge_at is not None:
+                timeout = min(timeout, max(0.0, hedge_at - now))
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if hedge_wait is not None and hedge_wait[0] in started_at and time.monotonic() >= hedge_time():
+                    hedge_wait = None
+                    # Request đầu đã đẩy text cho khách -> nó còn sống, không cần hedge
+                    if gate.owner is None:
+                        hedged, _ = launch()
+                        if hedged:
+                            metrics.inc("chatbot_llm_hedges_total", provider=hedged, primary=primary)
+                            log.info("llm_hedged", primary=primary, hedge=hedged,
+                                     page_id=trace.page_id if trace else "")
+                continue
+
+            for future in done:
+                attempt_id, name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(f"{name}: {str(e)[:200]}")
+                    if gate.owner == attempt_id:
+                        # Khách đã thấy câu đầu của request này -> câu trả lời khác sẽ lệch với phần đã gửi
+                        raise LLMUnavailable("; ".join(errors) + " (sau khi đã gửi mảnh đầu)")
+                    if not pending:
+                        failover, failover_id = launch()
+                        if failover and hedge_wait is not None:
+                            hedge_wait = (failover_id, self.hedge_deadline(failover))
+                    continue
+                if not gate.claim(attempt_id):
+                    # Khách đã thấy câu đầu của request khác -> chỉ chờ request đó
+                    continue
+                return result, name
+
+        raise LLMUnavailable("; ".join(errors) or "không có provider khả dụng")
+
+    def snapshot(self):
+        return {name: {"state": self.breakers[name].state, **self.stats[name].snapshot()}
+                for name in self.providers}
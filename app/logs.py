@@ -0,0 +1,141 @@
+# app/logs.py
+"""
+Log có cấu trúc, lấy mẫu, ghi bất đồng bộ (thay cho print() trên đường nóng).
+
+    log = get_logger("worker")
+    log.info("turn_done", page_id=page_id, ms=812)
+    -> {"ts": 1760000000.123, "level": "info", "logger": "worker", "event": "turn_done", "page_id": "1", "ms": 812}
+
+- Luồng xử lý chỉ tốn 1 lần put vào queue trong RAM; 1 thread QueueListener ghi stdout.
+  Queue đầy (stdout nghẽn) -> bỏ dòng log, không bao giờ chặn lượt chat.
+- Lấy mẫu: sự kiện lặp lại mỗi lượt chat truyền sample=HOT_SAMPLE (LOG_HOT_SAMPLE_RATE).
+  warning / error không bao giờ bị lấy mẫu.
+- LOG_FORMAT=text -> "HH:MM:SS level logger event k=v ..." cho lúc dev.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Tỉ lệ giữ lại log lặp lại mỗi lượt chat (1.0 = giữ hết)
+HOT_SAMPLE = float(os.getenv("LOG_HOT_SAMPLE_RATE", "0.1"))
+LOG_QUEUE_SIZE = 10000
+
+
+class _Formatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, "fields", {})
+        if LOG_FORMAT == "text":
+            pairs = " ".join(f"{k}={v}" for k, v in fields.items())
+            line = f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname.lower()} " \
+                   f"{record.name[8:]} {record.getMessage()} {pairs}".rstrip()
+        else:
+            line = json.dumps({
+                "ts": round(record.created, 3),
+                "level": record.levelname.lower(),
+                "logger": record.name[8:],   # bỏ tiền tố "chatbot."
+                "event": record.getMessage(),
+                **fields,
+            }, ensure_ascii=False, default=str)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Không format ở luồng gọi, queue đầy thì bỏ dòng log (đếm lại ở `dropped`)"""
+
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def _setup():
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(_Formatter())
+        _listener = logging.handlers.QueueListener(log_queue, stream)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger("chatbot")
+        root.addHandler(_DroppingQueueHandler(log_queue))
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+
+
+def _stop_listener():
+    # Trước fork (app/supervisor.py): ghi nốt queue rồi dừng thread ghi log -> process con không thừa hưởng
+    # lock (queue / stdout) đang bị thread đó giữ
+    if _listener is not None:
+        _listener.stop()
+
+
+def _start_listener():
+    if _listener is not None:
+        _listener.start()
+
+
+os.register_at_fork(before=_stop_listener, after_in_parent=_start_listener, after_in_child=_start_listener)
+
+
+class Logger:
+    def __init__(self, name):
+        self._logger = logging.getLogger(f"chatbot.{name}")
+
+    def _log(self, level, event, sample, exc_info, fields):
+        if sample < 1.0:
+            if random.random() >= sample:
+                return
+            fields["sample"] = sample
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, event, sample=1.0, **fields):
+        self._log(logging.DEBUG, event, sample, False, fields)
+
+    def info(self, event, sample=1.0, **fields):
+        self._log(logging.INFO, event, sample, False, fields)
+
+    def warning(self, event, exc_info=False, **fields):
+        self._log(logging.WARNING, event, 1.0, exc_info, fields)
+
+    def error(self, event, exc_info=False, **fields):
+        self._log(logging.ERROR, event, 1.0, exc_info, fields)
+
+
+def get_logger(name):
+    _setup()
+    return Logger(name)
+
+
+def shutdown():
+    """Ghi nốt log còn trong queue (process thoát bằng os._exit, vd process con của app/supervisor.py)"""
+    _stop_listener()
+
+
+def dropped_count():
+    return _DroppingQueueHandler.dropped
@@ -1,22 +1,77 @@
 # app/main.py
+import asyncio
 import os
 import sys
+import time
+import hmac
+import hashlib
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 from app.config_loader import load_config
 from app.fb_helper import FacebookClient
 from app.schemas import LeadData # Import khuôn dữ liệu
+from app.chat_queue import CHAT_GROUP, CHAT_QUEUE, CHAT_STREAM, QUEUE_BACKEND, enqueue_async
+from app.fair_queue import page_depths_async
+from app import dedup
+from app.spill_journal import SPILL_ENABLED, SPILL_ENQUEUE_TIMEOUT_MS, SpillJournal
+from app.supervisor import STATUS_KEY as SUPERVISOR_STATUS_KEY, STATUS_STALE_SECONDS
+from app.crm_connector import CRM_LEADS_QUEUE, CRM_RETRY_SCHEDULE, CRM_RETRY_QUEUE, CRM_DEAD_LETTER, CRM_STATS_KEY
+from app.outbound import OUTBOUND_DEAD, shard_keys as outbound_shard_keys
+from app.timers import TIMERS_KEY
+from app import metrics
+from app.logs import get_logger
 
 # Khởi tạo App
 app = FastAPI()
 
 # Load biến môi trường
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "1234567890")
+# App Secret của Facebook App -> dùng để kiểm tra chữ ký X-Hub-Signature-256
+FB_APP_SECRET = os.getenv("FB_APP_SECRET")
 redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "50"))
 
 # Queue (Redis) để Worker xử lý sau
-import redis
+# Dùng redis.asyncio + connection pool: webhook là async nên KHÔNG được gọi client đồng bộ
+# (BlockingConnectionPool: hết kết nối thì chờ, không ném lỗi "Too many connections")
+import redis.asyncio as aioredis
 import json
-r = redis.from_url(redis_url)
+redis_pool = aioredis.BlockingConnectionPool.from_url(redis_url, max_connections=REDIS_POOL_SIZE, timeout=5)
+r = aioredis.Redis(connection_pool=redis_pool)
+log = get_logger("webhook")
+# Redis lỗi / chậm -> ghi tin vào journal trên đĩa và vẫn ack Facebook (app/spill_journal.py)
+spill = SpillJournal() if SPILL_ENABLED else None
+# Record journal bắt đầu bằng byte này = cục webhook chưa qua dedup (lọc lúc replay)
+SPILL_UNFILTERED = b"~"
+
+if not FB_APP_SECRET:
+    log.warning("signature_check_disabled", reason="FB_APP_SECRET chưa cấu hình")
+
+def verify_signature(raw_body: bytes, signature_header):
+    """So khớp X-Hub-Signature-256 (sha256=<hex>) với HMAC của đúng bytes đã nhận"""
+    if not FB_APP_SECRET:
+        return True
+    if not signature_header or not signature_header.startswith("sha256="):
+        return False
+    expected = hmac.new(FB_APP_SECRET.encode(), raw_body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature_header[7:])
+
+@app.on_event("startup")
+def start_metrics_flusher():
+    # Flusher chạy trong thread -> dùng client đồng bộ riêng (1 kết nối)
+    import redis
+    metrics.start_flusher(redis.from_url(redis_url))
+
+@app.on_event("startup")
+async def start_spill_drainer():
+    if spill:
+        app.state.spill_drainer = asyncio.create_task(spill.run_drainer(_replay_spilled))
+
+@app.on_event("shutdown")
+async def close_redis_pool():
+    if spill:
+        spill.close()
+    await redis_pool.disconnect()
 
 @app.get("/")
 def home():
@@ -30,7 +85,7 @@ def verify_webhook(request: Request):
 
     if mode and token:
         if mode == "subscribe" and token == VERIFY_TOKEN:
-            print("WEBHOOK_VERIFIED")
+            log.info("webhook_verified")
             return int(challenge)
         else:
             raise HTTPException(status_code=403, detail="Forbidden")
@@ -38,11 +93,183 @@ def verify_webhook(request: Request):
 
 @app.post("/webhook")
 async def handle_webhook(request: Request):
-    body = await request.json()
-    # Đẩy toàn bộ cục tin nhắn vào hàng đợi (Queue) để Worker xử lý
-    r.rpush("chat_queue", json.dumps(body))
+    # Lấy bytes gốc: vừa để kiểm tra chữ ký, vừa đẩy nguyên văn vào queue (không parse/dump lại)
+    raw_body = await request.body()
+    if not verify_signature(raw_body, request.headers.get("X-Hub-Signature-256")):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+
+    # Journal còn tin chưa replay (Redis vừa lỗi) -> ghi tiếp vào journal để giữ thứ tự
+    if spill and spill.pending:
+        with metrics.span("webhook_spill"):
+            await spill.append(SPILL_UNFILTERED + raw_body)
+        return {"message": "Event received"}
+
+    # event_ids = None: dedup chưa trả kết quả (có thể đã đánh dấu trong Redis rồi mới quá hạn chờ)
+    accepted = {"raw": raw_body, "event_ids": None}
+    try:
+        if spill:
+            await asyncio.wait_for(_enqueue(accepted), SPILL_ENQUEUE_TIMEOUT_MS / 1000)
+        else:
+            await _enqueue(accepted)
+    except Exception as e:
+        if not spill:
+            # FB sẽ gửi lại -> lần đó không được coi là trùng
+            await _release_dedup(accepted)
+            raise
+        log.warning("webhook_spilled", error=str(e) or type(e).__name__)
+        try:
+            with metrics.span("webhook_spill"):
+                # Dedup có thể đã đánh dấu các sự kiện (kể cả khi quá hạn chờ) -> replay không lọc lại
+                await spill.append(accepted["raw"])
+        except Exception:
+            # Không vào được hàng đợi lẫn journal (đĩa đầy...) -> trả 500, lần FB gửi lại không bị coi là trùng
+            await _release_dedup(accepted)
+            raise
     return {"message": "Event received"}
 
+async def _enqueue(accepted):
+    """Bỏ sự kiện trùng rồi đẩy vào hàng đợi; accepted["raw"] luôn là phần còn lại cần xử lý"""
+    # Bỏ sự kiện FB gửi lại (trùng message.mid...) trước khi vào hàng đợi (app/dedup.py)
+    if dedup.DEDUP_ENABLED:
+        raw, accepted["event_ids"] = await dedup.filter_webhook_async(r, accepted["raw"])
+        if raw is None:
+            return
+        accepted["raw"] = raw
+
+    # Đẩy toàn bộ cục tin nhắn vào hàng đợi (Queue) để Worker xử lý
+    with metrics.span("webhook_enqueue"):
+        await enqueue_async(r, accepted["raw"])
+
+async def _release_dedup(accepted):
+    """Trả lại event_id đã đánh dấu; Redis lỗi thì chỉ ghi log (không che mất lỗi gốc)"""
+    event_ids = accepted["event_ids"]
+    if event_ids is None:
+        # Không biết lần kiểm tra đã đánh dấu những gì -> trả cả cục (thà xử lý trùng còn hơn mất tin)
+        event_ids = dedup.webhook_event_ids(accepted["raw"]) if dedup.DEDUP_ENABLED else []
+    try:
+        await dedup.release_async(r, event_ids)
+    except Exception as e:
+        log.warning("dedup_release_failed", events=len(event_ids), error=str(e) or type(e).__name__)
+
+async def _replay_spilled(record):
+    """Drainer: record chưa qua dedup (ghi lúc journal còn tồn) được lọc trùng trước khi vào hàng đợi"""
+    if not record.startswith(SPILL_UNFILTERED):
+        await enqueue_async(r, record)
+        return
+    accepted = {"raw": record[len(SPILL_UNFILTERED):], "event_ids": None}
+    try:
+        await _enqueue(accepted)
+    except asyncio.CancelledError:
+        # Quá SPILL_REPLAY_TIMEOUT_SECONDS: trả event_id ở task riêng, không giữ drainer chờ Redis
+        asyncio.ensure_future(_release_dedup(accepted))
+        raise
+    except Exception:
+        # Record được replay lại sau -> lần đó không được coi là trùng
+        await _release_dedup(accepted)
+        raise
+
+async def _chat_backlog():
+    """Số tin chờ xử lý: list -> LLEN; stream -> lag (chưa giao) + pending (chưa ACK) của group"""
+    if QUEUE_BACKEND == "fair":
+        pages, priority = await page_depths_async(r)
+        return sum(depth for depth, _ in pages.values()) + priority
+    if QUEUE_BACKEND != "stream":
+        return await r.llen(CHAT_QUEUE)
+    try:
+        groups = await r.xinfo_groups(CHAT_STREAM)
+    except Exception:
+        return 0
+    for group in groups:
+        if group.get("name") in (CHAT_GROUP, CHAT_GROUP.encode()):
+            return (group.get("lag") or 0) + (group.get("pending") or 0)
+    return 0
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Prometheus exposition format: metric cộng dồn của MỌI process (hash Redis "metrics",
+    xem app/metrics.py) + độ sâu các hàng đợi đo tại chỗ.
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(metrics.METRICS_KEY)
+    pipe.llen(OUTBOUND_DEAD)
+    pipe.llen(CRM_LEADS_QUEUE)
+    pipe.zcard(CRM_RETRY_SCHEDULE)
+    pipe.llen(CRM_DEAD_LETTER)
+    pipe.hgetall(SUPERVISOR_STATUS_KEY)
+    pipe.zcard(TIMERS_KEY)
+    pipe.zcount(TIMERS_KEY, "-inf", time.time())
+    for key in outbound_shard_keys():
+        pipe.llen(key)
+    (raw, outbound_dead, crm_pending, crm_retry, crm_dead, supervisors,
+     timers_total, timers_due, *outbound_shards) = await pipe.execute()
+    outbound_depth = sum(outbound_shards)
+    gauges = {"chatbot_queue_depth": [
+        ({"queue": "chat"}, await _chat_backlog()),
+        ({"queue": "outbound"}, outbound_depth),
+        ({"queue": "outbound_dead"}, outbound_dead),
+        ({"queue": "crm_pending"}, crm_pending),
+        ({"queue": "crm_retry"}, crm_retry),
+        ({"queue": "crm_dead"}, crm_dead),
+        # Timer đang hẹn / đã tới hạn mà chưa chạy (app/timers.py)
+        ({"queue": "timers"}, timers_total),
+        ({"queue": "timers_due"}, timers_due),
+    ]}
+    # Pool worker của từng supervisor (app/supervisor.py) còn đang chạy
+    gauges.update({"chatbot_workers": [], "chatbot_workers_desired": [], "chatbot_workers_busy": []})
+    for name, status in supervisors.items():
+        status = json.loads(status)
+        if time.time() - status.get("ts", 0) > STATUS_STALE_SECONDS:
+            continue
+        name = name.decode()
+        gauges["chatbot_workers"].append(({"supervisor": name, "state": "running"}, status["workers"]))
+        gauges["chatbot_workers"].append(({"supervisor": name, "state": "retiring"}, status["retiring"]))
+        gauges["chatbot_workers_desired"].append(({"supervisor": name}, status["desired"]))
+        gauges["chatbot_workers_busy"].append(({"supervisor": name}, status["busy"]))
+    if spill:
+        # Chỉ journal của process webhook đang trả lời request này
+        gauges["chatbot_queue_depth"].append(({"queue": "webhook_spill"}, spill.pending))
+    if QUEUE_BACKEND == "fair":
+        # Hàng đợi theo Page (app/fair_queue.py): tin chờ + tin đang xử lý của từng Page
+        pages, priority = await page_depths_async(r)
+        gauges["chatbot_queue_depth"].append(({"queue": "chat_priority"}, priority))
+        gauges["chatbot_page_queue_depth"] = [({"page_id": p}, depth) for p, (depth, _) in pages.items()]
+        gauges["chatbot_page_inflight"] = [({"page_id": p}, inflight) for p, (_, inflight) in pages.items()]
+    return PlainTextResponse(metrics.render(raw, gauges), media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/traces")
+async def recent_traces(limit: int = 50, page_id: str = None, min_ms: float = 0):
+    """Trace gần nhất của các lượt chat (lượt chậm + lượt được lấy mẫu): thời gian từng bước"""
+    raw = await r.lrange(metrics.TRACES_KEY, 0, metrics.TRACES_KEEP - 1)
+    traces = []
+    for item in raw:
+        trace = json.loads(item)
+        if page_id and trace.get("page_id") != page_id:
+            continue
+        if trace.get("total_ms", 0) < min_ms:
+            continue
+        traces.append(trace)
+        if len(traces) >= limit:
+            break
+    return {"traces": traces}
+
+@app.get("/crm/stats")
+async def crm_stats():
+    """Độ sâu hàng đợi CRM + độ trễ giao lead (xem app/crm_dispatcher.py)"""
+    pipe = r.pipeline(transaction=False)
+    pipe.llen(CRM_LEADS_QUEUE)
+    pipe.zcard(CRM_RETRY_SCHEDULE)
+    pipe.llen(CRM_RETRY_QUEUE)
+    pipe.llen(CRM_DEAD_LETTER)
+    pipe.hgetall(CRM_STATS_KEY)
+    pending, retrying, legacy, dead, raw_stats = await pipe.execute()
+    return {
+        "pending": pending,
+        "retrying": retrying + legacy,
+        "dead": dead,
+        **{k.decode(): v.decode() for k, v in raw_stats.items()},
+    }
+
 # ==========================================
 #  MOCK CRM API 
 # ==========================================
@@ -70,4 +297,31 @@ async def receive_lead_from_bot(lead: LeadData):
         "status": "success",
         "message": "Lead created successfully",
         "deal_id": "DEAL_NEW_9999"
-    }
\ No newline at end of file
+    }
+
+@app.post("/mock-crm/leads/batch")
+async def receive_lead_batch(request: Request):
+    """
+    Bản bulk của /mock-crm/leads: nhận {"leads": [...]}, trả kết quả RIÊNG từng lead
+    (lead sai schema chỉ lỗi lead đó, không làm hỏng cả batch).
+    """
+    payload = await request.json()
+    results = []
+    for i, raw_lead in enumerate(payload.get("leads", [])):
+        # Bản update (app/lead_index.py) chỉ chứa field định danh + field đã đổi
+        if raw_lead.get("op") == "update":
+            if raw_lead.get("facebook_uid") or raw_lead.get("phone") or raw_lead.get("email"):
+                results.append({"index": i, "status": "success", "deal_id": f"DEAL_{raw_lead.get('lead_id')}"})
+            else:
+                results.append({"index": i, "status": "error", "error": "update thiếu field định danh"})
+            continue
+        try:
+            lead = LeadData(**raw_lead)
+        except Exception as e:
+            results.append({"index": i, "status": "error", "error": str(e)[:200]})
+            continue
+        results.append({"index": i, "status": "success", "deal_id": f"DEAL_{lead.facebook_uid}"})
+
+    ok = sum(1 for item in results if item["status"] == "success")
+    print(f"🌟 [MOCK CRM] Nhận batch {len(results)} lead ({ok} hợp lệ)")
+    return {"status": "success", "results": results}
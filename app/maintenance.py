@@ -0,0 +1,303 @@
+# app/maintenance.py
+"""
+Công cụ bảo trì bộ nhớ hội thoại trên Redis (thay cho app/reset_memory.py).
+
+Không bao giờ dùng KEYS / DEL từng key:
+- Duyệt bằng SCAN theo con trỏ, mỗi lô đọc/xóa bằng 1 pipeline, xóa bằng UNLINK
+  (giải phóng bộ nhớ ở thread nền của Redis, không chặn server).
+- Giới hạn tốc độ (--max-keys-per-sec) + tự lùi lại khi độ trễ pipeline vượt
+  --max-latency-ms -> bot đang chạy không bị giật.
+
+Lệnh:
+    python -m app.maintenance audit                       # đếm key, số key thiếu TTL
+    python -m app.maintenance repair-ttl [--ttl 259200]   # gắn TTL cho key thiếu
+    python -m app.maintenance purge --page 2002 --older-than 30d --export backup.jsonl
+    python -m app.maintenance purge --all --dry-run
+
+purge xóa trọn bộ session/history/tags của từng khách khớp bộ lọc
+(--page / --topic / --older-than theo updated_at của session, hoặc --all) và gỡ khách
+khỏi chỉ mục tag của Page (app/tag_store.py). --all xóa luôn chỉ mục "tagidx:*".
+--orphans: xóa thêm history/tags không còn session đi kèm.
+"""
+import datetime
+import json
+import os
+import time
+
+from app.session_store import (SESSION_TTL_SECONDS, history_key, parse_tags, session_key,
+                               tag_index_key, tags_key)
+
+CONVERSATION_PATTERNS = ("session:*", "history:*", "tags:*")
+SCAN_BATCH = 500
+DEFAULT_MAX_KEYS_PER_SEC = 5000
+DEFAULT_MAX_LATENCY_MS = 20
+MAX_BACKOFF_SECONDS = 2.0
+
+
+def parse_age(value):
+    """ "30d" / "12h" / "45m" / "3600" -> số giây"""
+    if value is None:
+        return None
+    units = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+    value = str(value).strip().lower()
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def sender_of(key):
+    return key.decode().split(":", 1)[1]
+
+
+class Throttle:
+    """
+    Giữ tốc độ <= max_keys_per_sec và lùi lại (nhân đôi thời gian nghỉ) khi
+    round trip của pipeline chậm hơn max_latency_ms - dấu hiệu Redis đang bận.
+    """
+
+    def __init__(self, max_keys_per_sec=DEFAULT_MAX_KEYS_PER_SEC, max_latency_ms=DEFAULT_MAX_LATENCY_MS):
+        self.max_keys_per_sec = max_keys_per_sec
+        self.max_latency = max_latency_ms / 1000
+        self.backoff = 0.0
+        self.slow_batches = 0
+
+    def timed(self, pipe, raise_on_error=True):
+        started = time.perf_counter()
+        result = pipe.execute(raise_on_error=raise_on_error)
+        latency = time.perf_counter() - started
+        if latency > self.max_latency:
+            self.slow_batches += 1
+            self.backoff = min(MAX_BACKOFF_SECONDS, max(0.01, self.backoff * 2))
+        else:
+            self.backoff /= 2
+        return result
+
+    def pace(self, n_keys):
+        pause = self.backoff
+        if self.max_keys_per_sec:
+            pause += n_keys / self.max_keys_per_sec
+        if pause:
+            time.sleep(pause)
+
+
+def scan_batches(r, pattern, batch=SCAN_BATCH):
+    keys = []
+    for key in r.scan_iter(match=pattern, count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            yield keys
+            keys = []
+    if keys:
+        yield keys
+
+
+# ==========================================
+#  AUDIT / REPAIR TTL
+# ==========================================
+def audit(r, repair=False, ttl=SESSION_TTL_SECONDS, throttle=None, batch=SCAN_BATCH):
+    throttle = throttle or Throttle()
+    report = {}
+    for pattern in CONVERSATION_PATTERNS:
+        counts = {"keys": 0, "no_ttl": 0, "repaired": 0}
+        for keys in scan_batches(r, pattern, batch):
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                pipe.ttl(key)
+            ttls = throttle.timed(pipe)
+            missing = [key for key, t in zip(keys, ttls) if t == -1]
+            counts["keys"] += len(keys)
+            counts["no_ttl"] += len(missing)
+            if repair and missing:
+                pipe = r.pipeline(transaction=False)
+                for key in missing:
+                    pipe.expire(key, ttl)
+                throttle.timed(pipe)
+                counts["repaired"] += len(missing)
+            throttle.pace(len(keys))
+        report[pattern] = counts
+    report["slow_batches"] = throttle.slow_batches
+    return report
+
+
+# ==========================================
+#  PURGE
+# ==========================================
+def _session_matches(fields, page_id, topic, older_than, now):
+    page, session_topic, updated_at = fields
+    if page_id and (page or b"").decode() != str(page_id):
+        return False
+    if topic and (session_topic or b"").decode() != topic:
+        return False
+    if older_than:
+        try:
+            updated = datetime.datetime.fromisoformat(updated_at.decode()).timestamp()
+        except (AttributeError, ValueError):
+            return True   # Session cũ không có updated_at -> coi như rất cũ
+        if now - updated < older_than:
+            return False
+    return True
+
+
+def _read_tags(r, key, raw):
+    """Kết quả HGETALL tags:<id>; key còn là list kiểu cũ (WRONGTYPE) thì đọc bằng LRANGE"""
+    if isinstance(raw, Exception):
+        return [t.decode() for t in r.lrange(key, 0, -1)]
+    return parse_tags(raw)
+
+
+def _export(r, sender_ids, out, throttle):
+    pipe = r.pipeline(transaction=False)
+    for sender_id in sender_ids:
+        pipe.hgetall(session_key(sender_id))
+        pipe.lrange(history_key(sender_id), 0, -1)
+        pipe.hgetall(tags_key(sender_id))
+    raw = throttle.timed(pipe, raise_on_error=False)
+    for i, sender_id in enumerate(sender_ids):
+        session, history, tags = raw[3 * i:3 * i + 3]
+        out.write(json.dumps({
+            "sender_id": sender_id,
+            "session": {k.decode(): v.decode() for k, v in session.items()},
+            "history": [h.decode() for h in history],
+            "tags": _read_tags(r, tags_key(sender_id), tags),
+        }, ensure_ascii=False) + "\n")
+
+
+def _unindex_tags(r, sender_ids, throttle):
+    """Gỡ khách khỏi zset "tagidx:<page>:<tag>" trước khi xóa session (mất page_id)"""
+    pipe = r.pipeline(transaction=False)
+    for sender_id in sender_ids:
+        pipe.hget(session_key(sender_id), "page_id")
+        pipe.hkeys(tags_key(sender_id))
+    raw = throttle.timed(pipe, raise_on_error=False)
+    pipe = r.pipeline(transaction=False)
+    queued = 0
+    for i, sender_id in enumerate(sender_ids):
+        page_id, fields = raw[2 * i], raw[2 * i + 1]
+        if not page_id or isinstance(fields, Exception):
+            continue
+        for field in fields:
+            kind, tag = field.decode().split(":", 1)
+            if kind == "c":
+                pipe.zrem(tag_index_key(page_id.decode(), tag), sender_id)
+                queued += 1
+    if queued:
+        throttle.timed(pipe)
+
+
+def _unlink(r, keys, throttle):
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.unlink(key)
+    return sum(throttle.timed(pipe))
+
+
+def purge(r, page_id=None, topic=None, older_than=None, purge_all=False, orphans=False,
+          dry_run=False, export_path=None, throttle=None, batch=SCAN_BATCH):
+    if not (purge_all or page_id or topic or older_than or orphans):
+        raise ValueError("Cần ít nhất 1 bộ lọc (--page / --topic / --older-than / --orphans) hoặc --all")
+
+    throttle = throttle or Throttle()
+    stats = {"sessions_scanned": 0, "customers_matched": 0, "keys_deleted": 0, "orphans": 0}
+    out = open(export_path, "a", encoding="utf-8") if export_path else None
+    now = time.time()
+    try:
+        # 1. Theo session (có page_id / topic / updated_at để lọc)
+        if purge_all or page_id or topic or older_than:
+            for keys in scan_batches(r, "session:*", batch):
+                stats["sessions_scanned"] += len(keys)
+                if purge_all:
+                    matched = [sender_of(k) for k in keys]
+                else:
+                    pipe = r.pipeline(transaction=False)
+                    for key in keys:
+                        pipe.hmget(key, "page_id", "topic", "updated_at")
+                    rows = throttle.timed(pipe)
+                    matched = [sender_of(k) for k, fields in zip(keys, rows)
+                               if _session_matches(fields, page_id, topic, older_than, now)]
+                stats["customers_matched"] += len(matched)
+                if matched and not dry_run:
+                    if out:
+                        _export(r, matched, out, throttle)
+                    if not purge_all:
+                        _unindex_tags(r, matched, throttle)
+                    stats["keys_deleted"] += _unlink(r, [key_fn(s) for s in matched
+                                                         for key_fn in (session_key, history_key, tags_key)], throttle)
+                throttle.pace(len(keys))
+
+        # 2. history/tags mồ côi (không còn session) - hoặc tất cả (kèm chỉ mục tag) nếu --all
+        #    Tags mồ côi không còn page_id -> không gỡ được khỏi chỉ mục, để chỉ mục tự hết hạn
+        if purge_all or orphans:
+            for pattern in ("history:*", "tags:*") + (("tagidx:*",) if purge_all else ()):
+                for keys in scan_batches(r, pattern, batch):
+                    if purge_all:
+                        stale = keys
+                    else:
+                        pipe = r.pipeline(transaction=False)
+                        for key in keys:
+                            pipe.exists(session_key(sender_of(key)))
+                        stale = [k for k, alive in zip(keys, throttle.timed(pipe)) if not alive]
+                    stats["orphans"] += len(stale)
+                    if stale and not dry_run:
+                        # Chỉ mục tag là dữ liệu dẫn xuất -> không cần export
+                        if out and pattern != "tagidx:*":
+                            pipe = r.pipeline(transaction=False)
+                            for key in stale:
+                                if pattern == "history:*":
+                                    pipe.lrange(key, 0, -1)
+                                else:
+                                    pipe.hgetall(key)
+                            for key, values in zip(stale, throttle.timed(pipe, raise_on_error=False)):
+                                if pattern == "history:*":
+                                    values = [v.decode() for v in values]
+                                else:
+                                    values = _read_tags(r, key, values)
+                                out.write(json.dumps({"key": key.decode(), "values": values},
+                                                     ensure_ascii=False) + "\n")
+                        stats["keys_deleted"] += _unlink(r, stale, throttle)
+                    throttle.pace(len(keys))
+    finally:
+        if out:
+            out.close()
+
+    stats["dry_run"] = dry_run
+    stats["slow_batches"] = throttle.slow_batches
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    import redis
+    from dotenv import load_dotenv
+
+    sys.path.append(os.getcwd())
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Bảo trì bộ nhớ hội thoại trên Redis (SCAN + UNLINK, có giới hạn tốc độ)")
+    parser.add_argument("command", choices=["audit", "repair-ttl", "purge"])
+    parser.add_argument("--page", help="chỉ khách của page_id này")
+    parser.add_argument("--topic", help="chỉ khách của topic này")
+    parser.add_argument("--older-than", help="session không hoạt động lâu hơn (vd: 30d, 12h)")
+    parser.add_argument("--all", action="store_true", help="xóa TOÀN BỘ bộ nhớ hội thoại")
+    parser.add_argument("--orphans", action="store_true", help="xóa history/tags không còn session")
+    parser.add_argument("--dry-run", action="store_true", help="chỉ đếm, không xóa")
+    parser.add_argument("--export", help="ghi dữ liệu ra file JSONL trước khi xóa")
+    parser.add_argument("--ttl", type=int, default=SESSION_TTL_SECONDS, help="TTL (giây) cho repair-ttl")
+    parser.add_argument("--batch", type=int, default=SCAN_BATCH)
+    parser.add_argument("--max-keys-per-sec", type=int, default=DEFAULT_MAX_KEYS_PER_SEC)
+    parser.add_argument("--max-latency-ms", type=float, default=DEFAULT_MAX_LATENCY_MS)
+    args = parser.parse_args()
+
+    r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    throttle = Throttle(args.max_keys_per_sec, args.max_latency_ms)
+
+    if args.command in ("audit", "repair-ttl"):
+        result = audit(r, repair=args.command == "repair-ttl", ttl=args.ttl, throttle=throttle, batch=args.batch)
+    else:
+        try:
+            result = purge(r, page_id=args.page, topic=args.topic, older_than=parse_age(args.older_than),
+                           purge_all=args.all, orphans=args.orphans, dry_run=args.dry_run,
+                           export_path=args.export, throttle=throttle, batch=args.batch)
+        except ValueError as e:
+            parser.error(str(e))
+    print(f"✅ {args.command}: {json.dumps(result, ensure_ascii=False)}")
@@ -0,0 +1,339 @@
+# app/metrics.py
+"""
+Đo đạc nhẹ cho đường nóng + dữ liệu cho endpoint Prometheus GET /metrics (app/main.py).
+
+- Mỗi process cộng dồn counter / histogram trong RAM (dict + lock, không I/O trên đường nóng).
+- Thread nền cứ METRICS_FLUSH_SECONDS giây cộng phần chênh lệch vào hash Redis "metrics"
+  bằng 1 pipeline HINCRBYFLOAT -> webhook + mọi worker / dispatcher được gộp chung.
+  Field của hash chính là 1 series Prometheus, vd:
+      chatbot_stage_seconds_bucket{page_id="1",stage="llm",le="0.5"}
+- Trace theo lượt chat:
+      with metrics.trace(page_id, sender_id) as t:
+          with t.span("session_load"): ...
+  Mỗi span ghi vào histogram chatbot_stage_seconds{stage=...}. Lượt chậm hơn TRACE_SLOW_SECONDS
+  hoặc được lấy mẫu (TRACE_SAMPLE_RATE) được log + lưu vào list "metrics:traces" (GET /metrics/traces).
+  Code sâu bên dưới (ai_engine, outbound...) dùng metrics.span(...) / current_trace() mà không cần
+  truyền trace qua tham số.
+
+Stage trong lượt chat : queue_wait, config_load, session_load, context_build, cache_lookup, llm, flow,
+                        session_commit, fb_enqueue, crm_enqueue, turn (cả lượt),
+                        first_reply (đầu lượt -> xếp hàng tin đầu tiên; streaming gửi sớm, app/reply_stream.py).
+Stage ngoài lượt chat: webhook_enqueue, webhook_spill (ghi journal khi Redis lỗi, app/spill_journal.py),
+                        fb_send (1 payload), fb_delivery (xếp hàng -> gửi xong),
+                        crm_push (1 batch), crm_delivery (xếp hàng -> CRM nhận),
+                        timer_lag (tới hạn -> timer được chạy, app/timers.py).
+"""
+import atexit
+import bisect
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+
+from app.logs import get_logger
+
+METRICS_KEY = "metrics"
+TRACES_KEY = "metrics:traces"
+TRACES_KEEP = 200
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "8"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Tên metric -> (loại, mô tả, buckets)
+DEFINITIONS = {
+    "chatbot_stage_seconds": ("histogram", "Thời gian từng bước xử lý (theo page_id, stage)", LATENCY_BUCKETS),
+    "chatbot_turns_total": ("counter", "Số lượt chat theo kết quả (reply, cache_hit, human, error)", None),
+    "chatbot_llm_calls_total": ("counter", "Số lần gọi LLM (theo page_id, provider, status)", None),
+    "chatbot_llm_hedges_total": ("counter", "Số request LLM dự phòng (hedge) theo provider", None),
+    "chatbot_llm_breaker_total": ("counter", "Số lần circuit breaker của provider LLM đổi trạng thái", None),
+    "chatbot_llm_tokens_total": ("counter", "Token LLM (kind: prompt, cached, output)", None),
+    "chatbot_fb_send_total": ("counter", "Số payload gửi Graph API (status: ok, failed, retry, throttled)", None),
+    "chatbot_crm_leads_total": ("counter", "Quyết định / kết quả giao lead CRM", None),
+    "chatbot_webhook_duplicates_total": ("counter", "Sự kiện webhook FB gửi lại bị bỏ (layer: recent, bloom)", None),
+    "chatbot_spill_total": ("counter", "Tin webhook ghi vào / replay từ journal đĩa khi Redis lỗi (event: spilled, replayed)", None),
+    "chatbot_response_cache_total": ("counter", "Tra cache câu trả lời (result: exact_hit, semantic_hit, miss, bypassed)", None),
+    "chatbot_timers_total": ("counter", "Timer đã chạy theo loại (result: fired, retry, dropped), xem app/timers.py", None),
+    "chatbot_supervisor_events_total": ("counter", "Sự kiện pool worker (spawn, retire, crash, hung, scale_up...)", None),
+    "chatbot_errors_total": ("counter", "Số lỗi theo thành phần", None),
+}
+
+log = get_logger("metrics")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_le(bound):
+    return "+Inf" if bound is None else repr(float(bound))
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}   # (name, labels) -> giá trị
+        self._hists = {}      # (name, labels) -> [số lần theo từng bucket..., +Inf, tổng]
+        self._traces = []
+        self._unflushed = {}  # phần đã drain nhưng ghi Redis lỗi -> cộng vào lần sau
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = DEFINITIONS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = [0] * (len(buckets) + 1) + [0.0]
+            hist[index] += 1
+            hist[-1] += value
+
+    def add_trace(self, record):
+        with self._lock:
+            self._traces.append(json.dumps(record, ensure_ascii=False))
+            del self._traces[:-TRACES_KEEP]
+
+    def drain(self):
+        """Lấy phần chênh lệch từ lần flush trước: {series: delta}, [trace]"""
+        with self._lock:
+            counters, hists, traces = self._counters, self._hists, self._traces
+            self._counters, self._hists, self._traces = {}, {}, []
+
+        fields = self._unflushed
+        self._unflushed = {}
+        for (name, labels), value in counters.items():
+            series = _series(name, labels)
+            fields[series] = fields.get(series, 0) + value
+        for (name, labels), hist in hists.items():
+            buckets = DEFINITIONS[name][2] + (None,)
+            cumulative = 0
+            # Gửi đủ mọi bucket (kể cả 0) để series trong Redis luôn đầy đủ
+            for bound, count in zip(buckets, hist[:-1]):
+                cumulative += count
+                series = _series(name + "_bucket", labels + (("le", _format_le(bound)),))
+                fields[series] = fields.get(series, 0) + cumulative
+            for suffix, value in (("_sum", hist[-1]), ("_count", cumulative)):
+                series = _series(name + suffix, labels)
+                fields[series] = fields.get(series, 0) + value
+        return fields, traces
+
+    def flush(self, redis_client):
+        fields, traces = self.drain()
+        if not fields and not traces:
+            return 0
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for series, value in fields.items():
+                pipe.hincrbyfloat(METRICS_KEY, series, value)
+            if traces:
+                pipe.lpush(TRACES_KEY, *traces)
+                pipe.ltrim(TRACES_KEY, 0, TRACES_KEEP - 1)
+            pipe.execute()
+        except Exception as e:
+            with self._lock:
+                for series, value in fields.items():
+                    self._unflushed[series] = self._unflushed.get(series, 0) + value
+            log.warning("metrics_flush_failed", error=str(e), pending=len(fields))
+            return 0
+        return len(fields)
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def start_flusher(redis_client, interval=METRICS_FLUSH_SECONDS):
+    """Thread nền đẩy metric của process lên Redis (gọi nhiều lần cũng chỉ chạy 1 thread)"""
+    global _flusher
+    with _flusher_lock:
+        if _flusher is not None:
+            return _flusher
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                registry.flush(redis_client)
+
+        _flusher = threading.Thread(target=loop, name="metrics-flush", daemon=True)
+        _flusher.start()
+        atexit.register(registry.flush, redis_client)
+        return _flusher
+
+
+def _reset_after_fork():
+    # Process con (app/supervisor.py) không đếm lại metric chưa flush của process cha, tự chạy flusher riêng
+    global _flusher, _flusher_lock
+    registry.__init__()
+    _flusher = None
+    _flusher_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# ==========================================
+#  TRACE THEO LƯỢT
+# ==========================================
+_local = threading.local()
+
+
+class Trace:
+    __slots__ = ("page_id", "sender_id", "started", "spans", "outcome", "attrs")
+
+    def __init__(self, page_id, sender_id=None):
+        self.page_id = str(page_id or "")
+        self.sender_id = sender_id
+        self.started = time.perf_counter()
+        self.spans = []
+        self.outcome = "reply"
+        self.attrs = {}
+
+    def add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+        registry.observe("chatbot_stage_seconds", seconds, page_id=self.page_id, stage=stage)
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def finish(self):
+        total = time.perf_counter() - self.started
+        self.add("turn", total)
+        registry.inc("chatbot_turns_total", page_id=self.page_id, outcome=self.outcome)
+        slow = total >= TRACE_SLOW_SECONDS
+        if slow or random.random() < TRACE_SAMPLE_RATE:
+            record = {
+                "ts": round(time.time(), 3),
+                "page_id": self.page_id,
+                "sender_id": self.sender_id,
+                "outcome": self.outcome,
+                "total_ms": round(total * 1000, 1),
+                "spans": [[stage, round(seconds * 1000, 1)] for stage, seconds in self.spans[:-1]],
+                **self.attrs,
+            }
+            registry.add_trace(record)
+            log.info("turn_trace", slow=slow, **record)
+        return total
+
+
+@contextlib.contextmanager
+def trace(page_id, sender_id=None):
+    """Trace cho 1 lượt chat (gắn vào thread hiện tại để code bên dưới ghi thêm span)"""
+    current = Trace(page_id, sender_id)
+    previous = getattr(_local, "trace", None)
+    _local.trace = current
+    try:
+        yield current
+    except Exception:
+        current.outcome = "error"
+        registry.inc("chatbot_errors_total", component="turn", page_id=current.page_id)
+        raise
+    finally:
+        _local.trace = previous
+        current.finish()
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+@contextlib.contextmanager
+def use_trace(current):
+    """Gắn trace của lượt chat sang thread khác (vd: thread gọi LLM của app/llm_router.py)"""
+    previous = getattr(_local, "trace", None)
+    _local.trace = current
+    try:
+        yield current
+    finally:
+        _local.trace = previous
+
+
+@contextlib.contextmanager
+def span(stage, page_id=None):
+    """Đo 1 bước: ghi vào trace đang chạy nếu có, không thì ghi thẳng histogram"""
+    current = current_trace()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        if current is not None:
+            current.add(stage, seconds)
+        else:
+            registry.observe("chatbot_stage_seconds", seconds, page_id=str(page_id or ""), stage=stage)
+
+
+def current_page_id(default=""):
+    current = current_trace()
+    return current.page_id if current is not None else default
+
+
+# ==========================================
+#  XUẤT RA DẠNG PROMETHEUS
+# ==========================================
+def _base_name(series):
+    name = series.split("{", 1)[0]
+    if name in DEFINITIONS:
+        return name
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[:-len(suffix)] in DEFINITIONS:
+            return name[:-len(suffix)]
+    return name
+
+
+def _sort_key(item):
+    """Bucket xếp theo giá trị le (số), không theo chuỗi"""
+    series = item[0]
+    head, sep, le = series.rpartition(',le="')
+    if not sep:
+        return series, 0.0
+    le = le.rstrip('"}')
+    return head, float("inf") if le == "+Inf" else float(le)
+
+
+def render(raw_metrics, gauges=None):
+    """
+    raw_metrics: HGETALL "metrics" (bytes), gauges: {tên: [(labels dict, giá trị)]} đo tại chỗ.
+    Trả về text exposition format của Prometheus.
+    """
+    grouped = {}
+    for series, value in raw_metrics.items():
+        series = series.decode() if isinstance(series, bytes) else series
+        value = float(value)
+        grouped.setdefault(_base_name(series), []).append((series, value))
+
+    lines = []
+    for name in sorted(grouped):
+        kind, help_text, _ = DEFINITIONS.get(name, ("untyped", "", None))
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for series, value in sorted(grouped[name], key=_sort_key):
+            lines.append(f"{series} {int(value) if value.is_integer() else value}")
+    for name, samples in (gauges or {}).items():
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{_series(name, tuple(sorted(labels.items())))} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,488 @@
+# app/outbound.py
+"""
+Hệ thống GỬI TIN ra Messenger tách riêng khỏi worker AI.
+
+Worker chỉ RPUSH 1 item vào "outbound_queue:<shard>" rồi đi tiếp (không chờ Graph API).
+Shard = crc32(page_id:recipient_id) % OUTBOUND_SHARDS -> mọi tin của 1 người nhận nằm chung 1 list.
+Dispatcher (process riêng hoặc thread nhúng trong MỖI worker) lo phần gửi:
+- Mỗi shard chỉ có 1 dispatcher được kéo tại 1 thời điểm (khóa thuê "outbound_queue:<shard>:owner",
+  SET NX PX + gia hạn). Các dispatcher đang sống (zset "outbound:dispatchers") chia đều shard;
+  shard phải nhường thì gửi xong phần đang dở rồi mới trả khóa -> thứ tự giữ đúng giữa các process.
+- 1 httpx.AsyncClient dùng chung, giữ kết nối keep-alive (không bắt tay TLS mỗi tin).
+- Token bucket theo từng Page nằm trên Redis (hash "outbound:bucket:<page_id>", Lua) -> N dispatcher
+  cộng lại vẫn chỉ OUTBOUND_RATE_PER_PAGE tin/giây; tự giảm tốc theo header X-App-Usage /
+  X-Business-Use-Case-Usage / X-Page-Usage mà Graph API trả về, tạm dừng Page khi bị khóa.
+- Retry backoff có jitter với lỗi 5xx / 429 / mã throttling (613, 4, 17, 32, 80006...).
+- Hết lượt retry -> "outbound_queue:dead" để tra soát.
+
+Mỗi item = 1 người nhận + danh sách tin gửi TUẦN TỰ (giữ đúng thứ tự trong 1 lượt).
+Các item của CÙNG người nhận cũng được gửi lần lượt theo thứ tự xếp hàng.
+
+Chạy riêng:    python -m app.outbound
+Test offline:  GRAPH_API_URL=http://127.0.0.1:9200/v18.0/me/messages (xem bench/stub_graph.py)
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import zlib
+
+import httpx
+
+from app import metrics
+from app.logs import HOT_SAMPLE, get_logger
+
+OUTBOUND_QUEUE = "outbound_queue"
+OUTBOUND_DEAD = "outbound_queue:dead"
+OUTBOUND_DISPATCHERS = "outbound:dispatchers"
+OUTBOUND_BUCKET_PREFIX = "outbound:bucket:"
+
+log = get_logger("outbound")
+
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v18.0/me/messages")
+# "queue": worker chỉ đẩy vào outbound_queue | "direct": gửi thẳng như cũ (requests)
+FB_SEND_MODE = os.getenv("FB_SEND_MODE", "queue").lower()
+
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "50"))
+OUTBOUND_MAX_CONNECTIONS = int(os.getenv("OUTBOUND_MAX_CONNECTIONS", "100"))
+OUTBOUND_TIMEOUT_SECONDS = float(os.getenv("OUTBOUND_TIMEOUT_SECONDS", "10"))
+OUTBOUND_RATE_PER_PAGE = float(os.getenv("OUTBOUND_RATE_PER_PAGE", "20"))   # tin / giây / Page
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+OUTBOUND_SHARDS = int(os.getenv("OUTBOUND_SHARDS", "16"))
+OUTBOUND_LEASE_SECONDS = float(os.getenv("OUTBOUND_LEASE_SECONDS", "15"))   # khóa shard hết hạn nếu dispatcher chết
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+
+# Mã lỗi Graph API tạm thời / bị giới hạn tốc độ -> nên thử lại
+RETRYABLE_FB_CODES = {1, 2, 4, 17, 32, 341, 613, 80006}
+# Usage (%) vượt ngưỡng này thì bắt đầu giảm tốc
+USAGE_SLOWDOWN_PERCENT = 75
+
+
+# ==========================================
+#  PHÍA WORKER: CHỈ ĐẨY VÀO QUEUE
+# ==========================================
+def shard_key(shard):
+    return f"{OUTBOUND_QUEUE}:{shard}"
+
+
+def shard_keys():
+    """Toàn bộ list shard (đo độ sâu hàng đợi)"""
+    return [shard_key(shard) for shard in range(OUTBOUND_SHARDS)]
+
+
+def recipient_shard(page_id, recipient_id):
+    return zlib.crc32(f"{page_id}:{recipient_id}".encode()) % OUTBOUND_SHARDS
+
+
+def enqueue_messages(redis_client, page_id, recipient_id, parts):
+    """
+    parts: list payload Graph API (không gồm recipient), vd:
+        [{"message": {"text": "..."}, "messaging_type": "RESPONSE"}, {"sender_action": "typing_on"}]
+    """
+    item = {
+        "page_id": str(page_id),
+        "recipient_id": str(recipient_id),
+        "parts": parts,
+        "enqueued_at": time.time(),
+    }
+    key = shard_key(recipient_shard(page_id, recipient_id))
+    redis_client.rpush(key, json.dumps(item, ensure_ascii=False))
+
+
+def text_part(text):
+    return {"message": {"text": text}, "messaging_type": "RESPONSE"}
+
+
+def enqueue_text(redis_client, page_id, recipient_id, *texts):
+    enqueue_messages(redis_client, page_id, recipient_id, [text_part(t) for t in texts if t])
+
+
+def enqueue_sender_action(redis_client, page_id, recipient_id, action="typing_on"):
+    enqueue_messages(redis_client, page_id, recipient_id, [{"sender_action": action}])
+
+
+# ==========================================
+#  GIỚI HẠN TỐC ĐỘ THEO PAGE (DÙNG CHUNG MỌI PROCESS)
+# ==========================================
+# Dùng giờ của Redis (TIME) để các máy lệch đồng hồ vẫn chung 1 nhịp.
+# Số thực trả về dạng chuỗi (Lua -> Redis cắt số thành số nguyên).
+
+# KEYS[1]=hash bucket; ARGV[1]=tốc độ gốc (tin/giây)
+# Trả về số giây phải chờ: "0" = đã lấy được 1 lượt
+ACQUIRE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate', 'paused_until')
+local base = tonumber(ARGV[1])
+local rate = tonumber(b[3]) or base
+local capacity = math.max(1, base)
+local paused_until = tonumber(b[4]) or 0
+if now < paused_until then return tostring(paused_until - now) end
+local tokens = tonumber(b[1]) or capacity
+local ts = tonumber(b[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+if redis.call('PTTL', KEYS[1]) < 60000 then redis.call('PEXPIRE', KEYS[1], 60000) end
+return tostring(wait)
+"""
+
+# KEYS[1]=hash bucket; ARGV[1]=tốc độ mới, ARGV[2]=số giây tạm dừng (0 = không dừng)
+ADJUST_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('HSET', KEYS[1], 'rate', ARGV[1])
+local pause = tonumber(ARGV[2])
+if pause > 0 then
+    local paused_until = math.max(now + pause, tonumber(redis.call('HGET', KEYS[1], 'paused_until')) or 0)
+    redis.call('HSET', KEYS[1], 'paused_until', tostring(paused_until), 'tokens', '0', 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil((paused_until - now) * 1000) + 60000)
+elseif redis.call('PTTL', KEYS[1]) < 60000 then
+    redis.call('PEXPIRE', KEYS[1], 60000)
+end
+return 1
+"""
+
+
+class TokenBucket:
+    """Token bucket của 1 Page, trạng thái nằm trên Redis"""
+
+    def __init__(self, sender, page_id, rate):
+        self.sender = sender
+        self.key = OUTBOUND_BUCKET_PREFIX + str(page_id)
+        self.base_rate = rate
+
+    async def acquire(self):
+        while True:
+            wait = float(await self.sender._acquire(keys=[self.key], args=[repr(self.base_rate)]))
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def adjust(self, usage_percent, pause_seconds=0):
+        """Usage càng cao thì tốc độ càng giảm (không thấp hơn 5% tốc độ gốc); pause_seconds > 0 -> tạm dừng Page"""
+        rate = self.base_rate
+        if usage_percent >= USAGE_SLOWDOWN_PERCENT:
+            rate *= max(0.05, (100 - usage_percent) / (100 - USAGE_SLOWDOWN_PERCENT))
+        await self.sender._adjust(keys=[self.key], args=[repr(rate), repr(pause_seconds)])
+
+
+def parse_usage_headers(headers):
+    """
+    Trả về (usage_percent cao nhất, số giây phải chờ để lấy lại quyền truy cập)
+    từ X-App-Usage / X-Page-Usage / X-Business-Use-Case-Usage.
+    """
+    usage = 0.0
+    regain_seconds = 0.0
+    for name in ("x-app-usage", "x-page-usage"):
+        raw = headers.get(name)
+        if not raw:
+            continue
+        try:
+            values = json.loads(raw)
+            usage = max(usage, *(float(v) for v in values.values() if isinstance(v, (int, float))))
+        except (ValueError, TypeError, AttributeError):
+            pass
+
+    raw = headers.get("x-business-use-case-usage")
+    if raw:
+        try:
+            for entries in json.loads(raw).values():
+                for entry in entries:
+                    usage = max(usage, float(entry.get("call_count", 0)),
+                                float(entry.get("total_time", 0)), float(entry.get("total_cputime", 0)))
+                    regain_seconds = max(regain_seconds, float(entry.get("estimated_time_to_regain_access", 0)) * 60)
+        except (ValueError, TypeError, AttributeError):
+            pass
+    return usage, regain_seconds
+
+
+# ==========================================
+#  GỬI TIN (ASYNC, POOL KẾT NỐI DÙNG CHUNG)
+# ==========================================
+class OutboundSender:
+    def __init__(self, redis_client, api_url=GRAPH_API_URL, rate_per_page=OUTBOUND_RATE_PER_PAGE):
+        self.redis = redis_client
+        self._acquire = redis_client.register_script(ACQUIRE_LUA)
+        self._adjust = redis_client.register_script(ADJUST_LUA)
+        self.api_url = api_url
+        self.rate_per_page = rate_per_page
+        self.client = httpx.AsyncClient(
+            timeout=OUTBOUND_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=OUTBOUND_MAX_CONNECTIONS,
+                                max_keepalive_connections=OUTBOUND_MAX_CONNECTIONS),
+        )
+        self.buckets = {}
+        self.stats = {"sent": 0, "retries": 0, "failed": 0, "throttled": 0}
+
+    def bucket(self, page_id):
+        bucket = self.buckets.get(page_id)
+        if bucket is None:
+            bucket = self.buckets[page_id] = TokenBucket(self, page_id, self.rate_per_page)
+        return bucket
+
+    @staticmethod
+    def page_token(page_id):
+        """Token riêng của Page (config "page_access_token_env") hoặc FB_PAGE_ACCESS_TOKEN"""
+        from app.config_loader import registry
+        config = registry.get(page_id) or {}
+        env_name = config.get("page_access_token_env")
+        return (env_name and os.getenv(env_name)) or os.getenv("FB_PAGE_ACCESS_TOKEN")
+
+    @staticmethod
+    def _is_retryable(status_code, body):
+        if status_code >= 500 or status_code == 429:
+            return True
+        try:
+            error = body.get("error", {})
+        except AttributeError:
+            return False
+        return error.get("code") in RETRYABLE_FB_CODES or bool(error.get("is_transient"))
+
+    async def send(self, page_id, recipient_id, part):
+        """Gửi 1 payload; trả về True nếu thành công"""
+        token = self.page_token(page_id)
+        if not token:
+            metrics.inc("chatbot_fb_send_total", page_id=page_id, status="no_token")
+            log.error("page_token_missing", page_id=page_id)
+            return False
+
+        payload = {"recipient": {"id": recipient_id}, **part}
+        headers = {"Authorization": f"Bearer {token}"}
+        bucket = self.bucket(page_id)
+
+        for attempt in range(1, OUTBOUND_MAX_ATTEMPTS + 1):
+            await bucket.acquire()
+            body = {}
+            try:
+                response = await self.client.post(self.api_url, json=payload, headers=headers)
+                status_code = response.status_code
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}
+                usage, regain_seconds = parse_usage_headers(response.headers)
+                await bucket.adjust(usage, regain_seconds)
+                if regain_seconds:
+                    self.stats["throttled"] += 1
+                    metrics.inc("chatbot_fb_send_total", page_id=page_id, status="throttled")
+                if status_code < 400:
+                    self.stats["sent"] += 1
+                    metrics.inc("chatbot_fb_send_total", page_id=page_id, status="ok")
+                    return True
+                retryable = self._is_retryable(status_code, body)
+                error_text = f"HTTP {status_code}: {str(body)[:200]}"
+            except httpx.HTTPError as e:
+                retryable = True
+                error_text = f"{type(e).__name__}: {e}"
+
+            if not retryable or attempt == OUTBOUND_MAX_ATTEMPTS:
+                self.stats["failed"] += 1
+                metrics.inc("chatbot_fb_send_total", page_id=page_id, status="failed")
+                log.warning("fb_send_failed", page_id=page_id, recipient_id=recipient_id,
+                            attempts=attempt, error=error_text)
+                return False
+
+            # Full jitter: ngủ ngẫu nhiên trong [0, base * 2^attempt]
+            self.stats["retries"] += 1
+            metrics.inc("chatbot_fb_send_total", page_id=page_id, status="retry")
+            delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+            await asyncio.sleep(delay)
+        return False
+
+    async def close(self):
+        await self.client.aclose()
+
+
+# ==========================================
+#  DISPATCHER: KÉO TỪ CÁC SHARD outbound_queue:<n> VÀ GỬI
+# ==========================================
+# KEYS[1]=khóa shard; ARGV[1]=tên dispatcher, ARGV[2]=thời hạn (ms)
+# Gia hạn khi khóa vẫn của mình; trả về 0 nếu đã mất (hết hạn / dispatcher khác đã lấy)
+RENEW_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS[1]=khóa shard; ARGV[1]=tên dispatcher -> chỉ xóa khóa của chính mình
+RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+def lease_key(shard):
+    return f"{shard_key(shard)}:owner"
+
+
+class OutboundDispatcher:
+    def __init__(self, redis_url=None, concurrency=OUTBOUND_CONCURRENCY, sender=None):
+        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        self.concurrency = concurrency
+        self.sender = sender
+        self.name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.owned = set()       # shard đang được kéo
+        self.draining = set()    # shard đã nhường, chờ gửi xong phần dở rồi trả khóa
+        self.shard_tasks = {}    # shard -> task đang gửi
+        self._running = False
+
+    async def _deliver(self, item, slots, previous=None):
+        # Item trước của cùng người nhận phải gửi xong trước (vd: mảnh đầu streaming -> phần còn lại)
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with slots:
+            page_id, recipient_id = item["page_id"], item["recipient_id"]
+            for i, part in enumerate(item.get("parts", [])):
+                with metrics.span("fb_send", page_id):
+                    ok = await self.sender.send(page_id, recipient_id, part)
+                if not ok:
+                    # Giữ phần chưa gửi được để tra soát / gửi lại tay
+                    item["parts"] = item["parts"][i:]
+                    item["failed_at"] = time.time()
+                    await self.redis.rpush(OUTBOUND_DEAD, json.dumps(item, ensure_ascii=False))
+                    return
+            if item.get("parts") and "message" in item["parts"][-1]:
+                # Từ lúc worker xếp hàng đến khi gửi xong phần cuối
+                waited = time.time() - item.get("enqueued_at", time.time())
+                metrics.observe("chatbot_stage_seconds", waited, page_id=page_id, stage="fb_delivery")
+                log.info("fb_sent", sample=HOT_SAMPLE, page_id=page_id, recipient_id=recipient_id,
+                         waited_ms=round(waited * 1000))
+
+    async def _balance(self):
+        """
+        Báo còn sống, gia hạn khóa các shard đang giữ, nhường bớt nếu giữ quá phần của mình
+        (ceil(số shard / số dispatcher sống)) và nhận thêm shard còn trống nếu thiếu.
+        """
+        now = time.time()
+        lease_ms = int(OUTBOUND_LEASE_SECONDS * 1000)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(OUTBOUND_DISPATCHERS, {self.name: now})
+        pipe.zremrangebyscore(OUTBOUND_DISPATCHERS, "-inf", now - OUTBOUND_LEASE_SECONDS)
+        pipe.zcard(OUTBOUND_DISPATCHERS)
+        live = (await pipe.execute())[2]
+
+        held = sorted(self.owned | self.draining)
+        if held:
+            pipe = self.redis.pipeline(transaction=False)
+            for shard in held:
+                await self._renew(keys=[lease_key(shard)], args=[self.name, lease_ms], client=pipe)
+            for shard, kept in zip(held, await pipe.execute()):
+                if not kept:
+                    # Khóa đã hết hạn (vd: event loop bị nghẽn quá lâu) -> dừng kéo shard này
+                    self.owned.discard(shard)
+                    self.draining.discard(shard)
+                    log.warning("outbound_shard_lost", shard=shard, dispatcher=self.name)
+
+        target = -(-OUTBOUND_SHARDS // max(1, live))
+        while len(self.owned) > target:
+            self.draining.add(self.owned.pop())
+        for shard in list(self.draining):
+            if not self.shard_tasks.get(shard):
+                await self._release_lease(keys=[lease_key(shard)], args=[self.name])
+                self.draining.discard(shard)
+                log.info("outbound_shard_released", shard=shard, dispatcher=self.name)
+
+        if len(self.owned) < target:
+            offset = random.randrange(OUTBOUND_SHARDS)
+            for i in range(OUTBOUND_SHARDS):
+                shard = (offset + i) % OUTBOUND_SHARDS
+                if len(self.owned) >= target:
+                    break
+                if shard in self.owned or shard in self.draining:
+                    continue
+                if await self.redis.set(lease_key(shard), self.name, nx=True, px=lease_ms):
+                    self.owned.add(shard)
+                    log.info("outbound_shard_acquired", shard=shard, dispatcher=self.name)
+
+    async def run(self):
+        import redis.asyncio as aioredis
+
+        self.redis = aioredis.from_url(self.redis_url)
+        self._renew = self.redis.register_script(RENEW_LEASE_LUA)
+        self._release_lease = self.redis.register_script(RELEASE_LEASE_LUA)
+        self.sender = self.sender or OutboundSender(self.redis)
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        tails = {}   # (page_id, recipient_id) -> task gửi item mới nhất của người nhận đó
+        next_balance = 0.0
+        self._running = True
+        log.info("outbound_dispatcher_started", dispatcher=self.name, shards=OUTBOUND_SHARDS,
+                 concurrency=self.concurrency, rate_per_page=self.sender.rate_per_page)
+
+        while self._running:
+            try:
+                if time.monotonic() >= next_balance:
+                    await self._balance()
+                    next_balance = time.monotonic() + OUTBOUND_LEASE_SECONDS / 3
+                if not self.owned:
+                    await asyncio.sleep(1)
+                    continue
+                # BLPOP ưu tiên key đứng trước -> xáo thứ tự để shard nào cũng được kéo
+                keys = [shard_key(shard) for shard in self.owned]
+                random.shuffle(keys)
+                packed = await self.redis.blpop(keys, timeout=1)
+                if not packed:
+                    continue
+                shard = int(packed[0].rsplit(b":", 1)[1])
+                try:
+                    item = json.loads(packed[1])
+                except ValueError:
+                    continue
+                key = (item["page_id"], item["recipient_id"])
+                task = asyncio.create_task(self._deliver(item, slots, tails.get(key)))
+                tails[key] = task
+                tasks.add(task)
+                self.shard_tasks.setdefault(shard, set()).add(task)
+                task.add_done_callback(lambda t, key=key, shard=shard: self._release(tasks, tails, key, shard, t))
+            except Exception as e:
+                metrics.inc("chatbot_errors_total", component="outbound", page_id="")
+                log.error("outbound_loop_failed", error=str(e))
+                await asyncio.sleep(1)
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # Trả khóa ngay để dispatcher khác nhận shard, không chờ hết hạn
+        try:
+            for shard in self.owned | self.draining:
+                await self._release_lease(keys=[lease_key(shard)], args=[self.name])
+            await self.redis.zrem(OUTBOUND_DISPATCHERS, self.name)
+        except Exception as e:
+            log.warning("outbound_release_failed", error=str(e))
+        await self.sender.close()
+        await self.redis.aclose()
+
+    def _release(self, tasks, tails, key, shard, task):
+        tasks.discard(task)
+        self.shard_tasks.get(shard, set()).discard(task)
+        if tails.get(key) is task:
+            del tails[key]
+
+    def stop(self):
+        self._running = False
+
+
+def start_dispatcher_thread(redis_url=None):
+    """Chạy dispatcher trong thread nền (có event loop riêng) bên trong process worker"""
+    dispatcher = OutboundDispatcher(redis_url)
+    dispatcher.thread = threading.Thread(target=lambda: asyncio.run(dispatcher.run()), name="outbound", daemon=True)
+    dispatcher.thread.start()
+    return dispatcher
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    import redis
+
+    metrics.start_flusher(redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+    try:
+        asyncio.run(OutboundDispatcher().run())
+    except KeyboardInterrupt:
+        pass
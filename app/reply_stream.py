@@ -0,0 +1,211 @@
+# app/reply_stream.py
+"""
+Gửi SỚM câu đầu của câu trả lời trong lúc Gemini còn đang sinh JSON (streaming).
+
+- ReplyTextExtractor: parser JSON tăng dần, chỉ bóc giá trị "reply_text" (hoặc "reply_to_user")
+  ở cấp ngoài cùng, giải mã escape (\\n, \\", \\uXXXX...) ngay khi từng mảnh tới.
+  Các field còn lại (next_state, tags, classification...) vẫn được json.loads khi stream xong.
+- EarlyReply: gom text đã bóc; có câu hoàn chỉnh đầu tiên (hoặc đủ dài mà chưa có dấu câu) thì
+  gửi ngay, phần còn lại gửi sau khi lượt chat xử lý xong (remainder()).
+- StreamedTurns: mảnh đầu được gửi trước khi lượt chat commit -> ghi lại theo lượt (sender + msg_seq +
+  nội dung tin), key "early:<sender_id>:<msg_seq>:<hash>". Lượt bị xử lý lại (worker lỗi / chết) không gửi
+  lại mảnh đầu và dùng lại đúng câu trả lời AI đã stream (không gọi AI lần 2 ra câu khác).
+
+Config Page ghi đè mặc định:
+    "streaming": {"enabled": true, "first_chunk_min_chars": 20, "first_chunk_max_chars": 200}
+"""
+import hashlib
+import json
+import os
+import re
+
+STREAM_REPLY_ENABLED = os.getenv("STREAM_REPLY_ENABLED", "1") == "1"
+FIRST_CHUNK_MIN_CHARS = 20     # Không gửi riêng câu quá ngắn ("Dạ.", "Chào anh!")
+FIRST_CHUNK_MAX_CHARS = 200    # Quá độ dài này vẫn chưa hết câu -> cắt ở khoảng trắng gần nhất
+EARLY_REPLY_TTL_SECONDS = 3600
+
+REPLY_KEYS = ("reply_text", "reply_to_user")
+
+# Hết câu: . ! ? … (có thể kèm ngoặc / emoji đóng) rồi tới khoảng trắng, hoặc xuống dòng
+_SENTENCE_END = re.compile(r"[.!?…]+[\"')\]]*\s+|\n+")
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def stream_settings(config):
+    streaming = config.get("streaming", {})
+    return (
+        streaming.get("enabled", STREAM_REPLY_ENABLED),
+        streaming.get("first_chunk_min_chars", FIRST_CHUNK_MIN_CHARS),
+        streaming.get("first_chunk_max_chars", FIRST_CHUNK_MAX_CHARS),
+    )
+
+
+class ReplyTextExtractor:
+    """
+    feed(mảnh JSON) -> phần text MỚI của reply_text (chuỗi rỗng nếu chưa có).
+    done = True khi đã gặp dấu " đóng của reply_text.
+    """
+
+    def __init__(self, keys=REPLY_KEYS):
+        self.keys = keys
+        self.done = False
+        self._stack = []          # "{" / "[" đang mở
+        self._expect_key = False
+        self._last_key = None
+        self._in_string = False
+        self._is_key = False
+        self._streaming = False
+        self._escape = False
+        self._unicode = None      # chữ số hex của \uXXXX đang đọc
+        self._high_surrogate = None
+        self._key_chars = []
+
+    def _emit_char(self, char, out):
+        if self._is_key:
+            self._key_chars.append(char)
+        elif self._streaming:
+            out.append(char)
+
+    def _decode_unicode(self, out):
+        code = int("".join(self._unicode), 16)
+        self._unicode = None
+        if 0xD800 <= code <= 0xDBFF:
+            self._high_surrogate = code
+            return
+        if 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+            code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+        self._high_surrogate = None
+        self._emit_char(chr(code), out)
+
+    def feed(self, chunk):
+        out = []
+        for char in chunk:
+            if self._in_string:
+                if self._unicode is not None:
+                    self._unicode.append(char)
+                    if len(self._unicode) == 4:
+                        self._decode_unicode(out)
+                elif self._escape:
+                    self._escape = False
+                    if char == "u":
+                        self._unicode = []
+                    else:
+                        self._emit_char(_ESCAPES.get(char, char), out)
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._is_key:
+                        self._last_key = "".join(self._key_chars)
+                        self._is_key = False
+                    elif self._streaming:
+                        self._streaming = False
+                        self.done = True
+                else:
+                    self._emit_char(char, out)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                in_object = bool(self._stack) and self._stack[-1] == "{"
+                self._is_key = in_object and self._expect_key
+                self._key_chars = []
+                # Chỉ lấy reply_text ở cấp ngoài cùng, lần xuất hiện đầu tiên
+                self._streaming = (not self._is_key and not self.done and len(self._stack) == 1
+                                   and self._last_key in self.keys)
+            elif char in "{[":
+                self._stack.append(char)
+                self._expect_key = char == "{"
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                self._expect_key = False
+            elif char == ",":
+                self._expect_key = bool(self._stack) and self._stack[-1] == "{"
+            elif char == ":":
+                self._expect_key = False
+        return "".join(out)
+
+
+class EarlyReply:
+    """
+    Nối ai_engine (on_reply_text) với việc gửi tin:
+        early = EarlyReply(send, config)
+        ai_json = generate_ai_response(..., on_reply_text=early.feed)
+        rest = early.remainder(final_reply_text)
+    send(text, more) chỉ được gọi tối đa 1 lần (mảnh đầu); more=False nếu đã là cả câu trả lời.
+    sent / more: mảnh đầu lần xử lý trước đã gửi (StreamedTurns) -> không gửi gì thêm.
+    """
+
+    def __init__(self, send, config, sent=None, more=False):
+        _, self.min_chars, self.max_chars = stream_settings(config)
+        self.send = send
+        self.buffer = ""
+        self.sent = sent          # prefix NGUYÊN VĂN của reply_text đã gửi
+        self.more = more          # lúc gửi mảnh đầu còn text phía sau không
+
+    def feed(self, text, done=False):
+        if self.sent is not None:
+            return
+        self.buffer += text
+        cut = self._first_chunk_end(done)
+        if cut:
+            chunk = self.buffer[:cut].strip()
+            if chunk:
+                self.sent = self.buffer[:cut]
+                self.more = not done or bool(self.buffer[cut:].strip())
+                self.send(chunk, self.more)
+
+    def _first_chunk_end(self, done):
+        for match in _SENTENCE_END.finditer(self.buffer):
+            if match.end() >= self.min_chars:
+                return match.end()
+        if done:
+            # reply_text đã đóng: gửi nguyên câu trả lời, không chờ phần metadata phía sau
+            return len(self.buffer)
+        if len(self.buffer) >= self.max_chars:
+            space = self.buffer.rfind(" ", self.min_chars, self.max_chars)
+            return space + 1 if space > 0 else self.max_chars
+        return 0
+
+    def remainder(self, reply_text):
+        """Phần còn phải gửi sau cùng (cả câu trả lời nếu chưa gửi gì / nội dung cuối khác phần đã gửi)"""
+        if self.sent is None:
+            return reply_text
+        if reply_text.startswith(self.sent):
+            return reply_text[len(self.sent):].strip()
+        return reply_text
+
+
+def early_reply_key(sender_id, msg_seq, message_text):
+    digest = hashlib.blake2b(message_text.encode(), digest_size=8).hexdigest()
+    return f"early:{sender_id}:{msg_seq}:{digest}"
+
+
+class StreamedTurns:
+    """Mảnh đầu đã gửi (+ câu trả lời AI của lần stream đó) theo từng lượt"""
+
+    def __init__(self, redis_client, ttl=EARLY_REPLY_TTL_SECONDS):
+        self.redis = redis_client
+        self.ttl = ttl
+
+    def load(self, key):
+        """{"sent", "more", "ai_json" (nếu AI đã trả lời xong)} hoặc None"""
+        raw = self.redis.get(key)
+        if not raw:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    def claim(self, key, sent, more):
+        """Ghi nhận mảnh đầu TRƯỚC khi gửi; False nếu lượt này đã gửi mảnh đầu rồi"""
+        record = json.dumps({"sent": sent, "more": more}, ensure_ascii=False)
+        return bool(self.redis.set(key, record, nx=True, ex=self.ttl))
+
+    def save(self, key, sent, more, ai_json):
+        """Câu trả lời AI khớp với mảnh đầu đã gửi -> lần xử lý lại dùng đúng câu này"""
+        record = json.dumps({"sent": sent, "more": more, "ai_json": ai_json}, ensure_ascii=False)
+        self.redis.set(key, record, ex=self.ttl)
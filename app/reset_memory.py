@@ -2,30 +2,25 @@ import redis
 import os
 from dotenv import load_dotenv
 
+from app.maintenance import purge
+
 load_dotenv()
 redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 r = redis.from_url(redis_url)
 
 def reset_all():
+    """
+    Giữ lại cho thói quen cũ. Dùng app/maintenance.py (SCAN + UNLINK theo lô, có giới hạn tốc độ):
+        python -m app.maintenance purge --all [--dry-run] [--export backup.jsonl]
+    """
     print("🧹 ĐANG DỌN DẸP BỘ NHỚ BOT...")
-    
-    # 1. Tìm tất cả các key liên quan đến Session và History
-    keys_session = r.keys("session:*")
-    keys_history = r.keys("history:*")
-    keys_tags = r.keys("tags:*")
-    
-    all_keys = keys_session + keys_history + keys_tags
-    
-    if not all_keys:
+    stats = purge(r, purge_all=True)
+
+    if not stats["keys_deleted"]:
         print("✅ Bộ nhớ đã sạch, không có gì để xóa.")
         return
 
-    # 2. Xóa sạch
-    for key in all_keys:
-        r.delete(key)
-        print(f"   - Đã xóa: {key.decode()}")
-        
-    print(f" ĐÃ XÓA XONG {len(all_keys)} BẢN GHI.")
+    print(f" ĐÃ XÓA XONG {stats['keys_deleted']} BẢN GHI.")
 
 if __name__ == "__main__":
-    reset_all()
\ No newline at end of file
+    reset_all()
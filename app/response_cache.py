@@ -0,0 +1,248 @@
+# app/response_cache.py
+"""
+Cache câu trả lời cho các tin nhắn "mở đầu" lặp đi lặp lại (hỏi giá, "tư vấn giúp em", chào hỏi...)
+để khỏi tốn 1 lượt gọi Gemini.
+
+Khóa cache: (page_id, config_version, flow_state) + tin nhắn đã chuẩn hóa.
+Chỉ dùng cho lượt MỞ ĐẦU (khách chưa có lịch sử chat): lịch sử nằm trong prompt (app/context_builder.py)
+nhưng không nằm trong khóa -> tin ngắn phụ thuộc ngữ cảnh ("ok", "dạ", "có") giữa hội thoại
+sẽ bị trả lời bằng câu trả lời của khách khác.
+1. Tra khớp tuyệt đối (exact) theo tin nhắn chuẩn hóa.
+2. Không có -> tìm láng giềng gần nhất (cosine) trên vector embedding NumPy
+   của các tin đã cache, chấp nhận nếu độ tương đồng >= ngưỡng.
+
+Embedding là hashing trick trên n-gram ký tự + từ (không gọi API, không cần model).
+Mỗi namespace có giới hạn số entry (LRU) và TTL. Page có thể tắt trong config:
+    "response_cache": {"enabled": false}
+hoặc chỉnh: "ttl_seconds", "similarity_threshold", "max_entries".
+Hit / miss: counter chatbot_response_cache_total{result=...} (GET /metrics).
+"""
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from app import metrics
+from app.logs import get_logger
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+DEFAULT_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+DEFAULT_SIMILARITY_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.92"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+# Chỉ cache tin ngắn (câu mở đầu); tin dài thường mang ngữ cảnh riêng
+MAX_MESSAGE_CHARS = 120
+EMBEDDING_DIM = 512
+STATS_LOG_EVERY = 200
+
+log = get_logger("response_cache")
+
+# Các field của kết quả AI được phép dùng lại (không cache detected_info / dữ liệu cá nhân)
+CACHEABLE_FIELDS = ("reply_text", "reply_to_user", "next_state", "need_phone", "classification", "tags", "intent", "analysis")
+
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+# Tin có SĐT / email / số dài -> không cache (vừa là dữ liệu cá nhân, vừa phải đi qua AI)
+_PERSONAL_RE = re.compile(r"@|\d[\d\s.\-]{5,}\d")
+
+
+def normalize_message(text):
+    """Chữ thường, bỏ dấu tiếng Việt, bỏ dấu câu, gộp khoảng trắng"""
+    text = unicodedata.normalize("NFD", (text or "").lower().replace("đ", "d"))
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def embed(normalized):
+    """Vector đơn vị EMBEDDING_DIM chiều từ trigram ký tự + từ đơn (hashing trick)"""
+    vec = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    padded = f" {normalized} "
+    for i in range(len(padded) - 2):
+        vec[zlib.crc32(padded[i:i + 3].encode()) % EMBEDDING_DIM] += 1.0
+    for word in normalized.split():
+        vec[zlib.crc32(b"w:" + word.encode()) % EMBEDDING_DIM] += 2.0
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+class _Namespace:
+    """Cache của 1 (page, version, state): LRU theo OrderedDict + ma trận embedding"""
+
+    def __init__(self):
+        self.entries = OrderedDict()   # normalized -> (value, vector, expires_at)
+        self._matrix = None
+        self._keys = []
+
+    def matrix(self):
+        if self._matrix is None:
+            self._keys = list(self.entries)
+            if self._keys:
+                self._matrix = np.stack([self.entries[k][1] for k in self._keys])
+            else:
+                self._matrix = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        return self._keys, self._matrix
+
+    def invalidate(self):
+        self._matrix = None
+
+
+class ResponseCache:
+    def __init__(self):
+        self._namespaces = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "lookups": 0, "exact_hits": 0, "semantic_hits": 0, "misses": 0,
+            "bypassed": 0, "stores": 0, "evictions": 0, "expired": 0,
+        }
+
+    # ------------------------------------------------
+    # Cấu hình theo Page
+    # ------------------------------------------------
+    @staticmethod
+    def _settings(config):
+        settings = config.get("response_cache", {}) if config else {}
+        return (
+            RESPONSE_CACHE_ENABLED and settings.get("enabled", True),
+            settings.get("ttl_seconds", DEFAULT_TTL_SECONDS),
+            settings.get("similarity_threshold", DEFAULT_SIMILARITY_THRESHOLD),
+            settings.get("max_entries", DEFAULT_MAX_ENTRIES),
+        )
+
+    @staticmethod
+    def _namespace_key(page_id, config, flow_state):
+        version = config.get("_compiled", {}).get("version") or config.get("config_version", "")
+        return (str(page_id), version, flow_state or "START")
+
+    @staticmethod
+    def cacheable_message(message_text):
+        return bool(message_text) and len(message_text) <= MAX_MESSAGE_CHARS and not _PERSONAL_RE.search(message_text)
+
+    # ------------------------------------------------
+    # Tra / Lưu
+    # ------------------------------------------------
+    def lookup(self, page_id, config, flow_state, message_text, has_history=False):
+        """
+        Trả về dict kết quả AI (bản sao) hoặc None nếu miss.
+        has_history: khách đã có lịch sử chat -> không dùng cache (câu trả lời phụ thuộc ngữ cảnh)
+        """
+        enabled, _, threshold, _ = self._settings(config)
+        normalized = normalize_message(message_text) if enabled and not has_history else ""
+        if not normalized or not self.cacheable_message(message_text):
+            self._bump("bypassed")
+            metrics.inc("chatbot_response_cache_total", page_id=page_id, result="bypassed")
+            return None
+
+        now = time.time()
+        key = self._namespace_key(page_id, config, flow_state)
+        with self._lock:
+            self._stats["lookups"] += 1
+            ns = self._namespaces.get(key)
+            hit = None
+            if ns is not None:
+                entry = ns.entries.get(normalized)
+                if entry is not None and entry[2] > now:
+                    hit, kind = normalized, "exact_hits"
+                else:
+                    if entry is not None:
+                        self._drop(ns, normalized, "expired")
+                    hit = self._nearest(ns, embed(normalized), threshold, now)
+                    kind = "semantic_hits"
+
+            if hit is None:
+                self._stats["misses"] += 1
+                self._maybe_log()
+                value = None
+            else:
+                ns.entries.move_to_end(hit)
+                self._stats[kind] += 1
+                self._maybe_log()
+                value = dict(ns.entries[hit][0])
+        metrics.inc("chatbot_response_cache_total", page_id=page_id,
+                    result="miss" if hit is None else kind[:-1])
+        return value
+
+    def _nearest(self, ns, vector, threshold, now):
+        keys, matrix = ns.matrix()
+        if not keys:
+            return None
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        key = keys[best]
+        entry = ns.entries.get(key)
+        if entry is None or entry[2] <= now:
+            if entry is not None:
+                self._drop(ns, key, "expired")
+            return None
+        return key
+
+    def store(self, page_id, config, flow_state, message_text, ai_json, has_history=False):
+        enabled, ttl, _, max_entries = self._settings(config)
+        if not enabled or has_history or not self.cacheable_message(message_text):
+            return
+        # Không cache câu trả lời lỗi / rỗng / có dữ liệu cá nhân AI bắt được
+        if not ai_json or ai_json.get("next_state") == "ERROR" or ai_json.get("detected_info"):
+            return
+        if not (ai_json.get("reply_text") or ai_json.get("reply_to_user")):
+            return
+
+        normalized = normalize_message(message_text)
+        if not normalized:
+            return
+
+        value = {k: ai_json[k] for k in CACHEABLE_FIELDS if k in ai_json}
+        key = self._namespace_key(page_id, config, flow_state)
+        vector = embed(normalized)
+        with self._lock:
+            ns = self._namespaces.get(key)
+            if ns is None:
+                ns = self._namespaces[key] = _Namespace()
+            ns.entries[normalized] = (value, vector, time.time() + ttl)
+            ns.entries.move_to_end(normalized)
+            ns.invalidate()
+            self._stats["stores"] += 1
+            while len(ns.entries) > max_entries:
+                oldest = next(iter(ns.entries))
+                self._drop(ns, oldest, "evictions")
+
+    def _drop(self, ns, key, reason):
+        del ns.entries[key]
+        ns.invalidate()
+        self._stats[reason] += 1
+
+    # ------------------------------------------------
+    # Thống kê
+    # ------------------------------------------------
+    def _bump(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _maybe_log(self):
+        if self._stats["lookups"] % STATS_LOG_EVERY == 0:
+            s = self._stats
+            log.info("response_cache_stats", lookups=s["lookups"], exact_hits=s["exact_hits"],
+                     semantic_hits=s["semantic_hits"])
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = sum(len(ns.entries) for ns in self._namespaces.values())
+        hits = stats["exact_hits"] + stats["semantic_hits"]
+        stats["hits"] = hits
+        # Mỗi hit = 1 lượt gọi LLM tiết kiệm được
+        stats["llm_calls_saved"] = hits
+        stats["hit_rate"] = round(hits / stats["lookups"], 4) if stats["lookups"] else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._namespaces.clear()
+
+
+response_cache = ResponseCache()
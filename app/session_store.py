@@ -0,0 +1,270 @@
+# app/session_store.py
+"""
+Session Repository: gom toàn bộ I/O Redis của 1 lượt hội thoại về đúng 2 round trip.
+
+- load_turn()   : 1 pipeline đọc session (HGETALL) + lịch sử chat (LRANGE).
+- commit_turn() : 1 Lua script ghi nguyên tử mọi thay đổi của lượt:
+                  session fields + merge session.data + history + tags + TTL.
+- resume_bot()  : tắt HUMAN mode nếu Admin đã im lặng đủ lâu (timer "handoff", app/timers.py).
+
+Trạng thái flow chỉ còn 1 field duy nhất là "state".
+Field cũ "current_state" (do FlowEngine ghi trước đây) chỉ còn được đọc làm fallback
+và bị xóa ở lần commit kế tiếp.
+"""
+import datetime
+import json
+import time
+
+SESSION_TTL_SECONDS = 86400 * 3
+HISTORY_FETCH = 10      # Số tin gần nhất nạp mỗi lượt (mặc định, Page có thể đổi)
+HISTORY_MAX = 50        # Số tin tối đa giữ trong Redis
+TAG_INDEX_TTL_SECONDS = 86400 * 90   # Chỉ mục tag -> khách giữ 90 ngày gần nhất
+
+# KEYS[1]=session, KEYS[2]=history, KEYS[3]=tags,
+# KEYS[4]="tagidx:<page>", KEYS[4+i]="tagidx:<page>:<indexed[i]>" (chỉ khi có page_id)
+# ARGV[1]=JSON {fields, data, history[], tags[], indexed[], history_max, ttl, now, tag_index_ttl}
+# Tags: hash "tags:<id>" (c:<tag> = số lần, t:<tag> = lần cuối) + chỉ mục ngược theo Page
+# "tagidx:<page>:<tag>" (zset sender_id -> lần cuối), xem app/tag_store.py.
+# Tags còn là list kiểu cũ có tag chưa khai báo trong KEYS -> không ghi gì, trả về {'legacy', tag...}
+# để Python gọi lại kèm key chỉ mục của các tag đó.
+COMMIT_TURN_LUA = """
+local p = cjson.decode(ARGV[1])
+
+local idx = {}
+for i, t in ipairs(p.indexed) do idx[t] = KEYS[4 + i] end
+local old = nil
+if #p.tags > 0 and redis.call('TYPE', KEYS[3]).ok == 'list' then
+    old = redis.call('LRANGE', KEYS[3], 0, -1)
+    local missing = {}
+    for i, t in ipairs(old) do
+        old[i] = string.lower(t)
+        if #p.indexed > 0 and not idx[old[i]] then table.insert(missing, old[i]) end
+    end
+    if #missing > 0 then return {'legacy', unpack(missing)} end
+end
+
+local data = {}
+local raw = redis.call('HGET', KEYS[1], 'data')
+if raw then
+    local ok, decoded = pcall(cjson.decode, raw)
+    if ok and type(decoded) == 'table' then data = decoded end
+end
+for k, v in pairs(p.data) do data[k] = v end
+
+local args = {'data', cjson.encode(data)}
+for k, v in pairs(p.fields) do
+    table.insert(args, k)
+    table.insert(args, tostring(v))
+end
+redis.call('HSET', KEYS[1], unpack(args))
+redis.call('HDEL', KEYS[1], 'current_state')
+redis.call('EXPIRE', KEYS[1], p.ttl)
+
+if #p.history > 0 then
+    -- msg_seq = tổng số tin từng ghi (session cũ chưa có thì lấy độ dài history hiện tại)
+    if redis.call('HEXISTS', KEYS[1], 'msg_seq') == 0 then
+        redis.call('HSET', KEYS[1], 'msg_seq', redis.call('LLEN', KEYS[2]))
+    end
+    redis.call('HINCRBY', KEYS[1], 'msg_seq', #p.history)
+    redis.call('RPUSH', KEYS[2], unpack(p.history))
+    redis.call('LTRIM', KEYS[2], -p.history_max, -1)
+    redis.call('EXPIRE', KEYS[2], p.ttl)
+end
+
+if #p.tags > 0 then
+    -- List tags kiểu cũ -> đổi sang hash ngay khi chạm tới
+    if old then
+        redis.call('DEL', KEYS[3])
+        for _, t in ipairs(old) do
+            redis.call('HINCRBY', KEYS[3], 'c:' .. t, 1)
+            table.insert(p.tags, t)
+        end
+    end
+
+    local seen = {}
+    for i, t in ipairs(p.tags) do
+        if not seen[t] then
+            seen[t] = true
+            -- Tag cũ vừa chuyển đổi chỉ cập nhật lần cuối + chỉ mục, không đếm thêm
+            if i <= p.new_tags then redis.call('HINCRBY', KEYS[3], 'c:' .. t, 1) end
+            redis.call('HSET', KEYS[3], 't:' .. t, p.now)
+            if idx[t] then
+                redis.call('ZADD', idx[t], p.now, p.fields.user_id)
+                redis.call('ZREMRANGEBYSCORE', idx[t], '-inf', p.now - p.tag_index_ttl)
+                redis.call('EXPIRE', idx[t], p.tag_index_ttl)
+                redis.call('SADD', KEYS[4], t)
+                redis.call('EXPIRE', KEYS[4], p.tag_index_ttl)
+            end
+        end
+    end
+    redis.call('EXPIRE', KEYS[3], p.ttl)
+end
+return 1
+"""
+
+# KEYS[1]=session; ARGV[1]=mốc: Admin hoạt động lần cuối trước mốc này mới bật lại Bot, ARGV[2]=updated_at
+# Trả về {1 nếu đã bật lại Bot, last_human_activity hiện tại}
+RESUME_BOT_LUA = """
+local fields = redis.call('HMGET', KEYS[1], 'conversation_mode', 'last_human_activity')
+if fields[1] ~= 'HUMAN' then return {0, '0'} end
+local last = fields[2] or '0'
+if (tonumber(last) or 0) > tonumber(ARGV[1]) then return {0, last} end
+redis.call('HSET', KEYS[1], 'conversation_mode', 'BOT', 'last_human_activity', '0', 'updated_at', ARGV[2])
+return {1, last}
+"""
+
+
+def session_key(sender_id):
+    return f"session:{sender_id}"
+
+
+def history_key(sender_id):
+    return f"history:{sender_id}"
+
+
+def tags_key(sender_id):
+    return f"tags:{sender_id}"
+
+
+def tag_index_key(page_id, tag):
+    return f"tagidx:{page_id}:{tag}"
+
+
+def page_tags_key(page_id):
+    return f"tagidx:{page_id}"
+
+
+def parse_session(raw):
+    """Chuyển HGETALL (bytes) thành dict session chuẩn"""
+    session = {k.decode(): v.decode() for k, v in raw.items()}
+
+    if "data" in session:
+        try:
+            session["data"] = json.loads(session["data"])
+        except:
+            session["data"] = {}
+        # cjson mã hóa table rỗng thành "[]" ở một số bản Redis
+        if not isinstance(session["data"], dict):
+            session["data"] = {}
+    else:
+        session["data"] = {}
+
+    # Hợp nhất state: ưu tiên "state", fallback field cũ "current_state"
+    session["state"] = session.get("state") or session.pop("current_state", None) or "START"
+    session.pop("current_state", None)
+
+    session["conversation_mode"] = session.get("conversation_mode", "BOT")
+    try:
+        session["last_human_activity"] = float(session.get("last_human_activity", 0))
+    except:
+        session["last_human_activity"] = 0.0
+    return session
+
+
+def parse_tags(raw):
+    """HGETALL tags:<id> -> {tag: {"count": n, "last_seen": ts}}"""
+    tags = {}
+    for field, value in raw.items():
+        kind, tag = field.decode().split(":", 1)
+        entry = tags.setdefault(tag, {"count": 0, "last_seen": 0.0})
+        entry["count" if kind == "c" else "last_seen"] = float(value) if kind == "t" else int(value)
+    return tags
+
+
+def parse_history(raw_list):
+    history = []
+    for item in raw_list:
+        try:
+            history.append(json.loads(item))
+        except:
+            pass
+    return history
+
+
+class SessionRepository:
+    def __init__(self, redis_client, history_fetch=HISTORY_FETCH, history_max=HISTORY_MAX,
+                 ttl=SESSION_TTL_SECONDS):
+        self.redis = redis_client
+        self.history_fetch = history_fetch
+        self.history_max = history_max
+        self.ttl = ttl
+        self._commit_script = redis_client.register_script(COMMIT_TURN_LUA)
+        self._resume_script = redis_client.register_script(RESUME_BOT_LUA)
+
+    def load_turn(self, sender_id, history_fetch=None):
+        """1 round trip: trả về (session, history)"""
+        history_fetch = min(history_fetch or self.history_fetch, self.history_max)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(session_key(sender_id))
+        pipe.lrange(history_key(sender_id), -history_fetch, -1)
+        raw_session, raw_history = pipe.execute()
+        return parse_session(raw_session), parse_history(raw_history)
+
+    def commit_turn(self, sender_id, page_id=None, topic=None, state=None, new_data=None,
+                    conversation_mode=None, last_human_activity=None,
+                    history=None, tags=None, summary=None, summary_seq=None, extra_fields=None):
+        """
+        1 round trip, nguyên tử: ghi mọi thay đổi của lượt.
+        history: list (role, content) cần nối thêm; tags: list tag của lượt (đếm + cập nhật chỉ mục).
+        summary/summary_seq: bản tóm tắt cuốn chiếu (xem app/context_builder.py).
+        extra_fields: field session khác cần ghi (vd: lead_score / lead_stage).
+        Field nào None thì giữ nguyên giá trị cũ.
+        """
+        fields = {
+            "user_id": sender_id,
+            "updated_at": datetime.datetime.now().isoformat(),
+        }
+        if page_id is not None:
+            fields["page_id"] = page_id
+        if topic is not None:
+            fields["topic"] = topic
+        if state:
+            fields["state"] = state
+        if conversation_mode:
+            fields["conversation_mode"] = conversation_mode
+        if last_human_activity is not None:
+            fields["last_human_activity"] = str(last_human_activity)
+        if summary is not None:
+            fields["summary"] = summary
+        if summary_seq is not None:
+            fields["summary_seq"] = str(summary_seq)
+        for name, value in (extra_fields or {}).items():
+            if value is not None:
+                fields[name] = str(value)
+
+        # Tag chuẩn hóa chữ thường + bỏ trùng trong lượt ("VIP" và "vip" là 1 tag)
+        tags = [t for t in dict.fromkeys(str(t).strip().lower() for t in (tags or [])) if t]
+        payload = {
+            "fields": fields,
+            "data": new_data or {},
+            "history": [json.dumps({"role": role, "content": content}) for role, content in (history or [])],
+            "tags": tags,
+            "new_tags": len(tags),
+            "history_max": self.history_max,
+            "ttl": self.ttl,
+            "now": time.time(),
+            "tag_index_ttl": TAG_INDEX_TTL_SECONDS,
+        }
+        keys = [session_key(sender_id), history_key(sender_id), tags_key(sender_id)]
+        # Chỉ mục tag theo Page: mọi key script ghi phải nằm trong KEYS -> chỉ khi biết page_id
+        indexed = tags if page_id is not None else []
+        for _ in range(2):
+            payload["indexed"] = indexed
+            index_keys = [page_tags_key(page_id)] + [tag_index_key(page_id, t) for t in indexed] if indexed else []
+            result = self._commit_script(keys=keys + index_keys, args=[json.dumps(payload, ensure_ascii=False)])
+            if result == 1:
+                return
+            # List tags kiểu cũ có tag chưa khai báo -> gọi lại kèm key chỉ mục của các tag đó
+            indexed = indexed + [t.decode() for t in dict.fromkeys(result[1:]) if t.decode() not in indexed]
+        raise RuntimeError(f"commit_turn: không khai báo đủ chỉ mục tag cho {sender_id}")
+
+    def resume_bot(self, sender_id, idle_since):
+        """
+        Nguyên tử: đang HUMAN mode và Admin không hoạt động từ idle_since -> chuyển về BOT.
+        Trả về (đã chuyển hay chưa, last_human_activity) - Admin vừa chat lại thì last_human_activity > idle_since.
+        """
+        resumed, last = self._resume_script(
+            keys=[session_key(sender_id)],
+            args=[repr(idle_since), datetime.datetime.now().isoformat()]
+        )
+        return bool(resumed), float(last)
@@ -0,0 +1,315 @@
+# app/spill_journal.py
+"""
+Journal tràn (spill) trên đĩa của process webhook: Redis chậm / chết / khởi động lại thì webhook vẫn
+ghi nhận tin và ack Facebook ngay (không trả 500 -> FB không backoff / tắt webhook, không mất tin).
+
+- Đẩy vào hàng đợi lỗi hoặc chậm quá SPILL_ENQUEUE_TIMEOUT_MS -> cục webhook được ghi vào journal.
+  Khi journal còn tin chưa replay, tin mới cũng ghi tiếp vào journal (giữ thứ tự).
+- Journal: các segment SPILL_SEGMENT_BYTES cấp phát trước, memory-mapped, chỉ ghi nối đuôi.
+  Record = [độ dài][crc32][payload]; record ghi dở lúc crash bị crc loại bỏ.
+- Group commit: ghi vào mmap (memcpy) rồi chờ msync; mọi request tới trong lúc 1 lần msync đang chạy
+  dùng chung lần msync kế tiếp -> ack chỉ sau khi tin đã nằm trên đĩa, độ trễ vài ms.
+- Task nền (run_drainer) thử replay mỗi SPILL_DRAIN_INTERVAL_SECONDS theo đúng thứ tự ghi, lưu con trỏ
+  đã replay vào file "cursor"; replay hết thì xóa segment, webhook quay lại đẩy thẳng Redis.
+- Mỗi process có thư mục riêng SPILL_DIR/<host>-<pid>-<id> giữ flock suốt đời process. Thư mục không ai
+  giữ lock (process đã chết / được khởi động lại) được process khác nhận và replay nốt.
+
+At-least-once: tin đã vào Redis nhưng trả lời chậm quá ngưỡng, hoặc process chết sau khi replay mà
+chưa kịp ghi con trỏ, có thể được đẩy 2 lần.
+"""
+import asyncio
+import fcntl
+import mmap
+import os
+import shutil
+import socket
+import struct
+import time
+import uuid
+import zlib
+
+from app import metrics
+from app.logs import get_logger
+
+SPILL_ENABLED = os.getenv("SPILL_ENABLED", "1") == "1"
+SPILL_DIR = os.getenv("SPILL_DIR", "spill")
+SPILL_SEGMENT_BYTES = int(os.getenv("SPILL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+SPILL_ENQUEUE_TIMEOUT_MS = float(os.getenv("SPILL_ENQUEUE_TIMEOUT_MS", "100"))
+SPILL_DRAIN_INTERVAL_SECONDS = float(os.getenv("SPILL_DRAIN_INTERVAL_SECONDS", "1"))
+SPILL_REPLAY_TIMEOUT_SECONDS = 5     # 1 lần đẩy lại vào Redis lâu hơn -> coi như Redis chưa hồi phục
+ORPHAN_SCAN_SECONDS = 30
+
+HEADER = struct.Struct("<II")   # độ dài payload, crc32
+CURSOR = struct.Struct("<QQ")   # segment, offset của record tiếp theo cần replay
+
+log = get_logger("spill")
+
+
+def _segment_path(directory, seq):
+    return os.path.join(directory, f"{seq:08d}.seg")
+
+
+def _segment_seqs(directory):
+    return sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".seg"))
+
+
+def _read_record(mm, offset, limit):
+    """(payload, offset sau record); (None, offset) nếu hết dữ liệu hoặc record ghi dở"""
+    if offset + HEADER.size > limit:
+        return None, offset
+    length, crc = HEADER.unpack_from(mm, offset)
+    end = offset + HEADER.size + length
+    if length == 0 or end > limit:
+        return None, offset
+    payload = mm[offset + HEADER.size:end]
+    if zlib.crc32(payload) != crc:
+        return None, offset
+    return payload, end
+
+
+def _lock(path):
+    """flock không chờ trên file lock của thư mục journal; None nếu process khác đang giữ"""
+    fd = os.open(os.path.join(path, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _write_cursor(fd, seq, offset):
+    # Không fsync: con trỏ cũ hơn thực tế chỉ dẫn tới replay lại (at-least-once), không mất tin
+    os.pwrite(fd, CURSOR.pack(seq, offset), 0)
+
+
+def _read_cursor(directory):
+    try:
+        with open(os.path.join(directory, "cursor"), "rb") as f:
+            return CURSOR.unpack(f.read(CURSOR.size))
+    except (FileNotFoundError, struct.error):
+        return None
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Segment:
+    __slots__ = ("seq", "path", "fd", "mm", "size")
+
+    def __init__(self, directory, seq, size):
+        self.seq = seq
+        self.path = _segment_path(directory, seq)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        # Cấp phát thật trên đĩa (không để file thưa): đĩa đầy thì lỗi ngay ở đây, không SIGBUS khi ghi mmap
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self.fd, 0, size)
+        else:
+            os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+        self.size = size
+
+    def close(self, delete=False):
+        self.mm.close()
+        os.close(self.fd)
+        if delete:
+            os.unlink(self.path)
+
+
+def _msync(segments):
+    for segment in segments:
+        segment.mm.flush()
+
+
+async def _drain_directory(directory, enqueue):
+    """Replay nốt journal của process đã chết (thư mục đã được _lock), xong thì xóa thư mục"""
+    cursor = _read_cursor(directory)
+    cursor_fd = os.open(os.path.join(directory, "cursor"), os.O_RDWR | os.O_CREAT, 0o644)
+    replayed = 0
+    try:
+        for seq in _segment_seqs(directory):
+            path = _segment_path(directory, seq)
+            if cursor and seq < cursor[0]:
+                os.unlink(path)
+                continue
+            offset = cursor[1] if cursor and seq == cursor[0] else 0
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                while True:
+                    payload, next_offset = _read_record(mm, offset, len(mm))
+                    if payload is None:
+                        break
+                    await asyncio.wait_for(enqueue(payload), SPILL_REPLAY_TIMEOUT_SECONDS)
+                    offset = next_offset
+                    _write_cursor(cursor_fd, seq, offset)
+                    replayed += 1
+            os.unlink(path)
+    finally:
+        os.close(cursor_fd)
+        if replayed:
+            metrics.inc("chatbot_spill_total", replayed, event="replayed")
+            log.info("spill_orphan_replayed", directory=directory, messages=replayed)
+    shutil.rmtree(directory)
+
+
+class SpillJournal:
+    def __init__(self, root=SPILL_DIR, segment_bytes=SPILL_SEGMENT_BYTES):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.directory = None     # Tạo ở lần spill đầu tiên
+        self.pending = 0          # Số tin đã ghi, chưa replay
+        self._lock_fd = None
+        self._cursor_fd = None
+        self._segments = []       # Cũ -> mới; segment cuối đang được ghi
+        self._next_seq = 0
+        self._write_offset = 0
+        self._read = (0, 0)       # (segment, offset) record tiếp theo cần replay
+        self._synced = (0, 0)     # Mọi thứ trước vị trí này đã msync
+        self._flushing = None
+
+    def _open_directory(self):
+        os.makedirs(self.root, exist_ok=True)
+        name = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        # Lock trong thư mục tạm rồi mới đổi tên: process khác không kịp coi nó là journal mồ côi
+        staging = os.path.join(self.root, "." + name)
+        os.makedirs(staging)
+        self._lock_fd = _lock(staging)
+        self.directory = os.path.join(self.root, name)
+        os.rename(staging, self.directory)
+        self._cursor_fd = os.open(os.path.join(self.directory, "cursor"), os.O_RDWR | os.O_CREAT, 0o644)
+
+    def _roll(self, record_size):
+        if self.directory is None:
+            self._open_directory()
+        seq = self._next_seq
+        self._next_seq += 1
+        self._segments.append(_Segment(self.directory, seq, max(self.segment_bytes, record_size)))
+        _fsync_dir(self.directory)
+        if self.pending == 0:
+            self._read = (seq, 0)
+        self._write_offset = 0
+
+    async def append(self, raw):
+        """Ghi 1 cục webhook; trả về khi đã nằm trên đĩa"""
+        if isinstance(raw, str):
+            raw = raw.encode()
+        record_size = HEADER.size + len(raw)
+        if not self._segments or self._write_offset + record_size > self._segments[-1].size:
+            self._roll(record_size)
+        segment = self._segments[-1]
+        HEADER.pack_into(segment.mm, self._write_offset, len(raw), zlib.crc32(raw))
+        segment.mm[self._write_offset + HEADER.size:self._write_offset + record_size] = raw
+        self._write_offset += record_size
+        if self.pending == 0:
+            log.warning("spill_started", directory=self.directory)
+        self.pending += 1
+        metrics.inc("chatbot_spill_total", event="spilled")
+        await self._sync((segment.seq, self._write_offset))
+
+    async def _sync(self, position):
+        # Group commit: chờ chung lần msync đang chạy; chưa tới vị trí của mình thì chờ lần sau
+        while self._synced < position:
+            if self._flushing is None:
+                self._flushing = asyncio.ensure_future(self._flush())
+            await asyncio.shield(self._flushing)
+
+    async def _flush(self):
+        try:
+            target = (self._segments[-1].seq, self._write_offset)
+            segments = [s for s in self._segments if s.seq >= self._synced[0]]
+            await asyncio.get_running_loop().run_in_executor(None, _msync, segments)
+            self._synced = max(self._synced, target)
+        finally:
+            self._flushing = None
+
+    async def drain(self, enqueue):
+        """Replay tin của process này theo thứ tự ghi; Redis lỗi -> ném lỗi, lần sau làm tiếp từ con trỏ"""
+        replayed = 0
+        try:
+            while self.pending:
+                seq, offset = self._read
+                if seq > self._synced[0]:
+                    break
+                segment = next(s for s in self._segments if s.seq == seq)
+                # Chỉ replay phần đã msync (request tương ứng đã / sắp được ack)
+                limit = self._synced[1] if seq == self._synced[0] else segment.size
+                payload, next_offset = _read_record(segment.mm, offset, limit)
+                if payload is None:
+                    if seq >= self._synced[0]:
+                        break
+                    self._read = (seq + 1, 0)
+                    continue
+                await asyncio.wait_for(enqueue(payload), SPILL_REPLAY_TIMEOUT_SECONDS)
+                self._read = (seq, next_offset)
+                _write_cursor(self._cursor_fd, seq, next_offset)
+                self.pending -= 1
+                replayed += 1
+        finally:
+            if replayed:
+                metrics.inc("chatbot_spill_total", replayed, event="replayed")
+            self._drop_replayed()
+        if replayed and self.pending == 0:
+            log.info("spill_drained", messages=replayed)
+        return replayed
+
+    def _drop_replayed(self):
+        if self._flushing is not None:
+            return
+        if self.pending == 0:
+            # Replay hết: xóa mọi segment, lần spill sau bắt đầu segment mới
+            keep = []
+        else:
+            keep = [s for s in self._segments if s.seq >= self._read[0]]
+        for segment in self._segments:
+            if segment not in keep:
+                segment.close(delete=True)
+        self._segments = keep
+        if not keep:
+            self._read = self._synced = (self._next_seq, 0)
+            self._write_offset = 0
+
+    async def drain_orphans(self, enqueue):
+        """Nhận và replay journal của các process webhook không còn sống"""
+        if not os.path.isdir(self.root):
+            return
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if name.startswith(".") or path == self.directory or not os.path.isdir(path):
+                continue
+            fd = _lock(path)
+            if fd is None:
+                continue
+            try:
+                await _drain_directory(path, enqueue)
+            finally:
+                os.close(fd)
+
+    async def run_drainer(self, enqueue):
+        """Task nền của webhook: journal mồ côi trước (tin cũ hơn), rồi tới journal của process này"""
+        next_scan = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_scan:
+                    next_scan = time.monotonic() + ORPHAN_SCAN_SECONDS
+                    await self.drain_orphans(enqueue)
+                if self.pending:
+                    await self.drain(enqueue)
+            except Exception as e:
+                log.warning("spill_replay_failed", pending=self.pending, error=str(e) or type(e).__name__)
+            await asyncio.sleep(SPILL_DRAIN_INTERVAL_SECONDS)
+
+    def close(self):
+        """Tắt process: msync phần còn lại; tin chưa replay để process khác / lần chạy sau replay"""
+        _msync(self._segments)
+        for segment in self._segments:
+            segment.close(delete=self.pending == 0)
+        self._segments = []
+        for fd in (self._cursor_fd, self._lock_fd):
+            if fd is not None:
+                os.close(fd)
+        if self.directory and self.pending == 0:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,281 @@
+# app/supervisor.py
+"""
+Supervisor cho worker: 1 process cha quản lý pool process worker (thay cho chạy tay nhiều `python app/worker.py`).
+
+- Pre-fork: process cha import sẵn module nặng (SDK Gemini / OpenAI, numpy...) và nạp config mọi Page 1 lần
+  rồi mới fork -> process con dùng chung phần bộ nhớ đó (copy-on-write), thêm 1 worker chỉ mất vài trăm ms.
+  Kết nối mạng (Redis, HTTP) và thread nền KHÔNG an toàn khi fork nên process con tự tạo sau fork (import app.worker).
+- Autoscale mỗi SUPERVISOR_CHECK_SECONDS trong khoảng [SUPERVISOR_MIN_WORKERS, SUPERVISOR_MAX_WORKERS]:
+      tải = số tin chờ trong hàng đợi + số lượt đang xử lý (worker báo qua bộ nhớ chung)
+      số worker cần = ceil(tải / (sức chứa 1 worker x SCALE_TARGET_UTILIZATION))
+  sức chứa 1 worker = WORKER_CONCURRENCY (WORKER_MODE=async) hoặc 1 (sync).
+  Tin cũ nhất đã chờ quá SCALE_MAX_AGE_SECONDS -> thêm ít nhất 1 worker.
+  Tăng ngay; giảm chỉ khi nhu cầu thấp liên tục SCALE_DOWN_DELAY_SECONDS, mỗi lần bớt 1 worker rảnh nhất.
+- Drain: worker bị bớt / SIGTERM vào supervisor -> SIGTERM cho worker: ngừng kéo tin, làm xong mọi tin đã kéo
+  và để dispatcher gửi nốt rồi thoát; quá SUPERVISOR_DRAIN_SECONDS thì SIGKILL.
+- Health: worker chết bất thường hoặc heartbeat im lặng quá SUPERVISOR_HEARTBEAT_TIMEOUT (kẹt) -> kill và fork lại;
+  crash liên tục thì chờ lâu dần (tối đa CRASH_BACKOFF_MAX_SECONDS) trước khi fork lại.
+  Supervisor bị SIGKILL -> worker tự phát hiện (đổi process cha) và drain rồi thoát, không để lại process mồ côi.
+- Trạng thái pool ghi vào hash "supervisor:status" -> gauge chatbot_workers... ở GET /metrics.
+
+Chạy (cùng biến môi trường như app/worker.py):
+    WORKER_MODE=async SUPERVISOR_MIN_WORKERS=2 SUPERVISOR_MAX_WORKERS=16 python -m app.supervisor
+"""
+import json
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from collections import deque
+
+import redis
+from dotenv import load_dotenv
+
+from app import logs, metrics
+from app.chat_queue import get_chat_queue
+from app.logs import get_logger
+
+load_dotenv()
+
+SUPERVISOR_MIN_WORKERS = int(os.getenv("SUPERVISOR_MIN_WORKERS", "1"))
+SUPERVISOR_MAX_WORKERS = int(os.getenv("SUPERVISOR_MAX_WORKERS", str(os.cpu_count() or 4)))
+SUPERVISOR_CHECK_SECONDS = float(os.getenv("SUPERVISOR_CHECK_SECONDS", "2"))
+SUPERVISOR_DRAIN_SECONDS = float(os.getenv("SUPERVISOR_DRAIN_SECONDS", "60"))
+# Lượt chat sync có thể dài (LLM chậm + retry) -> ngưỡng rộng
+SUPERVISOR_HEARTBEAT_TIMEOUT = float(os.getenv("SUPERVISOR_HEARTBEAT_TIMEOUT", "300"))
+SCALE_TARGET_UTILIZATION = float(os.getenv("SCALE_TARGET_UTILIZATION", "0.7"))
+SCALE_MAX_AGE_SECONDS = float(os.getenv("SCALE_MAX_AGE_SECONDS", "5"))
+SCALE_DOWN_DELAY_SECONDS = float(os.getenv("SCALE_DOWN_DELAY_SECONDS", "60"))
+CRASH_WINDOW_SECONDS = 60
+CRASH_BACKOFF_MAX_SECONDS = 30
+
+# Giống app/worker.py / app/async_worker.py (không import: các module đó mở kết nối ngay lúc import)
+WORKER_MODE = os.getenv("WORKER_MODE", "sync").lower()
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "100"))
+
+STATUS_KEY = "supervisor:status"    # hash "<host>-<pid>" -> JSON trạng thái pool
+STATUS_STALE_SECONDS = 30           # Supervisor không cập nhật lâu hơn -> bỏ qua ở /metrics
+
+log = get_logger("supervisor")
+
+
+def warm_up():
+    """Import module nặng + nạp config ở process cha; trả về số Page"""
+    from app import ai_engine, context_builder, flow_engine, lead_scoring, reply_stream  # noqa: F401
+    from app.config_loader import registry
+
+    registry.reload(force=True)
+    return len(registry.page_ids())
+
+
+def _child_main(heartbeat, busy):
+    # Ctrl-C gửi SIGINT cho cả nhóm process -> để supervisor điều phối drain.
+    # SIGTERM trước khi worker cài handler (đang import) thì thoát luôn: chưa có tin nào trong tay
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    from app import worker
+    parent = os.getppid()
+
+    def report(n=0):
+        heartbeat.value = time.time()
+        busy.value = n
+        if os.getppid() != parent:
+            # Supervisor đã chết (SIGKILL) -> tự drain rồi thoát, không để lại process mồ côi
+            worker.request_stop()
+
+    worker.heartbeat = report
+    try:
+        worker.main()
+    finally:
+        # multiprocessing thoát process con bằng os._exit (không chạy atexit)
+        logs.shutdown()
+
+
+class _Worker:
+    __slots__ = ("process", "heartbeat", "busy", "retired_at")
+
+    def __init__(self, process, heartbeat, busy):
+        self.process = process
+        self.heartbeat = heartbeat
+        self.busy = busy
+        self.retired_at = None
+
+
+class Supervisor:
+    def __init__(self, redis_client, min_workers=SUPERVISOR_MIN_WORKERS, max_workers=SUPERVISOR_MAX_WORKERS):
+        self.redis = redis_client
+        self.queue = get_chat_queue(redis_client)
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.capacity = WORKER_CONCURRENCY if WORKER_MODE == "async" else 1
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self.workers = []     # Đang nhận tin
+        self.retiring = []    # Đã gửi SIGTERM, đang drain
+        self.desired = self.min_workers
+        self._ctx = multiprocessing.get_context("fork")
+        self._crashes = deque()
+        self._respawn_at = 0.0
+        self._low_since = None
+        self._stopping = False
+
+    # ------------------------------------------------
+    # Vòng đời process con
+    # ------------------------------------------------
+    def spawn(self):
+        heartbeat = self._ctx.RawValue("d", time.time())
+        busy = self._ctx.RawValue("i", 0)
+        process = self._ctx.Process(target=_child_main, args=(heartbeat, busy), name="worker")
+        process.start()
+        self.workers.append(_Worker(process, heartbeat, busy))
+        metrics.inc("chatbot_supervisor_events_total", event="spawn")
+        log.info("worker_spawned", pid=process.pid, workers=len(self.workers))
+
+    def retire(self, worker, reason):
+        self.workers.remove(worker)
+        worker.retired_at = time.monotonic()
+        self.retiring.append(worker)
+        if worker.process.is_alive():
+            os.kill(worker.process.pid, signal.SIGTERM)
+        metrics.inc("chatbot_supervisor_events_total", event="retire")
+        log.info("worker_retiring", pid=worker.process.pid, reason=reason, busy=worker.busy.value,
+                 workers=len(self.workers))
+
+    def _record_crash(self, now):
+        self._crashes.append(now)
+        while self._crashes and now - self._crashes[0] > CRASH_WINDOW_SECONDS:
+            self._crashes.popleft()
+        self._respawn_at = now + min(CRASH_BACKOFF_MAX_SECONDS, 0.5 * 2 ** (len(self._crashes) - 1))
+
+    def reap(self):
+        """Thu dọn worker đã thoát, kill worker drain quá hạn / kẹt, ghi nhận crash"""
+        now = time.monotonic()
+        for worker in list(self.retiring):
+            if not worker.process.is_alive():
+                worker.process.join()
+                self.retiring.remove(worker)
+                log.info("worker_exited", pid=worker.process.pid, exitcode=worker.process.exitcode,
+                         drain_ms=round((now - worker.retired_at) * 1000))
+            elif now - worker.retired_at > SUPERVISOR_DRAIN_SECONDS:
+                metrics.inc("chatbot_supervisor_events_total", event="drain_timeout")
+                log.error("worker_drain_timeout", pid=worker.process.pid, busy=worker.busy.value)
+                worker.process.kill()
+
+        for worker in list(self.workers):
+            if not worker.process.is_alive():
+                worker.process.join()
+                self.workers.remove(worker)
+                self._record_crash(now)
+                metrics.inc("chatbot_supervisor_events_total", event="crash")
+                log.error("worker_crashed", pid=worker.process.pid, exitcode=worker.process.exitcode,
+                          respawn_in_s=round(max(0.0, self._respawn_at - now), 1))
+            elif time.time() - worker.heartbeat.value > SUPERVISOR_HEARTBEAT_TIMEOUT:
+                metrics.inc("chatbot_supervisor_events_total", event="hung")
+                log.error("worker_hung", pid=worker.process.pid, busy=worker.busy.value,
+                          silent_s=round(time.time() - worker.heartbeat.value))
+                # Lần reap sau thấy process đã chết -> tính như crash và fork lại
+                worker.process.kill()
+
+    # ------------------------------------------------
+    # Autoscale
+    # ------------------------------------------------
+    def target(self, depth, oldest_age, busy):
+        """Số worker cần cho tải hiện tại (đã kẹp trong [min, max])"""
+        desired = math.ceil((depth + busy) / (self.capacity * SCALE_TARGET_UTILIZATION))
+        if oldest_age > SCALE_MAX_AGE_SECONDS:
+            desired = max(desired, len(self.workers) + 1)
+        return min(self.max_workers, max(self.min_workers, desired))
+
+    def scale(self):
+        now = time.monotonic()
+        busy = sum(worker.busy.value for worker in self.workers)
+        try:
+            depth, oldest_age = self.queue.depth(), self.queue.oldest_age()
+        except redis.RedisError as e:
+            # Không đo được tải -> giữ nguyên số worker (vẫn bù worker crash cho đủ tối thiểu)
+            log.warning("queue_stats_failed", error=str(e))
+            depth, oldest_age = None, 0.0
+            self.desired = max(self.min_workers, len(self.workers))
+        else:
+            self.desired = self.target(depth, oldest_age, busy)
+
+        current = len(self.workers)
+        if self.desired > current:
+            self._low_since = None
+            if now < self._respawn_at:
+                return
+            if current:
+                metrics.inc("chatbot_supervisor_events_total", event="scale_up")
+                log.info("scale_up", workers=current, desired=self.desired, depth=depth, busy=busy,
+                         oldest_age_s=round(oldest_age, 1))
+            for _ in range(self.desired - current):
+                self.spawn()
+        elif self.desired < current:
+            if self._low_since is None:
+                self._low_since = now
+            elif now - self._low_since >= SCALE_DOWN_DELAY_SECONDS:
+                # Bớt từng worker một, mỗi lần cách nhau SCALE_DOWN_DELAY_SECONDS
+                self._low_since = now
+                metrics.inc("chatbot_supervisor_events_total", event="scale_down")
+                self.retire(min(self.workers, key=lambda worker: worker.busy.value), "scale_down")
+        else:
+            self._low_since = None
+
+    def publish(self):
+        status = {
+            "ts": time.time(),
+            "workers": len(self.workers),
+            "retiring": len(self.retiring),
+            "desired": self.desired,
+            "busy": sum(worker.busy.value for worker in self.workers + self.retiring),
+            "capacity": self.capacity * len(self.workers),
+        }
+        try:
+            self.redis.hset(STATUS_KEY, self.name, json.dumps(status))
+        except redis.RedisError as e:
+            log.warning("supervisor_status_failed", error=str(e))
+        metrics.registry.flush(self.redis)
+
+    # ------------------------------------------------
+    # Vòng lặp chính
+    # ------------------------------------------------
+    def stop(self, signum=None, frame=None):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        log.info("supervisor_started", mode=WORKER_MODE, min_workers=self.min_workers,
+                 max_workers=self.max_workers, capacity_per_worker=self.capacity)
+        while not self._stopping:
+            self.reap()
+            self.scale()
+            self.publish()
+            time.sleep(SUPERVISOR_CHECK_SECONDS)
+        self.shutdown()
+
+    def shutdown(self):
+        log.info("supervisor_stopping", workers=len(self.workers))
+        for worker in list(self.workers):
+            self.retire(worker, "shutdown")
+        while self.retiring:
+            self.reap()
+            time.sleep(0.2)
+        try:
+            self.redis.hdel(STATUS_KEY, self.name)
+        except redis.RedisError:
+            pass
+        metrics.registry.flush(self.redis)
+        log.info("supervisor_stopped")
+
+
+def main():
+    pages = warm_up()
+    supervisor = Supervisor(redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+    log.info("supervisor_warmed_up", pages=pages)
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
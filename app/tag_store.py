@@ -0,0 +1,239 @@
+# app/tag_store.py
+"""
+Kho tag khách hàng + chỉ mục ngược tag -> khách để lọc phân khúc.
+
+Cấu trúc (ghi trong COMMIT_TURN_LUA của app/session_store.py, cùng round trip với lượt chat):
+- Hash "tags:<sender_id>"          : "c:<tag>" = số lượt có tag, "t:<tag>" = lần cuối (epoch).
+                                     Không trùng lặp, có TTL như session.
+- ZSET "tagidx:<page_id>:<tag>"    : member = sender_id, score = lần cuối gắn tag.
+                                     Tự cắt phần cũ hơn TAG_INDEX_TTL_SECONDS.
+- SET  "tagidx:<page_id>"          : danh sách tag đang có của Page.
+
+Truy vấn phân khúc ("vip + high_budget trên page X trong 7 ngày") = 1 Lua script:
+ZINTERSTORE (hoặc ZUNIONSTORE với --any) các zset tag -> ZREVRANGEBYSCORE theo mốc thời gian.
+Chi phí theo kích thước zset nhỏ nhất, không phải số khách.
+
+Lệnh:
+    python -m app.tag_store migrate [--dry-run]            # chuyển list "tags:<id>" cũ 1 lần
+    python -m app.tag_store segment --page 2002 --tags vip,high_budget --within 7d [--any]
+    python -m app.tag_store tags --page 2002               # tag của Page + số khách
+    python -m app.tag_store customer <sender_id>
+"""
+import datetime
+import json
+import os
+import time
+import uuid
+
+from app.maintenance import SCAN_BATCH, Throttle, parse_age, scan_batches, sender_of
+from app.session_store import (SESSION_TTL_SECONDS, TAG_INDEX_TTL_SECONDS, page_tags_key,
+                               parse_tags, session_key, tag_index_key, tags_key)
+
+SEGMENT_LIMIT = 1000
+
+# KEYS[1]=key tạm cho ZINTERSTORE / ZUNIONSTORE, KEYS[2..]=zset chỉ mục của từng tag
+# ARGV[1]=JSON {op: inter|union, since, limit}
+# Điểm của khách trong kết quả = lần gần nhất gắn 1 trong các tag (AGGREGATE MAX)
+SEGMENT_LUA = """
+local p = cjson.decode(ARGV[1])
+local src = KEYS[2]
+if #KEYS > 2 then
+    src = KEYS[1]
+    local args = {src, #KEYS - 1}
+    for i = 2, #KEYS do table.insert(args, KEYS[i]) end
+    table.insert(args, 'AGGREGATE')
+    table.insert(args, 'MAX')
+    redis.call(p.op == 'union' and 'ZUNIONSTORE' or 'ZINTERSTORE', unpack(args))
+end
+local rows = redis.call('ZREVRANGEBYSCORE', src, '+inf', p.since, 'WITHSCORES', 'LIMIT', 0, p.limit)
+if #KEYS > 2 then redis.call('DEL', src) end
+return rows
+"""
+
+# KEYS[1]=tags:<id>; khi index: KEYS[2]="tagidx:<page>", KEYS[2+i]="tagidx:<page>:<tags[i]>"
+# ARGV[1]=JSON {sender_id, tags[], counts{tag: n}, last_seen, index, ttl, index_ttl}
+# Chỉ chuyển khi key vẫn còn là list (lượt chat có thể đã tự chuyển trong COMMIT_TURN_LUA)
+MIGRATE_TAGS_LUA = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'list' then return 0 end
+local p = cjson.decode(ARGV[1])
+redis.call('DEL', KEYS[1])
+for i, tag in ipairs(p.tags) do
+    redis.call('HINCRBY', KEYS[1], 'c:' .. tag, p.counts[tag])
+    redis.call('HSET', KEYS[1], 't:' .. tag, p.last_seen)
+    if p.index then
+        local idx = KEYS[2 + i]
+        redis.call('ZADD', idx, 'GT', p.last_seen, p.sender_id)
+        redis.call('EXPIRE', idx, p.index_ttl)
+        redis.call('SADD', KEYS[2], tag)
+        redis.call('EXPIRE', KEYS[2], p.index_ttl)
+    end
+end
+redis.call('EXPIRE', KEYS[1], p.ttl)
+return 1
+"""
+
+
+def normalize_tag(tag):
+    return str(tag).strip().lower()
+
+
+class TagStore:
+    def __init__(self, redis_client, index_ttl=TAG_INDEX_TTL_SECONDS):
+        self.redis = redis_client
+        self.index_ttl = index_ttl
+        self._segment_script = redis_client.register_script(SEGMENT_LUA)
+        self._migrate_script = redis_client.register_script(MIGRATE_TAGS_LUA)
+
+    def customer_tags(self, sender_id):
+        """{tag: {"count", "last_seen"}} của 1 khách (list kiểu cũ: đếm tại chỗ, last_seen = 0)"""
+        key = tags_key(sender_id)
+        if self.redis.type(key) == b"list":
+            tags = {}
+            for raw in self.redis.lrange(key, 0, -1):
+                entry = tags.setdefault(normalize_tag(raw.decode()), {"count": 0, "last_seen": 0.0})
+                entry["count"] += 1
+            return tags
+        return parse_tags(self.redis.hgetall(key))
+
+    def page_tags(self, page_id):
+        """{tag: số khách trong chỉ mục} của 1 Page"""
+        tags = sorted(t.decode() for t in self.redis.smembers(page_tags_key(page_id)))
+        pipe = self.redis.pipeline(transaction=False)
+        for tag in tags:
+            pipe.zcard(tag_index_key(page_id, tag))
+        return {tag: n for tag, n in zip(tags, pipe.execute()) if n}
+
+    def segment(self, page_id, tags, within=None, match_any=False, limit=SEGMENT_LIMIT):
+        """
+        Khách của page_id có ĐỦ các tag (match_any: có ít nhất 1 tag),
+        hoạt động với các tag đó trong `within` giây gần nhất.
+        Trả về list (sender_id, last_seen) mới nhất trước.
+        """
+        tags = [t for t in dict.fromkeys(normalize_tag(t) for t in tags) if t]
+        if not tags:
+            return []
+        payload = {
+            "op": "union" if match_any else "inter",
+            "since": time.time() - within if within else "-inf",
+            "limit": limit or -1,
+        }
+        tmp_key = f"tagidx:tmp:{uuid.uuid4().hex}"
+        rows = self._segment_script(keys=[tmp_key] + [tag_index_key(page_id, t) for t in tags],
+                                    args=[json.dumps(payload)])
+        return [(rows[i].decode(), float(rows[i + 1])) for i in range(0, len(rows), 2)]
+
+    def migrate_legacy(self, dry_run=False, throttle=None, batch=SCAN_BATCH):
+        """
+        SCAN tags:* -> list kiểu cũ được đếm lại thành hash + đưa vào chỉ mục của Page.
+        Lần cuối gắn tag lấy theo updated_at của session (list cũ không lưu thời điểm).
+        Chạy lại an toàn: key đã là hash thì bỏ qua.
+        """
+        throttle = throttle or Throttle()
+        stats = {"keys_scanned": 0, "lists": 0, "migrated": 0, "tags": 0, "indexed": 0}
+        now = time.time()
+        for keys in scan_batches(self.redis, "tags:*", batch):
+            stats["keys_scanned"] += len(keys)
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.type(key)
+            lists = [k for k, kind in zip(keys, throttle.timed(pipe)) if kind == b"list"]
+            stats["lists"] += len(lists)
+            if not lists:
+                throttle.pace(len(keys))
+                continue
+
+            pipe = self.redis.pipeline(transaction=False)
+            for key in lists:
+                pipe.lrange(key, 0, -1)
+                pipe.hmget(session_key(sender_of(key)), "page_id", "updated_at")
+            raw = throttle.timed(pipe)
+
+            pipe = self.redis.pipeline(transaction=False)
+            for i, key in enumerate(lists):
+                values, (page_id, updated_at) = raw[2 * i], raw[2 * i + 1]
+                counts = {}
+                for value in values:
+                    tag = normalize_tag(value.decode())
+                    if tag:
+                        counts[tag] = counts.get(tag, 0) + 1
+                last_seen = now
+                if updated_at:
+                    try:
+                        last_seen = datetime.datetime.fromisoformat(updated_at.decode()).timestamp()
+                    except ValueError:
+                        pass
+                # Khách không còn session / quá hạn chỉ mục -> chỉ đổi sang hash, không đưa vào chỉ mục
+                index = bool(page_id) and now - last_seen < self.index_ttl
+                stats["tags"] += len(counts)
+                stats["indexed"] += index
+                if dry_run:
+                    continue
+                payload = {
+                    "sender_id": sender_of(key),
+                    "tags": list(counts),
+                    "counts": counts,
+                    "last_seen": last_seen,
+                    "index": index,
+                    "ttl": SESSION_TTL_SECONDS,
+                    "index_ttl": self.index_ttl,
+                }
+                script_keys = [key]
+                if index:
+                    page = page_id.decode()
+                    script_keys += [page_tags_key(page)] + [tag_index_key(page, tag) for tag in counts]
+                self._migrate_script(keys=script_keys, args=[json.dumps(payload, ensure_ascii=False)], client=pipe)
+            if not dry_run:
+                stats["migrated"] += sum(throttle.timed(pipe))
+            throttle.pace(len(keys))
+
+        stats["dry_run"] = dry_run
+        stats["slow_batches"] = throttle.slow_batches
+        return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    import redis
+    from dotenv import load_dotenv
+
+    sys.path.append(os.getcwd())
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Kho tag khách hàng + truy vấn phân khúc")
+    parser.add_argument("command", choices=["migrate", "segment", "tags", "customer"])
+    parser.add_argument("sender_id", nargs="?", help="cho lệnh customer")
+    parser.add_argument("--page", help="page_id (segment / tags)")
+    parser.add_argument("--tags", default="", help="danh sách tag, cách nhau bởi dấu phẩy")
+    parser.add_argument("--within", help="chỉ khách gắn tag trong khoảng này (vd: 7d, 12h)")
+    parser.add_argument("--any", action="store_true", help="có ít nhất 1 tag (mặc định: đủ tất cả)")
+    parser.add_argument("--limit", type=int, default=SEGMENT_LIMIT)
+    parser.add_argument("--dry-run", action="store_true", help="migrate: chỉ đếm, không ghi")
+    parser.add_argument("--batch", type=int, default=SCAN_BATCH)
+    parser.add_argument("--max-keys-per-sec", type=int, default=5000)
+    parser.add_argument("--max-latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    store = TagStore(r)
+
+    if args.command == "migrate":
+        result = store.migrate_legacy(dry_run=args.dry_run, batch=args.batch,
+                                      throttle=Throttle(args.max_keys_per_sec, args.max_latency_ms))
+        print(f"✅ migrate: {json.dumps(result, ensure_ascii=False)}")
+    elif args.command == "customer":
+        if not args.sender_id:
+            parser.error("Cần sender_id")
+        print(json.dumps(store.customer_tags(args.sender_id), ensure_ascii=False, indent=2))
+    else:
+        if not args.page:
+            parser.error("Cần --page")
+        if args.command == "tags":
+            print(json.dumps(store.page_tags(args.page), ensure_ascii=False, indent=2))
+        else:
+            started = time.perf_counter()
+            rows = store.segment(args.page, args.tags.split(","), within=parse_age(args.within),
+                                 match_any=args.any, limit=args.limit)
+            for sender_id, last_seen in rows:
+                print(f"{sender_id}\t{datetime.datetime.fromtimestamp(last_seen).isoformat()}")
+            print(f"✅ {len(rows)} khách ({(time.perf_counter() - started) * 1000:.1f} ms)")
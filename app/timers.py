@@ -0,0 +1,189 @@
+# app/timers.py
+"""
+Hẹn giờ (timer) dùng chung cho mọi worker, không phải quét "session:*" để tìm việc tới hạn.
+
+- zset "timers:due"     : timer_id -> thời điểm tới hạn (score)
+  hash "timers:payload" : timer_id -> JSON payload ({"kind": ..., ...})
+- schedule(timer_id, due_at, payload) / cancel(timer_id): O(log n). timer_id cố định theo việc
+  (vd "handoff:<sender_id>") -> hẹn lại = ghi đè giờ cũ, không bao giờ sinh timer trùng.
+- claim_due(): 1 lệnh Lua lấy tối đa TIMER_BATCH timer tới hạn và dời giờ của chúng sang
+  now + TIMER_LEASE_SECONDS (thuê) thay vì xóa -> nhiều worker cùng chạy không lấy trùng;
+  worker chết giữa chừng thì hết hạn thuê, timer tự tới hạn lại (at-least-once).
+- settle(): chỉ xóa / hẹn lại khi giờ của timer vẫn đúng là giờ thuê -> timer được schedule() lại
+  hoặc cancel() trong lúc handler đang chạy thì bản mới được giữ nguyên.
+- Handler lỗi -> thử lại sau TIMER_RETRY_SECONDS x số lần lỗi; quá TIMER_MAX_ATTEMPTS thì bỏ.
+
+TimerDispatcher chạy kèm trong mỗi worker (thread nền, TIMERS_EMBEDDED=0 để tắt), gọi handler theo
+payload["kind"]: handler(payload) trả về None (xong, xóa timer) hoặc (due_at, payload) để hẹn tiếp.
+Loại timer của app/worker.py (config Page):
+- "handoff"  : Admin im lặng quá "handoff": {"timeout_seconds": ...} -> bật lại Bot ngay lúc hết hạn,
+               không chờ khách nhắn tin tiếp.
+- "follow_up": "follow_up": {"steps": [{"after_seconds": 82800, "text": "..."}, ...], "skip_if_contact": true}
+               nhắc khách theo từng bước, tính từ tin cuối của khách (khách nhắn lại -> lịch chạy lại từ đầu).
+               Bỏ qua nếu Admin đang chat tay hoặc (skip_if_contact) khách đã để lại SĐT / Email.
+               Facebook chỉ cho nhắn tin thường trong 24h kể từ tin cuối của khách -> after_seconds < 86400.
+
+Số timer: gauge chatbot_queue_depth{queue="timers"|"timers_due"}, độ trễ: stage timer_lag (GET /metrics).
+"""
+import json
+import os
+import threading
+import time
+
+from app import metrics
+from app.logs import get_logger
+
+TIMERS_KEY = "timers:due"
+TIMERS_PAYLOAD_KEY = "timers:payload"
+TIMER_BATCH = int(os.getenv("TIMER_BATCH", "100"))
+TIMER_POLL_SECONDS = float(os.getenv("TIMER_POLL_SECONDS", "1"))
+TIMER_LEASE_SECONDS = float(os.getenv("TIMER_LEASE_SECONDS", "60"))
+TIMER_RETRY_SECONDS = 30
+TIMER_MAX_ATTEMPTS = 5
+
+log = get_logger("timers")
+
+# KEYS[1]=zset, KEYS[2]=hash; ARGV[1]=now, ARGV[2]=giờ hết thuê, ARGV[3]=số timer tối đa
+# Trả về phẳng: timer_id, giờ tới hạn gốc, payload (nil nếu mất) cho từng timer
+CLAIM_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[3]))
+local out = {}
+for i = 1, #due, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[2], due[i])
+    out[#out + 1] = due[i]
+    out[#out + 1] = due[i + 1]
+    out[#out + 1] = redis.call('HGET', KEYS[2], due[i])
+end
+return out
+"""
+
+# KEYS[1]=zset, KEYS[2]=hash; ARGV[1]=timer_id, ARGV[2]=giờ hết thuê lúc claim,
+# ARGV[3]=giờ hẹn lại ('' = xóa timer), ARGV[4]=payload mới ('' = giữ nguyên)
+# Giờ của timer đã khác giờ thuê (vừa được schedule / cancel) -> không động vào
+SETTLE_LUA = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score or tonumber(score) ~= tonumber(ARGV[2]) then return 0 end
+if ARGV[3] == '' then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+    if ARGV[4] ~= '' then redis.call('HSET', KEYS[2], ARGV[1], ARGV[4]) end
+end
+return 1
+"""
+
+
+class TimerStore:
+    def __init__(self, redis_client, lease_seconds=TIMER_LEASE_SECONDS):
+        self.redis = redis_client
+        self.lease_seconds = lease_seconds
+        self._claim = redis_client.register_script(CLAIM_LUA)
+        self._settle = redis_client.register_script(SETTLE_LUA)
+
+    def schedule(self, timer_id, due_at, payload):
+        """Hẹn (hoặc hẹn lại) timer_id vào lúc due_at (epoch giây)"""
+        pipe = self.redis.pipeline()   # MULTI: zset và hash luôn khớp nhau
+        pipe.hset(TIMERS_PAYLOAD_KEY, timer_id, json.dumps(payload, ensure_ascii=False))
+        pipe.zadd(TIMERS_KEY, {timer_id: due_at})
+        pipe.execute()
+
+    def cancel(self, timer_id):
+        pipe = self.redis.pipeline()
+        pipe.zrem(TIMERS_KEY, timer_id)
+        pipe.hdel(TIMERS_PAYLOAD_KEY, timer_id)
+        pipe.execute()
+
+    def claim_due(self, limit=TIMER_BATCH, now=None):
+        """Thuê các timer tới hạn: trả về (giờ hết thuê, [(timer_id, due_at, payload | None)])"""
+        now = now or time.time()
+        lease_until = now + self.lease_seconds
+        raw = self._claim(keys=[TIMERS_KEY, TIMERS_PAYLOAD_KEY], args=[repr(now), repr(lease_until), limit])
+        timers = []
+        for i in range(0, len(raw), 3):
+            payload = None
+            if raw[i + 2]:
+                try:
+                    payload = json.loads(raw[i + 2])
+                except ValueError:
+                    pass
+            timers.append((raw[i].decode(), float(raw[i + 1]), payload))
+        return lease_until, timers
+
+    def settle(self, lease_until, outcomes):
+        """outcomes: [(timer_id, None | (due_at, payload))] - 1 pipeline cho cả lô"""
+        pipe = self.redis.pipeline(transaction=False)
+        for timer_id, follow in outcomes:
+            if follow is None:
+                args = [timer_id, repr(lease_until), "", ""]
+            else:
+                due_at, payload = follow
+                args = [timer_id, repr(lease_until), repr(due_at),
+                        json.dumps(payload, ensure_ascii=False) if payload is not None else ""]
+            self._settle(keys=[TIMERS_KEY, TIMERS_PAYLOAD_KEY], args=args, client=pipe)
+        pipe.execute()
+
+
+class TimerDispatcher:
+    def __init__(self, store, handlers, batch=TIMER_BATCH, poll_seconds=TIMER_POLL_SECONDS):
+        self.store = store
+        self.handlers = handlers       # kind -> handler(payload)
+        self.batch = batch
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+
+    def _fire(self, timer_id, due_at, payload):
+        """Chạy handler của 1 timer -> None (xóa) hoặc (due_at, payload) để hẹn lại"""
+        kind = (payload or {}).get("kind")
+        handler = self.handlers.get(kind)
+        if handler is None:
+            log.warning("timer_unknown_kind", timer_id=timer_id, kind=kind)
+            return None
+        page_id = payload.get("page_id", "")
+        metrics.observe("chatbot_stage_seconds", max(0.0, time.time() - due_at), page_id=page_id, stage="timer_lag")
+        try:
+            follow = handler(payload)
+        except Exception as e:
+            attempts = payload.get("_attempts", 0) + 1
+            metrics.inc("chatbot_errors_total", component="timers", page_id=page_id)
+            if attempts >= TIMER_MAX_ATTEMPTS:
+                metrics.inc("chatbot_timers_total", kind=kind, result="dropped")
+                log.error("timer_dropped", timer_id=timer_id, attempts=attempts, error=str(e), exc_info=True)
+                return None
+            metrics.inc("chatbot_timers_total", kind=kind, result="retry")
+            log.warning("timer_failed", timer_id=timer_id, attempts=attempts, error=str(e))
+            return time.time() + TIMER_RETRY_SECONDS * attempts, {**payload, "_attempts": attempts}
+        metrics.inc("chatbot_timers_total", kind=kind, result="fired")
+        return follow
+
+    def run_once(self):
+        """Xử lý 1 lô timer tới hạn, trả về số timer đã lấy"""
+        lease_until, timers = self.store.claim_due(self.batch)
+        if timers:
+            self.store.settle(lease_until, [(timer_id, self._fire(timer_id, due_at, payload))
+                                            for timer_id, due_at, payload in timers])
+        return len(timers)
+
+    def run(self):
+        log.info("timer_dispatcher_started", kinds=sorted(self.handlers), batch=self.batch)
+        while not self._stop.is_set():
+            try:
+                claimed = self.run_once()
+            except Exception as e:
+                metrics.inc("chatbot_errors_total", component="timers", page_id="")
+                log.error("timer_dispatcher_loop_failed", error=str(e))
+                claimed = 0
+            # Lô đầy -> còn timer tới hạn, lấy tiếp ngay
+            if claimed < self.batch:
+                self._stop.wait(self.poll_seconds)
+
+    def stop(self):
+        self._stop.set()
+
+
+def start_dispatcher_thread(store, handlers):
+    """Chạy dispatcher trong thread nền bên trong process worker"""
+    dispatcher = TimerDispatcher(store, handlers)
+    dispatcher.thread = threading.Thread(target=dispatcher.run, name="timers", daemon=True)
+    dispatcher.thread.start()
+    return dispatcher
@@ -1,6 +1,8 @@
+import collections
 import os
+import signal
 import sys
-import datetime
+import threading
 import time 
 
 # Thêm đường dẫn gốc
@@ -10,14 +12,23 @@ import redis
 import json
 from dotenv import load_dotenv
 
-from app.config_loader import load_config
-from app.ai_engine import generate_ai_response
+from app.config_loader import load_config, registry as config_registry
+from app.ai_engine import generate_ai_response, summarize_turn
 from app.flow_engine import FlowEngine
 from app.fb_helper import FacebookClient
 from app.crm_connector import CRMConnector
+from app.chat_queue import get_chat_queue
+from app.response_cache import response_cache
+from app.session_store import SessionRepository
+from app.context_builder import ContextBuilder, context_settings
+from app import outbound, lead_scoring, metrics
+from app.reply_stream import EarlyReply, StreamedTurns, early_reply_key, stream_settings
+from app.timers import TimerStore
+from app.logs import HOT_SAMPLE, get_logger
 
 # --- CẤU HÌNH THỜI GIAN CHỜ ---
 HANDOFF_TIMEOUT_SECONDS = 60 # 1 phút (Nếu Admin im lặng 60s, Bot sẽ bật lại)
+# Page ghi đè bằng "handoff": {"timeout_seconds": ...}; nhắc khách: "follow_up" (xem app/timers.py)
 # Nếu anh biết ID App của Bot, điền vào .env: BOT_APP_ID=123456...
 BOT_APP_ID = os.getenv("BOT_APP_ID") 
 # -----------------------------
@@ -27,220 +38,616 @@ load_dotenv()
 redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 redis_client = redis.from_url(redis_url)
 
+# Chế độ chạy: "sync" (mặc định, 1 tin / lần) hoặc "async" (xem app/async_worker.py)
+WORKER_MODE = os.getenv("WORKER_MODE", "sync").lower()
+
+# Burst coalescing (cả 2 chế độ): cửa sổ gộp tin mặc định,
+# Page ghi đè bằng "burst": {"window_ms": ..., "max_messages": ...}
+BURST_WINDOW_MS = int(os.getenv("BURST_WINDOW_MS", "1200"))
+BURST_MAX_MESSAGES = 5
+# Mỗi tin mới tới lại gia hạn cửa sổ, nhưng tổng thời gian chờ không quá N lần cửa sổ
+BURST_MAX_WAIT_FACTOR = 3
+
+# Nạp toàn bộ config 1 lần lúc khởi động + nghe tín hiệu reload từ Redis
+# (chạy dưới app/supervisor.py: process cha đã nạp sẵn trước khi fork -> chỉ kiểm tra mtime)
+config_registry.reload()
+config_registry.start_reload_listener(redis_client)
+
+chat_queue = get_chat_queue(redis_client)
+session_repo = SessionRepository(redis_client)
+context_builder = ContextBuilder(llm_summarizer=summarize_turn)
 flow_engine = FlowEngine(redis_client)
 fb_client = FacebookClient() 
-crm = CRMConnector()
+crm = CRMConnector(redis_client)
+# Hẹn giờ bật lại Bot / nhắc khách (app/timers.py), dispatcher chạy kèm mọi worker
+timers = TimerStore(redis_client)
+# Mảnh đầu đã stream của từng lượt -> lượt bị xử lý lại không gửi lại / không ra câu trả lời khác
+streamed_turns = StreamedTurns(redis_client)
+log = get_logger("worker")
+# Metric của process được cộng dồn lên Redis (GET /metrics trên webhook gộp mọi worker)
+metrics.start_flusher(redis_client)
+
+log.info("worker_started", mode=WORKER_MODE, handoff_timeout=HANDOFF_TIMEOUT_SECONDS)
+
+# SIGTERM -> ngừng kéo tin mới, làm xong lượt đang chạy rồi thoát
+_stopping = threading.Event()
+# Dispatcher gửi tin / CRM chạy kèm trong process (để dừng êm khi thoát)
+_dispatchers = []
+
+
+def heartbeat(busy=0):
+    """Báo còn sống + số lượt đang xử lý; app/supervisor.py thay bằng hàm ghi vào bộ nhớ chung"""
+
 
-print(f" WORKER ĐANG CHẠY... (Auto Handoff: {HANDOFF_TIMEOUT_SECONDS}s)")
+def request_stop(signum=None, frame=None):
+    if not _stopping.is_set():
+        log.info("worker_draining")
+    _stopping.set()
+
+
+def stopping():
+    return _stopping.is_set()
 
 # ====================================================
 # 👇 KHU VỰC QUẢN LÝ SESSION & MEMORY
 # ====================================================
 
+# Mỗi lượt chỉ 2 round trip Redis: load_turn (pipeline) + commit_turn (Lua script)
+# Các hàm get_/save_/update_ bên dưới giữ lại cho code cũ, đều đi qua repository.
+
 def get_chat_history(sender_id):
     """Lấy lịch sử chat"""
-    key = f"history:{sender_id}"
-    raw_list = redis_client.lrange(key, -10, -1) 
-    history = []
-    for item in raw_list:
-        try:
-            history.append(json.loads(item))
-        except:
-            pass
-    return history
+    return session_repo.load_turn(sender_id)[1]
 
 def save_chat_history(sender_id, role, content):
     """Lưu tin nhắn mới"""
-    key = f"history:{sender_id}"
-    message = json.dumps({"role": role, "content": content})
-    redis_client.rpush(key, message)
-    redis_client.ltrim(key, -50, -1)
+    session_repo.commit_turn(sender_id, history=[(role, content)])
 
 def get_session(sender_id):
     """Lấy Context khách hàng"""
-    key = f"session:{sender_id}"
-    data = redis_client.hgetall(key)
-    session = {k.decode(): v.decode() for k, v in data.items()}
-    
-    if "data" in session:
-        try:
-            session["data"] = json.loads(session["data"])
-        except:
-            session["data"] = {}
-    else:
-        session["data"] = {}
-        
-    session["conversation_mode"] = session.get("conversation_mode", "BOT")
-    try:
-        session["last_human_activity"] = float(session.get("last_human_activity", 0))
-    except:
-        session["last_human_activity"] = 0.0
-
-    return session
+    return session_repo.load_turn(sender_id)[0]
 
 def update_session(sender_id, page_id, topic, state, new_data=None, 
                    conversation_mode=None, last_human_activity=None): 
     """Lưu Session chuẩn Schema"""
-    key = f"session:{sender_id}"
+    session_repo.commit_turn(
+        sender_id, page_id=page_id, topic=topic, state=state, new_data=new_data,
+        conversation_mode=conversation_mode, last_human_activity=last_human_activity
+    )
+
+def handoff_timeout(config):
+    return config.get("handoff", {}).get("timeout_seconds", HANDOFF_TIMEOUT_SECONDS)
+
+def follow_up_settings(config):
+    follow_up = config.get("follow_up", {})
+    return follow_up.get("steps", []), follow_up.get("skip_if_contact", True)
+
+def handoff_timer_id(sender_id):
+    return f"handoff:{sender_id}"
+
+def follow_up_timer_id(sender_id):
+    return f"follow_up:{sender_id}"
+
+# ====================================================
+# 👇 XỬ LÝ MỘT SỰ KIỆN (DÙNG CHUNG CHO CẢ CHẾ ĐỘ SYNC & ASYNC)
+# ====================================================
+
+def enqueued_at(msg_id, body):
+    """
+    Thời điểm tin vào hàng đợi: ID của Redis Stream là "<ms>-<seq>";
+    backend list không có -> lấy entry.time (ms) Facebook gắn vào webhook.
+    """
+    if msg_id:
+        try:
+            return int((msg_id.decode() if isinstance(msg_id, bytes) else msg_id).split("-")[0]) / 1000
+        except ValueError:
+            pass
+    for entry in body.get("entry", []):
+        if entry.get("time"):
+            return entry["time"] / 1000
+    return None
+
+def iter_events(body, queued_at=None):
+    """
+    Tách 1 cục webhook thành từng sự kiện (page_id, config, topic_id, messaging).
+    Config chỉ tra 1 lần cho mỗi entry.
+    queued_at: gắn vào messaging["_queued_at"] để lượt chat đo được thời gian chờ trong hàng đợi.
+    """
+    for entry in body.get("entry", []):
+        page_id = str(entry.get("id")) 
+        
+        # --- LOAD CONFIG (tra registry trong RAM, page_name/topic_id đã tính sẵn) ---
+        with metrics.span("config_load", page_id):
+            config = load_config(page_id)
+        if not config:
+            metrics.inc("chatbot_errors_total", component="config", page_id=page_id)
+            continue
+        topic_id = config["topic_id"]
+        # -------------------
+
+        for messaging in entry.get("messaging", []):
+            if queued_at:
+                messaging["_queued_at"] = queued_at
+            yield page_id, config, topic_id, messaging
+
+def conversation_key(page_id, messaging):
+    """
+    Khóa hội thoại = ID khách hàng.
+    Với tin Admin/Echo thì khách là người nhận (recipient), còn lại là người gửi.
+    Mọi sự kiện cùng khóa phải được xử lý tuần tự.
+    """
+    message_obj = messaging.get("message", {})
+    sender_id = str(messaging.get("sender", {}).get("id"))
+    if message_obj.get("is_echo", False) or sender_id == page_id:
+        return str(messaging.get("recipient", {}).get("id"))
+    return sender_id
+
+def customer_message_text(page_id, messaging):
+    """Text của tin KHÁCH gửi (None nếu là Admin/Echo hoặc tin không có text)"""
+    message_obj = messaging.get("message", {})
+    sender_id = str(messaging.get("sender", {}).get("id"))
+    if message_obj.get("is_echo", False) or sender_id == page_id:
+        return None
+    return message_obj.get("text") or None
+
+def handle_messaging(page_id, config, topic_id, messaging):
+    """Xử lý trọn vẹn 1 sự kiện messaging (Admin echo hoặc tin nhắn của khách)"""
+    message_obj = messaging.get("message", {})
     
-    current_data_str = redis_client.hget(key, "data")
-    current_data = json.loads(current_data_str) if current_data_str else {}
+    # 1. LOGIC PHÁT HIỆN ADMIN/ECHO (ĐÃ CẬP NHẬT)
+    is_echo = message_obj.get("is_echo", False)
+    sender_id = str(messaging.get("sender", {}).get("id"))
+    recipient_id = str(messaging.get("recipient", {}).get("id"))
     
-    if new_data:
-        current_data.update(new_data)
+    # Một tin nhắn là từ Page nếu is_echo=True HOẶC sender_id == page_id
+    if is_echo or (sender_id == page_id):
+        msg_app_id = str(message_obj.get("app_id", ""))
+        admin_text = message_obj.get("text", "")
+        
+        # Log app_id để đối chiếu với BOT_APP_ID
+        log.debug("echo_received", page_id=page_id, app_id=msg_app_id, text=admin_text[:50])
+
+        # --- KIỂM TRA XEM CÓ PHẢI BOT TỰ GỬI KHÔNG ---
+        # Nếu trong .env có cấu hình BOT_APP_ID và khớp với msg_app_id -> Bỏ qua
+        if BOT_APP_ID and msg_app_id == BOT_APP_ID:
+            # print("🤖 [IGNORE] Tin nhắn từ Bot.")
+            return
+        
+        # --- XÁC NHẬN LÀ ADMIN ---
+        target_user_id = recipient_id # Khách hàng là người nhận
+        
+        # Kích hoạt HUMAN MODE (giữ nguyên state hiện tại, 1 round trip)
+        now = time.time()
+        session_repo.commit_turn(
+            target_user_id,
+            page_id=page_id,
+            topic=topic_id,
+            conversation_mode="HUMAN", 
+            last_human_activity=now 
+        )
+        # Hẹn giờ bật lại Bot (mỗi tin Admin dời giờ hẹn, không chờ khách nhắn mới kiểm tra)
+        timers.schedule(handoff_timer_id(target_user_id), now + handoff_timeout(config),
+                        {"kind": "handoff", "page_id": page_id, "sender_id": target_user_id})
+        metrics.inc("chatbot_turns_total", page_id=page_id, outcome="admin_takeover")
+        log.info("human_mode_on", page_id=page_id, sender_id=target_user_id, app_id=msg_app_id)
+        return 
+
+    # 2. XỬ LÝ TIN NHẮN TỪ KHÁCH HÀNG
+    message_text = message_obj.get("text")
+    if not message_text: return 
+
+    handle_customer_turn(page_id, config, topic_id, sender_id, [message_text],
+                         queued_at=messaging.get("_queued_at"))
+
+def handle_customer_turn(page_id, config, topic_id, sender_id, message_texts, queued_at=None):
+    """
+    1 lượt hội thoại của khách = 1 lần gọi AI.
+    message_texts: 1 tin, hoặc nhiều tin nhắn liên tiếp đã được gộp (burst coalescing)
+    queued_at: thời điểm tin vào hàng đợi (đo queue_wait)
+    """
+    with metrics.trace(page_id, sender_id) as trace:
+        if queued_at:
+            trace.add("queue_wait", max(0.0, time.time() - queued_at))
+        trace.attrs["messages"] = len(message_texts)
+        _run_customer_turn(trace, page_id, config, topic_id, sender_id, message_texts)
+
+def _run_customer_turn(trace, page_id, config, topic_id, sender_id, message_texts):
+    message_text = "\n".join(message_texts)
+    log.info("turn_start", sample=HOT_SAMPLE, page_id=page_id, sender_id=sender_id, chars=len(message_text))
+
+    # Round trip 1/2: session + lịch sử
+    ctx_settings = context_settings(config)
+    with trace.span("session_load"):
+        session_obj, history = session_repo.load_turn(sender_id, history_fetch=ctx_settings["history_fetch"])
+    current_state = session_obj["state"]
+    session_data_json = session_obj.get("data", {})
+    
+    mode = session_obj["conversation_mode"]
+    last_human_activity = session_obj["last_human_activity"]
+    current_time = time.time()
+
+    # --- LOGIC TỰ ĐỘNG BẬT/TẮT BOT ---
+    # (Thường timer "handoff" đã bật lại Bot đúng hạn; đây là lưới an toàn khi timer chưa kịp chạy)
+    if mode == "HUMAN":
+        silence_duration = current_time - last_human_activity
+        
+        if silence_duration > handoff_timeout(config):
+            log.info("auto_resume", page_id=page_id, sender_id=sender_id, silence_seconds=int(silence_duration))
+            mode = "BOT"
+        else:
+            trace.outcome = "human"
+            log.info("human_mode_silent", sample=HOT_SAMPLE, page_id=page_id, sender_id=sender_id,
+                     silence_seconds=int(silence_duration))
+            return 
+
+    # 3. NẾU LÀ BOT MODE -> GỌI AI XỬ LÝ
+    # Lịch sử gần đây theo ngân sách token + tóm tắt cuốn chiếu các lượt cũ
+    with trace.span("context_build"):
+        context = context_builder.build(history, session_obj, config, [{"role": "user", "content": message_text}])
+
+    # Câu mở đầu lặp lại (hỏi giá, chào...) -> lấy từ cache, khỏi gọi Gemini.
+    # Chỉ lượt đầu tiên: giữa hội thoại câu trả lời phụ thuộc lịch sử, không nằm trong khóa cache
+    has_history = bool(history or session_obj.get("summary"))
+    with trace.span("cache_lookup"):
+        ai_json = response_cache.lookup(page_id, config, current_state, message_text, has_history=has_history)
+    early = None
+    stream_broken = False
+    if ai_json is None and stream_settings(config)[0]:
+        # Streaming: câu đầu của reply_text được gửi ngay khi Gemini vừa sinh xong câu đó.
+        # Lượt này đã stream ở lần xử lý trước (chưa kịp commit) -> không gửi lại, dùng lại câu trả lời đó
+        early_key = early_reply_key(sender_id, session_obj.get("msg_seq", len(history)), message_text)
+        streamed = streamed_turns.load(early_key) or {}
+        early = EarlyReply(lambda text, more: send_first_chunk(trace, page_id, sender_id, text, more, early_key,
+                                                               early.sent),
+                           config, sent=streamed.get("sent"), more=streamed.get("more", False))
+        ai_json = streamed.get("ai_json")
+        if ai_json is not None:
+            trace.attrs["stream_replayed"] = True
+    if ai_json is None:
+        with trace.span("llm"):
+            ai_json = generate_ai_response(context["turns"], config, json.dumps(session_data_json),
+                                           flow_state=current_state, summary=context["summary"],
+                                           on_reply_text=early.feed if early and early.sent is None else None)
+        if ai_json.get("next_state") == "ERROR":
+            trace.outcome = "llm_error"
+        if early is not None and early.sent is not None:
+            if ai_json.get("next_state") == "ERROR":
+                # Lỗi sau khi đã stream mảnh đầu: không lưu câu báo lỗi làm câu trả lời của lượt
+                stream_broken = True
+            else:
+                streamed_turns.save(early_key, early.sent, early.more, ai_json)
+        response_cache.store(page_id, config, current_state, message_text, ai_json, has_history=has_history)
+    elif early is None:
+        trace.outcome = "cache_hit"
+    
+    # Bắt SĐT/Email trên TỪNG tin đã gộp, không bỏ sót số nào
+    with trace.span("flow"):
+        final_result = flow_engine.process_ai_result(sender_id, message_text, ai_json, config,
+                                                     message_parts=message_texts)
+    reply_text = final_result["text_to_send"]
+    if stream_broken:
+        # Khách chỉ nhận được mảnh đầu -> history ghi đúng phần đã gửi, không nối câu báo lỗi
+        reply_text = early.sent.strip()
+    lead_data = final_result["lead_data"]
+
+    next_state = final_result["next_state"] or current_state
+    new_data_points = {}
+    if lead_data.get("classification"):
+        new_data_points["classification"] = lead_data.get("classification")
+    if lead_data.get("subtopic"):
+        new_data_points["subtopic"] = lead_data.get("subtopic")
+    if lead_data.get("intent"):
+        # Intent đã dùng để chấm điểm lượt này (AI trả về hoặc sub_topic) -> rescore dùng lại đúng giá trị
+        new_data_points["intent"] = lead_data.get("intent")
+    if lead_data.get("phone") or lead_data.get("email"):
+        new_data_points["has_contact"] = True
     
-    update_payload = {
-        "user_id": sender_id,
-        "page_id": page_id, 
-        "topic": topic,
-        "state": state,
-        "data": json.dumps(current_data),
-        "updated_at": datetime.datetime.now().isoformat()
-    }
-
-    if conversation_mode:
-        update_payload["conversation_mode"] = conversation_mode
-    if last_human_activity is not None:
-        update_payload["last_human_activity"] = str(last_human_activity) 
-
-    redis_client.hset(key, mapping=update_payload)
-    redis_client.expire(key, 86400 * 3) 
+    # Round trip 2/2: session (giữ mode BOT) + history + tags, ghi nguyên tử
+    with trace.span("session_commit"):
+        session_repo.commit_turn(
+            sender_id,
+            page_id=page_id,
+            topic=topic_id,
+            state=next_state,
+            new_data=new_data_points,
+            conversation_mode="BOT", 
+            last_human_activity=0,
+            history=[("user", message_text), ("model", reply_text)],
+            tags=final_result["tags"],
+            summary=context["summary"],
+            summary_seq=context["summary_seq"],
+            # Điểm Lead theo bảng điểm hiện tại (chấm lại hàng loạt: python -m app.lead_scoring rescore)
+            extra_fields={
+                "lead_score": final_result["score"],
+                "lead_stage": final_result["stage"],
+                "score_version": lead_scoring.scoring_table(config)["version"],
+            }
+        )
+
+    with trace.span("fb_enqueue"):
+        if early is not None and early.sent is not None:
+            remainder = "" if stream_broken else early.remainder(reply_text)
+            if remainder:
+                send_reply(page_id, sender_id, remainder)
+            elif early.more:
+                # Đã bật lại "đang soạn" sau mảnh đầu nhưng không còn gì để gửi
+                send_sender_action(page_id, sender_id, "typing_off")
+        else:
+            send_reply(page_id, sender_id, reply_text)
+            trace.add("first_reply", time.perf_counter() - trace.started)
+
+    if final_result["action"] == "PUSH_CRM":
+        with trace.span("crm_enqueue"):
+            trace.attrs["crm"] = crm.enqueue_lead(lead_data)
+
+    # Lịch nhắc khách chạy lại từ tin vừa rồi (đã có SĐT / Email thì thôi nhắc)
+    steps, skip_if_contact = follow_up_settings(config)
+    if steps:
+        if skip_if_contact and (new_data_points.get("has_contact") or session_data_json.get("has_contact")):
+            timers.cancel(follow_up_timer_id(sender_id))
+        else:
+            timers.schedule(follow_up_timer_id(sender_id), current_time + steps[0]["after_seconds"],
+                            {"kind": "follow_up", "page_id": page_id, "sender_id": sender_id,
+                             "step": 0, "last_turn": current_time})
+
+def send_reply(page_id, sender_id, reply_text, keep_typing=False):
+    """
+    Mặc định chỉ đẩy vào outbound_queue (dispatcher gửi), không chờ Graph API.
+    keep_typing: bật lại "đang soạn" sau tin này (còn phần sau của câu trả lời)
+    """
+    if outbound.FB_SEND_MODE == "direct":
+        fb_client.send_text_message(sender_id, reply_text)
+        if keep_typing:
+            fb_client.send_sender_action(sender_id, "typing_on")
+    else:
+        parts = [outbound.text_part(reply_text)]
+        if keep_typing:
+            parts.append({"sender_action": "typing_on"})
+        outbound.enqueue_messages(redis_client, page_id, sender_id, parts)
+
+def send_sender_action(page_id, sender_id, action):
+    if outbound.FB_SEND_MODE == "direct":
+        fb_client.send_sender_action(sender_id, action)
+    else:
+        outbound.enqueue_sender_action(redis_client, page_id, sender_id, action)
+
+def send_first_chunk(trace, page_id, sender_id, text, more, early_key, sent):
+    """Mảnh đầu của câu trả lời (streaming) - gọi từ giữa lúc Gemini đang sinh. Mỗi lượt gửi tối đa 1 lần"""
+    if not streamed_turns.claim(early_key, sent, more):
+        return
+    send_reply(page_id, sender_id, text, keep_typing=more)
+    trace.add("first_reply", time.perf_counter() - trace.started)
+    trace.attrs["streamed"] = True
+
+def send_typing_indicator(page_id, sender_id):
+    """Bật "đang soạn tin" cho khách (bỏ qua nếu Admin đang chat tay - HUMAN MODE)"""
+    try:
+        mode = redis_client.hget(f"session:{sender_id}", "conversation_mode")
+        if mode == b"HUMAN":
+            return
+        send_sender_action(page_id, sender_id, "typing_on")
+    except Exception as e:
+        metrics.inc("chatbot_errors_total", component="typing", page_id=page_id)
+        log.warning("typing_indicator_failed", page_id=page_id, sender_id=sender_id, error=str(e))
 
 # ====================================================
-# 👇 VÒNG LẶP XỬ LÝ CHÍNH
+# 👇 TIMER (CHẠY TRONG THREAD DISPATCHER, app/timers.py)
 # ====================================================
 
-def process_message():
-    while True:
-        try:
-            packed_item = redis_client.blpop("chat_queue", timeout=5)
-            if not packed_item: continue 
+def on_handoff_timer(payload):
+    """Hết hạn HUMAN mode -> bật lại Bot. Admin vừa chat lại (chưa kịp dời hẹn) -> hẹn theo tin mới nhất"""
+    page_id, sender_id = payload["page_id"], payload["sender_id"]
+    timeout = handoff_timeout(load_config(page_id) or {})
+    resumed, last_human_activity = session_repo.resume_bot(sender_id, time.time() - timeout)
+    if resumed:
+        metrics.inc("chatbot_turns_total", page_id=page_id, outcome="auto_resume")
+        log.info("auto_resume", page_id=page_id, sender_id=sender_id, source="timer",
+                 silence_seconds=int(time.time() - last_human_activity))
+    elif last_human_activity:
+        return last_human_activity + timeout, None
+    return None
+
+def on_follow_up_timer(payload):
+    """Gửi bước nhắc khách payload["step"] rồi hẹn bước kế tiếp (nếu có)"""
+    page_id, sender_id, step = payload["page_id"], payload["sender_id"], payload.get("step", 0)
+    config = load_config(page_id)
+    steps, skip_if_contact = follow_up_settings(config or {})
+    if step >= len(steps):
+        return None
+    session_obj, _ = session_repo.load_turn(sender_id, history_fetch=1)
+    # Session đã bị xóa / khách đang chat với Page khác / Admin đang chat tay / đã để lại liên hệ
+    if session_obj.get("page_id") != page_id or session_obj["conversation_mode"] == "HUMAN":
+        return None
+    if skip_if_contact and session_obj["data"].get("has_contact"):
+        return None
+
+    # Đánh dấu trước khi gửi: timer chạy lại (worker chết giữa chừng) không nhắc khách 2 lần
+    marker = f"{int(payload['last_turn'])}:{step}"
+    if session_obj.get("follow_up_sent") == marker:
+        return None
+    text = steps[step]["text"]
+    session_repo.commit_turn(sender_id, history=[("model", text)], extra_fields={"follow_up_sent": marker})
+    send_reply(page_id, sender_id, text)
+    metrics.inc("chatbot_turns_total", page_id=page_id, outcome="follow_up")
+    log.info("follow_up_sent", page_id=page_id, sender_id=sender_id, step=step)
+
+    if step + 1 < len(steps):
+        return payload["last_turn"] + steps[step + 1]["after_seconds"], {**payload, "step": step + 1}
+    return None
+
+TIMER_HANDLERS = {"handoff": on_handoff_timer, "follow_up": on_follow_up_timer}
+
+def handle_body(body, queued_at=None):
+    """Xử lý tuần tự toàn bộ 1 cục webhook (không gộp burst)"""
+    for page_id, config, topic_id, messaging in iter_events(body, queued_at):
+        handle_messaging(page_id, config, topic_id, messaging)
+
+def burst_settings(config):
+    burst = config.get("burst", {})
+    return burst.get("window_ms", BURST_WINDOW_MS) / 1000, burst.get("max_messages", BURST_MAX_MESSAGES)
+
+# ====================================================
+# 👇 VÒNG LẶP XỬ LÝ CHÍNH (CHẾ ĐỘ SYNC - 1 LƯỢT / LẦN)
+# ====================================================
+
+class _Delivery:
+    """1 tin trong queue: còn bao nhiêu sự kiện chưa xong, có sự kiện nào lỗi không"""
+    __slots__ = ("msg_id", "remaining", "failed")
 
-            raw_json = packed_item[1]
+    def __init__(self, msg_id, remaining):
+        self.msg_id = msg_id
+        self.remaining = remaining
+        self.failed = False
+
+def _settle(delivery):
+    # Có sự kiện lỗi -> không ACK, tin nằm lại trong pending, sẽ được claim & thử lại
+    # (backend fair: trả slot và đưa tin về đầu list của Page)
+    if delivery.failed:
+        chat_queue.release(delivery.msg_id)
+    else:
+        chat_queue.ack(delivery.msg_id)
+
+def _pull_events(backlog, block_ms=5000):
+    """Kéo 1 lô tin, tách thành sự kiện (delivery, event) nối vào backlog; trả về số tin đã kéo"""
+    batch = chat_queue.pull(block_ms=block_ms)
+    for msg_id, raw_json in batch:
+        try:
             body = json.loads(raw_json)
+        except Exception as e:
+            chat_queue.fail(msg_id, raw_json, f"JSON lỗi: {e}")
+            continue
+        try:
+            events = list(iter_events(body, enqueued_at(msg_id, body)))
+        except Exception as e:
+            metrics.inc("chatbot_errors_total", component="worker", page_id="")
+            log.error("event_failed", msg_id=msg_id, error=str(e), exc_info=True)
+            chat_queue.release(msg_id)
+            continue
+        delivery = _Delivery(msg_id, len(events))
+        if not events:
+            _settle(delivery)
+        backlog.extend((delivery, event) for event in events)
+    return len(batch)
+
+def _take_burst(backlog, page_id, key, limit):
+    """
+    Lấy khỏi backlog (tối đa `limit`) các tin text LIÊN TIẾP của cùng khách;
+    dừng ở sự kiện đầu tiên của khách đó không phải tin text để không phá thứ tự.
+    """
+    taken = []
+    for item in list(backlog):
+        if len(taken) >= limit:
+            break
+        q_page_id, _, _, q_messaging = item[1]
+        if conversation_key(q_page_id, q_messaging) != key:
+            continue
+        if q_page_id != page_id or customer_message_text(q_page_id, q_messaging) is None:
+            break
+        backlog.remove(item)
+        taken.append(item)
+    return taken
+
+def _gather_burst(backlog, item):
+    """Như AsyncWorkerEngine._gather cho chế độ sync: chờ trong cửa sổ burst, kéo thêm tin để gộp"""
+    _, (page_id, config, topic_id, messaging) = item
+    if customer_message_text(page_id, messaging) is None:
+        return [item]
+    window, max_messages = burst_settings(config)
+    if window <= 0 or max_messages <= 1:
+        return [item]
+
+    key = conversation_key(page_id, messaging)
+    send_typing_indicator(page_id, key)
+    items = [item]
+    deadline = time.monotonic() + window * BURST_MAX_WAIT_FACTOR
+    window_end = min(deadline, time.monotonic() + window)
+    try:
+        while len(items) < max_messages and not _stopping.is_set():
+            taken = _take_burst(backlog, page_id, key, max_messages - len(items))
+            if taken:
+                items.extend(taken)
+                window_end = min(deadline, time.monotonic() + window)
+                continue
+            remaining = window_end - time.monotonic()
+            if remaining <= 0:
+                break
+            _pull_events(backlog, block_ms=int(remaining * 1000))
+    except Exception as e:
+        # Tin đã kéo về vẫn nằm trong backlog / items -> vẫn xử lý, không bỏ rơi
+        log.warning("burst_gather_failed", page_id=page_id, sender_id=key, error=str(e))
+    if len(items) > 1:
+        log.info("burst_coalesced", sample=HOT_SAMPLE, page_id=page_id, sender_id=key, messages=len(items))
+    return items
+
+def _run_items(items):
+    """Xử lý 1 sự kiện hoặc 1 burst đã gộp rồi ACK / release các tin đã xong hết sự kiện"""
+    _, (page_id, config, topic_id, messaging) = items[0]
+    failed = False
+    try:
+        if len(items) == 1:
+            handle_messaging(page_id, config, topic_id, messaging)
+        else:
+            texts = [customer_message_text(p, m) for _, (p, _, _, m) in items]
+            # Thời gian chờ tính từ tin đầu tiên của burst
+            handle_customer_turn(page_id, config, topic_id, conversation_key(page_id, messaging), texts,
+                                 messaging.get("_queued_at"))
+    except Exception as e:
+        failed = True
+        metrics.inc("chatbot_errors_total", component="worker", page_id=page_id)
+        log.error("event_failed", page_id=page_id, error=str(e), exc_info=True)
+    for delivery, _ in items:
+        delivery.failed = delivery.failed or failed
+        delivery.remaining -= 1
+        if delivery.remaining == 0:
+            _settle(delivery)
 
-            for entry in body.get("entry", []):
-                page_id = str(entry.get("id")) 
-                
-                # --- LOAD CONFIG ---
-                config = load_config(page_id)
-                if not config:
-                    print(f"❌ Không tìm thấy Config cho Page {page_id}")
-                    continue
-                
-                page_name = config.get("page_name")
-                if not page_name:
-                    page_name = config.get("meta_data", {}).get("brand_default", "Unknown")
-                config["page_name"] = page_name
-                topic_id = config.get("topic_id", "general")
-                # -------------------
-
-                for messaging in entry.get("messaging", []):
-                    message_obj = messaging.get("message", {})
-                    
-                    # 1. LOGIC PHÁT HIỆN ADMIN/ECHO (ĐÃ CẬP NHẬT)
-                    is_echo = message_obj.get("is_echo", False)
-                    sender_id = str(messaging.get("sender", {}).get("id"))
-                    recipient_id = str(messaging.get("recipient", {}).get("id"))
-                    
-                    # Một tin nhắn là từ Page nếu is_echo=True HOẶC sender_id == page_id
-                    if is_echo or (sender_id == page_id):
-                        msg_app_id = str(message_obj.get("app_id", ""))
-                        admin_text = message_obj.get("text", "")
-                        
-                        # 👇👇👇 ĐÃ MỞ LOG NÀY ĐỂ ANH CHECK APP ID 👇👇👇
-                        print(f"DEBUG ECHO: app_id={msg_app_id}, text={admin_text}")
-
-                        # --- KIỂM TRA XEM CÓ PHẢI BOT TỰ GỬI KHÔNG ---
-                        # Nếu trong .env có cấu hình BOT_APP_ID và khớp với msg_app_id -> Bỏ qua
-                        if BOT_APP_ID and msg_app_id == BOT_APP_ID:
-                            # print("🤖 [IGNORE] Tin nhắn từ Bot.")
-                            continue
-                        
-                        # --- XÁC NHẬN LÀ ADMIN ---
-                        print(f"\n👮 [DETECTED ADMIN] AppID: {msg_app_id} | Text: {admin_text[:20]}...")
-                        
-                        target_user_id = recipient_id # Khách hàng là người nhận
-                        
-                        sess = get_session(target_user_id)
-                        curr_state = sess.get("state", "START")
-                        
-                        # Kích hoạt HUMAN MODE
-                        update_session(
-                            sender_id=target_user_id,
-                            page_id=page_id,
-                            topic=topic_id,
-                            state=curr_state,
-                            conversation_mode="HUMAN", 
-                            last_human_activity=time.time() 
-                        )
-                        print(f"   => Đã chuyển {target_user_id} sang HUMAN MODE.")
-                        continue 
-
-                    # 2. XỬ LÝ TIN NHẮN TỪ KHÁCH HÀNG
-                    message_text = message_obj.get("text")
-                    if not message_text: continue 
-
-                    print(f"\n📨 User {sender_id}: {message_text}")
-
-                    session_obj = get_session(sender_id)
-                    current_state = session_obj.get("state", "START")
-                    session_data_json = session_obj.get("data", {})
-                    
-                    mode = session_obj["conversation_mode"]
-                    last_human_activity = session_obj["last_human_activity"]
-                    current_time = time.time()
-
-                    # --- LOGIC TỰ ĐỘNG BẬT/TẮT BOT ---
-                    if mode == "HUMAN":
-                        silence_duration = current_time - last_human_activity
-                        
-                        if silence_duration > HANDOFF_TIMEOUT_SECONDS:
-                            print(f"⏰ [AUTO RESUME] Admin im lặng {int(silence_duration)}s > {HANDOFF_TIMEOUT_SECONDS}s. Bot bật lại.")
-                            mode = "BOT"
-                        else:
-                            print(f"🤫 [HUMAN MODE] Bot đang im lặng. (Admin mới chat cách đây {int(silence_duration)}s)")
-                            continue 
-
-                    # 3. NẾU LÀ BOT MODE -> GỌI AI XỬ LÝ
-                    history = get_chat_history(sender_id)
-                    current_history = history + [{"role": "user", "content": message_text}]
-
-                    ai_json = generate_ai_response(current_history, config, json.dumps(session_data_json))
-                    
-                    final_result = flow_engine.process_ai_result(sender_id, message_text, ai_json, config)
-                    reply_text = final_result["text_to_send"]
-                    lead_data = final_result["lead_data"]
-
-                    next_state = ai_json.get("next_state") or current_state
-                    new_data_points = {}
-                    if lead_data.get("classification"):
-                        new_data_points["classification"] = lead_data.get("classification")
-                    if lead_data.get("subtopic"):
-                        new_data_points["subtopic"] = lead_data.get("subtopic")
-                    
-                    # Cập nhật Session (Giữ nguyên mode là BOT)
-                    update_session(
-                        sender_id=sender_id,
-                        page_id=page_id,
-                        topic=topic_id,
-                        state=next_state,
-                        new_data=new_data_points,
-                        conversation_mode="BOT", 
-                        last_human_activity=0 
-                    )
-
-                    fb_client.send_text_message(sender_id, reply_text)
-                    save_chat_history(sender_id, "user", message_text)
-                    save_chat_history(sender_id, "model", reply_text)
-
-                    if final_result["action"] == "PUSH_CRM":
-                        print(f"💎 DATA LEAD -> CRM...")
-                        crm.push_lead(lead_data)
+def process_message():
+    # Sự kiện đã kéo về mà chưa xử lý (kể cả tin kéo thêm trong lúc chờ cửa sổ burst)
+    backlog = collections.deque()
+    while not _stopping.is_set() or backlog:
+        heartbeat(len(backlog))
+        try:
+            if not backlog:
+                _pull_events(backlog)
+                continue
+            _run_items(_gather_burst(backlog, backlog.popleft()))
 
         except Exception as e:
-            print(f"❌ Worker Lỗi: {e}")
+            metrics.inc("chatbot_errors_total", component="queue", page_id="")
+            log.error("worker_loop_failed", error=str(e))
             time.sleep(1)
 
+def main():
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # Dispatcher gửi tin chạy kèm trong process (OUTBOUND_EMBEDDED=0 nếu chạy riêng: python -m app.outbound)
+    if outbound.FB_SEND_MODE != "direct" and os.getenv("OUTBOUND_EMBEDDED", "1") == "1":
+        _dispatchers.append(outbound.start_dispatcher_thread(redis_url))
+    # Tương tự với dispatcher CRM (CRM_EMBEDDED=0 nếu chạy riêng: python -m app.crm_dispatcher)
+    if os.getenv("CRM_EMBEDDED", "1") == "1":
+        from app.crm_dispatcher import start_dispatcher_thread as start_crm_dispatcher
+        _dispatchers.append(start_crm_dispatcher(redis_url))
+    # Dispatcher timer: mọi worker cùng lấy timer tới hạn (Lua, không lấy trùng); TIMERS_EMBEDDED=0 để tắt
+    if os.getenv("TIMERS_EMBEDDED", "1") == "1":
+        from app.timers import start_dispatcher_thread as start_timer_dispatcher
+        _dispatchers.append(start_timer_dispatcher(timers, TIMER_HANDLERS))
+
+    # WORKER_MODE=async -> chạy engine bất đồng bộ (nhiều hội thoại song song)
+    if WORKER_MODE == "async":
+        # Dùng lại chính module này (tránh import app.worker lần 2 -> khởi tạo lại Redis/FB/CRM)
+        sys.modules.setdefault("app.worker", sys.modules[__name__])
+        from app.async_worker import run_async_worker
+        run_async_worker()
+    else:
+        process_message()
+
+    # Lượt chat đã xong hết: dispatcher gửi nốt phần đang gửi dở rồi mới thoát
+    for dispatcher in _dispatchers:
+        dispatcher.stop()
+    for dispatcher in _dispatchers:
+        dispatcher.thread.join(timeout=30)
+    metrics.registry.flush(redis_client)
+    log.info("worker_stopped")
+
 if __name__ == "__main__":
-    process_message()
\ No newline at end of file
+    main()
@@ -0,0 +1,75 @@
+# bench/bench_ai_engine.py
+"""
+Đo token input & độ trễ mỗi lượt gọi generate_ai_response: có / không Context Cache.
+
+Mặc định tự bật server giả lập bench/stub_gemini.py (không tốn quota):
+    python -m bench.bench_ai_engine -n 50
+Đo với Gemini thật (cần GOOGLE_API_KEY, tốn quota):
+    python -m bench.bench_ai_engine --real -n 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+STUB_PORT = 9100
+
+
+def run_calls(ai_engine, config, n, use_cache):
+    ai_engine.CONTEXT_CACHE_ENABLED = use_cache
+    for key in ai_engine._usage_stats:
+        ai_engine._usage_stats[key] = 0
+    for i in range(n):
+        history = [{"role": "user", "content": f"Cho em hỏi giá bao nhiêu vậy ạ? (#{i})"}]
+        ai_engine.generate_ai_response(history, config, {"last_state": "START"})
+    return ai_engine.get_usage_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ai_engine (token & latency)")
+    parser.add_argument("-n", type=int, default=50)
+    parser.add_argument("--page", default="105524314620167")
+    parser.add_argument("--real", action="store_true", help="Gọi Gemini thật thay vì stub")
+    args = parser.parse_args()
+
+    server = None
+    if not args.real:
+        os.environ["GEMINI_API_ENDPOINT"] = f"http://127.0.0.1:{STUB_PORT}"
+        os.environ.setdefault("GOOGLE_API_KEY", "stub")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "bench.stub_gemini:app",
+             "--port", str(STUB_PORT), "--log-level", "warning"],
+            stdout=subprocess.DEVNULL
+        )
+        time.sleep(2)
+
+    try:
+        sys.path.append(os.getcwd())
+        from app import ai_engine
+        from app.config_loader import load_config
+
+        config = load_config(args.page)
+        results = {
+            "no_cache": run_calls(ai_engine, config, args.n, use_cache=False),
+            "context_cache": run_calls(ai_engine, config, args.n, use_cache=True),
+        }
+        for name, stats in results.items():
+            print(json.dumps({"mode": name, **{k: stats[k] for k in (
+                "calls", "errors", "cache_hits", "avg_prompt_tokens",
+                "avg_uncached_prompt_tokens", "avg_latency_ms")}}, ensure_ascii=False))
+
+        before = results["no_cache"]["avg_uncached_prompt_tokens"]
+        after = results["context_cache"]["avg_uncached_prompt_tokens"]
+        if before:
+            print(f"➡️ Token input tính phí đầy đủ mỗi lượt: {before} -> {after} "
+                  f"(giảm {100 * (before - after) / before:.0f}%)")
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
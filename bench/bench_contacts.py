@@ -0,0 +1,102 @@
+# bench/bench_contacts.py
+"""
+So sánh bộ bóc SĐT/Email cũ (FlowEngine regex) với app/contact_extractor.py:
+- Độ chính xác trên bộ dữ liệu gán nhãn bench/contacts_corpus.jsonl (precision / recall).
+- Tốc độ (µs / tin) trên corpus nhân bản và riêng phần tin chat thường (không chứa liên hệ).
+
+Chạy:
+    python -m bench.bench_contacts -n 20000
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.getcwd())
+from app.contact_extractor import extract_batch, extract_contacts
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "contacts_corpus.jsonl")
+
+
+# --- Bản cũ (giữ nguyên logic để so sánh) ---
+def legacy_extract_phone_number(text):
+    if not text: return None
+    clean_text = text.replace('.', '').replace('-', '').replace(' ', '')
+    matches = re.findall(r'0[3|5|7|8|9]\d{8}', clean_text)
+    return matches[0] if matches else None
+
+
+def legacy_extract_email(text):
+    if not text: return None
+    match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', text)
+    return
+
+
+def legacy_extract(text):
+    phone = legacy_extract_phone_number(text)
+    email = legacy_extract_email(text)
+    return {"phones": [phone] if phone else [], "emails": [email] if email else []}
+
+
+def load_corpus():
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def score(extract, corpus):
+    tp = fp = fn = exact = 0
+    for item in corpus:
+        result = extract(item["text"])
+        got = set(result["phones"]) | set(result["emails"])
+        want = set(item["phones"]) | set(item["emails"])
+        tp += len(got & want)
+        fp += len(got - want)
+        fn += len(want - got)
+        exact += got == want
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 1.0
+    return precision, recall, exact / len(corpus)
+
+
+def timeit(fn, texts):
+    start = time.perf_counter()
+    fn(texts)
+    return (time.perf_counter() - start) / len(texts) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000, help="số tin dùng đo tốc độ")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    texts = [item["text"] for item in corpus]
+    plain = [item["text"] for item in corpus if not item["phones"] and not item["emails"]]
+    workload = (texts * (args.n // len(texts) + 1))[:args.n]
+    # Phần lớn tin thực tế không chứa liên hệ -> đo riêng
+    plain_workload = (plain * (args.n // len(plain) + 1))[:args.n]
+
+    print(f"Corpus: {len(corpus)} tin gán nhãn ({len(plain)} tin thường), đo tốc độ trên {args.n} tin\n")
+    print(f"{'':10} {'precision':>10} {'recall':>8} {'exact':>7} {'µs/tin corpus':>14} {'µs/tin thường':>14}")
+    for name, single, batch in (
+        ("legacy", legacy_extract, lambda ts: [legacy_extract(t) for t in ts]),
+        ("new", extract_contacts, extract_batch),
+    ):
+        precision, recall, exact = score(single, corpus)
+        batch(workload[:1000])  # warm-up
+        us = timeit(batch, workload)
+        us_plain = timeit(batch, plain_workload)
+        print(f"{name:10} {precision:>10.2%} {recall:>8.2%} {exact:>7.2%} {us:>14.2f} {us_plain:>14.2f}")
+
+    misses = [item["text"] for item in corpus if extract_contacts(item["text"])["phones"] != item["phones"]
+              or extract_contacts(item["text"])["emails"] != item["emails"]]
+    if misses:
+        print("\nTin bản mới còn sai:")
+        for text in misses:
+            print(f"  - {text}  ->  {extract_contacts(text)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# bench/bench_llm_router.py
+"""
+Đo độ trễ đuôi (p50 / p95 / p99) của generate_ai_response qua app/llm_router.py: có / không hedging,
+với provider chính chậm đuôi dài hoặc hay lỗi.
+
+Tự bật 2 server giả lập: bench/stub_gemini.py (9100) và bench/stub_openai.py (9400).
+    python -m bench.bench_llm_router -n 200 --gemini-dist lognormal --gemini-sigma 1.0
+    python -m bench.bench_llm_router -n 200 --gemini-error-rate 0.3      # failover + circuit breaker
+Mỗi mode in 1 dòng JSON: phân vị độ trễ, số lần hedge, số lượt không provider nào trả lời, trạng thái breaker.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+GEMINI_PORT = 9100
+OPENAI_PORT = 9400
+
+
+def start_stub(module, port, latency_ms, dist, sigma, error_rate):
+    env = {**os.environ, "STUB_LATENCY_MS": str(latency_ms), "STUB_LATENCY_DIST": dist,
+           "STUB_LATENCY_SIGMA": str(sigma), "STUB_ERROR_RATE": str(error_rate)}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"bench.{module}:app", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL
+    )
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 1)
+
+
+def run_mode(ai_engine, metrics, config, n, concurrency, hedge):
+    config = {**config, "llm": {**config.get("llm", {}), "hedge": hedge}}
+    metrics.registry.drain()
+
+    def one_call(i):
+        history = [{"role": "user", "content": f"Cho em hỏi giá bao nhiêu vậy ạ? (#{i})"}]
+        started = time.perf_counter()
+        result = ai_engine.generate_ai_response(history, config, {"last_state": "START"})
+        return (time.perf_counter() - started) * 1000, result.get("next_state") == "ERROR"
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one_call, range(n)))
+
+    counters, _ = metrics.registry.drain()
+    latencies = [ms for ms, _ in results]
+    return {
+        "mode": "hedge" if hedge else "no_hedge",
+        "calls": n,
+        "p50_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": round(max(latencies), 1),
+        "hedges": int(sum(v for k, v in counters.items() if k.startswith("chatbot_llm_hedges_total"))),
+        "unavailable": sum(1 for _, failed in results if failed),
+        "providers": ai_engine.router.snapshot(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LLM router (hedging / failover)")
+    parser.add_argument("-n", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--page", default="105524314620167")
+    parser.add_argument("--gemini-latency-ms", type=float, default=300)
+    parser.add_argument("--gemini-dist", default="lognormal")
+    parser.add_argument("--gemini-sigma", type=float, default=0.8)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency-ms", type=float, default=400)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--hedge-min-ms", type=float, default=300,
+                        help="LLM_HEDGE_MIN_MS của lần chạy (mặc định app: 1000)")
+    parser.add_argument("--modes", default="no_hedge,hedge")
+    args = parser.parse_args()
+
+    servers = [
+        start_stub("stub_gemini", GEMINI_PORT, args.gemini_latency_ms, args.gemini_dist, args.gemini_sigma,
+                   args.gemini_error_rate),
+        start_stub("stub_openai", OPENAI_PORT, args.openai_latency_ms, "uniform", 0.5, args.openai_error_rate),
+    ]
+    os.environ["GEMINI_API_ENDPOINT"] = f"http://127.0.0.1:{GEMINI_PORT}"
+    os.environ.setdefault("GOOGLE_API_KEY", "stub")
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{OPENAI_PORT}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    os.environ["LLM_HEDGE_MIN_MS"] = str(args.hedge_min_ms)
+    os.environ.setdefault("CONTEXT_CACHE_ENABLED", "0")
+    time.sleep(2)
+
+    try:
+        sys.path.append(os.getcwd())
+        from app import ai_engine, metrics
+        from app.config_loader import load_config
+
+        config = load_config(args.page)
+        for mode in args.modes.split(","):
+            report = run_mode(ai_engine, metrics, config, args.n, args.concurrency, hedge=mode == "hedge")
+            print(json.dumps(report, ensure_ascii=False))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
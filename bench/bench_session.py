@@ -0,0 +1,113 @@
+# bench/bench_session.py
+"""
+Đếm số round trip Redis & thời gian I/O session cho 1 lượt hội thoại:
+- legacy : chuỗi lệnh cũ (get_session, get_chat_history, FlowEngine HSET/RPUSH,
+           update_session, save_chat_history x2)
+- repo   : SessionRepository.load_turn + commit_turn
+
+Chạy (cần Redis local, dùng DB riêng vì sẽ ghi key bench_*):
+    REDIS_URL=redis://localhost:6379/15 python -m bench.bench_session -n 2000
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+import redis
+
+sys.path.append(os.getcwd())
+from app.session_store import SessionRepository
+
+TAGS = ["vip", "high_budget", "investor"]
+
+
+class CountingRedis(redis.Redis):
+    """Redis client đếm số round trip (mỗi lệnh lẻ hoặc mỗi pipeline.execute = 1)"""
+    round_trips = 0
+
+    def execute_command(self, *args, **options):
+        CountingRedis.round_trips += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        original_execute = pipe.execute
+
+        def execute(raise_on_error=True):
+            CountingRedis.round_trips += 1
+            return original_execute(raise_on_error)
+
+        pipe.execute = execute
+        return pipe
+
+
+def legacy_turn(r, sender_id):
+    # get_session
+    r.hgetall(f"session:{sender_id}")
+    # get_chat_history
+    r.lrange(f"history:{sender_id}", -10, -1)
+    # FlowEngine.process_ai_result
+    r.hset(f"session:{sender_id}", "current_state", "ASK_NEED")
+    for tag in TAGS:
+        r.rpush(f"tags:{sender_id}", tag)
+    # update_session
+    current = r.hget(f"session:{sender_id}", "data")
+    data = json.loads(current) if current else {}
+    data.update({"classification": "vip"})
+    r.hset(f"session:{sender_id}", mapping={
+        "user_id": sender_id, "page_id": "2002", "topic": "bds_luxury", "state": "ASK_NEED",
+        "data": json.dumps(data), "updated_at": datetime.datetime.now().isoformat(),
+        "conversation_mode": "BOT", "last_human_activity": "0",
+    })
+    r.expire(f"session:{sender_id}", 86400 * 3)
+    # save_chat_history x2
+    for role, content in (("user", "Giá bao nhiêu ạ"), ("model", "Dạ căn góc giá 12 tỷ ạ")):
+        r.rpush(f"history:{sender_id}", json.dumps({"role": role, "content": content}))
+        r.ltrim(f"history:{sender_id}", -50, -1)
+
+
+def repo_turn(repo, sender_id):
+    repo.load_turn(sender_id)
+    repo.commit_turn(
+        sender_id, page_id="2002", topic="bds_luxury", state="ASK_NEED",
+        new_data={"classification": "vip"}, conversation_mode="BOT", last_human_activity=0,
+        history=[("user", "Giá bao nhiêu ạ"), ("model", "Dạ căn góc giá 12 tỷ ạ")], tags=TAGS,
+    )
+
+
+def run(name, fn, n):
+    CountingRedis.round_trips = 0
+    started = time.perf_counter()
+    for i in range(n):
+        fn(f"bench_{name}_{i % 200}")
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": name,
+        "turns": n,
+        "round_trips_per_turn": round(CountingRedis.round_trips / n, 2),
+        "ms_per_turn": round(elapsed * 1000 / n, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Redis I/O mỗi lượt hội thoại")
+    parser.add_argument("-n", type=int, default=2000)
+    args = parser.parse_args()
+
+    r = CountingRedis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/15"))
+    repo = SessionRepository(r)
+    repo_turn(repo, "bench_warmup")  # nạp Lua script 1 lần (SCRIPT LOAD)
+
+    for result in (run("legacy", lambda sid: legacy_turn(r, sid), args.n),
+                   run("repo", lambda sid: repo_turn(repo, sid), args.n)):
+        print(json.dumps(result))
+
+    for pattern in ("session:bench_*", "history:bench_*", "tags:bench_*"):
+        for key in r.scan_iter(pattern, count=500):
+            r.unlink(key)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# bench/bench_webhook.py
+"""
+Benchmark endpoint POST /webhook: số request/giây và độ trễ ack (p50/p99).
+
+So sánh 2 đường ingest:
+- legacy : code cũ (client redis ĐỒNG BỘ trong hàm async + request.json() rồi json.dumps lại)
+- current: app.main (redis.asyncio pool + đẩy nguyên bytes + kiểm tra chữ ký)
+
+Cách chạy (cần Redis local, REDIS_URL như worker):
+    python -m bench.bench_webhook --target legacy  -n 5000 -c 100
+    python -m bench.bench_webhook --target current -n 5000 -c 100
+    python -m bench.bench_webhook --url http://host:8000/webhook   # server đang chạy sẵn
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+# ==========================================
+#  APP "TRƯỚC KHI TỐI ƯU" ĐỂ SO SÁNH
+# ==========================================
+from fastapi import FastAPI, Request
+import redis
+
+legacy_app = FastAPI()
+_legacy_r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+
+@legacy_app.post("/webhook")
+async def legacy_handle_webhook(request: Request):
+    body = await request.json()
+    _legacy_r.rpush("chat_queue", json.dumps(body))
+    return {"message": "Event received"}
+
+
+TARGETS = {
+    "legacy": "bench.bench_webhook:legacy_app",
+    "current": "app.main:app",
+}
+
+
+# mid khác nhau giữa các lần chạy: webhook bỏ sự kiện trùng mid (app/dedup.py)
+RUN_ID = uuid.uuid4().hex[:8]
+
+
+def sample_payload(i):
+    return {
+        "object": "page",
+        "entry": [{
+            "id": "2002",
+            "time": int(time.time() * 1000),
+            "messaging": [{
+                "sender": {"id": f"bench_user_{i % 1000}"},
+                "recipient": {"id": "2002"},
+                "timestamp": int(time.time() * 1000),
+                "message": {"mid": f"m_bench_{RUN_ID}_{i}", "text": "Cho em hỏi giá căn góc view biển ạ"}
+            }]
+        }]
+    }
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+async def fire(url, total, concurrency, app_secret=None):
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def one_user():
+            nonlocal errors
+            for i in counter:
+                raw = json.dumps(sample_payload(i)).encode()
+                headers = {"Content-Type": "application/json"}
+                if app_secret:
+                    sig = hmac.new(app_secret.encode(), raw, hashlib.sha256).hexdigest()
+                    headers["X-Hub-Signature-256"] = f"sha256={sig}"
+                t0 = time.perf_counter()
+                try:
+                    resp = await client.post(url, content=raw, headers=headers)
+                    if resp.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - t0) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one_user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+def wait_until_up(url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url.rsplit("/", 1)[0] + "/docs", timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError("Server không khởi động được")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark webhook ingest")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="current")
+    parser.add_argument("--url", help="Bắn vào server có sẵn thay vì tự khởi động")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("-n", "--requests", type=int, default=5000)
+    parser.add_argument("-c", "--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    app_secret = os.getenv("FB_APP_SECRET")
+    server = None
+    url = args.url
+    if not url:
+        url = f"http://127.0.0.1:{args.port}/webhook"
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", TARGETS[args.target],
+             "--port", str(args.port), "--log-level", "warning"],
+            stdout=subprocess.DEVNULL
+        )
+    try:
+        wait_until_up(url)
+        result = asyncio.run(fire(url, args.requests, args.concurrency, app_secret))
+        result["target"] = args.url or args.target
+        print(json.dumps(result, ensure_ascii=False))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,535 @@
+# bench/load_test.py
+"""
+Load test END-TO-END offline: webhook (app.main) -> hàng đợi -> worker -> Gemini / Graph / CRM giả lập.
+
+Harness tự bật:
+- bench/stub_gemini.py (:9100), bench/stub_graph.py (:9200), bench/stub_crm.py (:9300),
+  bench/stub_openai.py (:9400, provider dự phòng của app/llm_router.py)
+- webhook app.main (:8765) + N process worker (python app/worker.py) trỏ vào các stub trên.
+
+Mỗi "khách ảo" gửi tin rồi CHỜ câu trả lời tới stub Graph (closed loop, như người thật) rồi mới
+gửi tin tiếp. Độ trễ trả lời = từ lúc POST /webhook tới khi tin text đầu tiên tới Graph.
+
+Báo cáo (1 dòng JSON): throughput, p50/p95/p99 độ trễ trả lời, độ trễ ack webhook,
+số lệnh Redis / tin (INFO commandstats, tính cả lệnh chờ của worker), thời gian trung bình từng
+stage (hash "metrics", xem app/metrics.py), số call tới từng stub.
+
+Chạy (cần Redis local; dùng DB riêng vì harness ghi session / queue của khách lt_*):
+    REDIS_URL=redis://localhost:6379/15 python -m bench.load_test --customers 200 --messages 5 -c 100
+    python -m bench.load_test --save-payloads bench/traffic.jsonl     # ghi lại payload vừa sinh
+    python -m bench.load_test --replay bench/traffic.jsonl            # phát lại (mỗi dòng 1 payload webhook)
+    python -m bench.load_test --llm-latency-ms 1200 --latency-dist lognormal --llm-error-rate 0.02
+    python -m bench.load_test --llm-error-rate 0.5 --openai-latency-ms 600   # failover sang OpenAI
+Noisy neighbour (1 Page nổ traffic, Page kia ít khách) - so sánh p99 theo Page giữa 2 backend:
+    python -m bench.load_test --pages 2002=300,105524314620167=20 -c 300 --worker-concurrency 20 --queue-backend list
+    python -m bench.load_test --pages 2002=300,105524314620167=20 -c 300 --worker-concurrency 20 --queue-backend fair
+FB gửi lại webhook (ack chậm / timeout) - webhook phải bỏ bản trùng (app/dedup.py), llm_calls không tăng:
+    python -m bench.load_test --redeliver-rate 0.3
+Worker chạy dưới supervisor (app/supervisor.py), tự co giãn 1..4 process theo độ sâu hàng đợi:
+    python -m bench.load_test --worker-mode sync --worker-concurrency 1 --supervisor 1:4
+Cassette câu trả lời model thật (xem bench/stub_gemini.py):
+    GOOGLE_API_KEY=... python -m bench.load_test --cassette bench/cassettes/bds.jsonl --cassette-mode record
+    python -m bench.load_test --cassette bench/cassettes/bds.jsonl
+So sánh với baseline (exit 1 nếu xấu đi quá --tolerance):
+    python -m bench.load_test --save-baseline bench/baseline.json
+    python -m bench.load_test --baseline bench/baseline.json --tolerance 0.15
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+import redis
+
+GEMINI_PORT = 9100
+GRAPH_PORT = 9200
+CRM_PORT = 9300
+OPENAI_PORT = 9400
+APP_PORT = 8765
+
+# Kịch bản hội thoại mẫu (khách BĐS); {phone} được thay bằng SĐT ngẫu nhiên để đi qua đường lead CRM
+SCRIPT = [
+    "Chào shop, cho em hỏi dự án bên mình còn căn không ạ?",
+    "Căn 2 phòng ngủ view biển giá bao nhiêu vậy?",
+    "Em muốn xem nhà cuối tuần này, số em {phone} nha",
+    "Thanh toán theo tiến độ được không anh?",
+    "Có hỗ trợ vay ngân hàng không ạ, lãi suất thế nào?",
+    "Pháp lý dự án đã có sổ chưa?",
+    "Ok em cảm ơn, anh gửi em bảng giá chi tiết nhé",
+]
+
+# Chỉ số so với baseline: (tên, True nếu càng cao càng tốt)
+COMPARED = [
+    ("throughput_msgs_per_s", True),
+    ("reply_p50_ms", False),
+    ("reply_p95_ms", False),
+    ("reply_p99_ms", False),
+    ("redis_ops_per_message", False),
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+# ==========================================
+#  PAYLOAD: SINH MỚI / PHÁT LẠI
+# ==========================================
+def webhook_payload(page_id, messaging):
+    now_ms = int(time.time() * 1000)
+    return {"object": "page", "entry": [{"id": page_id, "time": now_ms, "messaging": [messaging]}]}
+
+
+def generate_conversations(page_id, customers, messages, lead_ratio, run_id):
+    conversations = []
+    for i in range(customers):
+        sender_id = f"lt_{run_id}_{i}"
+        with_phone = random.random() < lead_ratio
+        events = []
+        for j in range(messages):
+            text = SCRIPT[j % len(SCRIPT)]
+            if "{phone}" in text:
+                text = text.format(phone=f"09{random.randint(10000000, 99999999)}") if with_phone \
+                    else text.replace(", số em {phone} nha", "")
+            events.append({
+                "sender": {"id": sender_id},
+                "recipient": {"id": page_id},
+                "message": {"mid": f"m_{run_id}_{i}_{j}", "text": text},
+            })
+        conversations.append((page_id, sender_id, events))
+    return conversations
+
+
+def load_replay(path, run_id):
+    """
+    Mỗi dòng 1 body webhook Messenger. Tách theo khách, giữ thứ tự tin của từng khách.
+    Sender / mid được gắn thêm run_id để mỗi lần chạy là session mới (kết quả so sánh được).
+    """
+    by_sender = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            body = json.loads(line)
+            for entry in body.get("entry", []):
+                page_id = str(entry.get("id"))
+                for messaging in entry.get("messaging", []):
+                    message = messaging.get("message") or {}
+                    if message.get("is_echo") or not message.get("text"):
+                        continue
+                    sender_id = f"{messaging['sender']['id']}_{run_id}"
+                    key = (page_id, sender_id)
+                    events = by_sender.setdefault(key, [])
+                    events.append({
+                        **messaging,
+                        "sender": {"id": sender_id},
+                        "message": {**message, "mid": f"{message.get('mid', 'm')}_{run_id}_{len(events)}"},
+                    })
+    return [(page_id, sender_id, events) for (page_id, sender_id), events in by_sender.items()]
+
+
+def save_payloads(path, conversations):
+    with open(path, "w", encoding="utf-8") as f:
+        for page_id, _, events in conversations:
+            for messaging in events:
+                f.write(json.dumps(webhook_payload(page_id, messaging), ensure_ascii=False) + "\n")
+
+
+# ==========================================
+#  TIẾN TRÌNH: STUB + WEBHOOK + WORKER
+# ==========================================
+def child_env(args, **extra):
+    env = dict(os.environ)
+    env.update({
+        "REDIS_URL": args.redis_url,
+        "GEMINI_API_ENDPOINT": f"http://127.0.0.1:{GEMINI_PORT}",
+        "GOOGLE_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{OPENAI_PORT}/v1",
+        "OPENAI_API_KEY": "stub",
+        "GRAPH_API_URL": f"http://127.0.0.1:{GRAPH_PORT}/v18.0/me/messages",
+        "FB_PAGE_ACCESS_TOKEN": "stub",
+        "CHARM_API_URL": f"http://127.0.0.1:{CRM_PORT}/leads",
+        "CHARM_BULK_URL": f"http://127.0.0.1:{CRM_PORT}/leads/batch",
+        "METRICS_FLUSH_SECONDS": "1",
+        "QUEUE_BACKEND": args.queue_backend,
+        "WORKER_CONCURRENCY": str(args.worker_concurrency),
+        "STUB_LATENCY_DIST": args.latency_dist,
+    })
+    env.update({k: str(v) for k, v in extra.items() if v is not None})
+    return env
+
+
+def start_processes(args):
+    uvicorn = [sys.executable, "-m", "uvicorn", "--log-level", "warning"]
+    log = open(args.log_file, "a") if args.log_file else subprocess.DEVNULL
+    gemini_env = {"STUB_LATENCY_MS": args.llm_latency_ms, "STUB_ERROR_RATE": args.llm_error_rate,
+                  "STUB_TOKENS_PER_SECOND": args.llm_tokens_per_s,
+                  "STUB_CASSETTE": args.cassette, "STUB_CASSETTE_MODE": args.cassette_mode}
+    if args.cassette_mode == "record":
+        # Stub ghi cassette cần key Gemini THẬT; worker vẫn dùng "stub"
+        gemini_env["STUB_UPSTREAM_API_KEY"] = os.getenv("GOOGLE_API_KEY")
+    specs = [
+        (uvicorn + ["bench.stub_gemini:app", "--port", str(GEMINI_PORT)], gemini_env),
+        (uvicorn + ["bench.stub_graph:app", "--port", str(GRAPH_PORT)],
+         {"STUB_LATENCY_MS": args.graph_latency_ms, "STUB_ERROR_RATE": args.graph_error_rate}),
+        (uvicorn + ["bench.stub_crm:app", "--port", str(CRM_PORT)],
+         {"STUB_LATENCY_MS": args.crm_latency_ms, "STUB_ERROR_RATE": args.crm_error_rate}),
+        (uvicorn + ["bench.stub_openai:app", "--port", str(OPENAI_PORT)],
+         {"STUB_LATENCY_MS": args.openai_latency_ms, "STUB_ERROR_RATE": args.openai_error_rate,
+          "STUB_TOKENS_PER_SECOND": args.llm_tokens_per_s}),
+        (uvicorn + ["app.main:app", "--port", str(APP_PORT)], {}),
+    ]
+    if args.supervisor:
+        # Pool worker do app/supervisor.py tự co giãn thay cho --workers process cố định
+        min_workers, _, max_workers = args.supervisor.partition(":")
+        specs.append(([sys.executable, "-m", "app.supervisor"], {
+            "WORKER_MODE": args.worker_mode, "SUPERVISOR_MIN_WORKERS": min_workers,
+            "SUPERVISOR_MAX_WORKERS": max_workers or min_workers, "SUPERVISOR_CHECK_SECONDS": 1,
+            "SCALE_DOWN_DELAY_SECONDS": 10,
+        }))
+    else:
+        specs += [([sys.executable, "app/worker.py"], {"WORKER_MODE": args.worker_mode})] * args.workers
+    return [subprocess.Popen(cmd, env=child_env(args, **extra), stdout=log, stderr=subprocess.STDOUT)
+            for cmd, extra in specs]
+
+
+def stop_processes(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            # Supervisor chờ worker drain xong lượt đang chạy
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def wait_until_up(urls, timeout=30):
+    deadline = time.time() + timeout
+    for url in urls:
+        while True:
+            try:
+                httpx.get(url, timeout=1)
+                break
+            except httpx.HTTPError:
+                if time.time() > deadline:
+                    raise RuntimeError(f"Server không khởi động được: {url}")
+                time.sleep(0.2)
+
+
+# ==========================================
+#  ĐO ĐẠC
+# ==========================================
+def redis_command_calls(r):
+    """Tổng số lần gọi theo lệnh từ INFO commandstats (bỏ lệnh của chính harness); None nếu server không hỗ trợ"""
+    try:
+        stats = r.info("commandstats")
+    except redis.ResponseError:
+        return None
+    calls = {}
+    for name, stat in stats.items():
+        command = name.replace("cmdstat_", "")
+        if command in ("info", "flushdb"):
+            continue
+        calls[command] = stat["calls"]
+    return calls
+
+
+def stage_totals(r):
+    """{stage: (tổng giây, số lần)} cộng mọi page từ hash "metrics" """
+    totals = {}
+    for series, value in r.hgetall("metrics").items():
+        series = series.decode()
+        if not series.startswith(("chatbot_stage_seconds_sum", "chatbot_stage_seconds_count")):
+            continue
+        stage = series.split('stage="', 1)[1].split('"', 1)[0]
+        seconds, count = totals.get(stage, (0.0, 0))
+        if series.startswith("chatbot_stage_seconds_sum"):
+            seconds += float(value)
+        else:
+            count += int(float(value))
+        totals[stage] = (seconds, count)
+    return totals
+
+
+class Results:
+    def __init__(self):
+        self.sent = 0
+        self.webhook_errors = 0
+        self.no_reply = 0
+        self.acks = []
+        self.replies = []
+        self.page_replies = {}   # page_id -> [giây]
+        self.page_no_reply = {}
+        self.redelivered = 0
+        self.background = []
+
+
+async def run_customer(client, args, page_id, sender_id, events, results, app_secret):
+    wait_url = f"http://127.0.0.1:{GRAPH_PORT}/stub/wait/{sender_id}"
+    webhook_url = f"http://127.0.0.1:{APP_PORT}/webhook"
+    for messaging in events:
+        # Phần cuối của câu trả lời trước (nhiều part) có thể tới muộn -> đọc lại số tin hiện tại
+        seen = (await client.get(wait_url, params={"after": 0, "timeout": 0})).json()["count"]
+        raw = json.dumps(webhook_payload(page_id, {**messaging, "timestamp": int(time.time() * 1000)})).encode()
+        headers = {"Content-Type": "application/json"}
+        if app_secret:
+            headers["X-Hub-Signature-256"] = "sha256=" + hmac.new(app_secret.encode(), raw, hashlib.sha256).hexdigest()
+
+        started = time.perf_counter()
+        results.sent += 1
+        try:
+            response = await client.post(webhook_url, content=raw, headers=headers)
+        except httpx.HTTPError:
+            results.webhook_errors += 1
+            continue
+        results.acks.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            results.webhook_errors += 1
+            continue
+        if args.redeliver_rate and random.random() < args.redeliver_rate:
+            # Như FB gửi lại đúng payload đó trong lúc worker đang xử lý
+            results.redelivered += 1
+            results.background.append(asyncio.create_task(client.post(webhook_url, content=raw, headers=headers)))
+
+        reply = (await client.get(wait_url, params={"after": seen, "timeout": args.reply_timeout})).json()
+        if reply["timed_out"]:
+            results.no_reply += 1
+            results.page_no_reply[page_id] = results.page_no_reply.get(page_id, 0) + 1
+        else:
+            results.replies.append(time.perf_counter() - started)
+            results.page_replies.setdefault(page_id, []).append(results.replies[-1])
+        if args.think_ms:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * args.think_ms / 1000)
+
+
+async def drive(args, conversations, results):
+    app_secret = os.getenv("FB_APP_SECRET")
+    # -c áp dụng cho TỪNG Page: Page ít khách không phải chờ slot của Page đông khách
+    page_slots = {}
+    for page_id, _, _ in conversations:
+        page_slots.setdefault(page_id, asyncio.Semaphore(args.concurrency))
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+
+    async with httpx.AsyncClient(limits=limits, timeout=args.reply_timeout + 10) as client:
+        async def one(index, conversation):
+            # Dàn đều thời điểm bắt đầu của khách trong --ramp giây
+            if args.ramp:
+                await asyncio.sleep(args.ramp * index / max(1, len(conversations)))
+            async with page_slots[conversation[0]]:
+                await run_customer(client, args, *conversation, results, app_secret)
+
+        await asyncio.gather(*(one(i, c) for i, c in enumerate(conversations)))
+        await asyncio.gather(*results.background, return_exceptions=True)
+
+
+def stub_stats():
+    stats = {}
+    for name, url in (("gemini", f"http://127.0.0.1:{GEMINI_PORT}/stub/stats"),
+                      ("graph", f"http://127.0.0.1:{GRAPH_PORT}/stub/summary"),
+                      ("crm", f"http://127.0.0.1:{CRM_PORT}/stub/stats"),
+                      ("openai", f"http://127.0.0.1:{OPENAI_PORT}/stub/stats")):
+        try:
+            stats[name] = httpx.get(url, timeout=5).json()
+        except httpx.HTTPError:
+            stats[name] = {}
+    return stats
+
+
+def counter_total(r, name, **labels):
+    """Tổng 1 counter trong hash "metrics" (mọi label, hoặc chỉ các series khớp labels)"""
+    wanted = [f'{key}="{value}"' for key, value in labels.items()]
+    total = 0.0
+    for series, value in r.hgetall("metrics").items():
+        series = series.decode()
+        if series.startswith(name + "{") and all(label in series for label in wanted):
+            total += float(value)
+    return total
+
+
+def build_report(args, results, elapsed, ops_before, ops_after, stages_before, stages_after, stubs,
+                 duplicates_dropped=0, workers_spawned=0):
+    messages = max(1, results.sent)
+    ops_per_message = top_ops = None
+    if ops_before is not None and ops_after is not None:
+        ops = {cmd: calls - ops_before.get(cmd, 0) for cmd, calls in ops_after.items()}
+        ops = {cmd: calls for cmd, calls in ops.items() if calls > 0}
+        ops_per_message = round(sum(ops.values()) / messages, 2)
+        top_ops = {cmd: round(calls / messages, 2) for cmd, calls in sorted(ops.items(), key=lambda item: -item[1])[:10]}
+    stage_mean_ms = {}
+    for stage, (seconds, count) in stages_after.items():
+        base_seconds, base_count = stages_before.get(stage, (0.0, 0))
+        if count > base_count:
+            stage_mean_ms[stage] = round((seconds - base_seconds) / (count - base_count) * 1000, 2)
+
+    def ms(values, p):
+        return round(percentile(values, p) * 1000, 1)
+
+    return {
+        "scenario": args.replay or f"generated:{args.pages or args.customers}x{args.messages}",
+        "worker_mode": args.worker_mode,
+        "workers": args.supervisor or args.workers,
+        "workers_spawned": int(workers_spawned),
+        "concurrency": args.concurrency,
+        "messages": results.sent,
+        "replied": len(results.replies),
+        "no_reply": results.no_reply,
+        "webhook_errors": results.webhook_errors,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_msgs_per_s": round(len(results.replies) / elapsed, 2) if elapsed else 0.0,
+        "reply_p50_ms": ms(results.replies, 50),
+        "reply_p95_ms": ms(results.replies, 95),
+        "reply_p99_ms": ms(results.replies, 99),
+        "ack_p50_ms": ms(results.acks, 50),
+        "ack_p99_ms": ms(results.acks, 99),
+        "redis_ops_per_message": ops_per_message,
+        "redis_top_ops_per_message": top_ops,
+        "stage_mean_ms": stage_mean_ms,
+        "queue_backend": args.queue_backend,
+        "redelivered": results.redelivered,
+        "duplicates_dropped": int(duplicates_dropped),
+        "per_page": {
+            page_id: {
+                "replied": len(replies),
+                "no_reply": results.page_no_reply.get(page_id, 0),
+                "reply_p50_ms": ms(replies, 50),
+                "reply_p95_ms": ms(replies, 95),
+                "reply_p99_ms": ms(replies, 99),
+            }
+            for page_id, replies in sorted(results.page_replies.items())
+        },
+        "llm_calls": stubs["gemini"].get("generate_calls"),
+        "openai_calls": stubs["openai"].get("calls"),
+        "cassette": {k: stubs["gemini"].get(k) for k in ("cassette_hits", "cassette_misses", "recorded")},
+        "graph": stubs["graph"],
+        "crm": stubs["crm"],
+    }
+
+
+def compare(report, baseline, tolerance):
+    """In chênh lệch so với baseline; trả về danh sách chỉ số xấu đi quá tolerance"""
+    regressions = []
+    for name, higher_is_better in COMPARED:
+        old, new = baseline.get(name), report.get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        print(json.dumps({"metric": name, "baseline": old, "current": new,
+                          "change_pct": round(change * 100, 1), "regression": worse}))
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test end-to-end với Gemini / Graph / CRM giả lập")
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/15"))
+    parser.add_argument("--flush-db", action="store_true", help="FLUSHDB trước khi chạy (XÓA mọi key của DB)")
+    parser.add_argument("--page", default="2002")
+    parser.add_argument("--customers", type=int, default=100)
+    parser.add_argument("--pages", help="Nhiều Page: page_id=số khách,... (vd: 2002=300,105524314620167=20)")
+    parser.add_argument("--messages", type=int, default=5, help="Số tin mỗi khách")
+    parser.add_argument("--lead-ratio", type=float, default=0.3, help="Tỉ lệ khách để lại SĐT")
+    parser.add_argument("--replay", help="File JSONL payload webhook để phát lại thay vì sinh mới")
+    parser.add_argument("--save-payloads", help="Ghi payload đã sinh ra file JSONL (dùng lại với --replay)")
+    parser.add_argument("-c", "--concurrency", type=int, default=50, help="Số khách hoạt động cùng lúc (mỗi Page)")
+    parser.add_argument("--ramp", type=float, default=5.0, help="Dàn đều khách bắt đầu trong N giây")
+    parser.add_argument("--think-ms", type=float, default=500, help="Thời gian khách đọc / gõ giữa 2 tin")
+    parser.add_argument("--reply-timeout", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--supervisor", help="MIN:MAX - chạy worker qua app/supervisor.py (autoscale) thay cho --workers")
+    parser.add_argument("--worker-mode", choices=("sync", "async"), default="async")
+    parser.add_argument("--worker-concurrency", type=int, default=100, help="WORKER_CONCURRENCY của mỗi worker")
+    parser.add_argument("--queue-backend", choices=("list", "stream", "fair"), default="list")
+    parser.add_argument("--redeliver-rate", type=float, default=0, help="Tỉ lệ webhook bị gửi lại (giả lập FB)")
+    parser.add_argument("--latency-dist", choices=("uniform", "lognormal", "fixed"), default="uniform")
+    parser.add_argument("--llm-latency-ms", type=float, default=800)
+    parser.add_argument("--llm-error-rate", type=float, default=0)
+    parser.add_argument("--llm-tokens-per-s", type=float, default=0, help="Tốc độ sinh output (0 = tức thì)")
+    parser.add_argument("--openai-latency-ms", type=float, default=800)
+    parser.add_argument("--openai-error-rate", type=float, default=0)
+    parser.add_argument("--graph-latency-ms", type=float, default=80)
+    parser.add_argument("--graph-error-rate", type=float, default=0)
+    parser.add_argument("--crm-latency-ms", type=float, default=150)
+    parser.add_argument("--crm-error-rate", type=float, default=0)
+    parser.add_argument("--cassette", help="File cassette câu trả lời model (bench/stub_gemini.py)")
+    parser.add_argument("--cassette-mode", choices=("replay", "record"), default="replay")
+    parser.add_argument("--log-file", help="Ghi log của stub / webhook / worker vào file")
+    parser.add_argument("--baseline", help="File JSON baseline để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    parser.add_argument("--save-baseline", help="Ghi kết quả lần chạy này làm baseline")
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:6]
+    if args.replay:
+        conversations = load_replay(args.replay, run_id)
+    elif args.pages:
+        conversations = []
+        for spec in args.pages.split(","):
+            page_id, _, customers = spec.partition("=")
+            conversations += generate_conversations(page_id, int(customers or args.customers), args.messages,
+                                                    args.lead_ratio, f"{run_id}_{page_id}")
+        # Xen kẽ theo thời điểm bắt đầu (--ramp) thay vì hết Page này tới Page kia
+        random.shuffle(conversations)
+    else:
+        conversations = generate_conversations(args.page, args.customers, args.messages, args.lead_ratio, run_id)
+    if args.save_payloads:
+        save_payloads(args.save_payloads, conversations)
+
+    r = redis.from_url(args.redis_url)
+    if args.flush_db:
+        r.flushdb()
+
+    processes = start_processes(args)
+    try:
+        wait_until_up([f"http://127.0.0.1:{port}/docs" for port in (GEMINI_PORT, GRAPH_PORT, CRM_PORT, APP_PORT)])
+        # Khởi động nóng: worker nạp config, tạo Context Cache, mở kết nối
+        warmup = [(page_id, f"lt_{run_id}_warmup_{page_id}",
+                   [{"sender": {"id": f"lt_{run_id}_warmup_{page_id}"}, "recipient": {"id": page_id},
+                     "message": {"mid": f"m_{run_id}_warmup_{page_id}", "text": SCRIPT[0]}}])
+                  for page_id in sorted({c[0] for c in conversations} or {args.page})]
+        asyncio.run(drive(args, warmup, Results()))
+        time.sleep(2)   # chờ metric của lượt warmup được flush
+
+        ops_before, stages_before = redis_command_calls(r), stage_totals(r)
+        duplicates_before = counter_total(r, "chatbot_webhook_duplicates_total")
+        spawns_before = counter_total(r, "chatbot_supervisor_events_total", event="spawn")
+        results = Results()
+        started = time.perf_counter()
+        asyncio.run(drive(args, conversations, results))
+        elapsed = time.perf_counter() - started
+        time.sleep(2)
+        ops_after, stages_after = redis_command_calls(r), stage_totals(r)
+        duplicates = counter_total(r, "chatbot_webhook_duplicates_total") - duplicates_before
+        spawns = counter_total(r, "chatbot_supervisor_events_total", event="spawn") - spawns_before
+        report = build_report(args, results, elapsed, ops_before, ops_after, stages_before, stages_after, stub_stats(),
+                              duplicates, spawns)
+    finally:
+        stop_processes(processes)
+
+    print(json.dumps(report, ensure_ascii=False))
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
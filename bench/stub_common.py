@@ -0,0 +1,69 @@
+# bench/stub_common.py
+"""
+Phân phối độ trễ / lỗi dùng chung cho các server giả lập (stub_gemini, stub_openai, stub_graph, stub_crm).
+
+Biến môi trường (mỗi stub chạy 1 process riêng nên dùng chung tên):
+- STUB_LATENCY_MS     : độ trễ trung vị (ms)
+- STUB_LATENCY_DIST   : uniform (mặc định, ± STUB_JITTER_MS) | lognormal (đuôi dài, độ lệch STUB_LATENCY_SIGMA)
+                        | fixed
+- STUB_ERROR_RATE     : tỉ lệ trả lỗi 5xx
+- STUB_TIMEOUT_RATE   : tỉ lệ "treo" STUB_TIMEOUT_MS rồi mới trả lỗi (giả lập timeout phía client)
+"""
+import asyncio
+import json
+import math
+import os
+import random
+
+LATENCY_DIST = os.getenv("STUB_LATENCY_DIST", "uniform").lower()
+LATENCY_SIGMA = float(os.getenv("STUB_LATENCY_SIGMA", "0.5"))
+ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+TIMEOUT_RATE = float(os.getenv("STUB_TIMEOUT_RATE", "0"))
+TIMEOUT_MS = float(os.getenv("STUB_TIMEOUT_MS", "30000"))
+
+
+def sample_latency_ms(median_ms, jitter_ms=0.0, dist=LATENCY_DIST, sigma=LATENCY_SIGMA):
+    if median_ms <= 0:
+        return 0.0
+    if dist == "lognormal":
+        # median = exp(mu) -> mu = ln(median); p99 ≈ median * exp(2.33 * sigma)
+        return random.lognormvariate(math.log(median_ms), sigma)
+    if dist == "fixed":
+        return median_ms
+    return max(0.0, median_ms + random.uniform(-jitter_ms, jitter_ms))
+
+
+async def delay(median_ms, jitter_ms=0.0):
+    await asyncio.sleep(sample_latency_ms(median_ms, jitter_ms) / 1000)
+
+
+async def injected_failure(error_rate=ERROR_RATE, timeout_rate=TIMEOUT_RATE):
+    """
+    Gọi SAU khi đã delay: trả về "timeout" / "error" nếu lần gọi này phải lỗi, None nếu bình thường.
+    Với "timeout" hàm đã ngủ thêm TIMEOUT_MS trước khi trả về.
+    """
+    roll = random.random()
+    if roll < timeout_rate:
+        await asyncio.sleep(TIMEOUT_MS / 1000)
+        return "timeout"
+    if roll < timeout_rate + error_rate:
+        return "error"
+    return None
+
+
+def estimate_tokens(obj):
+    if not obj:
+        return 0
+    text = obj if isinstance(obj, str) else json.dumps(obj, ensure_ascii=False)
+    return max(1, len(text) // 4)
+
+
+def fake_reply(user_text):
+    """Câu trả lời JSON đúng format ai_engine mong đợi"""
+    return {
+        "reply_text": "Dạ em cảm ơn anh/chị đã nhắn tin. Anh/chị cho em biết thêm nhu cầu cụ thể để em tư vấn kỹ hơn nhé?",
+        "next_state": "ASK_NEED",
+        "need_phone": False,
+        "classification": "unknown",
+        "tags": ["stub"],
+    }
@@ -0,0 +1,83 @@
+# bench/stub_crm.py
+"""
+Server giả lập CRM (Charm.Contact) để test / benchmark đường giao lead offline.
+
+- POST /leads       : 1 lead (crm_connector.push_lead)
+- POST /leads/batch : {"leads": [...]} -> kết quả riêng từng lead (app/crm_dispatcher.py)
+- Độ trễ / lỗi theo bench/stub_common.py; STUB_LEAD_ERROR_RATE: tỉ lệ lỗi RIÊNG từng lead trong batch.
+- GET /stub/stats : số batch, số lead tạo / cập nhật / lỗi, số khách khác nhau.
+
+Chạy:
+    STUB_LATENCY_MS=150 python -m uvicorn bench.stub_crm:app --port 9300
+    CHARM_API_URL=http://127.0.0.1:9300/leads python -m app.crm_dispatcher
+"""
+import os
+import random
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from bench.stub_common import delay, injected_failure
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "150"))
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "50"))
+STUB_LEAD_ERROR_RATE = float(os.getenv("STUB_LEAD_ERROR_RATE", "0"))
+
+app = FastAPI()
+stats = {"requests": 0, "batches": 0, "created": 0, "updated": 0, "lead_errors": 0, "errors": 0}
+_customers = set()
+
+
+def _accept(lead, index=None):
+    result = {} if index is None else {"index": index}
+    if random.random() < STUB_LEAD_ERROR_RATE:
+        stats["lead_errors"] += 1
+        return {**result, "status": "error", "error": "stub lead error"}
+    identity = lead.get("facebook_uid") or lead.get("phone") or lead.get("email")
+    if not identity:
+        stats["lead_errors"] += 1
+        return {**result, "status": "error", "error": "thiếu field định danh"}
+    stats["updated" if lead.get("op") == "update" else "created"] += 1
+    _customers.add(identity)
+    return {**result, "status": "success", "deal_id": f"DEAL_{identity}"}
+
+
+async def _begin():
+    stats["requests"] += 1
+    await delay(STUB_LATENCY_MS, STUB_JITTER_MS)
+    if await injected_failure():
+        stats["errors"] += 1
+        return JSONResponse({"status": "error", "message": "stub CRM error"}, status_code=503)
+    return None
+
+
+@app.post("/leads")
+async def create_lead(request: Request):
+    failure = await _begin()
+    if failure is not None:
+        return failure
+    return _accept(await request.json())
+
+
+@app.post("/leads/batch")
+async def create_lead_batch(request: Request):
+    failure = await _begin()
+    if failure is not None:
+        return failure
+    stats["batches"] += 1
+    payload = await request.json()
+    results = [_accept(lead, i) for i, lead in enumerate(payload.get("leads", []))]
+    return {"status": "success", "results": results}
+
+
+@app.get("/stub/stats")
+async def get_stats():
+    return {**stats, "customers": len(_customers)}
+
+
+@app.post("/stub/reset")
+async def reset_stats():
+    _customers.clear()
+    for k in stats:
+        stats[k] = 0
+    return {"status": "ok"}
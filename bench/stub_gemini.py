@@ -0,0 +1,308 @@
+# bench/stub_gemini.py
+"""
+Server giả lập Gemini API (REST v1beta) để test / benchmark offline, không tốn quota.
+
+Hỗ trợ:
+- POST  /v1beta/models/{model}:generateContent
+- POST  /v1beta/models/{model}:streamGenerateContent (REST streaming: mảng JSON tới dần, STUB_STREAM_CHUNK_CHARS / mảnh)
+- POST  /v1beta/cachedContents          (Context Caching)
+- GET / PATCH / DELETE /v1beta/cachedContents/{id}
+
+Token được ước lượng ~ 4 ký tự / token. usageMetadata trả về giống Gemini thật:
+promptTokenCount = toàn bộ input (kể cả phần trong cache), cachedContentTokenCount = phần cache.
+
+Độ trễ / lỗi: STUB_LATENCY_MS, STUB_JITTER_MS, STUB_ERROR_RATE... (xem bench/stub_common.py).
+
+Cassette (STUB_CASSETTE=file.jsonl) - câu trả lời THẬT của model để benchmark sát thực tế:
+- STUB_CASSETTE_MODE=record : chuyển tiếp generateContent lên Gemini thật (STUB_UPSTREAM, key lấy từ
+  STUB_UPSTREAM_API_KEY / GOOGLE_API_KEY của process stub), ghi câu trả lời + độ trễ vào file.
+  Context Cache vẫn giữ ở stub: system instruction trong cache được gửi kèm nguyên văn lên upstream.
+- STUB_CASSETTE_MODE=replay (mặc định): trả lại câu trả lời đã ghi theo khóa
+  (system instruction, flow_state, user_message); không có trong cassette -> fake_reply + đếm miss.
+  STUB_CASSETTE_LATENCY=recorded (mặc định) dùng độ trễ đã ghi, =stub dùng phân phối của stub.
+
+Chạy:
+    STUB_LATENCY_MS=300 python -m uvicorn bench.stub_gemini:app --port 9100
+    GEMINI_API_ENDPOINT=http://127.0.0.1:9100 GOOGLE_API_KEY=stub python app/worker.py
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from bench.stub_common import delay, estimate_tokens, fake_reply, injected_failure
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "200"))
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "50"))
+# Gemini thật từ chối tạo cache nếu nội dung quá ngắn; 0 = chấp nhận mọi độ dài
+STUB_CACHE_MIN_TOKENS = int(os.getenv("STUB_CACHE_MIN_TOKENS", "0"))
+# Tốc độ sinh output: STUB_LATENCY_MS là thời gian tới token đầu, phần output mất thêm tokens / tốc độ
+STUB_TOKENS_PER_SECOND = float(os.getenv("STUB_TOKENS_PER_SECOND", "0"))
+STUB_STREAM_CHUNK_CHARS = int(os.getenv("STUB_STREAM_CHUNK_CHARS", "24"))
+
+app = FastAPI()
+_caches = {}
+stats = {"generate_calls": 0, "request_bytes": 0, "prompt_tokens": 0, "cached_tokens": 0,
+         "cassette_hits": 0, "cassette_misses": 0, "recorded": 0, "stream_calls": 0}
+
+STUB_CASSETTE = os.getenv("STUB_CASSETTE")
+STUB_CASSETTE_MODE = os.getenv("STUB_CASSETTE_MODE", "replay").lower()
+STUB_CASSETTE_LATENCY = os.getenv("STUB_CASSETTE_LATENCY", "recorded").lower()
+STUB_UPSTREAM = os.getenv("STUB_UPSTREAM", "https://generativelanguage.googleapis.com")
+_cassette = {}   # key -> [bản ghi]; nhiều bản ghi cùng khóa thì trả lần lượt
+_cassette_turn = {}
+_upstream = None
+
+
+def _text_of(content):
+    if not content:
+        return ""
+    return "".join(p.get("text", "") for p in content.get("parts", []))
+
+
+def _expire_at(ttl):
+    seconds = float(str(ttl or "3600s").rstrip("s"))
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+
+
+def _cache_view(cache_id):
+    cache = _caches[cache_id]
+    now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    return {
+        "name": f"cachedContents/{cache_id}",
+        "model": cache["model"],
+        "displayName": cache.get("displayName", ""),
+        "createTime": now,
+        "updateTime": now,
+        "expireTime": cache["expire_at"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "usageMetadata": {"totalTokenCount": cache["tokens"]},
+    }
+
+
+_USER_MESSAGE_RE = re.compile(r'\(user_message\):\s*"(.*)"\s*$', re.S)
+_FLOW_STATE_RE = re.compile(r"\(flow_state\): (\S+)")
+
+
+def cassette_key(system_text, contents):
+    """
+    Khóa ổn định giữa các lần chạy: session_data / lịch sử trong prompt thay đổi theo thời gian
+    nên chỉ lấy system instruction + flow_state + tin khách vừa gửi (xem TURN_PROMPT_TEMPLATE).
+    """
+    prompt = _text_of(contents[-1]) if contents else ""
+    user = _USER_MESSAGE_RE.search(prompt)
+    state = _FLOW_STATE_RE.search(prompt)
+    material = "\n".join((
+        hashlib.sha1(system_text.encode()).hexdigest()[:12],
+        state.group(1) if state else "",
+        user.group(1) if user else prompt,
+    ))
+    return hashlib.sha1(material.encode()).hexdigest()
+
+
+def load_cassette(path):
+    if not path or not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                _cassette.setdefault(record["key"], []).append(record)
+
+
+def _replay(key):
+    records = _cassette.get(key)
+    if not records:
+        stats["cassette_misses"] += 1
+        return None
+    stats["cassette_hits"] += 1
+    turn = _cassette_turn.get(key, 0)
+    _cassette_turn[key] = turn + 1
+    return records[turn % len(records)]
+
+
+async def _record(key, model_action, body, system_text, user_text):
+    """Gọi Gemini thật rồi ghi cassette; trả về response gốc của upstream"""
+    global _upstream
+    if _upstream is None:
+        _upstream = httpx.AsyncClient(timeout=60)
+    upstream_body = dict(body)
+    upstream_body.pop("cachedContent", None)
+    if system_text:
+        upstream_body["systemInstruction"] = {"parts": [{"text": system_text}]}
+    api_key = os.getenv("STUB_UPSTREAM_API_KEY") or os.getenv("GOOGLE_API_KEY", "")
+    started = time.perf_counter()
+    response = await _upstream.post(f"{STUB_UPSTREAM}/v1beta/models/{model_action}",
+                                    json=upstream_body, headers={"x-goog-api-key": api_key})
+    latency_ms = round((time.perf_counter() - started) * 1000, 1)
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=response.text[:500])
+    result = response.json()
+    record = {"key": key, "user_message": user_text[-200:], "latency_ms": latency_ms, "response": result}
+    with open(STUB_CASSETTE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    _cassette.setdefault(key, []).append(record)
+    stats["recorded"] += 1
+    return result
+
+
+load_cassette(STUB_CASSETTE if STUB_CASSETTE_MODE == "replay" else None)
+
+
+@app.post("/v1beta/cachedContents")
+async def create_cache(request: Request):
+    body = await request.json()
+    tokens = estimate_tokens(_text_of(body.get("systemInstruction"))) + estimate_tokens(body.get("contents"))
+    if tokens < STUB_CACHE_MIN_TOKENS:
+        raise HTTPException(status_code=400, detail=f"Cached content is too small: {tokens} < {STUB_CACHE_MIN_TOKENS}")
+    cache_id = uuid.uuid4().hex[:12]
+    _caches[cache_id] = {
+        "model": body.get("model"),
+        "displayName": body.get("displayName", ""),
+        "systemInstruction": body.get("systemInstruction"),
+        "tokens": tokens,
+        "expire_at": _expire_at(body.get("ttl")),
+    }
+    return _cache_view(cache_id)
+
+
+@app.get("/v1beta/cachedContents/{cache_id}")
+async def get_cache(cache_id: str):
+    if cache_id not in _caches:
+        raise HTTPException(status_code=404, detail="Not found")
+    return _cache_view(cache_id)
+
+
+@app.patch("/v1beta/cachedContents/{cache_id}")
+async def update_cache(cache_id: str, request: Request):
+    if cache_id not in _caches:
+        raise HTTPException(status_code=404, detail="Not found")
+    body = await request.json()
+    _caches[cache_id]["expire_at"] = _expire_at(body.get("ttl"))
+    return _cache_view(cache_id)
+
+
+@app.delete("/v1beta/cachedContents/{cache_id}")
+async def delete_cache(cache_id: str):
+    _caches.pop(cache_id, None)
+    return {}
+
+
+def _stream_pieces(result):
+    """Chia câu trả lời thành các mảnh như streamGenerateContent thật (mảnh cuối kèm usage)"""
+    candidate = result["candidates"][0]
+    text = _text_of(candidate.get("content"))
+    size = max(1, STUB_STREAM_CHUNK_CHARS)
+    pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+    for i, piece in enumerate(pieces):
+        chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": piece}]}, "index": 0}]}
+        if i == len(pieces) - 1:
+            chunk["candidates"][0]["finishReason"] = candidate.get("finishReason", "STOP")
+            chunk["usageMetadata"] = result.get("usageMetadata", {})
+        yield chunk
+
+
+def _generation_seconds(result):
+    """Thời gian sinh phần output (STUB_TOKENS_PER_SECOND=0 -> tức thì)"""
+    if STUB_TOKENS_PER_SECOND <= 0:
+        return 0.0
+    return result.get("usageMetadata", {}).get("candidatesTokenCount", 0) / STUB_TOKENS_PER_SECOND
+
+
+async def _stream(result):
+    pieces = list(_stream_pieces(result))
+    interval = _generation_seconds(result) / len(pieces)
+    # REST streaming của Gemini: 1 mảng JSON, từng phần tử tới dần
+    for i, chunk in enumerate(pieces):
+        if i:
+            await asyncio.sleep(interval)
+        yield ("[" if i == 0 else "\n,\r\n") + json.dumps(chunk, ensure_ascii=False)
+    yield "]"
+
+
+@app.post("/v1beta/models/{model_action}")
+async def generate_content(model_action: str, request: Request):
+    model, _, action = model_action.partition(":")
+    if action not in ("generateContent", "streamGenerateContent"):
+        raise HTTPException(status_code=404, detail=f"Unsupported action {action}")
+
+    raw = await request.body()
+    body = json.loads(raw)
+
+    cached_tokens = 0
+    system_text = _text_of(body.get("systemInstruction"))
+    cached_name = body.get("cachedContent")
+    if cached_name:
+        cache = _caches.get(cached_name.split("/")[-1])
+        if not cache:
+            raise HTTPException(status_code=404, detail=f"CachedContent not found: {cached_name}")
+        cached_tokens = cache["tokens"]
+        system_text = _text_of(cache.get("systemInstruction"))
+
+    contents = body.get("contents", [])
+    user_text = _text_of(contents[-1]) if contents else ""
+    stats["generate_calls"] += 1
+    stats["request_bytes"] += len(raw)
+    if action == "streamGenerateContent":
+        stats["stream_calls"] += 1
+
+    if STUB_CASSETTE and STUB_CASSETTE_MODE == "record":
+        result = await _record(cassette_key(system_text, contents), f"{model}:generateContent",
+                               body, system_text, user_text)
+    else:
+        result = await _respond(body, contents, system_text, user_text, cached_tokens)
+
+    if action == "streamGenerateContent":
+        return StreamingResponse(_stream(result), media_type="application/json")
+    await asyncio.sleep(_generation_seconds(result))
+    return result
+
+
+async def _respond(body, contents, system_text, user_text, cached_tokens):
+    """Câu trả lời từ cassette hoặc fake_reply, sau độ trễ tới token đầu (time to first token)"""
+    record = _replay(cassette_key(system_text, contents)) if _cassette else None
+    if record is not None and STUB_CASSETTE_LATENCY == "recorded":
+        await asyncio.sleep(record["latency_ms"] / 1000)
+    else:
+        await delay(STUB_LATENCY_MS, STUB_JITTER_MS)
+    failure = await injected_failure()
+    if failure:
+        raise HTTPException(status_code=503 if failure == "error" else 504,
+                            detail="The model is overloaded (stub)")
+    if record is not None:
+        return record["response"]
+
+    prompt_tokens = cached_tokens + estimate_tokens(_text_of(body.get("systemInstruction"))) + estimate_tokens(contents)
+    reply = json.dumps(fake_reply(user_text), ensure_ascii=False)
+    output_tokens = estimate_tokens(reply)
+
+    stats["prompt_tokens"] += prompt_tokens
+    stats["cached_tokens"] += cached_tokens
+
+    usage = {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": output_tokens,
+        "totalTokenCount": prompt_tokens + output_tokens,
+    }
+    if cached_tokens:
+        usage["cachedContentTokenCount"] = cached_tokens
+    return {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": reply}]},
+            "finishReason": "STOP",
+            "index": 0,
+        }],
+        "usageMetadata": usage,
+    }
+
+
+@app.get("/stub/stats")
+async def get_stats():
+    return stats
@@ -0,0 +1,134 @@
+# bench/stub_graph.py
+"""
+Server giả lập Graph API Send (Messenger) để test / benchmark gửi tin offline.
+
+- POST /{version}/me/messages : trả {"recipient_id", "message_id"} sau STUB_LATENCY_MS.
+- Luôn trả header X-App-Usage / X-Business-Use-Case-Usage tính theo số call trong 60s gần nhất
+  so với STUB_PAGE_LIMIT (giống Graph thật: vượt 100% -> lỗi 613 + estimated_time_to_regain_access).
+- STUB_ERROR_RATE: tỉ lệ trả 500 ngẫu nhiên (kiểm tra retry). Phân phối độ trễ: xem bench/stub_common.py.
+- GET /stub/stats : số call, số lỗi, thứ tự tin theo từng người nhận.
+- GET /stub/wait/{recipient}?after=N&timeout=S : chờ tới khi người nhận có > N tin text
+  (bench/load_test.py dùng để đo độ trễ trả lời).
+
+Chạy:
+    STUB_LATENCY_MS=80 python -m uvicorn bench.stub_graph:app --port 9200
+    GRAPH_API_URL=http://127.0.0.1:9200/v18.0/me/messages FB_PAGE_ACCESS_TOKEN=stub python -m app.outbound
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import defaultdict, deque
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from bench.stub_common import delay, injected_failure
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "80"))
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "20"))
+STUB_PAGE_LIMIT = int(os.getenv("STUB_PAGE_LIMIT", "6000"))   # call / 60s / token
+
+app = FastAPI()
+_calls = defaultdict(deque)          # token -> timestamps trong 60s gần nhất
+stats = {"calls": 0, "delivered": 0, "errors": 0, "throttled": 0}
+delivered = defaultdict(list)        # recipient -> [text | sender_action]
+text_counts = defaultdict(int)       # recipient -> số tin text đã nhận
+_waiters = defaultdict(list)         # recipient -> [(after, Future)]
+
+
+def _usage_headers(percent, regain_minutes=0):
+    percent = min(100, int(percent))
+    return {
+        "X-App-Usage": json.dumps({"call_count": percent, "total_time": percent // 2, "total_cputime": percent // 2}),
+        "X-Business-Use-Case-Usage": json.dumps({"stub-page": [{
+            "type": "messenger", "call_count": percent, "total_time": percent // 2,
+            "total_cputime": percent // 2, "estimated_time_to_regain_access": regain_minutes,
+        }]}),
+    }
+
+
+@app.post("/{version}/me/messages")
+async def send_message(version: str, request: Request):
+    stats["calls"] += 1
+    token = request.headers.get("authorization", "")
+    now = time.time()
+    window = _calls[token]
+    window.append(now)
+    while window and window[0] < now - 60:
+        window.popleft()
+    percent = len(window) * 100 / STUB_PAGE_LIMIT
+
+    await delay(STUB_LATENCY_MS, STUB_JITTER_MS)
+
+    if percent > 100:
+        stats["throttled"] += 1
+        return JSONResponse(
+            {"error": {"message": "(#613) Calls to this api have exceeded the rate limit.", "code": 613}},
+            status_code=400, headers=_usage_headers(100, regain_minutes=1))
+    if await injected_failure():
+        stats["errors"] += 1
+        return JSONResponse({"error": {"message": "stub error", "code": 2, "is_transient": True}},
+                            status_code=500, headers=_usage_headers(percent))
+
+    payload = await request.json()
+    recipient_id = payload.get("recipient", {}).get("id")
+    text = payload.get("message", {}).get("text")
+    delivered[recipient_id].append(text or payload.get("sender_action"))
+    stats["delivered"] += 1
+    if text:
+        text_counts[recipient_id] += 1
+        _notify(recipient_id)
+    return JSONResponse({"recipient_id": recipient_id, "message_id": f"m_{uuid.uuid4().hex}"},
+                        headers=_usage_headers(percent))
+
+
+def _notify(recipient_id):
+    count = text_counts[recipient_id]
+    pending = []
+    for after, future in _waiters.pop(recipient_id, []):
+        if future.done():
+            continue
+        if count > after:
+            future.set_result(count)
+        else:
+            pending.append((after, future))
+    if pending:
+        _waiters[recipient_id] = pending
+
+
+@app.get("/stub/wait/{recipient_id}")
+async def wait_reply(recipient_id: str, after: int = 0, timeout: float = 30):
+    """Long-poll: trả về ngay khi người nhận có hơn `after` tin text (timeout=0 -> đọc số hiện tại)"""
+    count = text_counts[recipient_id]
+    if count > after or timeout <= 0:
+        return {"count": count, "timed_out": count <= after}
+    future = asyncio.get_running_loop().create_future()
+    _waiters[recipient_id].append((after, future))
+    try:
+        count = await asyncio.wait_for(future, timeout)
+        return {"count": count, "timed_out": False}
+    except asyncio.TimeoutError:
+        return {"count": text_counts[recipient_id], "timed_out": True}
+
+
+@app.get("/stub/stats")
+async def get_stats():
+    return {**stats, "recipients": len(delivered), "delivered_by_recipient": delivered}
+
+
+@app.get("/stub/summary")
+async def get_summary():
+    """Như /stub/stats nhưng không kèm nội dung tin (dùng khi load test hàng nghìn khách)"""
+    return {**stats, "recipients": len(delivered), "texts": sum(text_counts.values())}
+
+
+@app.post("/stub/reset")
+async def reset_stats():
+    _calls.clear()
+    delivered.clear()
+    text_counts.clear()
+    for k in stats:
+        stats[k] = 0
+    return {"status": "ok"}
@@ -0,0 +1,114 @@
+# bench/stub_openai.py
+"""
+Server giả lập OpenAI Chat Completions để test / benchmark provider dự phòng (app/llm_router.py) offline.
+
+- POST /v1/chat/completions : trả fake_reply (bench/stub_common.py) dạng JSON;
+  "stream": true -> Server-Sent Events "data: {...}" từng mảnh STUB_STREAM_CHUNK_CHARS ký tự, kết thúc "data: [DONE]".
+- Độ trễ tới token đầu / lỗi: STUB_LATENCY_MS, STUB_JITTER_MS, STUB_ERROR_RATE... (xem bench/stub_common.py).
+- STUB_TOKENS_PER_SECOND: tốc độ sinh output (0 = tức thì).
+- GET /stub/stats : số call, số call stream, số lỗi.
+
+Chạy:
+    STUB_LATENCY_MS=400 python -m uvicorn bench.stub_openai:app --port 9400
+    OPENAI_BASE_URL=http://127.0.0.1:9400/v1 OPENAI_API_KEY=stub python app/worker.py
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from bench.stub_common import delay, estimate_tokens, fake_reply, injected_failure
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "300"))
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "50"))
+STUB_TOKENS_PER_SECOND = float(os.getenv("STUB_TOKENS_PER_SECOND", "0"))
+STUB_STREAM_CHUNK_CHARS = int(os.getenv("STUB_STREAM_CHUNK_CHARS", "24"))
+
+app = FastAPI()
+stats = {"calls": 0, "stream_calls": 0, "errors": 0, "prompt_tokens": 0, "output_tokens": 0}
+
+
+def _generation_seconds(output_tokens):
+    if STUB_TOKENS_PER_SECOND <= 0:
+        return 0.0
+    return output_tokens / STUB_TOKENS_PER_SECOND
+
+
+async def _stream(completion_id, model, reply, output_tokens):
+    size = max(1, STUB_STREAM_CHUNK_CHARS)
+    pieces = [reply[i:i + size] for i in range(0, len(reply), size)]
+    interval = _generation_seconds(output_tokens) / max(1, len(pieces))
+    base = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+    for i, piece in enumerate(pieces):
+        if i:
+            await asyncio.sleep(interval)
+        delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+        chunk = {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    done = {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    yield f"data: {json.dumps(done)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    model = body.get("model", "gpt-4o-mini")
+    stream = bool(body.get("stream"))
+    stats["calls"] += 1
+    if stream:
+        stats["stream_calls"] += 1
+
+    await delay(STUB_LATENCY_MS, STUB_JITTER_MS)
+    failure = await injected_failure()
+    if failure:
+        stats["errors"] += 1
+        error = {"message": "The server is overloaded (stub)", "type": "server_error"}
+        return JSONResponse({"error": error}, status_code=503 if failure == "error" else 504)
+
+    user_text = messages[-1].get("content", "") if messages else ""
+    reply = json.dumps(fake_reply(user_text), ensure_ascii=False)
+    prompt_tokens = estimate_tokens(messages)
+    output_tokens = estimate_tokens(reply)
+    stats["prompt_tokens"] += prompt_tokens
+    stats["output_tokens"] += output_tokens
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    if stream:
+        return StreamingResponse(_stream(completion_id, model, reply, output_tokens),
+                                 media_type="text/event-stream")
+
+    await asyncio.sleep(_generation_seconds(output_tokens))
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": reply},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": output_tokens,
+            "total_tokens": prompt_tokens + output_tokens,
+        },
+    }
+
+
+@app.get("/stub/stats")
+async def get_stats():
+    return stats
+
+
+@app.post("/stub/reset")
+async def reset_stats():
+    for k in stats:
+        stats[k] = 0
+    return {"status": "ok"}